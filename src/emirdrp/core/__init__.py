@@ -35,6 +35,7 @@ EMIR_DET_PS_PIX = EMIR_DETECTOR_PS * EMIR_PIXSIZE_DETECTOR
 
 EMIR_GAIN = 5.0  # ADU / e-
 EMIR_RON = 5.69  # ADU
+EMIR_SATURATION = 55000.0  # ADU
 
 EMIR_NBARS = 55
 EMIR_NAXIS1 = 2048
@@ -0,0 +1,88 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Least recently used cache of computed values"""
+
+import collections
+
+
+class LRUCache:
+    """Values stored under a key, keeping the most recently used ones
+
+    The hits and misses of `lookup` are counted in the attributes
+    `hits` and `misses`.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of values kept in memory. The least recently
+        used value is discarded when the limit is reached.
+
+    Raises
+    ------
+    ValueError
+        If maxsize is lower than 1.
+
+    """
+
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be positive, not {maxsize}")
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def lookup(self, key, compute=None):
+        """Value stored under key.
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the value.
+        compute : callable or None
+            Function without arguments that computes the value if it
+            is not stored. The value is then stored under key.
+
+        Returns
+        -------
+        value : object
+            Stored or computed value, None if the value is not
+            stored and compute is None.
+
+        """
+        if key in self._items:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key]
+        self.misses += 1
+        if compute is None:
+            return None
+        value = compute()
+        self.store(key, value)
+        return value
+
+    def store(self, key, value):
+        """Store a value under key, discarding the least recently used."""
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        """Remove the stored values and reset the counters."""
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
@@ -8,7 +8,9 @@
 #
 
 
+import collections
 import logging
+import os
 
 import numpy
 import numina.util.node
@@ -16,9 +18,103 @@ import numina.datamodel as dm
 import numina.processing as proc
 
 import emirdrp.core as c
+from emirdrp.core.cache import LRUCache
 
 _logger = logging.getLogger(__name__)
 
+CalibrationData = collections.namedtuple("CalibrationData", ["data", "calibid"])
+
+
+class CalibrationCache(LRUCache):
+    """Calibration arrays, shared between recipes
+
+    The arrays of the calibrations read from files are stored under
+    the path, size, modification time and checksum of the file, so a
+    calibration used by many reductions in the same process is read
+    and validated only once. The stored arrays are copies in native
+    byte order, and they are read-only, so they can be shared by the
+    correctors and inherited by worker processes without copies.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of arrays kept in memory.
+
+    """
+
+    def __init__(self, maxsize=16):
+        super().__init__(maxsize)
+
+    @staticmethod
+    def key(filename, kind="image"):
+        """Key of the calibration of a kind stored in a file."""
+        from emirdrp.processing.headerindex import read_headers
+
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        header = read_headers(path)[0]
+        checksum = header.get("CHECKSUM", header.get("DATASUM"))
+        return kind, path, stat.st_size, stat.st_mtime_ns, checksum
+
+    def load(self, frame, kind="image", validate=None):
+        """Data and identifier of a calibration frame.
+
+        Parameters
+        ----------
+        frame : numina.types.dataframe.DataFrame
+            Calibration frame. Frames without a file are not stored.
+        kind : str
+            Kind of calibration, part of the key of the stored data.
+        validate : callable or None
+            Function that checks the data of the calibration, and
+            returns the data to use.
+
+        Returns
+        -------
+        calibration : CalibrationData
+            Data and identifier of the calibration. The data of the
+            frames read from files are read-only.
+
+        """
+        filename = getattr(frame, "filename", None)
+        if filename is None:
+            with frame.open() as hdul:
+                return _read_calibration(hdul, validate)
+
+        def read():
+            _logger.debug("reading calibration %s of %s", kind, filename)
+            with frame.open() as hdul:
+                calibration = _read_calibration(hdul, validate, copy=True)
+            calibration.data.flags.writeable = False
+            return calibration
+
+        return self.lookup(self.key(filename, kind), read)
+
+
+def _read_calibration(hdul, validate=None, copy=False):
+    """Data and identifier of a calibration HDUList."""
+    data = hdul["primary"].data
+    if copy:
+        data = data.astype(data.dtype.newbyteorder("="))
+    if validate is not None:
+        data = validate(data)
+    return CalibrationData(data, dm.get_imgid(hdul, prefix=True))
+
+
+def _validate_flat(mflat):
+    """Check NaN and negative values of a flat, and replace values <= 0."""
+    mask1 = mflat < 0
+    mask2 = ~numpy.isfinite(mflat)
+    if numpy.any(mask1):
+        _logger.warning("flat has %d values below 0", mask1.sum())
+    if numpy.any(mask2):
+        _logger.warning("flat has %d NaN", mask2.sum())
+    mflat[mflat <= 0] = 1.0  # To avoid NaN
+    return mflat
+
+
+calibration_cache = CalibrationCache()
+
 
 def get_corrector_p(rinput, meta, ins, datamodel):
     key = "master_bpm"
@@ -27,14 +123,14 @@ def get_corrector_p(rinput, meta, ins, datamodel):
 
     if info is not None:
         inputval = getattr(rinput, key)
-        with inputval.open() as hdul:
-            _logger.info('loading "%s"', key)
-            _logger.debug("info: %s", info)
-            corrector = corrector_class(
-                hdul[0].data,
-                datamodel=datamodel,
-                calibid=dm.get_imgid(hdul, prefix=True),
-            )
+        _logger.info('loading "%s"', key)
+        _logger.debug("info: %s", info)
+        calibration = calibration_cache.load(inputval, kind=key)
+        corrector = corrector_class(
+            calibration.data,
+            datamodel=datamodel,
+            calibid=calibration.calibid,
+        )
     else:
         _logger.info('"%s" not provided, ignored', key)
         corrector = numina.util.node.IdNode()
@@ -59,13 +155,12 @@ def get_corrector_b(rinput, meta, ins, datamodel):
     # Loading calibrations
     if use_bias:
         bias_info = meta["master_bias"]
-        with rinput.master_bias.open() as hdul:
-            _logger.info("loading bias")
-            _logger.debug("bias info: %s", bias_info)
-            mbias = hdul[0].data
-            bias_corrector = proc.BiasCorrector(
-                mbias, datamodel=datamodel, calibid=dm.get_imgid(hdul, prefix=True)
-            )
+        _logger.info("loading bias")
+        _logger.debug("bias info: %s", bias_info)
+        calibration = calibration_cache.load(rinput.master_bias, kind="master_bias")
+        bias_corrector = proc.BiasCorrector(
+            calibration.data, datamodel=datamodel, calibid=calibration.calibid
+        )
     else:
         _logger.info("ignoring bias")
         bias_corrector = numina.util.node.IdNode()
@@ -79,14 +174,14 @@ def get_corrector_s(rinput, meta, ins, datamodel):
     if sky_info is None:
         return numina.util.node.IdNode()
     else:
-        with rinput.master_sky.open() as hdul:
-            _logger.info("loading sky")
-            _logger.debug("sky info: %s", sky_info)
-            sky_corrector = proc.SkyCorrector(
-                hdul[0].data,
-                datamodel=datamodel,
-                calibid=dm.get_imgid(hdul, prefix=True),
-            )
+        _logger.info("loading sky")
+        _logger.debug("sky info: %s", sky_info)
+        calibration = calibration_cache.load(rinput.master_sky, kind="master_sky")
+        sky_corrector = proc.SkyCorrector(
+            calibration.data,
+            datamodel=datamodel,
+            calibid=calibration.calibid,
+        )
         return sky_corrector
 
 
@@ -95,20 +190,14 @@ def get_corrector_f(rinput, meta, ins, datamodel):
     from emirdrp.processing.flatfield import FlatFieldCorrector
 
     flat_info = meta["master_flat"]
-    with rinput.master_flat.open() as hdul:
-        _logger.info("loading intensity flat")
-        _logger.debug("flat info: %s", flat_info)
-        mflat = hdul[0].data
-        # Check NaN and Ceros
-        mask1 = mflat < 0
-        mask2 = ~numpy.isfinite(mflat)
-        if numpy.any(mask1):
-            _logger.warning("flat has %d values below 0", mask1.sum())
-        if numpy.any(mask2):
-            _logger.warning("flat has %d NaN", mask2.sum())
-        flat_corrector = FlatFieldCorrector(
-            mflat, datamodel=datamodel, calibid=dm.get_imgid(hdul, prefix=True)
-        )
+    _logger.info("loading intensity flat")
+    _logger.debug("flat info: %s", flat_info)
+    calibration = calibration_cache.load(
+        rinput.master_flat, kind="master_flat", validate=_validate_flat
+    )
+    flat_corrector = FlatFieldCorrector(
+        calibration.data, datamodel=datamodel, calibid=calibration.calibid
+    )
 
     return flat_corrector
 
@@ -118,20 +207,14 @@ def get_corrector_sf(rinput, meta, ins, datamodel):
     from emirdrp.processing.flatfield import FlatFieldCorrector
 
     flat_info = meta["master_flat"]
-    with rinput.master_flat.open() as hdul:
-        _logger.info("loading spectral flat")
-        _logger.debug("flat info: %s", flat_info)
-        mflat = hdul[0].data
-        # Check NaN and Ceros
-        mask1 = mflat < 0
-        mask2 = ~numpy.isfinite(mflat)
-        if numpy.any(mask1):
-            _logger.warning("flat has %d values below 0", mask1.sum())
-        if numpy.any(mask2):
-            _logger.warning("flat has %d NaN", mask2.sum())
-        flat_corrector = FlatFieldCorrector(
-            mflat, datamodel=datamodel, calibid=dm.get_imgid(hdul, prefix=True)
-        )
+    _logger.info("loading spectral flat")
+    _logger.debug("flat info: %s", flat_info)
+    calibration = calibration_cache.load(
+        rinput.master_flat, kind="master_flat", validate=_validate_flat
+    )
+    flat_corrector = FlatFieldCorrector(
+        calibration.data, datamodel=datamodel, calibid=calibration.calibid
+    )
 
     return flat_corrector
 
@@ -155,11 +238,10 @@ def get_corrector_gen(rinput, datamodel, CorrectorClass, key):
             msg = '"{}" not provided, is required'.format(key)
             raise ValueError(msg)
     else:
-        with value.open() as hdul:
-            datac = hdul["primary"].data
-            corrector = CorrectorClass(
-                datac, calibid=dm.get_imgid(hdul, prefix=True), datamodel=datamodel
-            )
+        calibration = calibration_cache.load(value, kind=key)
+        corrector = CorrectorClass(
+            calibration.data, calibid=calibration.calibid, datamodel=datamodel
+        )
         return corrector
 
 
@@ -58,4 +58,6 @@ class EmirRecipe(recipes.BaseRecipe):
         # to
         # flow = self.init_filters(rinput)[0]
         # we should do it in the future
-        return super().init_filters(rinput, ins)[0]
+        from emirdrp.processing.fusedflow import fuse_flow
+
+        return fuse_flow(super().init_filters(rinput, ins)[0])
@@ -65,6 +65,19 @@ class EmirDataModel(dm.DataModel):
     def shape(self):
         return (2048, 2048)
 
+    def gather_info(self, dframe):
+        """Obtain a summary of information about the image.
+
+        The headers of the frames stored in files are read without
+        reading their data.
+        """
+        if getattr(dframe, "frame", None) is None and dframe.filename is not None:
+            from emirdrp.processing.headerindex import frame_record
+
+            record = frame_record(dframe)
+            return self.gather_info_hdu(record.to_hdulist())
+        return super().gather_info(dframe)
+
     def do_sky_correction(self, img):
         header = img["primary"].header
         return header.get("SKYADD", True)
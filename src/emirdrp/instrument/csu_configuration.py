@@ -9,6 +9,7 @@
 
 from astropy.io import fits
 from copy import deepcopy
+import hashlib
 
 from emirdrp.core import EMIR_NBARS
 from emirdrp.core import EMIR_MINIMUM_SLITLET_WIDTH_MM
@@ -209,6 +210,18 @@ class CsuConfiguration:
 
         return outdict
 
+    def stringify(self):
+        """Return string with the exact location of the bars."""
+
+        left = ",".join(repr(float(value)) for value in self._csu_bar_left)
+        right = ",".join(repr(float(value)) for value in self._csu_bar_right)
+        return f"left={left}:right={right}"
+
+    def csuhash(self):
+        """Return MD5 hash of the exact location of the bars."""
+
+        return hashlib.md5(self.stringify().encode("utf-8")).hexdigest()
+
     def widths_in_range_mm(
         self,
         minwidth=EMIR_MINIMUM_SLITLET_WIDTH_MM,
@@ -9,15 +9,29 @@
 
 """Preprocessing EMIR readout modes"""
 
+import collections
+import concurrent.futures
+import logging
+import os
+import uuid
+
 from astropy.io import fits
+import numpy
 
-from numina.array import ramp_array, fowler_array
+from numina.array.nirproc import ramp_array, fowler_array
 
-from .core import EMIR_READ_MODES
+from .core import EMIR_READ_MODES, EMIR_GAIN, EMIR_RON, EMIR_SATURATION
+from .processing.blockcombine import rows_per_block
 
 PREPROC_KEY = "READPROC"
 PREPROC_VAL = True
 
+# default memory budget (bytes) for the rows of the readout cube
+# read at the same time
+DEFAULT_MAX_MEMORY = 16 * 1024**2
+
+_logger = logging.getLogger(__name__)
+
 
 class ReadModeGuessing:
     def __init__(self, mode, info=None):
@@ -25,6 +39,86 @@ class ReadModeGuessing:
         self.info = info
 
 
+class ReadoutParameters:
+    """Detector and timing parameters of a readout
+
+    Parameters
+    ----------
+    gain : float
+        Detector gain.
+    ron : float
+        Readout noise (ADU).
+    saturation : float
+        Saturation level (ADU).
+    ti : float
+        Integration time (s), from the first to the last read.
+    ts : float
+        Time between samples (s), for Fowler readouts.
+
+    """
+
+    def __init__(
+        self, gain=EMIR_GAIN, ron=EMIR_RON, saturation=EMIR_SATURATION, ti=0.0, ts=0.0
+    ):
+        self.gain = gain
+        self.ron = ron
+        self.saturation = saturation
+        self.ti = ti
+        self.ts = ts
+
+    @classmethod
+    def from_header(cls, header):
+        """Parameters of the EMIR detector, with the times of a header."""
+        return cls(ti=header.get("EXPTIME", 0.0))
+
+    def process(self, mode, cube, badpixels=None):
+        """Signal of a readout cube, with numina.array.nirproc.
+
+        Parameters
+        ----------
+        mode : str
+            Read mode: 'cds', 'fowler' or 'ramp'.
+        cube : numpy.ndarray
+            Readout cube, with the reads along the first axis.
+        badpixels : numpy.ndarray or None
+            Mask (uint8) of the pixels not processed.
+
+        Returns
+        -------
+        result, var, npix, mask : numpy.ndarray
+            Signal, its variance, number of reads used and mask.
+
+        """
+        cube = numpy.asarray(cube)
+        if cube.dtype.itemsize < 4:
+            # the kernels of numina do not accept 8 and 16 bits
+            # integers, that are exact in float32
+            cube = cube.astype("float32")
+        if mode in ["cds", "fowler"]:
+            return fowler_array(
+                cube,
+                ti=self.ti,
+                ts=self.ts,
+                gain=self.gain,
+                ron=self.ron,
+                badpixels=badpixels,
+                dtype="float32",
+                saturation=self.saturation,
+            )
+        elif mode == "ramp":
+            return ramp_array(
+                cube,
+                self.ti,
+                gain=self.gain,
+                ron=self.ron,
+                badpixels=badpixels,
+                dtype="float32",
+                saturation=self.saturation,
+            )
+        else:
+            raise ValueError(f"Unexpected read mode: {mode}")
+
+
 def image_readmode(hdulist, default=None):
     header = hdulist[0].header
     if "READMODE" in header:
@@ -49,80 +143,253 @@ def image_readmode(hdulist, default=None):
         return None
 
 
-def preprocess_single(hdulist):
-    return hdulist
+def _read_rows(hdu, row1, row2):
+    """Rows of all the reads of a readout cube."""
+    if hdu.fileinfo() is not None:
+        # only the requested rows are read from the file
+        return hdu.section[:, row1:row2, :]
+    return hdu.data[:, row1:row2, :]
 
 
-def preprocess_cds(hdulist):
-    # CDS is Fowler with just one pair of reads
-    return preprocess_fowler(hdulist)
-
-
-def preprocess_fowler(hdulist):
-    hdulist[0].header.update(PREPROC_KEY, PREPROC_VAL)
-    # We need:
-    tint = 0.0  # Integration time (from first read to last read)
-    ts = 0.0  # Time between samples
-    gain = 1.0  # Detector gain (number)
-    ron = 1.0  # Detector RON (number)
-    # A master badpixel mask
-    cube = hdulist[0].data
-
-    res, var, npix, mask = fowler_array(
-        cube,
-        ti=tint,
-        ts=ts,
-        gain=gain,
-        ron=ron,
-        badpixels=None,
-        dtype="float32",
-        saturation=55000.0,
+def _process_file_rows(filename, mode, params, row1, row2, badpixels):
+    """Process the rows of the readout cube of a file (in a worker)."""
+    with fits.open(filename, memmap=False) as hdulist:
+        cube = _read_rows(hdulist[0], row1, row2)
+    return params.process(mode, cube, badpixels)
+
+
+def readout_blocks(
+    hdu,
+    mode,
+    params,
+    badpixels=None,
+    max_memory=DEFAULT_MAX_MEMORY,
+    processes=None,
+):
+    """Process a readout cube by blocks of rows.
+
+    The readout cube is read in blocks of consecutive rows, with all
+    the reads of each row, and each block is processed independently.
+    Only the rows of the block are read from the file, so the memory
+    needed does not depend on the number of reads.
+
+    Parameters
+    ----------
+    hdu : astropy.io.fits.PrimaryHDU
+        HDU with the readout cube, with the reads along the first axis.
+    mode : str
+        Read mode: 'cds', 'fowler' or 'ramp'.
+    params : ReadoutParameters
+        Parameters of the detector and the readout.
+    badpixels : numpy.ndarray or None
+        Mask (uint8) of the pixels not processed.
+    max_memory : int
+        Memory budget (bytes) of the rows of the cube read at once.
+    processes : int or None
+        Number of worker processes. If None, or if the cube is not
+        in a file, the blocks are processed in this process.
+
+    Notes
+    -----
+    The rows of a cube read from a file are always read from the
+    file, not from the data of the HDU.
+
+    Yields
+    ------
+    rows : slice
+        Rows of the block.
+    result : tuple of numpy.ndarray
+        Signal, variance, number of reads used and mask of the block.
+
+    """
+    if len(hdu.shape) != 3:
+        raise ValueError(f"readout cube must be 3D, its shape is {hdu.shape}")
+    nreads, nrows, ncols = hdu.shape
+    # the rows are copied once, to change their type or byte order
+    itemsize = abs(hdu.header["BITPIX"]) // 8 + 4
+    nblock = min(nrows, rows_per_block(nreads, ncols, itemsize, max_memory))
+    blocks = [(row1, min(row1 + nblock, nrows)) for row1 in range(0, nrows, nblock)]
+    _logger.debug(
+        "processing %s cube of shape %s in blocks of %d rows",
+        mode,
+        hdu.shape,
+        nblock,
     )
-    hdulist[0].data = res
-    varhdu = fits.ImageHDU(var)
-    varhdu.update_ext_name("VARIANCE")
-    hdulist.append(varhdu)
-    nmap = fits.ImageHDU(npix)
-    nmap.update_ext_name("MAP")
-    hdulist.append(nmap)
-    nmask_hdu = fits.ImageHDU(mask)
-    nmask_hdu.update_ext_name("MASK")
-    hdulist.append(nmask_hdu)
+
+    def block_mask(row1, row2):
+        return None if badpixels is None else badpixels[row1:row2]
+
+    fileinfo = hdu.fileinfo()
+    filename = None if fileinfo is None else fileinfo["file"].name
+    if processes is None or filename is None:
+        for row1, row2 in blocks:
+            cube = _read_rows(hdu, row1, row2)
+            yield slice(row1, row2), params.process(mode, cube, block_mask(row1, row2))
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        # the blocks are returned in order, with at most two blocks
+        # per worker waiting to be collected
+        pending = collections.deque()
+        for row1, row2 in blocks:
+            if len(pending) >= 2 * processes:
+                rows, future = pending.popleft()
+                yield rows, future.result()
+            future = executor.submit(
+                _process_file_rows,
+                filename,
+                mode,
+                params,
+                row1,
+                row2,
+                block_mask(row1, row2),
+            )
+            pending.append((slice(row1, row2), future))
+        while pending:
+            rows, future = pending.popleft()
+            yield rows, future.result()
+
+
+def _preprocess_hdulist(hdulist, mode, params=None, **kwargs):
+    hdu = hdulist[0]
+    if params is None:
+        params = ReadoutParameters.from_header(hdu.header)
+    shape = hdu.shape[1:]
+    outputs = None
+    for rows, block in readout_blocks(hdu, mode, params, **kwargs):
+        if outputs is None:
+            outputs = [numpy.empty(shape, dtype=arr.dtype) for arr in block]
+        for out, arr in zip(outputs, block):
+            out[rows] = arr
+    result, var, npix, mask = outputs
+
+    hdulist[0] = fits.PrimaryHDU(result, header=hdu.header)
+    hdulist[0].header[PREPROC_KEY] = PREPROC_VAL
+    hdulist.append(fits.ImageHDU(var, name="VARIANCE"))
+    hdulist.append(fits.ImageHDU(npix, name="MAP"))
+    hdulist.append(fits.ImageHDU(mask, name="MASK"))
     return hdulist
 
 
-def preprocess_ramp(hdulist):
-    hdulist[0].header.update(PREPROC_KEY, PREPROC_VAL)
-    cube = hdulist[0].data
-    # We need
-    ti = 0.0  # Integration time
-    gain = 1.0
-    ron = 1.0
-    rslt = ramp_array(
-        cube,
-        ti,
-        gain=gain,
-        ron=ron,
-        badpixels=None,
-        dtype="float32",
-        saturation=55000.0,
-    )
-    result, var, npix, mask = rslt
-
-    hdulist[0].data = result
-    varhdu = fits.ImageHDU(var)
-    varhdu.update_ext_name("VARIANCE")
-    hdulist.append(varhdu)
-
-    nmap = fits.ImageHDU(npix)
-    nmap.update_ext_name("MAP")
-    hdulist.append(nmap)
-    nmask = fits.ImageHDU(mask)
-    nmask.update_ext_name("MASK")
-    hdulist.append(nmask)
+def preprocess_single(hdulist):
     return hdulist
 
 
+def preprocess_cds(hdulist, params=None, **kwargs):
+    # CDS is Fowler with just one pair of reads
+    return preprocess_fowler(hdulist, params=params, **kwargs)
+
+
+def preprocess_fowler(hdulist, params=None, **kwargs):
+    """Signal of a Fowler readout, with VARIANCE, MAP and MASK extensions.
+
+    See `readout_blocks` for the additional arguments.
+
+    """
+    return _preprocess_hdulist(hdulist, "fowler", params=params, **kwargs)
+
+
+def preprocess_ramp(hdulist, params=None, **kwargs):
+    """Signal of a ramp readout, with VARIANCE, MAP and MASK extensions.
+
+    See `readout_blocks` for the additional arguments.
+
+    """
+    return _preprocess_hdulist(hdulist, "ramp", params=params, **kwargs)
+
+
+def _image_header(hdu_class, shape, dtype, header=None, name=None):
+    """Header of an image, without creating its data."""
+    hdu = hdu_class(numpy.zeros((1, 1), dtype=dtype), header=header)
+    if name is not None:
+        hdu.name = name
+    hdu.header["NAXIS1"] = shape[1]
+    hdu.header["NAXIS2"] = shape[0]
+    return hdu.header
+
+
+def preprocess_stream(
+    filename, output, mode, params=None, badpixels=None, overwrite=True, **kwargs
+):
+    """Preprocess a readout cube from a file into a file.
+
+    The cube is processed by blocks of rows (see `readout_blocks`),
+    and the signal and the VARIANCE, MAP and MASK extensions of each
+    block are written directly in the output file, so neither the
+    cube nor the output images are held in memory. The extensions
+    of the input after the primary are copied after MASK. The output
+    is written in a temporary file in the same directory, that
+    replaces the output at the end, so the output can be the input.
+
+    Parameters
+    ----------
+    filename : str
+        FITS file with the readout cube in the primary HDU.
+    output : str
+        Output FITS file.
+    mode : str
+        Read mode: 'cds', 'fowler' or 'ramp'.
+    params : ReadoutParameters or None
+        Parameters of the readout. If None, they are taken from the
+        detector and the header.
+    badpixels : numpy.ndarray or None
+        Mask (uint8) of the pixels not processed.
+    overwrite : bool
+        Overwrite the output file if it exists.
+    **kwargs
+        Additional arguments of `readout_blocks`.
+
+    """
+    with fits.open(filename, memmap=False) as hdulist:
+        hdu = hdulist[0]
+        header = hdu.header.copy()
+        if params is None:
+            params = ReadoutParameters.from_header(header)
+        for key in ["BZERO", "BSCALE", "BLANK"]:
+            header.remove(key, ignore_missing=True)
+        header[PREPROC_KEY] = PREPROC_VAL
+        shape = hdu.shape[1:]
+        dtype = numpy.result_type(hdu.section[:1, :1, :1].dtype, "float32")
+        layout = [
+            _image_header(fits.PrimaryHDU, shape, dtype, header=header),
+            _image_header(fits.ImageHDU, shape, dtype, name="VARIANCE"),
+            _image_header(fits.ImageHDU, shape, "uint8", name="MAP"),
+            _image_header(fits.ImageHDU, shape, "uint8", name="MASK"),
+        ]
+        if not overwrite and os.path.exists(output):
+            raise FileExistsError(f"output file {output!r} exists")
+        dirname, basename = os.path.split(os.path.abspath(output))
+        tmpname = os.path.join(dirname, f".{basename}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmpname, "xb") as fd:
+                offsets = []
+                for out_header in layout:
+                    fd.write(out_header.tostring().encode("ascii"))
+                    offsets.append(fd.tell())
+                    nbytes = shape[0] * shape[1] * abs(out_header["BITPIX"]) // 8
+                    # data padded with zeros to a multiple of the block size
+                    fd.seek(offsets[-1] + -(-nbytes // 2880) * 2880 - 1)
+                    fd.write(b"\0")
+
+                for rows, block in readout_blocks(
+                    hdu, mode, params, badpixels=badpixels, **kwargs
+                ):
+                    for offset, out_header, arr in zip(offsets, layout, block):
+                        itemsize = abs(out_header["BITPIX"]) // 8
+                        fd.seek(offset + rows.start * shape[1] * itemsize)
+                        if itemsize > 1:
+                            arr = arr.astype(arr.dtype.newbyteorder(">"))
+                        fd.write(arr.tobytes())
+
+            for ext in hdulist[1:]:
+                fits.append(tmpname, ext.data, ext.header)
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+    os.replace(tmpname, output)
+
+
 def fits_wrapper(frame):
     if isinstance(frame, str):
         return fits.open(frame)
@@ -132,12 +399,18 @@ def fits_wrapper(frame):
         raise TypeError
 
 
-def preprocess(input_, output):
+def preprocess(input_, output, **kwargs):
+    """Preprocess a raw frame according to its read mode.
+
+    Readout cubes in files are processed with `preprocess_stream`.
+    See `readout_blocks` for the additional arguments.
+
+    """
     with fits_wrapper(input_) as hdulist:
         header = hdulist[0].header
-        if "PREPROC" in header:
+        if PREPROC_KEY in header:
             # if the image is preprocessed, do nothing
-            if input != output:
+            if input_ != output:
                 hdulist.writeto(output, overwrite=True)
             return
         # determine the READ mode
@@ -146,14 +419,18 @@ def preprocess(input_, output):
             # We have a problem here
             return
 
+        if guess.mode in ["cds", "fowler", "ramp"] and isinstance(input_, str):
+            preprocess_stream(input_, output, guess.mode, **kwargs)
+            return
+
         if guess.mode == "single":
             hduproc = preprocess_single(hdulist)
         elif guess.mode == "cds":
-            hduproc = preprocess_cds(hdulist)
+            hduproc = preprocess_cds(hdulist, **kwargs)
         elif guess.mode == "fowler":
-            hduproc = preprocess_fowler(hdulist)
+            hduproc = preprocess_fowler(hdulist, **kwargs)
         elif guess.mode == "ramp":
-            pass
+            hduproc = preprocess_ramp(hdulist, **kwargs)
         else:
             hduproc = preprocess_single(hdulist)
 
@@ -0,0 +1,184 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Incremental weighted mean of frames on a growable canvas"""
+
+import logging
+
+from astropy.io import fits
+import numpy
+
+_logger = logging.getLogger(__name__)
+
+# names of the extensions that store the accumulated arrays
+ACCUM_EXTENSIONS = ("ACCSUM", "ACCSUM2", "ACCWGT", "ACCNUM")
+
+
+class MosaicAccumulator:
+    """Weighted sums of the frames added to a mosaic
+
+    The accumulator stores, for every pixel of the canvas, the
+    weighted sum of the values, the weighted sum of their squares,
+    the sum of weights and the number of frames added. Adding a
+    frame only updates the pixels of its region, and the mean,
+    its variance and the number of frames are computed on demand.
+    The canvas can be enlarged to receive frames that extend beyond
+    its borders.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the canvas.
+
+    """
+
+    def __init__(self, shape):
+        self.sum = numpy.zeros(shape)
+        self.sum2 = numpy.zeros(shape)
+        self.weight = numpy.zeros(shape)
+        self.num = numpy.zeros(shape, dtype="int32")
+
+    @property
+    def shape(self):
+        return self.sum.shape
+
+    @classmethod
+    def from_hdulist(cls, hdulist, mask=None, weight=1.0):
+        """Accumulator stored in a HDUList, or initialized from its data.
+
+        Parameters
+        ----------
+        hdulist : astropy.io.fits.HDUList
+            Image with the extensions of an accumulator (see `to_hdus`)
+            or, if they are missing, an image with a mean to start the
+            accumulation.
+        mask : numpy.ndarray or None
+            Pixels without a valid mean (non-zero values), used only if
+            the image has no accumulator extensions.
+        weight : float
+            Weight of the mean, used only if the image has no
+            accumulator extensions. The variance of the values combined
+            in the mean is unknown, and it is taken as zero.
+
+        Returns
+        -------
+        accumulator : MosaicAccumulator
+
+        """
+        if all(name in hdulist for name in ACCUM_EXTENSIONS):
+            self = cls.__new__(cls)
+            self.sum = hdulist["ACCSUM"].data.astype("float64")
+            self.sum2 = hdulist["ACCSUM2"].data.astype("float64")
+            self.weight = hdulist["ACCWGT"].data.astype("float64")
+            self.num = hdulist["ACCNUM"].data.astype("int32")
+            return self
+
+        _logger.debug("initializing accumulator with weight %s", weight)
+        data = hdulist[0].data
+        self = cls(data.shape)
+        self.add(data, mask=mask, weight=weight, num=int(round(weight)))
+        return self
+
+    def resize(self, shape, region):
+        """Move the canvas to a region of a larger canvas.
+
+        Parameters
+        ----------
+        shape : tuple of int
+            Shape of the new canvas.
+        region : tuple of slice
+            Region of the new canvas that corresponds to the current
+            canvas.
+
+        Returns
+        -------
+        resized : bool
+            True if the canvas has changed.
+
+        """
+        shape = tuple(shape)
+        if shape == self.shape:
+            return False
+        _logger.debug("resizing accumulator from %s to %s", self.shape, shape)
+        for name in ["sum", "sum2", "weight", "num"]:
+            arr = getattr(self, name)
+            newarr = numpy.zeros(shape, dtype=arr.dtype)
+            newarr[region] = arr
+            setattr(self, name, newarr)
+        return True
+
+    def add(self, data, mask=None, region=Ellipsis, weight=1.0, num=1):
+        """Add a frame in a region of the canvas.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Values of the frame, with the shape of the region.
+        mask : numpy.ndarray or None
+            Pixels of the frame not added (non-zero values).
+        region : tuple of slice
+            Region of the canvas covered by the frame.
+        weight : float
+            Weight of the frame.
+        num : int
+            Number of frames represented by data.
+
+        """
+        valid = numpy.isfinite(data)
+        if mask is not None:
+            valid &= mask == 0
+        values = numpy.where(valid, data, 0.0)
+        weights = valid * float(weight)
+        self.sum[region] += weights * values
+        self.sum2[region] += weights * values * values
+        self.weight[region] += weights
+        self.num[region] += valid * num
+
+    def mean(self, region=Ellipsis, dtype="float32"):
+        """Weighted mean, its variance and number of frames.
+
+        Parameters
+        ----------
+        region : tuple of slice
+            Region of the canvas.
+        dtype : data-type
+            Type of the mean and the variance.
+
+        Returns
+        -------
+        mean, variance, num : numpy.ndarray
+            Weighted mean, variance of the frames (with frequency
+            weights) and number of frames. The pixels without frames
+            are zero.
+
+        """
+        total = self.sum[region]
+        weight = self.weight[region]
+        used = weight > 0
+        mean = numpy.zeros(weight.shape)
+        numpy.divide(total, weight, out=mean, where=used)
+        variance = numpy.zeros(weight.shape)
+        multiple = weight > 1
+        numpy.divide(
+            self.sum2[region] - total * mean,
+            weight - 1,
+            out=variance,
+            where=multiple,
+        )
+        numpy.clip(variance, 0, None, out=variance)
+        return mean.astype(dtype), variance.astype(dtype), self.num[region].copy()
+
+    def to_hdus(self):
+        """Image extensions that store the accumulator."""
+        return [
+            fits.ImageHDU(self.sum, name="ACCSUM"),
+            fits.ImageHDU(self.sum2, name="ACCSUM2"),
+            fits.ImageHDU(self.weight, name="ACCWGT"),
+            fits.ImageHDU(self.num, name="ACCNUM"),
+        ]
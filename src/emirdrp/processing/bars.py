@@ -7,15 +7,18 @@
 # License-Filename: LICENSE.txt
 #
 
+"""Detection of the borders of the CSU bars"""
+
+import logging
 
 import numpy
-from numina.array.utils import coor_to_pix_1d
 from scipy.ndimage import convolve1d
 from scipy.ndimage import median_filter
 
 import emirdrp.instrument.distortions as dist
 from emirdrp.core import EMIR_PIXSCALE, EMIR_NBARS, EMIR_RON
 from emirdrp.processing.bardetect import char_bar_peak_l, char_bar_peak_r
+from emirdrp.processing.roi import StageTimer, TileStack
 
 
 def median_filtering(hdulist, mfilter_size):
@@ -36,11 +39,45 @@ def find_bars(
     fit_peak_npoints=3,
     median_filter_size=5,
     logger=None,
+    timings=None,
 ):
+    """Find the borders of the CSU bars in an image.
 
-    logger.debug("filtering image")
-    # Processed array
-    arr_median = median_filtering(hdulist, median_filter_size)
+    The image is filtered and differentiated only in windows around
+    the positions of the bars predicted by the nominal positions and
+    the CSU configuration. The pixels of the derivative images read
+    by the peak finding algorithm are the same as if the whole frame
+    were filtered.
+
+    Parameters
+    ----------
+    hdulist : HDUList
+        Reduced image.
+    bars_nominal_positions : numpy.ndarray
+        Nominal positions of the bars.
+    csupos : array_like
+        Positions of the bars in the CSU.
+    dtur : array_like
+        DTU shift.
+    logger : logging.Logger
+        Logger.
+    timings : dict or None
+        If not None, the time in seconds spent in each stage is
+        stored in this dictionary.
+
+    Returns
+    -------
+    allpos : dict
+        Positions of the bars for each kernel size of the derivative.
+    slits : numpy.ndarray
+        Corners of the slits, computed with kernel size 5.
+
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    timer = StageTimer()
+    kernel_sizes = [3, 5, 7, 9]
 
     xfac = dtur[0] / EMIR_PIXSCALE
     yfac = -dtur[1] / EMIR_PIXSCALE
@@ -49,7 +86,7 @@ def find_bars(
     logger.debug("DTU shift is %s", vec)
 
     # and the table of approx positions of the slits
-    barstab = bars_nominal_positions
+    barstab = numpy.asarray(bars_nominal_positions)
     # Currently, we only use fields 0 and 2
     # of the nominal positions file
 
@@ -73,11 +110,38 @@ def find_bars(
     # scipy >= xx has a savgol_filter function
     # for compatibility we do it manually
 
+    with timer("windows"):
+        bars = predict_bar_windows(barstab, csupos)
+        # windows around the borders of the bars that are measured
+        measured = numpy.flatnonzero(bars["valid"])
+        rows = numpy.concatenate([bars["prow"][measured]] * 2)
+        cols = numpy.concatenate(
+            [bars["bstart_l"][measured], bars["bstart_r"][measured]]
+        )
+        width = numpy.concatenate([bars["bend_l"][measured], bars["bend_r"][measured]])
+        width = (width - cols).max(initial=0)
+        rows = numpy.clip(rows, 0, 2047) - _BAR_WINDOW_HALF_HEIGHT
+        cols = cols - _BAR_WINDOW_MARGIN
+        shape = (2 * _BAR_WINDOW_HALF_HEIGHT + 1, width + 2 * _BAR_WINDOW_MARGIN)
+        margin = median_filter_size // 2
+        tiles = TileStack(
+            rows, cols, shape, margin=(margin, margin + max(kernel_sizes) // 2)
+        )
+        logger.debug("using %d windows of %d x %d pixels", len(tiles), *shape)
+
+    logger.debug("filtering image")
+    with timer("median"):
+        # Processed array
+        arr = hdulist[0].data
+        arr_median = tiles.gather(arr)
+        arr_median = median_filter(arr_median, size=(1, 1, median_filter_size))
+        arr_median = median_filter(arr_median, size=(1, median_filter_size, 1))
+
     allpos = {}
     slits = numpy.zeros((EMIR_NBARS, 8), dtype="float")
 
     logger.info("find peaks in derivative image")
-    for ks in [3, 5, 7, 9]:
+    for ks in kernel_sizes:
         logger.debug("kernel size is %d", ks)
         # S and G kernel for derivative
         kw = ks * (ks * ks - 1) / 12.0
@@ -85,7 +149,9 @@ def find_bars(
         logger.debug("kernel weights are %s", coeffs_are)
 
         logger.debug("derive image in X direction")
-        arr_deriv = convolve1d(arr_median, coeffs_are, axis=-1)
+        with timer(f"derivative k{ks}"):
+            arr_deriv = convolve1d(arr_median, coeffs_are, axis=-1)
+            arr_deriv = tiles.scatter(arr_deriv, arr.shape)
         # self.save_intermediate_array(arr_deriv, 'deriv_image_k%d.fits' % ks)
         # Axis 0 is
         #
@@ -94,127 +160,195 @@ def find_bars(
 
         positions = []
         logger.info("using bar parameters")
-        for idx in range(EMIR_NBARS):
-            params_l = barstab[idx]
-            params_r = barstab[idx + EMIR_NBARS]
-            lbarid = int(params_l[0])
-
-            # CSUPOS for this bar
-            rbarid = lbarid + EMIR_NBARS
-            current_csupos_l = csupos[lbarid - 1]
-            current_csupos_r = csupos[rbarid - 1]
-            logger.debug("CSUPOS for bar %d is %f", lbarid, current_csupos_l)
-            logger.debug("CSUPOS for bar %d is %f", rbarid, current_csupos_r)
-
-            ref_y_coor_virt = params_l[1]  # Do I need to add vec[1]?
-            ref_x_l_coor_virt = params_l[3] + current_csupos_l * params_l[2]
-            ref_x_r_coor_virt = params_r[3] + current_csupos_r * params_r[2]
-            # Transform to REAL..
-            ref_x_l_coor, ref_y_l_coor = dist.exvp(ref_x_l_coor_virt, ref_y_coor_virt)
-            ref_x_r_coor, ref_y_r_coor = dist.exvp(ref_x_r_coor_virt, ref_y_coor_virt)
-            # FIXME: check if DTU has to be applied
-            # ref_y_coor = ref_y_coor + vec[1]
-            prow = coor_to_pix_1d(ref_y_l_coor) - 1
-            fits_row = prow + 1  # FITS pixel index
-
-            logger.debug("looking for bars with ids %d - %d", lbarid, rbarid)
-            logger.debug("ref Y virtual position is %7.2f", ref_y_coor_virt)
-            logger.debug(
-                "ref X virtual positions are %7.2f %7.2f",
-                ref_x_l_coor_virt,
-                ref_x_r_coor_virt,
-            )
-            logger.debug("ref X positions are %7.2f %7.2f", ref_x_l_coor, ref_x_r_coor)
-            logger.debug("ref Y positions are %7.2f %7.2f", ref_y_l_coor, ref_y_r_coor)
-            # if ref_y_coor is outlimits, skip this bar
-            # ref_y_coor is in FITS format
-            if (ref_y_l_coor >= 2047 + 16) or (ref_y_l_coor <= 1 - 16):
-                logger.debug("reference y position is outlimits, skipping")
-                positions.append([lbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
-                positions.append([rbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
-                continue
-
-            # minimal width of the slit
-            minwidth = 0.9
-            if abs(ref_x_l_coor_virt - ref_x_r_coor_virt) < minwidth:
-                # FIXME: if width < minwidth fit peak in image
-                logger.debug("slit is less than %d virt pixels, skipping", minwidth)
-                positions.append([lbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
-                positions.append([rbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
-                continue
-
-            # Left bar
-            # Dont add +1 to virtual pixels
-            logger.debug("measure left border (%d)", lbarid)
-            regionw = 10
-            bstart1 = coor_to_pix_1d(ref_x_l_coor - regionw)
-            bend1 = coor_to_pix_1d(ref_x_l_coor + regionw) + 1
-            centery, centery_virt, xpos1, xpos1_virt, fwhm, st = char_bar_peak_l(
-                arr_deriv, prow, bstart1, bend1, threshold
-            )
-
-            insert1 = [
-                lbarid,
-                centery + 1,
-                centery_virt,
-                fits_row,
-                xpos1 + 1,
-                xpos1_virt,
-                fwhm,
-                st,
-            ]
-            positions.append(insert1)
-
-            # Right bar
-            # Dont add +1 to virtual pixels
-            logger.debug("measure rigth border (%d)", rbarid)
-            bstart2 = coor_to_pix_1d(ref_x_r_coor - regionw)
-            bend2 = coor_to_pix_1d(ref_x_r_coor + regionw) + 1
-            centery, centery_virt, xpos2, xpos2_virt, fwhm, st = char_bar_peak_r(
-                arr_deriv, prow, bstart2, bend2, threshold
-            )
-            # This centery/centery_virt should be equal to ref_y_coor_virt
-            insert2 = [
-                rbarid,
-                centery + 1,
-                centery_virt,
-                fits_row,
-                xpos2 + 1,
-                xpos2_virt,
-                fwhm,
-                st,
-            ]
-            positions.append(insert2)
-
-            # FIXME: hardcoded value
-            y1_virt = ref_y_coor_virt - 16.242
-            y2_virt = ref_y_coor_virt + 16.242
-            _, y1 = dist.exvp(xpos1_virt + 1, y1_virt + 1)
-            _, y2 = dist.exvp(xpos2_virt + 1, y2_virt + 1)
-
-            # Update positions
-
-            msg = (
-                "bar %d, centroid-y %9.4f centroid-y virt %9.4f, "
-                "row %d, x-pos %9.4f x-pos virt %9.4f, FWHM %6.3f, status %d"
-            )
-            logger.debug(msg, *positions[-2])
-            logger.debug(msg, *positions[-1])
-
-            if ks == 5:
-                slits[lbarid - 1] = numpy.array(
-                    [xpos1, y2, xpos2, y2, xpos2, y1, xpos1, y1]
+        with timer(f"peaks k{ks}"):
+            for idx in range(EMIR_NBARS):
+                positions.extend(
+                    _find_bar_pair(bars[idx], arr_deriv, ks, threshold, slits, logger)
                 )
-                # FITS coordinates
-                slits[lbarid - 1] += 1.0
-                logger.debug('inserting bars %d-%d into "slits"', lbarid, rbarid)
 
         # GCS doesn't like lists of lists
         allpos[ks] = numpy.asarray(positions, dtype="float")
 
+    logger.info("bar detection timings: %s", timer)
+    if timings is not None:
+        timings.update(timer.timings)
     return allpos, slits
 
 
+# Rows around the bar and extra columns on both sides of the search
+# interval read by char_bar_peak_l and char_bar_peak_r
+_BAR_WINDOW_HALF_HEIGHT = 18
+_BAR_WINDOW_MARGIN = 6
+
+_BAR_WINDOW_DTYPE = [
+    ("lbarid", int),
+    ("rbarid", int),
+    ("ref_y_coor_virt", float),
+    ("ref_x_l_coor_virt", float),
+    ("ref_x_r_coor_virt", float),
+    ("ref_x_l_coor", float),
+    ("ref_y_l_coor", float),
+    ("ref_x_r_coor", float),
+    ("ref_y_r_coor", float),
+    ("prow", int),
+    ("bstart_l", int),
+    ("bend_l", int),
+    ("bstart_r", int),
+    ("bend_r", int),
+    ("valid", bool),
+]
+
+
+def predict_bar_windows(bars_nominal_positions, csupos, regionw=10, minwidth=0.9):
+    """Predicted positions of the pairs of bars in the image.
+
+    Parameters
+    ----------
+    bars_nominal_positions : numpy.ndarray
+        Nominal positions of the bars.
+    csupos : array_like
+        Positions of the bars in the CSU.
+    regionw : int
+        Half width of the interval of columns searched for each bar.
+    minwidth : float
+        Minimum width of the slit, in virtual pixels.
+
+    Returns
+    -------
+    bars : numpy.ndarray
+        Structured array with one element per pair of bars, with the
+        virtual and real coordinates of the bars, the row (prow) and
+        the intervals of columns (bstart_l, bend_l, bstart_r, bend_r)
+        where the borders are searched. Field valid is False if the
+        bars are outside of the image or the slit is too narrow.
+
+    """
+    barstab = numpy.asarray(bars_nominal_positions)
+    csupos = numpy.asarray(csupos)
+    params_l = barstab[:EMIR_NBARS]
+    params_r = barstab[EMIR_NBARS : 2 * EMIR_NBARS]
+
+    bars = numpy.zeros(EMIR_NBARS, dtype=_BAR_WINDOW_DTYPE)
+    bars["lbarid"] = params_l[:, 0].astype(int)
+    # CSUPOS for this bar
+    bars["rbarid"] = bars["lbarid"] + EMIR_NBARS
+    current_csupos_l = csupos[bars["lbarid"] - 1]
+    current_csupos_r = csupos[bars["rbarid"] - 1]
+
+    bars["ref_y_coor_virt"] = params_l[:, 1]  # Do I need to add vec[1]?
+    bars["ref_x_l_coor_virt"] = params_l[:, 3] + current_csupos_l * params_l[:, 2]
+    bars["ref_x_r_coor_virt"] = params_r[:, 3] + current_csupos_r * params_r[:, 2]
+    # Transform to REAL..
+    bars["ref_x_l_coor"], bars["ref_y_l_coor"] = dist.exvp(
+        bars["ref_x_l_coor_virt"], bars["ref_y_coor_virt"]
+    )
+    bars["ref_x_r_coor"], bars["ref_y_r_coor"] = dist.exvp(
+        bars["ref_x_r_coor_virt"], bars["ref_y_coor_virt"]
+    )
+    # FIXME: check if DTU has to be applied
+    # ref_y_coor = ref_y_coor + vec[1]
+    # same as coor_to_pix_1d
+    bars["prow"] = numpy.floor(bars["ref_y_l_coor"] + 0.5) - 1
+    # Dont add +1 to virtual pixels
+    bars["bstart_l"] = numpy.floor(bars["ref_x_l_coor"] - regionw + 0.5)
+    bars["bend_l"] = numpy.floor(bars["ref_x_l_coor"] + regionw + 0.5) + 1
+    bars["bstart_r"] = numpy.floor(bars["ref_x_r_coor"] - regionw + 0.5)
+    bars["bend_r"] = numpy.floor(bars["ref_x_r_coor"] + regionw + 0.5) + 1
+
+    # if ref_y_coor is outlimits, skip this bar
+    # ref_y_coor is in FITS format
+    inside = (bars["ref_y_l_coor"] < 2047 + 16) & (bars["ref_y_l_coor"] > 1 - 16)
+    # FIXME: if width < minwidth fit peak in image
+    wide = numpy.abs(bars["ref_x_l_coor_virt"] - bars["ref_x_r_coor_virt"]) >= minwidth
+    bars["valid"] = inside & wide
+    return bars
+
+
+def _find_bar_pair(bar, arr_deriv, ks, threshold, slits, logger):
+    """Measure the borders of a pair of bars in the derivative image."""
+    lbarid = int(bar["lbarid"])
+    rbarid = int(bar["rbarid"])
+    ref_y_coor_virt = bar["ref_y_coor_virt"]
+    prow = int(bar["prow"])
+    fits_row = prow + 1  # FITS pixel index
+
+    logger.debug("looking for bars with ids %d - %d", lbarid, rbarid)
+    logger.debug("ref Y virtual position is %7.2f", ref_y_coor_virt)
+    logger.debug(
+        "ref X virtual positions are %7.2f %7.2f",
+        bar["ref_x_l_coor_virt"],
+        bar["ref_x_r_coor_virt"],
+    )
+    logger.debug(
+        "ref X positions are %7.2f %7.2f", bar["ref_x_l_coor"], bar["ref_x_r_coor"]
+    )
+    logger.debug(
+        "ref Y positions are %7.2f %7.2f", bar["ref_y_l_coor"], bar["ref_y_r_coor"]
+    )
+    if not bar["valid"]:
+        logger.debug("bar is outlimits or slit is too narrow, skipping")
+        return [
+            [lbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3],
+            [rbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3],
+        ]
+
+    # Left bar
+    logger.debug("measure left border (%d)", lbarid)
+    centery, centery_virt, xpos1, xpos1_virt, fwhm, st = char_bar_peak_l(
+        arr_deriv, prow, int(bar["bstart_l"]), int(bar["bend_l"]), threshold
+    )
+    insert1 = [
+        lbarid,
+        centery + 1,
+        centery_virt,
+        fits_row,
+        xpos1 + 1,
+        xpos1_virt,
+        fwhm,
+        st,
+    ]
+
+    # Right bar
+    logger.debug("measure rigth border (%d)", rbarid)
+    centery, centery_virt, xpos2, xpos2_virt, fwhm, st = char_bar_peak_r(
+        arr_deriv, prow, int(bar["bstart_r"]), int(bar["bend_r"]), threshold
+    )
+    # This centery/centery_virt should be equal to ref_y_coor_virt
+    insert2 = [
+        rbarid,
+        centery + 1,
+        centery_virt,
+        fits_row,
+        xpos2 + 1,
+        xpos2_virt,
+        fwhm,
+        st,
+    ]
+
+    # FIXME: hardcoded value
+    y1_virt = ref_y_coor_virt - 16.242
+    y2_virt = ref_y_coor_virt + 16.242
+    _, y1 = dist.exvp(xpos1_virt + 1, y1_virt + 1)
+    _, y2 = dist.exvp(xpos2_virt + 1, y2_virt + 1)
+
+    # Update positions
+
+    msg = (
+        "bar %d, centroid-y %9.4f centroid-y virt %9.4f, "
+        "row %d, x-pos %9.4f x-pos virt %9.4f, FWHM %6.3f, status %d"
+    )
+    logger.debug(msg, *insert1)
+    logger.debug(msg, *insert2)
+
+    if ks == 5:
+        slits[lbarid - 1] = numpy.array([xpos1, y2, xpos2, y2, xpos2, y1, xpos1, y1])
+        # FITS coordinates
+        slits[lbarid - 1] += 1.0
+        logger.debug('inserting bars %d-%d into "slits"', lbarid, rbarid)
+
+    return [insert1, insert2]
+
+
 def slits_to_ds9_reg(ds9reg, slits):
     """Transform fiber traces to ds9-region format.
 
@@ -0,0 +1,180 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Combination of frames by blocks of rows, within a memory budget"""
+
+import logging
+
+import numpy
+
+_logger = logging.getLogger(__name__)
+
+# default memory budget (bytes) for the buffers of the combination
+DEFAULT_MAX_MEMORY = 128 * 1024**2
+
+
+def _region_limits(region, shape):
+    """First and last (excluded) row and column of a region."""
+    if region is None or region is Ellipsis:
+        return 0, shape[0], 0, shape[1]
+    rows, cols = region
+    r1, r2, rstep = rows.indices(shape[0])
+    c1, c2, cstep = cols.indices(shape[1])
+    if rstep != 1 or cstep != 1:
+        raise ValueError(f"unexpected step in region {region}")
+    return r1, max(r1, r2), c1, max(c1, c2)
+
+
+def rows_per_block(nframes, ncols, itemsize, max_memory=DEFAULT_MAX_MEMORY):
+    """Number of rows of the blocks that fit in the memory budget.
+
+    Parameters
+    ----------
+    nframes : int
+        Number of frames combined.
+    ncols : int
+        Number of columns of the frames.
+    itemsize : int
+        Bytes per pixel of the buffers (data and mask) of one frame.
+    max_memory : int
+        Memory budget (bytes) of the buffers.
+
+    Returns
+    -------
+    nrows : int
+        Number of rows, at least 1.
+
+    """
+    return max(1, int(max_memory // max(1, nframes * ncols * itemsize)))
+
+
+def combine_row_blocks(
+    method,
+    arrays,
+    masks=None,
+    regions=None,
+    scales=None,
+    out=None,
+    dtype="float32",
+    max_memory=DEFAULT_MAX_MEMORY,
+    **kwargs,
+):
+    """Combine frames with a numina.array.combine method, by blocks of rows.
+
+    The output is computed in blocks of consecutive rows. For each
+    block, only the rows of the frames that overlap the block are read,
+    within the valid region of each frame, and copied into buffers
+    allocated once, with a size given by the memory budget. The
+    pixels outside the valid region of a frame are masked. The
+    combination of each block is written directly in the output.
+
+    Parameters
+    ----------
+    method : callable
+        Combination function of numina.array.combine (mean, median,
+        sigmaclip...).
+    arrays : list of numpy.ndarray
+        Frames, with the same 2D shape (they can be memory-mapped).
+    masks : list of numpy.ndarray or None
+        Masks of the frames (non-zero values are masked).
+    regions : list of tuple of slice or None
+        Valid region of each frame. The pixels outside the region are
+        neither read nor used. If None, the whole frames are valid.
+    scales : list of float or None
+        Scale of each frame.
+    out : numpy.ndarray or None
+        Array of shape (3,) + shape of the frames, that receives the
+        combined frame, the variance and the number of pixels used.
+    dtype : data-type
+        Type of the output, if out is None.
+    max_memory : int
+        Memory budget (bytes) of the buffers of the frames.
+    **kwargs
+        Additional arguments of method.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        Combined frame, variance and number of pixels used. The pixels
+        without valid values are set to 0.
+
+    """
+    nframes = len(arrays)
+    if nframes == 0:
+        raise ValueError("no frames to combine")
+    shape = arrays[0].shape
+    for arr in arrays:
+        if arr.shape != shape:
+            raise ValueError(f"frames with different shapes: {arr.shape} != {shape}")
+    if regions is None:
+        regions = [None] * nframes
+    if scales is None:
+        scales = [1.0] * nframes
+    if out is None:
+        out = numpy.zeros((3,) + shape, dtype=dtype)
+    elif out.shape != (3,) + shape:
+        raise ValueError(f"out has shape {out.shape}, expected {(3,) + shape}")
+
+    limits = [_region_limits(region, shape) for region in regions]
+    data_dtype = numpy.result_type(*[arr.dtype for arr in arrays])
+    if masks is not None:
+        mask_dtype = numpy.result_type(*[mask.dtype for mask in masks])
+    else:
+        mask_dtype = numpy.dtype("uint8")
+    itemsize = data_dtype.itemsize + mask_dtype.itemsize
+    nrows = min(shape[0], rows_per_block(nframes, shape[1], itemsize, max_memory))
+    _logger.debug(
+        "combining %d frames of shape %s in blocks of %d rows", nframes, shape, nrows
+    )
+
+    data_buffer = numpy.empty((nframes, nrows, shape[1]), dtype=data_dtype)
+    mask_buffer = numpy.empty((nframes, nrows, shape[1]), dtype=mask_dtype)
+
+    for row1 in range(0, shape[0], nrows):
+        row2 = min(row1 + nrows, shape[0])
+        height = row2 - row1
+        block_data = []
+        block_masks = []
+        block_scales = []
+        partial = False
+        for idx, (r1, r2, c1, c2) in enumerate(limits):
+            b1, b2 = max(r1, row1), min(r2, row2)
+            if b1 >= b2 or c1 >= c2:
+                # the frame does not overlap the block
+                continue
+            k = len(block_data)
+            data = data_buffer[k, :height]
+            mask = mask_buffer[k, :height]
+            inner = (slice(b1 - row1, b2 - row1), slice(c1, c2))
+            if (b1, b2, c1, c2) != (row1, row2, 0, shape[1]):
+                partial = True
+                data[...] = 0
+                mask[...] = 1
+            data[inner] = arrays[idx][b1:b2, c1:c2]
+            if masks is not None:
+                mask[inner] = masks[idx][b1:b2, c1:c2]
+            else:
+                mask[inner] = 0
+            block_data.append(data)
+            block_masks.append(mask)
+            block_scales.append(scales[idx])
+
+        if not block_data:
+            out[:, row1:row2] = 0
+            continue
+        if masks is None and not partial:
+            block_masks = None
+        method(
+            block_data,
+            masks=block_masks,
+            scales=block_scales,
+            out=out[:, row1:row2],
+            **kwargs,
+        )
+    return out
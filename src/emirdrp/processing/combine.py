@@ -21,7 +21,6 @@ if sys.version_info <= (3, 10):
 import numpy
 from astropy.io import fits
 import numina.datamodel as datam
-from numina.frame.utils import copy_img
 from numina.array import combine
 from numina.array import combine_shape
 
@@ -48,6 +47,126 @@ def basic_processing(rinput, flow):
     return basic_processing_(rinput.obresult.images, flow)
 
 
+# default number of rows of the chunks of the nodded difference
+NODDED_CHUNK_ROWS = 128
+
+
+def nodded_difference(
+    pairs,
+    variances=None,
+    out=None,
+    out_variance=None,
+    dtype="float32",
+    chunk_rows=NODDED_CHUNK_ROWS,
+):
+    """Sum of the differences of pairs of nodded frames.
+
+    The difference of the frames of the first pair is written directly
+    in the output, and the differences of the other pairs are added to
+    it, one chunk of rows at a time. The frames are converted to dtype
+    chunk by chunk, so no full-size temporary is allocated. The result
+    is the same as converting the frames with astype(dtype) and
+    computing (A0 - B0) + (A1 - B1) + ...
+
+    Parameters
+    ----------
+    pairs : list of tuple of numpy.ndarray
+        Pairs (A, B) of frames, with the same 2D shape.
+    variances : list of tuple of numpy.ndarray or None
+        Pairs of variances of the frames. The variance of the result is
+        the sum of the variances.
+    out : numpy.ndarray or None
+        Array that receives the result.
+    out_variance : numpy.ndarray or None
+        Array that receives the variance of the result.
+    dtype : data-type
+        Type of the computation and of the output arrays.
+    chunk_rows : int
+        Number of rows of the chunks.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        Sum of the differences.
+    out_variance : numpy.ndarray or None
+        Variance of the sum, if variances is not None.
+
+    """
+    if not pairs:
+        raise ValueError("no pairs of frames")
+    shape = pairs[0][0].shape
+    for pair in pairs:
+        for arr in pair:
+            if arr.shape != shape:
+                raise ValueError(
+                    f"frames with different shapes: {arr.shape} != {shape}"
+                )
+    if out is None:
+        out = numpy.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError(f"out has shape {out.shape}, expected {shape}")
+
+    if variances is not None:
+        if len(variances) != len(pairs):
+            raise ValueError("the number of variances and frames are different")
+        if out_variance is None:
+            out_variance = numpy.empty(shape, dtype=dtype)
+        elif out_variance.shape != shape:
+            raise ValueError(
+                f"out_variance has shape {out_variance.shape}, expected {shape}"
+            )
+
+    nrows = max(1, min(chunk_rows, shape[0]))
+    buffer = numpy.empty((nrows,) + shape[1:], dtype=dtype)
+    for row1 in range(0, shape[0], nrows):
+        rows = slice(row1, min(row1 + nrows, shape[0]))
+        tmp = buffer[: rows.stop - rows.start]
+        _accumulate_pairs(pairs, rows, out[rows], tmp, numpy.subtract, dtype)
+        if variances is not None:
+            _accumulate_pairs(
+                variances, rows, out_variance[rows], tmp, numpy.add, dtype
+            )
+    return out, out_variance
+
+
+def _accumulate_pairs(pairs, rows, out, tmp, operation, dtype):
+    """Add operation(A, B) over the pairs, in a chunk of rows."""
+    arr1, arr2 = pairs[0]
+    operation(arr1[rows], arr2[rows], out=out, dtype=dtype, casting="unsafe")
+    for arr1, arr2 in pairs[1:]:
+        operation(arr1[rows], arr2[rows], out=tmp, dtype=dtype, casting="unsafe")
+        out += tmp
+
+
+def copy_img_with_data(img, data):
+    """Copy an HDUList, with new data in the primary HDU.
+
+    The data of the primary HDU of img is not copied.
+
+    """
+    hdu = fits.PrimaryHDU(data, header=img[0].header.copy())
+    return fits.HDUList([hdu] + [ext.copy() for ext in img[1:]])
+
+
+def _nodded_images(images, keys, errors):
+    """Sum of the differences of a sequence of nodded images."""
+    frames = dict(A=[], B=[])
+    for img, key in zip(images, keys):
+        frames[key].append(img)
+    pairs = [(a[0].data, b[0].data) for a, b in zip(frames["A"], frames["B"])]
+    variances = None
+    if errors and all("VARIANCE" in img for img in images):
+        variances = [
+            (a["VARIANCE"].data, b["VARIANCE"].data)
+            for a, b in zip(frames["A"], frames["B"])
+        ]
+    data, variance = nodded_difference(pairs, variances=variances)
+    result = copy_img_with_data(images[0], data)
+    if variance is not None:
+        result["VARIANCE"].data = variance
+    return result
+
+
 def process_abba(images, errors=False, prolog=None):
     """
     Process images in ABBA sequence
@@ -55,7 +174,9 @@ def process_abba(images, errors=False, prolog=None):
     Parameters
     ----------
     images
-    errors
+    errors : bool (optional)
+        If True, and the images have a VARIANCE extension, the
+        variance of the result is propagated
     prolog
 
     Returns
@@ -63,23 +184,12 @@ def process_abba(images, errors=False, prolog=None):
 
     """
     cnum = len(images)
-    result = copy_img(images[0])
-    base_header = result[0].header.copy()
+    base_header = images[0][0].header
 
     now = datetime.datetime.now(datetime.UTC)
     _logger.info("processing ABBA")
-    ###
-    ###
-    dataA0 = images[0][0].data.astype("float32")
-    dataB0 = images[1][0].data.astype("float32")
-    dataB1 = images[2][0].data.astype("float32")
-    dataA1 = images[3][0].data.astype("float32")
-    dataAB0 = dataA0 - dataB0
-    dataAB1 = dataA1 - dataB1
-    data = dataAB0 + dataAB1
-    ###
+    result = _nodded_images(images, ["A", "B", "B", "A"], errors)
     hdu = result[0]
-    hdu.data = data
     _logger.debug("update result header")
     if prolog:
         hdu.header["history"] = prolog
@@ -98,9 +208,6 @@ def process_abba(images, errors=False, prolog=None):
         imgid = datam.get_imgid(img)
         hdu.header["history"] = "Image '{}' is '{}'".format(imgid, key)
 
-    # Update primary extension
-    result[0] = hdu
-
     return result
 
 
@@ -111,7 +218,9 @@ def process_ab(images, errors=False, prolog=None):
     Parameters
     ----------
     images
-    errors
+    errors : bool (optional)
+        If True, and the images have a VARIANCE extension, the
+        variance of the result is propagated
     prolog
 
     Returns
@@ -119,18 +228,11 @@ def process_ab(images, errors=False, prolog=None):
 
     """
     cnum = len(images)
-    result = copy_img(images[0])
-    base_header = result[0].header.copy()
+    base_header = images[0][0].header
     now = datetime.datetime.now(datetime.UTC)
     _logger.info("processing AB")
-    ###
-    ###
-    dataA0 = images[0][0].data.astype("float32")
-    dataB0 = images[1][0].data.astype("float32")
-    data = dataA0 - dataB0
-
-    ###
-    hdu = fits.PrimaryHDU(data, header=base_header)
+    result = _nodded_images(images, ["A", "B"], errors)
+    hdu = result[0]
     _logger.debug("update result header")
     if prolog:
         hdu.header["history"] = prolog
@@ -148,20 +250,63 @@ def process_ab(images, errors=False, prolog=None):
         imgid = datam.get_imgid(img)
         hdu.header["history"] = "Image '{}' is '{}'".format(imgid, key)
 
-    # Update primary extension
     # Not sure why this is needed
     hdu.header["EXTEND"] = True
-    result[0] = hdu
 
     return result
 
 
+def create_combined_hdulist(images, data, method_name, prolog=None):
+    """Create the result of the combination of a sequence of HDUList objects.
+
+    The header and the extensions are those of the first image, with
+    the following keywords updated:
+     * HISTORY, with the method and the combined images
+     * NUM-NCOM
+     * UUID, TSUTC2
+
+    Parameters
+    ----------
+    images : list of astropy.io.fits.HDUList
+        Combined images, only their headers are used.
+    data : numpy.ndarray
+        Combined data.
+    method_name : str
+        Name of the combination method.
+    prolog : str (optional)
+        Text added to the HISTORY before the other entries.
+
+    Returns
+    -------
+    astropy.io.fits.HDUList
+
+    """
+    cnum = len(images)
+    result = copy_img_with_data(images[0], data)
+    hdu = result[0]
+    base_header = images[0][0].header
+    now = datetime.datetime.now(datetime.UTC)
+    if prolog:
+        hdu.header["history"] = prolog
+    hdu.header["history"] = "Combined %d images using '%s'" % (cnum, method_name)
+    hdu.header["history"] = "Combination time {}".format(now.isoformat())
+    for img in images:
+        hdu.header["history"] = "Image {}".format(datam.get_imgid(img))
+    prevnum = base_header.get("NUM-NCOM", 1)
+    hdu.header["NUM-NCOM"] = prevnum * cnum
+    hdu.header["UUID"] = str(uuid.uuid1())
+    # Headers of last image
+    if "TSUTC2" in base_header:
+        hdu.header["TSUTC2"] = images[-1][0].header["TSUTC2"]
+    # Not sure why this is needed
+    hdu.header["EXTEND"] = True
+    return result
+
+
 def create_proc_hdulist(images, data_array):
     # cnum = len(images)
-    result = copy_img(images[0])
-    base_header = result[0].header.copy()
-
-    hdu = fits.PrimaryHDU(data_array, header=base_header)
+    result = copy_img_with_data(images[0], data_array)
+    hdu = result[0]
     # self.set_base_headers(hdu.header)
     hdu.header["UUID"] = str(uuid.uuid1())
     # Update obsmode in header
@@ -170,7 +315,6 @@ def create_proc_hdulist(images, data_array):
     hdu.header["TSUTC2"] = images[-1][0].header["TSUTC2"]
     # Not sure why this is needed
     hdu.header["EXTEND"] = True
-    result[0] = hdu
     return result
 
 
@@ -241,30 +385,9 @@ def combine_images(
     -------
 
     """
-    cnum = len(images)
-    result = copy_img(images[0])
-    base_header = result[0].header.copy()
-
-    now = datetime.datetime.now(datetime.UTC)
-    _logger.info("stacking %d images using '%s'", cnum, method.__name__)
+    _logger.info("stacking %d images using '%s'", len(images), method.__name__)
     data = method([d[0].data for d in images], dtype="float32")
-    hdu = result[0]
-    hdu.data = data[0]
-    _logger.debug("update result header")
-    if prolog:
-        hdu.header["history"] = prolog
-    hdu.header["history"] = "Combined %d images using '%s'" % (cnum, method.__name__)
-    hdu.header["history"] = "Combination time {}".format(now.isoformat())
-    for img in images:
-        hdu.header["history"] = "Image {}".format(datam.get_imgid(img))
-    prevnum = base_header.get("NUM-NCOM", 1)
-    hdu.header["NUM-NCOM"] = prevnum * cnum
-    hdu.header["UUID"] = str(uuid.uuid1())
-    # Headers of last image
-    hdu.header["TSUTC2"] = images[-1][0].header["TSUTC2"]
-    # Not sure why this is needed
-    hdu.header["EXTEND"] = True
-    result[0] = hdu
+    result = create_combined_hdulist(images, data[0], method.__name__, prolog=prolog)
     if errors:
         varhdu = fits.ImageHDU(data[1], name="VARIANCE")
         result.append(varhdu)
@@ -10,13 +10,13 @@
 
 """Offsets from cross-correlation"""
 
+import functools
 import logging
 
 import numpy
 import numpy.linalg
-import scipy.signal
+import scipy.fft
 import numina.array.imsurfit as imsurfit
-from numina.array.imsurfit import vertex_of_quadratic
 import numina.array.utils as utils
 import numina.array.stats as s
 
@@ -44,13 +44,16 @@ def offsets_from_crosscor(arrs, region, refine=True, refine_box=3, order="ij"):
         raise ValueError("'order' must be either 'ij' or 'xy'")
 
     result = numpy.zeros((len(arrs), 2))
-    ref_array = arrs[0]
+    # the reference region is transformed only once
+    correlator = RegionCorrelator(arrs[0], [region])
 
     for idx, arr in enumerate(arrs[1:], 1):
 
-        refoff = offset_from_crosscor(
-            ref_array, arr, region, refine=refine, refine_box=refine_box, order=order
+        (refoff,) = correlator.offsets(
+            arr, refine=refine, refine_box=refine_box, order=order
         )
+        if numpy.any(numpy.isnan(refoff)):
+            raise ValueError("Peak below threshold")
         result[idx] = refoff
 
     return result
@@ -65,117 +68,234 @@ def offsets_from_crosscor_regions(
         raise ValueError("'order' must be either 'ij' or 'xy'")
 
     result = numpy.zeros((len(arrs), 2))
-    ref_array = arrs[0]
+    # the reference regions are transformed only once
+    correlator = RegionCorrelator(arrs[0], regions)
 
     for idx, arr in enumerate(arrs[1:], 1):
 
-        refoff = offset_from_crosscor_regions(
-            ref_array,
-            arr,
-            regions,
-            refine=refine,
-            refine_box=refine_box,
-            order=order,
-            tol=tol,
+        values = correlator.offsets(
+            arr, refine=refine, refine_box=refine_box, order=order
         )
-        result[idx] = refoff
+        result[idx] = combine_region_offsets(values, tol=tol)
 
     return result
 
 
+class RegionCorrelator:
+    """Cross-correlation of regions of images with a reference image
+
+    The cutouts of the reference image are filtered, standardized and
+    Fourier transformed only once. The regions with the same shape are
+    stacked, so that the cutouts of each new image are correlated in a
+    single batched FFT, and the peaks of all the correlations are
+    located and refined at once.
+
+    Parameters
+    ----------
+    arr0 : numpy.ndarray
+        Reference image.
+    regions : list of tuple of slices
+        Regions of the images to correlate.
+
+    """
+
+    def __init__(self, arr0, regions):
+        self.regions = list(regions)
+        self.groups = []
+
+        shapes = {}
+        for idx, region in enumerate(self.regions):
+            shapes.setdefault(arr0[region].shape, []).append(idx)
+
+        for rshape, idxs in shapes.items():
+            d1 = numpy.array([self._cutout(arr0, idx) for idx in idxs])
+            # size of the full linear correlation
+            cshape = [2 * n - 1 for n in rshape]
+            fshape = [scipy.fft.next_fast_len(n, True) for n in cshape]
+            sp1 = scipy.fft.rfftn(d1, fshape, axes=(1, 2))
+            self.groups.append((idxs, rshape, cshape, fshape, sp1))
+
+    def _cutout(self, arr, idx):
+        return standarize(filter_region(arr[self.regions[idx]]))
+
+    def correlate(self, arr1):
+        """Cross-correlation of each region of arr1 with the reference.
+
+        Each correlation has the shape of its region (as computed
+        by `scipy.signal.fftconvolve` with mode 'same') and is
+        normalized to its maximum value.
+
+        """
+        result = [None] * len(self.regions)
+        for idxs, rshape, cshape, fshape, sp1 in self.groups:
+            d2 = numpy.array([self._cutout(arr1, idx) for idx in idxs])
+            # correlation is equivalent to convolution with inverted image
+            sp2 = scipy.fft.rfftn(d2[:, ::-1, ::-1], fshape, axes=(1, 2))
+            ret = scipy.fft.irfftn(sp1 * sp2, fshape, axes=(1, 2))
+            i0, j0 = [(c - n) // 2 for c, n in zip(cshape, rshape)]
+            corrs = ret[:, i0 : i0 + rshape[0], j0 : j0 + rshape[1]]
+            # normalize
+            corrs /= corrs.max(axis=(1, 2), keepdims=True)
+            for idx, corr in zip(idxs, corrs):
+                result[idx] = corr
+        return result
+
+    def offsets(self, arr1, refine=True, refine_box=3, order="ij"):
+        """Offsets of arr1 relative to the reference in each region.
+
+        Parameters
+        ----------
+        arr1 : numpy.ndarray
+            Image.
+        refine : bool
+            Refine the peaks of the correlations to subpixel.
+        refine_box : int
+            Half size of the box used to refine the peaks.
+        order : {'ij', 'xy'}
+            Order of the coordinates of the offsets.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (len(regions), 2) with the offsets. Regions
+            where the peak of the correlation is below the threshold
+            are NaN.
+
+        """
+        if order not in ["xy", "ij"]:
+            raise ValueError("'order' must be either 'ij' or 'xy'")
+
+        corrs = self.correlate(arr1)
+        result = numpy.full((len(self.regions), 2), numpy.nan)
+        peaks = []
+        for idxs, rshape, _, _, _ in self.groups:
+            stack = numpy.array([corrs[idx] for idx in idxs])
+            flat = stack.reshape(len(idxs), -1)
+            maxindex = numpy.column_stack(
+                numpy.unravel_index(flat.argmax(axis=1), rshape)
+            )
+            # Check the peak is above n times the background
+            peakvalue = flat.max(axis=1)
+            threshold = numpy.median(flat, axis=1) + 5 * numpy.std(flat, axis=1)
+            dcenter = numpy.asarray(rshape) // 2
+            for idx, pidx, value, thres in zip(idxs, maxindex, peakvalue, threshold):
+                _logger.debug("The peak value is %f, threshold %f", value, thres)
+                # a constant cutout gives a correlation without a peak (NaN)
+                if not value >= thres:
+                    _logger.debug("Peak below threshold in region %d", idx)
+                else:
+                    peaks.append((idx, pidx, dcenter))
+
+        if refine:
+            finals = refine_peaks(
+                [corrs[idx] for idx, _, _ in peaks],
+                [pidx for _, pidx, _ in peaks],
+                refine_box=refine_box,
+            )
+        else:
+            finals = [pidx for _, pidx, _ in peaks]
+
+        for (idx, _, dcenter), final in zip(peaks, finals):
+            result[idx] = dcenter - final
+
+        if order == "xy":
+            return result[:, ::-1]
+        else:
+            return result
+
+
+@functools.lru_cache(maxsize=16)
+def _quadratic_fit_operator(shape):
+    # imsurfit is linear in the data, compute its matrix
+    basis = numpy.eye(shape[0] * shape[1])
+    cols = [imsurfit.imsurfit(b.reshape(shape), order=2)[0] for b in basis]
+    return numpy.array(cols)
+
+
+def refine_peaks(corrs, maxindices, refine_box=3):
+    """Refine to subpixel the peaks of several cross-correlations.
+
+    A 2D quadratic surface is fitted to a box around each peak.
+    The peaks with boxes of the same shape are fitted at once.
+    If the vertex of the surface is not a maximum or it is more
+    than one pixel away, the peak is not refined.
+
+    Parameters
+    ----------
+    corrs : list of numpy.ndarray
+        Cross-correlations.
+    maxindices : list of array-like
+        Pixel (i, j) of the peak of each cross-correlation.
+    refine_box : int
+        Half size of the box around the peak.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        Refined (i, j) coordinates of the peaks.
+
+    """
+    finals = [numpy.asarray(maxindex, dtype=float) for maxindex in maxindices]
+    boxes = {}
+    for pos, (corr, maxindex) in enumerate(zip(corrs, maxindices)):
+        region_ref = utils.image_box(maxindex, corr.shape, box=(refine_box, refine_box))
+        box = corr[region_ref]
+        boxes.setdefault(box.shape, []).append((pos, box))
+
+    for bshape, members in boxes.items():
+        data = numpy.array([box.ravel() for _, box in members])
+        # coeffs are a + b *x + c * y + d*x**2 + e * x* y + f * y**2
+        coeffs = data @ _quadratic_fit_operator(bshape)
+        C, D, A, E, B = coeffs[:, 1:].T
+        det = 4 * A * B - E**2
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            xm = -(2 * B * C - D * E) / det
+            ym = -(2 * A * D - C * E) / det
+        # det <= 0: quadratic has no maximum
+        # abs(xm) > 1 or abs(ym) > 1: probably bad fit, dont apply
+        good = (det > 0) & (numpy.abs(xm) <= 1) & (numpy.abs(ym) <= 1)
+        for (pos, _), flag, x, y in zip(members, good, xm, ym):
+            if flag:
+                finals[pos] = finals[pos] + numpy.asarray([y, x])
+    return finals
+
+
 def offset_from_crosscor(arr0, arr1, region, refine=True, refine_box=3, order="ij"):
     # import astropy.io.fits as fits
     # allowed values for order
     if order not in ["xy", "ij"]:
         raise ValueError("'order' must be either 'ij' or 'xy'")
 
-    ref_array = arr0
-    shape = ref_array.shape
-    data1 = filter_region(ref_array[region])
-    d1 = standarize(data1)
-    # fits.writeto('cutout_%d.fits' % 0, d1, overwrite=True)
-
-    dcenter = numpy.asarray(d1.shape) // 2
-    # Correlate
-
-    data2 = filter_region(arr1[region])
-    d2 = standarize(data2)
-    # fits.writeto('cutout_%d.fits' % idx, d2, overwrite=True)
-    # corr = scipy.signal.correlate2d(d1, d2, mode='same', boundary='fill', fillvalue=fillvalue)
-    # correlation is equivalent to convolution with inverted image
-    corr = scipy.signal.fftconvolve(d1, d2[::-1, ::-1], mode="same")
-    # normalize
-    corr /= corr.max()
-    # fits.writeto('corr_%d.fits' % idx, corr, overwrite=True)
-    # fits.writeto('corr2_%d.fits' % idx, corr2 / corr2.max(), overwrite=True)
-    # Find peak in cross-cor
-    maxindex = numpy.unravel_index(corr.argmax(), corr.shape)
-
-    # Check the peak is above n times the background
-    median_corr = numpy.median(corr)
-    std_corr = numpy.std(corr)
-    peakvalue = corr[maxindex]
-    threshold = median_corr + 5 * std_corr
-    _logger.debug("The peak value is %f, threshold %f", peakvalue, threshold)
-    if peakvalue < threshold:
+    correlator = RegionCorrelator(arr0, [region])
+    (refoff,) = correlator.offsets(
+        arr1, refine=refine, refine_box=refine_box, order=order
+    )
+    if numpy.any(numpy.isnan(refoff)):
         raise ValueError("Peak below threshold")
-
-    # baseoff = dcenter - numpy.asarray(maxindex)
-    # Pixel (0,0) in reference corresponds to baseoff in image
-    # print("Pixel (0,0) in reference corresponds to %s in image" % baseoff)
-
-    if refine:
-        # Refine to subpixel
-        # Fit a 2D surface to the peak of the crosscorr
-        region_ref = utils.image_box(maxindex, shape, box=(refine_box, refine_box))
-
-        (coeffs,) = imsurfit.imsurfit(corr[region_ref], order=2)
-        # coefss are a + b *x + c * y + d*x**2 + e * x* y + f * y**2
-
-        try:
-            # get peak from coeffs
-            xm, ym = vertex_of_quadratic(coeffs)
-            # xm ym are offsets
-
-            if abs(xm) > 1 or abs(ym) > 1:
-                # probably bad fit
-                # dont apply
-                final = maxindex
-            else:
-                final = maxindex + numpy.asarray([ym, xm])
-        except ValueError as error:
-            _logger.debug("Error fitting peak, %s", error)
-            final = maxindex
-    else:
-        final = maxindex
-
-    refoff = dcenter - final
-    # Pixel (0,0) in reference corresponds to baseoff in image
-    # print("Pixel (0,0) in reference corresponds to %s in image" % refoff)
-    # result xy
-    if order == "xy":
-        return refoff[::-1]
-    else:
-        return refoff
+    # Pixel (0,0) in reference corresponds to refoff in image
+    return refoff
 
 
 def offset_from_crosscor_regions(
     arr0, arr1, regions, refine=True, refine_box=3, order="ij", tol=0.5
 ):
 
-    values = []
-    for region in regions:
-        try:
-            res = offset_from_crosscor(
-                arr0, arr1, region, refine=refine, refine_box=refine_box, order=order
-            )
-            values.append(res)
-        except ValueError as error:
-            _logger.debug("error in offset_from_crosscor_regions: %s", error)
+    correlator = RegionCorrelator(arr0, regions)
+    values = correlator.offsets(arr1, refine=refine, refine_box=refine_box, order=order)
+    return combine_region_offsets(values, tol=tol)
+
+
+def combine_region_offsets(values, tol=0.5):
+    """Combine the offsets measured in several regions.
+
+    The offsets (NaN for failed regions) farther than tol from
+    their median are rejected, the rest are averaged.
+    """
+    values = numpy.asarray(values)
+    values = values[~numpy.any(numpy.isnan(values), axis=1)]
 
     if len(values) == 0:
         raise ValueError("No measurements to compute offset in any region")
-    values = numpy.array(values)
     _logger.debug("offsets from cross-correlation:\n%s", values)
     med_c = numpy.median(values, axis=0)
 
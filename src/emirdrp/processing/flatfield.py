@@ -37,8 +37,12 @@ class FlatFieldCorrector(proc.Corrector):
             datamodel=datamodel, calibid=calibid, dtype=dtype
         )
 
+        invalid = flatdata <= 0
+        if numpy.any(invalid):
+            if not flatdata.flags.writeable:
+                flatdata = flatdata.copy()
+            flatdata[invalid] = 1.0  # To avoid NaN
         self.flatdata = flatdata
-        self.flatdata[flatdata <= 0] = 1.0  # To avoid NaN
         self.flat_stats = flatdata.mean()
 
     def run(self, img):
@@ -62,11 +66,14 @@ class FlatFieldCorrector(proc.Corrector):
 
         # FIXME: not using datamodel
         img["primary"].data = result
-        hdr = img["primary"].header
+        self.update_header(img["primary"].header)
+        return img
+
+    def update_header(self, hdr):
+        """Record the flat-field correction in a header."""
         hdr["NUM-FF"] = self.calibid
         hdr["history"] = "Flat-field correction with {}".format(self.calibid)
         hdr["history"] = "Flat-field correction time {}".format(
             datetime.datetime.now(datetime.UTC).isoformat()
         )
         hdr["history"] = "Flat-field correction mean {}".format(self.flat_stats)
-        return img
@@ -0,0 +1,171 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Store of intermediate frames backed by memory-mapped .npy files"""
+
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy
+
+_logger = logging.getLogger(__name__)
+
+
+class StoredFrame:
+    """Frame of a FrameStore, read from its file on demand
+
+    Slicing a StoredFrame returns a copy of the region, read from the
+    .npy file of the frame, that is mapped only during the read. The
+    pages of the file do not remain then in the memory of the process,
+    as they do with a numpy.memmap.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the .npy file.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        frame = numpy.load(filename, mmap_mode="r")
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+
+    def __getitem__(self, region):
+        frame = numpy.load(self.filename, mmap_mode="r")
+        return numpy.array(frame[region])
+
+
+class FrameStore:
+    """Store of intermediate frames backed by memory-mapped .npy files
+
+    Each frame is a numpy.memmap of a raw .npy file, so that the
+    processing stages can update the frames in place, without
+    copying them to new files. The files are removed when the
+    store is closed.
+
+    Parameters
+    ----------
+    directory : str or None
+        Directory where the private directory of the store is
+        created. If None, the default temporary directory is used.
+    prefix : str
+        Prefix of the private directory of the store.
+
+    """
+
+    def __init__(self, directory=None, prefix="framestore_"):
+        self.directory = tempfile.mkdtemp(prefix=prefix, dir=directory)
+        self._frames = {}
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def __getitem__(self, key):
+        frame = self._frames[key]
+        if frame is None:
+            # the frame was released, it is mapped again
+            frame = numpy.load(self.filename(key), mmap_mode="r+")
+            self._frames[key] = frame
+        return frame
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def filename(self, key):
+        """Name of the .npy file of a frame."""
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def create(self, key, shape, dtype="float32", fill=0):
+        """Create a frame, initialized with a constant value.
+
+        If a frame with the same key, shape and dtype already exists,
+        it is reused (and reinitialized).
+
+        Parameters
+        ----------
+        key : str
+            Name of the frame.
+        shape : tuple
+            Shape of the frame.
+        dtype : data-type
+            Type of the frame.
+        fill : scalar or None
+            Initial value of the frame. If None, the frame is not
+            initialized.
+
+        Returns
+        -------
+        frame : numpy.memmap
+            Array backed by the .npy file of the frame.
+
+        """
+        shape = tuple(shape)
+        dtype = numpy.dtype(dtype)
+        frame = self._frames.get(key)
+        if frame is None or frame.shape != shape or frame.dtype != dtype:
+            self.remove(key)
+            _logger.debug("creating frame %s, shape %s, dtype %s", key, shape, dtype)
+            frame = numpy.lib.format.open_memmap(
+                self.filename(key), mode="w+", dtype=dtype, shape=shape
+            )
+            self._frames[key] = frame
+        if fill is not None:
+            frame[...] = fill
+        return frame
+
+    def store(self, key, array):
+        """Create a frame with a copy of array."""
+        frame = self.create(key, array.shape, dtype=array.dtype, fill=None)
+        frame[...] = array
+        return frame
+
+    def release(self, key):
+        """Write a frame to disk and unmap it, keeping its file.
+
+        The frame is mapped again when it is accessed; it can also be
+        read without mapping it with `reader`.
+
+        """
+        frame = self._frames[key]
+        if frame is not None:
+            frame.flush()
+            self._frames[key] = None
+
+    def reader(self, key):
+        """StoredFrame that reads a frame from its file."""
+        if self._frames[key] is not None:
+            self._frames[key].flush()
+        return StoredFrame(self.filename(key))
+
+    def remove(self, key):
+        """Remove a frame and its file, if they exist."""
+        if key in self._frames:
+            del self._frames[key]
+            os.remove(self.filename(key))
+
+    def flush(self):
+        """Write pending changes of all the frames to disk."""
+        for frame in self._frames.values():
+            if frame is not None:
+                frame.flush()
+
+    def close(self):
+        """Remove all the frames and the directory of the store."""
+        self._frames.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,304 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Detector corrections fused in a single pass over the frame"""
+
+import datetime
+import logging
+import sys
+
+import numpy
+import numina.processing as proc
+import numina.util.flow
+import numina.util.node
+
+from emirdrp.processing.checkers import Checker
+from emirdrp.processing.flatfield import FlatFieldCorrector
+
+if sys.version_info[:2] <= (3, 10):
+    datetime.UTC = datetime.timezone.utc
+
+_logger = logging.getLogger(__name__)
+
+# default number of rows of the chunks of the fused pass
+FUSED_CHUNK_ROWS = 64
+
+
+def _now():
+    return datetime.datetime.now(datetime.UTC).isoformat()
+
+
+class _Step:
+    """Pixel by pixel correction, applied to chunks of rows."""
+
+    update_variance = False
+    # the correction may write into the chunk it receives
+    inplace = False
+
+    def __init__(self, corrector):
+        self.corrector = corrector
+
+    def prepare(self, img, imgid):
+        """Prepare the correction of an image, return False to skip it."""
+        return True
+
+    def apply(self, data, rows):
+        """Correct the data of a chunk of rows, return the result."""
+        return data
+
+    def apply_variance(self, variance, rows):
+        """Update in place the variance of a chunk of rows."""
+
+    def finish(self, img):
+        """Record the correction in the image."""
+
+
+class _BiasStep(_Step):
+    inplace = True
+
+    def __init__(self, corrector):
+        super().__init__(corrector)
+        self.update_variance = corrector.update_variance
+
+    def prepare(self, img, imgid):
+        _logger.debug("correcting bias in %s", imgid)
+        _logger.debug("bias mean is %f", self.corrector.bias_stats)
+        return True
+
+    def apply(self, data, rows):
+        numpy.subtract(data, self.corrector.biasmap[rows], out=data)
+        return data
+
+    def apply_variance(self, variance, rows):
+        numpy.add(variance, self.corrector.biasvar[rows], out=variance)
+
+    def finish(self, img):
+        corrector = self.corrector
+        hdr = img["primary"].header
+        hdr["NUM-BS"] = corrector.calibid
+        hdr["history"] = f"Bias correction with {corrector.calibid}"
+        hdr["history"] = f"Bias image mean is {corrector.bias_stats}"
+        hdr["history"] = f"Bias correction time {_now()}"
+
+
+class _DarkStep(_Step):
+    inplace = True
+
+    def __init__(self, corrector):
+        super().__init__(corrector)
+        self.update_variance = corrector.update_variance
+        self.etime = None
+
+    def prepare(self, img, imgid):
+        self.etime = self.corrector.datamodel.get_darktime(img)
+        return True
+
+    def apply(self, data, rows):
+        numpy.subtract(data, self.corrector.darkmap[rows] * self.etime, out=data)
+        return data
+
+    def apply_variance(self, variance, rows):
+        darkvar = self.corrector.darkvar[rows]
+        numpy.add(variance, darkvar * self.etime * self.etime, out=variance)
+
+    def finish(self, img):
+        hdr = img["primary"].header
+        hdr["NUM-DK"] = self.corrector.calibid
+        hdr["history"] = f"Dark correction with {self.corrector.calibid}"
+        hdr["history"] = f"Dark correction time {_now()}"
+
+
+class _DivideStep(_Step):
+    """Division or subtraction, with the result cast to the corrector dtype."""
+
+    operation = numpy.divide
+    inplace = True
+
+    def __init__(self, corrector, calibration):
+        super().__init__(corrector)
+        self.calibration = calibration
+        self.dtype = numpy.dtype(corrector.dtype)
+
+    def apply(self, data, rows):
+        calibration = self.calibration[rows]
+        if numpy.result_type(data, calibration) == data.dtype == self.dtype:
+            return self.operation(data, calibration, out=data)
+        return self.operation(data, calibration).astype(self.dtype)
+
+
+class _FlatStep(_DivideStep):
+    def __init__(self, corrector):
+        super().__init__(corrector, corrector.flatdata)
+        self.nonfinite = 0
+        self.zeros = numpy.count_nonzero(corrector.flatdata < 0)
+
+    def prepare(self, img, imgid):
+        _logger.debug("correcting flat in %s", imgid)
+        _logger.debug("flat mean is %f", self.corrector.flat_stats)
+        if self.zeros:
+            _logger.warning("flat has %d zeros", self.zeros)
+        self.nonfinite = 0
+        return True
+
+    def apply(self, data, rows):
+        self.nonfinite += data.size - numpy.count_nonzero(numpy.isfinite(data))
+        return super().apply(data, rows)
+
+    def finish(self, img):
+        if self.nonfinite:
+            _logger.warning("image has %d NaN", self.nonfinite)
+        self.corrector.update_header(img["primary"].header)
+
+
+class _SkyStep(_DivideStep):
+    operation = numpy.subtract
+
+    def __init__(self, corrector):
+        super().__init__(corrector, corrector.skydata)
+
+    def prepare(self, img, imgid):
+        if self.corrector.datamodel.do_sky_correction(img):
+            _logger.debug("correcting sky in %s", imgid)
+            _logger.debug("sky mean is %f", self.corrector.calib_stats)
+            return True
+        _logger.debug("skip sky correction in %s", imgid)
+        return False
+
+    def finish(self, img):
+        corrector = self.corrector
+        hdr = img["primary"].header
+        hdr["NUM-SK"] = corrector.calibid
+        hdr["history"] = f"Sky subtraction with {corrector.calibid}"
+        hdr["history"] = f"Sky subtraction time {_now()}"
+        hdr["history"] = f"Sky subtraction mean {corrector.calib_stats}"
+
+
+class _CheckStep(_Step):
+    def prepare(self, img, imgid):
+        _logger.debug("running checker after flat")
+        self.nonfinite = 0
+        return True
+
+    def apply(self, data, rows):
+        self.nonfinite += data.size - numpy.count_nonzero(numpy.isfinite(data))
+        return data
+
+    def finish(self, img):
+        if self.nonfinite:
+            _logger.warning("image has %d NaN", self.nonfinite)
+
+
+# correctors that can be fused, by exact type
+FUSED_STEPS = {
+    proc.BiasCorrector: _BiasStep,
+    proc.DarkCorrector: _DarkStep,
+    FlatFieldCorrector: _FlatStep,
+    proc.SkyCorrector: _SkyStep,
+    Checker: _CheckStep,
+}
+
+
+class FusedCorrector(proc.Corrector):
+    """A Node that applies several pixel by pixel corrections in one pass.
+
+    The frame is traversed once, in chunks of rows, and each chunk
+    goes through all the corrections before the next chunk is read.
+    Each chunk is copied before the first correction that writes into
+    it, and the corrections are then done in place when they do not
+    change the type of the data, so the arrays of the input image are
+    never modified and the only full-size array allocated is the
+    output. The variance is updated in the same pass. The result is
+    the same as applying the correctors one after another.
+
+    Parameters
+    ----------
+    correctors : list of numina.processing.Corrector
+        Correctors, in order of application. Their types must be in
+        FUSED_STEPS.
+    chunk_rows : int
+        Number of rows of the chunks.
+
+    """
+
+    def __init__(self, correctors, chunk_rows=FUSED_CHUNK_ROWS):
+        super().__init__()
+        self.correctors = list(correctors)
+        self.steps = [FUSED_STEPS[type(corr)](corr) for corr in self.correctors]
+        self.chunk_rows = chunk_rows
+
+    def run(self, img):
+        imgid = self.get_imgid(img)
+        steps = [step for step in self.steps if step.prepare(img, imgid)]
+        var_steps = [step for step in steps if step.update_variance]
+
+        data = img["primary"].data
+        variance = img["variance"].data.copy() if var_steps else None
+        out = None
+        nrows = max(1, self.chunk_rows)
+        for row1 in range(0, data.shape[0], nrows):
+            rows = slice(row1, min(row1 + nrows, data.shape[0]))
+            chunk = data[rows]
+            result = chunk
+            for step in steps:
+                if step.inplace and result is chunk:
+                    result = chunk.copy()
+                result = step.apply(result, rows)
+            if result is not chunk:
+                if out is None:
+                    out = numpy.empty(data.shape, dtype=result.dtype)
+                out[rows] = result
+            for step in var_steps:
+                step.apply_variance(variance[rows], rows)
+
+        if out is not None:
+            img["primary"].data = out
+        if variance is not None:
+            img["variance"].data = variance
+        for step in steps:
+            step.finish(img)
+        return img
+
+
+def fuse_flow(flow, chunk_rows=FUSED_CHUNK_ROWS):
+    """Replace the consecutive fusible correctors of a flow by a FusedCorrector.
+
+    Parameters
+    ----------
+    flow : numina.util.flow.SerialFlow
+        Flow of correctors, as created by init_filters.
+    chunk_rows : int
+        Number of rows of the chunks of the fused correctors.
+
+    Returns
+    -------
+    flow : numina.util.flow.SerialFlow
+        Flow with the same result. The correctors that are not in
+        FUSED_STEPS (for example, the bad pixel corrector, that uses
+        the neighbours of each pixel) are kept as they are.
+
+    """
+    nodes = []
+    group = []
+
+    def flush():
+        if group:
+            nodes.append(FusedCorrector(group, chunk_rows=chunk_rows))
+            group.clear()
+
+    for node in flow:
+        if type(node) in FUSED_STEPS:
+            group.append(node)
+        elif type(node) is numina.util.node.IdNode:
+            continue
+        else:
+            flush()
+            nodes.append(node)
+    flush()
+    _logger.debug("fused flow is %s", nodes)
+    return numina.util.flow.SerialFlow(nodes)
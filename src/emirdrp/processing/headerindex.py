@@ -0,0 +1,539 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Persistent index of the headers of FITS frames"""
+
+import gzip
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from astropy.io import fits
+from astropy.time import Time
+from astropy.wcs import WCS
+
+from emirdrp.instrument.components.dtu import DtuConf
+from emirdrp.instrument.csu_configuration import CsuConfiguration
+
+_logger = logging.getLogger(__name__)
+
+# name of the index in a work directory
+INDEX_FILENAME = "emir_header_index.sqlite"
+
+_BLOCK = 2880
+
+# keywords stored as queryable values
+INDEX_KEYWORDS = (
+    "UUID",
+    "DATE-OBS",
+    "MJD-OBS",
+    "AIRMASS",
+    "EXPTIME",
+    "TSTAMP",
+    "TSUTC1",
+    "TSUTC2",
+    "OBSMODE",
+    "READMODE",
+    "FILTER",
+    "GRISM",
+    "NUM-NCOM",
+    "NUM-SK",
+    "SKYADD",
+)
+
+# keywords of the celestial WCS in the primary header
+_WCS_KEYWORD = re.compile(
+    r"^(WCSAXES|CTYPE\d|CUNIT\d|CRPIX\d|CRVAL\d|CDELT\d|CROTA\d|CD\d_\d|PC\d_\d"
+    r"|PV\d_\d+|LONPOLE|LATPOLE|RADESYS|RADECSYS|EQUINOX|EPOCH|WCSNAME"
+    r"|MJD-OBS|DATE-OBS|[AB]P?_\w+)$"
+)
+
+_DTU_KEYWORD = re.compile(r"^[XYZ]DTU(_F|_0)?$")
+
+# keywords of the DTU and the CSU in the MECS header
+_MECS_KEYWORD = re.compile(r"^([XYZ]DTU(_F|_0)?|CSUP\d+|CS_\d+)$")
+
+# numeric value of a card, without the parsing of astropy
+_NUMERIC_VALUE = re.compile(r"^= +([-+]?(\d+\.?\d*|\.\d+)([ED][-+]?\d+)?) *(/.*)?$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    filename TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    mjd REAL,
+    airmass REAL,
+    extnames TEXT,
+    keywords TEXT,
+    wcs TEXT,
+    dtu TEXT,
+    csup TEXT,
+    cs TEXT
+);
+CREATE TABLE IF NOT EXISTS headers (
+    filename TEXT,
+    hdu INTEGER,
+    header TEXT,
+    PRIMARY KEY (filename, hdu)
+);
+"""
+
+
+def celestial_wcs_cards(header):
+    """Cards of the celestial WCS of a header, as a string."""
+    return "".join(
+        str(card) for card in header.cards if _WCS_KEYWORD.match(card.keyword)
+    )
+
+
+def _open_file(filename):
+    if str(filename).endswith(".gz"):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def _read_header_block(fd):
+    """Bytes of the next header, or None at the end of the file."""
+    blocks = []
+    while True:
+        block = fd.read(_BLOCK)
+        if len(block) < _BLOCK:
+            if blocks or block.strip(b"\0 "):
+                raise ValueError("truncated FITS header")
+            return None
+        blocks.append(block)
+        for pos in range(0, _BLOCK, 80):
+            if block[pos : pos + 8] == b"END     ":
+                return b"".join(blocks)
+
+
+def _json_value(value):
+    """Value of a keyword that can be stored as JSON."""
+    if isinstance(value, fits.card.Undefined):
+        return None
+    return value
+
+
+def _card_value(card):
+    """Value of a card, parsing directly the common numeric values."""
+    match = _NUMERIC_VALUE.match(card.image[8:])
+    if match is None:
+        return _json_value(card.value)
+    text = match.group(1)
+    if match.group(3) is None and "." not in text:
+        return int(text)
+    return float(text.replace("D", "E"))
+
+
+def _data_size(header):
+    """Bytes of the data of a HDU, including the padding."""
+    naxis = header.get("NAXIS", 0)
+    if naxis == 0:
+        return 0
+    dims = [header.get(f"NAXIS{idx}", 0) for idx in range(1, naxis + 1)]
+    if header.get("GROUPS", False) and dims[0] == 0:
+        # random groups
+        dims = dims[1:]
+    npix = 1
+    for dim in dims:
+        npix *= dim
+    size = abs(header["BITPIX"]) // 8 * header.get("GCOUNT", 1)
+    size *= header.get("PCOUNT", 0) + npix
+    return -(-size // _BLOCK) * _BLOCK
+
+
+def read_headers(filename):
+    """Headers of all the HDUs of a FITS file.
+
+    Only the header blocks are read, the data blocks are skipped.
+    Tile-compressed images are read with astropy, to obtain the
+    headers of the images instead of those of the binary tables.
+
+    Parameters
+    ----------
+    filename : str or os.PathLike
+        Name of the FITS file, optionally compressed with gzip.
+
+    Returns
+    -------
+    headers : list of astropy.io.fits.Header
+
+    """
+    headers = []
+    with _open_file(filename) as fd:
+        while True:
+            text = _read_header_block(fd)
+            if text is None:
+                break
+            header = fits.Header.fromstring(text.decode("ascii"))
+            if header.get("ZIMAGE", False):
+                return _read_headers_astropy(filename)
+            headers.append(header)
+            fd.seek(_data_size(header), os.SEEK_CUR)
+    return headers
+
+
+def _read_headers_astropy(filename):
+    with fits.open(filename, mode="readonly") as hdulist:
+        return [hdu.header.copy() for hdu in hdulist]
+
+
+class FrameRecord:
+    """Metadata of a frame, as stored in the header index
+
+    Attributes
+    ----------
+    filename : str or None
+        Name of the file of the frame.
+    mjd : float or None
+        Modified Julian date of the observation (MJD-OBS, or DATE-OBS).
+    airmass : float or None
+        Airmass of the observation.
+    extnames : list of str
+        Names of the HDUs ('PRIMARY' for the first one).
+    keywords : dict
+        Values of INDEX_KEYWORDS in the primary header (None for
+        the keywords without value).
+    csup : list of float
+        Positions of the CSU bars (CSUP1 to CSUP110).
+    cs : list of float
+        CSU sensors (CS_0 to CS_439).
+
+    """
+
+    def __init__(
+        self,
+        filename=None,
+        mjd=None,
+        airmass=None,
+        extnames=None,
+        keywords=None,
+        wcs_cards=None,
+        dtu=None,
+        csup=None,
+        cs=None,
+        headers=None,
+    ):
+        self.filename = filename
+        self.mjd = mjd
+        self.airmass = airmass
+        self.extnames = extnames or []
+        self.keywords = keywords or {}
+        self.csup = csup or []
+        self.cs = cs or []
+        self._wcs_cards = wcs_cards or ""
+        self._dtu = dtu or {}
+        self._headers = headers
+        self._wcs = None
+
+    @classmethod
+    def from_headers(cls, headers, filename=None):
+        """Record of a frame with the given headers."""
+        primary = headers[0]
+        mecs = primary
+        extnames = ["PRIMARY"]
+        for header in headers[1:]:
+            extname = header.get("EXTNAME", "")
+            extnames.append(extname)
+            if extname == "MECS":
+                mecs = header
+
+        keywords = {
+            key: _json_value(primary[key]) for key in INDEX_KEYWORDS if key in primary
+        }
+        mjd = primary.get("MJD-OBS")
+        if mjd is None and "DATE-OBS" in primary:
+            try:
+                mjd = Time(primary["DATE-OBS"], scale="utc").mjd
+            except ValueError:
+                mjd = None
+        airmass = primary.get("AIRMASS")
+
+        wcs_cards = celestial_wcs_cards(primary)
+        values = {
+            card.keyword: _card_value(card)
+            for card in mecs.cards
+            if _MECS_KEYWORD.match(card.keyword)
+        }
+        dtu = {key: value for key, value in values.items() if _DTU_KEYWORD.match(key)}
+        csup = [values.get(f"CSUP{idx}", 0.0) for idx in range(1, 111)]
+        cs = [values.get(f"CS_{idx}", 0.0) for idx in range(0, 440)]
+
+        return cls(
+            filename=filename,
+            mjd=mjd,
+            airmass=airmass,
+            extnames=extnames,
+            keywords=keywords,
+            wcs_cards=wcs_cards,
+            dtu=dtu,
+            csup=csup,
+            cs=cs,
+            headers=headers,
+        )
+
+    @classmethod
+    def from_hdulist(cls, hdulist, filename=None):
+        """Record of a frame opened as a HDUList."""
+        return cls.from_headers([hdu.header for hdu in hdulist], filename=filename)
+
+    def __contains__(self, extname):
+        return extname in self.extnames
+
+    def __getitem__(self, key):
+        return self.keywords[key.upper()]
+
+    def get(self, key, default=None):
+        """Value of a keyword in INDEX_KEYWORDS."""
+        return self.keywords.get(key.upper(), default)
+
+    @property
+    def wcs(self):
+        """Celestial WCS of the primary header."""
+        if self._wcs is None:
+            self._wcs = WCS(fits.Header.fromstring(self._wcs_cards))
+        return self._wcs
+
+    def dtu_conf(self):
+        """DtuConf of the frame."""
+        return DtuConf.from_header(self._dtu)
+
+    def csu_conf(self, fov=341.5):
+        """CsuConfiguration of the frame."""
+        header = {f"CSUP{idx}": value for idx, value in enumerate(self.csup, 1)}
+        return CsuConfiguration.define_from_header(header, fov=fov)
+
+    @property
+    def headers(self):
+        """Headers of all the HDUs."""
+        if callable(self._headers):
+            # headers stored in the index, read when needed
+            self._headers = self._headers()
+        return self._headers
+
+    def to_hdulist(self):
+        """HDUList with the headers of the frame and no data."""
+        headers = self.headers
+        hdus = [fits.PrimaryHDU(header=headers[0].copy())]
+        for header in headers[1:]:
+            hdus.append(fits.ImageHDU(header=header.copy()))
+        return fits.HDUList(hdus)
+
+
+class HeaderIndex:
+    """Index of the headers of FITS frames, stored in a SQLite database
+
+    The headers of each frame are read once (only the header blocks
+    of the file) and stored, together with the metadata used by the
+    recipes: WCS, DTU configuration, CSU bar positions, MJD and
+    airmass. A frame is scanned again if its modification time or
+    size change.
+
+    The index is closed with `close`, or at the end of a with
+    statement.
+
+    Parameters
+    ----------
+    path : str
+        Name of the database file, or ':memory:'.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._records = {}
+        self.scanned = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM frames").fetchone()
+        return count
+
+    def __contains__(self, filename):
+        key = os.path.abspath(filename)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM frames WHERE filename = ?", (key,)
+            ).fetchone()
+        return row is not None
+
+    def _is_fresh(self, key, stat):
+        row = self._conn.execute(
+            "SELECT mtime, size FROM frames WHERE filename = ?", (key,)
+        ).fetchone()
+        return row is not None and row == (stat.st_mtime, stat.st_size)
+
+    def scan(self, filenames):
+        """Read and store the headers of the frames not yet indexed.
+
+        Parameters
+        ----------
+        filenames : iterable of str
+            Names of FITS files.
+
+        Returns
+        -------
+        nscanned : int
+            Number of files read.
+
+        """
+        nscanned = 0
+        with self._lock, self._conn:
+            for filename in filenames:
+                key = os.path.abspath(filename)
+                stat = os.stat(key)
+                if self._is_fresh(key, stat):
+                    continue
+                headers = read_headers(key)
+                record = FrameRecord.from_headers(headers, filename=key)
+                self._store(key, stat, record)
+                self._records.pop(key, None)
+                nscanned += 1
+        self.scanned += nscanned
+        if nscanned:
+            _logger.debug("header index %s, %d frames scanned", self.path, nscanned)
+        return nscanned
+
+    def _store(self, key, stat, record):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                stat.st_mtime,
+                stat.st_size,
+                record.mjd,
+                record.airmass,
+                json.dumps(record.extnames),
+                json.dumps(record.keywords),
+                record._wcs_cards,
+                json.dumps(record._dtu),
+                json.dumps(record.csup),
+                json.dumps(record.cs),
+            ),
+        )
+        self._conn.execute("DELETE FROM headers WHERE filename = ?", (key,))
+        self._conn.executemany(
+            "INSERT INTO headers VALUES (?, ?, ?)",
+            [
+                (key, idx, header.tostring())
+                for idx, header in enumerate(record.headers)
+            ],
+        )
+
+    def get(self, filename):
+        """Record of a frame, scanning it if needed.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the FITS file.
+
+        Returns
+        -------
+        record : FrameRecord
+
+        """
+        key = os.path.abspath(filename)
+        self.scan([key])
+        record = self._records.get(key)
+        if record is not None:
+            return record
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mjd, airmass, extnames, keywords, wcs, dtu, csup, cs"
+                " FROM frames WHERE filename = ?",
+                (key,),
+            ).fetchone()
+        mjd, airmass, extnames, keywords, wcs_cards, dtu, csup, cs = row
+        record = FrameRecord(
+            filename=key,
+            mjd=mjd,
+            airmass=airmass,
+            extnames=json.loads(extnames),
+            keywords=json.loads(keywords),
+            wcs_cards=wcs_cards,
+            dtu=json.loads(dtu),
+            csup=json.loads(csup),
+            cs=json.loads(cs),
+            headers=lambda: self._load_headers(key),
+        )
+        self._records[key] = record
+        return record
+
+    def _load_headers(self, key):
+        with self._lock:
+            texts = self._conn.execute(
+                "SELECT header FROM headers WHERE filename = ? ORDER BY hdu", (key,)
+            ).fetchall()
+        return [fits.Header.fromstring(text) for (text,) in texts]
+
+    def query(self, where="1", params=()):
+        """Names of the frames that satisfy a SQL condition.
+
+        The condition can use the columns mjd and airmass of the
+        table frames, for example 'mjd BETWEEN ? AND ?'.
+
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT filename FROM frames WHERE {where} ORDER BY mjd", params
+            ).fetchall()
+        return [filename for (filename,) in rows]
+
+    def close(self):
+        """Close the database."""
+        self._records.clear()
+        self._conn.close()
+
+
+def frame_record(frame, index=None):
+    """Metadata of a frame, without reading its data.
+
+    Parameters
+    ----------
+    frame : numina.types.dataframe.DataFrame
+        Frame, in a file or in memory.
+    index : HeaderIndex or None
+        Index of the frames in files. If None, the headers of the
+        file are read.
+
+    Returns
+    -------
+    record : FrameRecord
+
+    """
+    if getattr(frame, "frame", None) is None and frame.filename is not None:
+        if index is None:
+            filename = os.path.abspath(frame.filename)
+            return FrameRecord.from_headers(read_headers(filename), filename=filename)
+        return index.get(frame.filename)
+    return FrameRecord.from_hdulist(frame.open())
+
+
+def frame_records(frames, index=None):
+    """Metadata of a sequence of frames, scanning the files in bulk."""
+    if index is not None:
+        index.scan(
+            frame.filename
+            for frame in frames
+            if getattr(frame, "frame", None) is None and frame.filename is not None
+        )
+    return [frame_record(frame, index=index) for frame in frames]
@@ -0,0 +1,205 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Statistics of images over fixed sets of labelled pixels"""
+
+import numpy
+from scipy import interpolate
+
+
+class LabelIndex:
+    """Pixels of an image grouped by label
+
+    The pixels are sorted by label only once, so that the statistics
+    of every label in a new image require a single gather of the
+    image and one reduction per contiguous group of pixels.
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        Image of non negative integer labels.
+
+    """
+
+    def __init__(self, labels):
+        labels = numpy.asarray(labels)
+        if labels.dtype.kind not in "iu":
+            raise ValueError(f"labels must be integer, not {labels.dtype}")
+        flat = labels.ravel()
+        if flat.size > 0 and flat.min() < 0:
+            raise ValueError("labels must be non negative")
+
+        self.labels = labels
+        self.order = numpy.argsort(flat, kind="stable")
+        sorted_labels = flat[self.order]
+        nlabels = int(sorted_labels[-1]) + 1 if flat.size > 0 else 0
+        self.bounds = numpy.searchsorted(sorted_labels, numpy.arange(nlabels + 1))
+
+    @property
+    def nlabels(self):
+        return len(self.bounds) - 1
+
+    @property
+    def shape(self):
+        return self.labels.shape
+
+    def median(self, arr, mask=None):
+        """Median of the image for each label.
+
+        Parameters
+        ----------
+        arr : numpy.ndarray
+            Image, with the same shape as the labels.
+        mask : numpy.ndarray or None
+            Only the pixels where mask is 0 are used.
+
+        Returns
+        -------
+        medians : numpy.ndarray
+            Median of each label (0 if the label has no useful pixels).
+        counts : numpy.ndarray
+            Number of useful pixels of each label.
+
+        """
+        arr = numpy.asarray(arr)
+        if arr.shape != self.shape:
+            raise ValueError(f"image shape {arr.shape} != labels shape {self.shape}")
+        values = numpy.ravel(arr)[self.order]
+        if mask is not None:
+            if mask.shape != self.shape:
+                raise ValueError(
+                    f"mask shape {mask.shape} != labels shape {self.shape}"
+                )
+            useful = numpy.ravel(mask)[self.order] == 0
+
+        dtype = arr.dtype if arr.dtype.kind == "f" else float
+        medians = numpy.zeros(self.nlabels, dtype=dtype)
+        counts = numpy.zeros(self.nlabels, dtype=int)
+        for label in range(self.nlabels):
+            segment = values[self.bounds[label] : self.bounds[label + 1]]
+            if mask is not None:
+                segment = segment[useful[self.bounds[label] : self.bounds[label + 1]]]
+            counts[label] = segment.size
+            if segment.size > 0:
+                medians[label] = numpy.median(segment)
+        return medians, counts
+
+    def expand(self, values):
+        """Image with the value of each label in its pixels."""
+        return numpy.asarray(values)[self.labels]
+
+
+class TileSurface:
+    """Smooth surface fitted to the medians of tiles within quadrants
+
+    Each quadrant is divided in nside x nside tiles. The surface of a
+    quadrant is the cubic interpolation of the masked medians of the
+    tiles, placed in the tile centers, extended with the nearest tile
+    value outside the convex hull of the centers.
+
+    The tiles never change, so the pixels of the tiles are grouped
+    once (see `LabelIndex`), and the map of nearest tile of each pixel
+    is reused while the set of useful tiles of the quadrant does not
+    change.
+
+    Parameters
+    ----------
+    lim_i : list of int
+        Limits of the quadrants along the first axis, starting at 0.
+    lim_j : list of int
+        Limits of the quadrants along the second axis, starting at 0.
+    nside : int
+        Number of tiles along each axis of a quadrant.
+
+    """
+
+    def __init__(self, lim_i, lim_j, nside):
+        if nside <= 0:
+            raise ValueError(f"nside must be positive, not {nside}")
+        if lim_i[0] != 0 or lim_j[0] != 0:
+            raise ValueError("the quadrants must start at 0")
+        labels = numpy.zeros((lim_i[-1], lim_j[-1]), dtype="int32")
+        self.quadrants = []
+        label = 0
+        for i in range(len(lim_i) - 1):
+            i1, i2 = lim_i[i], lim_i[i + 1]
+            for j in range(len(lim_j) - 1):
+                j1, j2 = lim_j[j], lim_j[j + 1]
+                limi = numpy.linspace(i1, i2, nside + 1, dtype=int)
+                limj = numpy.linspace(j1, j2, nside + 1, dtype=int)
+                centers = []
+                for ii in range(nside):
+                    ii1, ii2 = limi[ii], limi[ii + 1]
+                    for jj in range(nside):
+                        jj1, jj2 = limj[jj], limj[jj + 1]
+                        labels[ii1:ii2, jj1:jj2] = label + len(centers)
+                        centers.append([(jj1 + jj2) / 2.0, (ii1 + ii2) / 2.0])
+                tiles = numpy.arange(label, label + len(centers))
+                label += len(centers)
+                self.quadrants.append(((i1, i2, j1, j2), tiles, numpy.array(centers)))
+
+        self.index = LabelIndex(labels)
+        self._nearest = [(None, None)] * len(self.quadrants)
+
+    @property
+    def shape(self):
+        return self.index.shape
+
+    def __call__(self, arr, mask):
+        """Compute the surface fitted to an image.
+
+        Parameters
+        ----------
+        arr : numpy.ndarray
+            Image; only the region covered by the quadrants is used.
+        mask : numpy.ndarray
+            Only the pixels where mask is 0 are used.
+
+        Returns
+        -------
+        surface : numpy.ndarray
+            Surface, with the same shape and type of arr (0 outside
+            the quadrants).
+
+        """
+        ni, nj = self.shape
+        medians, counts = self.index.median(arr[:ni, :nj], mask[:ni, :nj])
+
+        surface = numpy.zeros_like(arr)
+        for q, ((i1, i2, j1, j2), tiles, centers) in enumerate(self.quadrants):
+            useful = counts[tiles] > 0
+            xyfit = centers[useful]
+            zfit = medians[tiles][useful]
+            xgrid, ygrid = numpy.meshgrid(
+                numpy.arange(j1, j2, dtype=float),
+                numpy.arange(i1, i2, dtype=float),
+            )
+
+            key = useful.tobytes()
+            cached_key, nearest = self._nearest[q]
+            if cached_key != key:
+                ip = interpolate.NearestNDInterpolator(
+                    xyfit, numpy.arange(len(xyfit)), rescale=True
+                )
+                nearest = ip((xgrid, ygrid)).astype(int)
+                self._nearest[q] = (key, nearest)
+            surface_nearest = zfit[nearest]
+
+            surface_cubic = interpolate.griddata(
+                xyfit,
+                zfit,
+                (xgrid, ygrid),
+                method="cubic",
+                fill_value=-1.0e30,
+                rescale=True,
+            )
+            surface[i1:i2, j1:j2] = numpy.where(
+                surface_cubic < -1.0e29, surface_nearest, surface_cubic
+            )
+        return surface
@@ -0,0 +1,145 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Binning of images in polar coordinates"""
+
+import numpy
+
+
+def polar_coordinates(shape, center=None):
+    """Polar coordinates of the pixels of an image
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image (NAXIS2, NAXIS1).
+    center : tuple or None
+        Center (xc, yc) in FITS convention (first pixel is 1).
+        If None, the center of the image is used.
+
+    Returns
+    -------
+    r, theta : numpy.ndarray
+        Flattened arrays with the radius and the polar angle
+        (in radians, within [-pi, pi]) of each pixel.
+
+    """
+    naxis2, naxis1 = shape
+    if center is None:
+        xc = naxis1 / 2 + 0.5
+        yc = naxis2 / 2 + 0.5
+    else:
+        xc, yc = center
+
+    pixel_x = numpy.arange(1, naxis1 + 1)
+    pixel_y = numpy.arange(1, naxis2 + 1)
+    ix_array, iy_array = numpy.meshgrid(pixel_x, pixel_y)
+    dx = (ix_array - xc).ravel()
+    dy = (iy_array - yc).ravel()
+
+    r = numpy.sqrt(dx**2 + dy**2)
+    theta = numpy.arctan2(dy, dx)
+    return r, theta
+
+
+def segment_median(labels, values, nlabels):
+    """Median of values sharing the same label
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        Integer labels, in the range [0, nlabels).
+    values : numpy.ndarray
+        Values, same shape as labels.
+    nlabels : int
+        Number of labels.
+
+    Returns
+    -------
+    median : numpy.ndarray
+        Median of the values of each label, NaN for empty labels.
+        As in numpy.median, the median is NaN if any of the values
+        of the label is NaN.
+    counts : numpy.ndarray
+        Number of values of each label.
+
+    """
+    labels = numpy.asarray(labels).ravel()
+    values = numpy.asarray(values).ravel()
+
+    counts = numpy.bincount(labels, minlength=nlabels)
+    median = numpy.full(nlabels, numpy.nan)
+    if labels.size == 0:
+        return median, counts
+
+    # sort by value, and then by label with a stable sort, so that the
+    # values are sorted within each label; the stable sort of small
+    # unsigned integers is a radix sort, much faster than lexsort
+    order = numpy.argsort(values)
+    ldtype = numpy.min_scalar_type(max(nlabels - 1, 0))
+    order = order[numpy.argsort(labels[order].astype(ldtype), kind="stable")]
+    svalues = values[order]
+
+    starts = numpy.zeros(nlabels, dtype=int)
+    numpy.cumsum(counts[:-1], out=starts[1:])
+    valid = counts > 0
+    lo = starts[valid] + (counts[valid] - 1) // 2
+    hi = starts[valid] + counts[valid] // 2
+    median[valid] = 0.5 * (
+        svalues[lo].astype("float64") + svalues[hi].astype("float64")
+    )
+    # NaN values are sorted last within each label
+    last = starts[valid] + counts[valid] - 1
+    median[valid] = numpy.where(numpy.isnan(svalues[last]), numpy.nan, median[valid])
+    return median, counts
+
+
+def polar_binned_median(values, r, theta, r_bins, theta_bins, mask=None):
+    """Median of values in bins of (theta, r)
+
+    The bins are closed on the left and open on the right,
+    values outside the bins are ignored.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Values to be binned.
+    r, theta : numpy.ndarray
+        Polar coordinates of the values, same shape as values.
+    r_bins, theta_bins : numpy.ndarray
+        Bin edges in r and theta.
+    mask : numpy.ndarray or None
+        Boolean array, only values where mask is True are used.
+
+    Returns
+    -------
+    median : numpy.ndarray
+        Array of shape (ntheta, nr) with the median of each bin,
+        NaN for empty bins.
+    counts : numpy.ndarray
+        Array of shape (ntheta, nr) with the number of values in each bin.
+
+    """
+    values = numpy.asarray(values).ravel()
+    r = numpy.asarray(r).ravel()
+    theta = numpy.asarray(theta).ravel()
+
+    nbins_r = len(r_bins) - 1
+    nbins_theta = len(theta_bins) - 1
+
+    ii = numpy.searchsorted(r_bins, r, side="right") - 1
+    jj = numpy.searchsorted(theta_bins, theta, side="right") - 1
+    inside = (ii >= 0) & (ii < nbins_r) & (jj >= 0) & (jj < nbins_theta)
+    if mask is not None:
+        inside &= numpy.asarray(mask).ravel()
+
+    labels = jj[inside] * nbins_r + ii[inside]
+    median, counts = segment_median(labels, values[inside], nbins_theta * nbins_r)
+    shape = (nbins_theta, nbins_r)
+    return median.reshape(shape), counts.reshape(shape)
@@ -0,0 +1,278 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Reprojection of several layers between two WCS of the same detector"""
+
+import logging
+
+import numpy
+from astropy.wcs.utils import pixel_to_pixel
+from numina.tools.pixel_solid_angle_arcsec2 import pixel_solid_angle_arcsec2
+from reproject import reproject_interp, reproject_adaptive, reproject_exact
+from scipy.ndimage import map_coordinates
+
+from emirdrp.core.cache import LRUCache
+
+_logger = logging.getLogger(__name__)
+
+_REPROJECT_FUNCTIONS = {
+    "interp": reproject_interp,
+    "adaptive": reproject_adaptive,
+    "exact": reproject_exact,
+}
+
+
+def canonical_wcs(wcs):
+    """Copy of a celestial WCS with the reference point at (0, 0).
+
+    Two WCS of the same detector that share everything but the
+    reference point (CRVAL) map their pixels in the same way, and
+    the solid angles of their pixels are equal. Using the copy with
+    the reference point at (0, 0), the results computed for one of
+    them can be reused for the others.
+
+    """
+    wcs = wcs.deepcopy()
+    wcs.wcs.crval = [0.0, 0.0]
+    wcs.wcs.set()
+    return wcs
+
+
+def same_reference(wcs_in, wcs_out):
+    """True if two celestial WCS have the same reference point (CRVAL)."""
+    return numpy.array_equal(wcs_in.wcs.crval, wcs_out.wcs.crval)
+
+
+def distortion_signature(wcs):
+    """Hashable description of a WCS, excluding its reference point.
+
+    Parameters
+    ----------
+    wcs : astropy.wcs.WCS
+        Celestial WCS.
+
+    Returns
+    -------
+    signature : tuple
+        Projection, reference pixel, linear transformation and
+        projection parameters of the WCS.
+
+    """
+    wcs = canonical_wcs(wcs)
+    return (
+        tuple(wcs.wcs.ctype),
+        tuple(wcs.wcs.crpix.tolist()),
+        tuple(wcs.pixel_scale_matrix.ravel().tolist()),
+        tuple(sorted(wcs.wcs.get_pv())),
+        float(wcs.wcs.lonpole),
+        float(wcs.wcs.latpole),
+    )
+
+
+class ReprojectionPlan:
+    """Reprojection between two WCS, applied to any number of layers
+
+    For method 'interp', the coordinates in the input image of every
+    pixel of the output image are computed once, as reproject_interp
+    does, and each layer is then only interpolated (bilinearly) on
+    those coordinates. For methods 'adaptive' and 'exact', the layers
+    are stacked and reprojected in a single call, that computes the
+    transformation once for all of them.
+
+    When both WCS have the same reference point (CRVAL), the
+    transformation is computed with the reference point moved to
+    (0, 0) (see `canonical_wcs`), so the plan can be reused for frames
+    whose WCS differ only in CRVAL. Otherwise, the transformation is
+    computed with the WCS as they are.
+
+    Parameters
+    ----------
+    wcs_in : astropy.wcs.WCS
+        WCS of the input layers.
+    wcs_out : astropy.wcs.WCS
+        WCS of the output layers.
+    shape : tuple of int
+        Shape of the input and output layers.
+    method : str
+        Reprojection method: 'interp', 'adaptive' or 'exact'.
+
+    """
+
+    def __init__(self, wcs_in, wcs_out, shape, method="interp"):
+        if method not in _REPROJECT_FUNCTIONS:
+            raise ValueError(f"Unexpected reprojection method: {method}")
+        self.method = method
+        self.shape = tuple(shape)
+        self.canonical = same_reference(wcs_in, wcs_out)
+        if self.canonical:
+            wcs_in, wcs_out = canonical_wcs(wcs_in), canonical_wcs(wcs_out)
+        self.wcs_in = wcs_in
+        self.wcs_out = wcs_out
+        self._coords = None
+        self._reset = None
+        if method == "interp":
+            _logger.debug("computing reprojection coordinates for shape %s", shape)
+            self._compute_coordinates()
+
+    def _compute_coordinates(self):
+        # as in reproject_interp, with roundtrip_coords=True
+        pixel_out = numpy.meshgrid(
+            *[numpy.arange(size, dtype=float) for size in self.shape],
+            indexing="ij",
+            sparse=False,
+            copy=False,
+        )
+        pixel_out = [p.ravel() for p in pixel_out]
+        pixel_in = pixel_to_pixel(self.wcs_out, self.wcs_in, *pixel_out[::-1])
+        check = pixel_to_pixel(self.wcs_in, self.wcs_out, *pixel_in)
+        failed = numpy.zeros(check[0].shape, dtype=bool)
+        for value, expected in zip(check, pixel_out[::-1]):
+            failed |= numpy.abs(value - expected) > 1
+        coords = numpy.array(pixel_in[::-1])
+        coords[:, failed] = numpy.nan
+
+        # coordinates in the outer half of the border pixels are
+        # moved to their centers, coordinates beyond are undefined
+        reset = numpy.zeros(coords.shape[1], dtype=bool)
+        for axis, size in enumerate(self.shape):
+            reset |= coords[axis] < -0.5
+            reset |= coords[axis] > size - 0.5
+            coords[axis][(coords[axis] < 0) & (coords[axis] >= -0.5)] = 0
+            coords[axis][(coords[axis] < size - 0.5) & (coords[axis] >= size - 1)] = (
+                size - 1
+            )
+        self._coords = coords
+        self._reset = reset
+
+    def __call__(self, *layers):
+        """Reproject the layers.
+
+        Parameters
+        ----------
+        *layers : numpy.ndarray
+            Arrays with the shape of the plan.
+
+        Returns
+        -------
+        result : list of tuple
+            For each layer, the reprojected array and its footprint
+            (1 where the output pixel is defined, 0 elsewhere).
+
+        """
+        for layer in layers:
+            if layer.shape != self.shape:
+                raise ValueError(
+                    f"layer shape {layer.shape} != reprojection shape {self.shape}"
+                )
+
+        if self.method != "interp":
+            reproject_function = _REPROJECT_FUNCTIONS[self.method]
+            stack = numpy.stack(layers)
+            stack_out, footprint = reproject_function(
+                input_data=(stack, self.wcs_in),
+                output_projection=self.wcs_out,
+                shape_out=stack.shape,
+            )
+            return list(zip(stack_out, footprint))
+
+        result = []
+        for layer in layers:
+            if not layer.dtype.isnative:
+                layer = layer.astype(layer.dtype.newbyteorder("="))
+            if layer.dtype.kind != "f" or layer.dtype.itemsize < 4:
+                layer = layer.astype("float32")
+            layer_out = numpy.empty(self.shape)
+            values = layer_out.reshape(-1)
+            map_coordinates(
+                layer,
+                self._coords,
+                output=values,
+                order=1,
+                mode="constant",
+                cval=numpy.nan,
+            )
+            values[self._reset] = numpy.nan
+            footprint = (~numpy.isnan(layer_out)).astype(float)
+            result.append((layer_out, footprint))
+        return result
+
+
+class ReprojectionCache:
+    """Reprojection plans and pixel solid angles shared between frames
+
+    The plans between WCS with the same reference point (CRVAL) are
+    stored under the distortion signatures (see `distortion_signature`)
+    of their WCS, so a plan computed for a frame is reused for the
+    following frames of a dither sequence, whose WCS differ only in
+    CRVAL. The plans between WCS with different reference points are
+    computed every time, without storing them. The solid angles of
+    the pixels are stored under the signature of a single WCS.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of plans and of solid angle maps kept in
+        memory (a plan for a 2048x2048 image needs 64 MB).
+
+    """
+
+    def __init__(self, maxsize=2):
+        self._plans = LRUCache(maxsize)
+        self._solid_angles = LRUCache(maxsize)
+
+    @property
+    def hits(self):
+        return self._plans.hits + self._solid_angles.hits
+
+    @property
+    def misses(self):
+        return self._plans.misses + self._solid_angles.misses
+
+    def plan(self, wcs_in, wcs_out, shape, method="interp"):
+        """Reprojection plan between two WCS."""
+        if not same_reference(wcs_in, wcs_out):
+            _logger.debug("WCS with different CRVAL, the plan is not stored")
+            return ReprojectionPlan(wcs_in, wcs_out, shape, method=method)
+        key = (
+            distortion_signature(wcs_in),
+            distortion_signature(wcs_out),
+            tuple(shape),
+            method,
+        )
+        return self._plans.lookup(
+            key,
+            lambda: ReprojectionPlan(wcs_in, wcs_out, shape, method=method),
+        )
+
+    def pixel_solid_angle(self, wcs, shape, method=3, kernel_size=(11, 11)):
+        """Solid angle (arcsec**2) of every pixel of a WCS.
+
+        See numina.tools.pixel_solid_angle_arcsec2.
+
+        """
+        naxis2, naxis1 = shape
+        key = (distortion_signature(wcs), tuple(shape), method, kernel_size)
+        return self._solid_angles.lookup(
+            key,
+            lambda: pixel_solid_angle_arcsec2(
+                wcs=canonical_wcs(wcs),
+                naxis1=naxis1,
+                naxis2=naxis2,
+                method=method,
+                kernel_size=kernel_size,
+            ),
+        )
+
+    def clear(self):
+        """Remove the stored items and reset the counters."""
+        self._plans.clear()
+        self._solid_angles.clear()
+
+
+reprojection_cache = ReprojectionCache()
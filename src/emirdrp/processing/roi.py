@@ -0,0 +1,170 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Filtering of small regions of interest of an image"""
+
+import contextlib
+import time
+
+import numpy
+
+
+def reflect_indices(indices, size):
+    """Indices of an axis extended beyond its limits as mode='reflect'.
+
+    Parameters
+    ----------
+    indices : array_like
+        Integer positions, possibly outside [0, size).
+    size : int
+        Length of the axis.
+
+    Returns
+    -------
+    indices : numpy.ndarray
+        Positions within [0, size), reflecting about the edges of
+        the axis (d c b a | a b c d | d c b a), as the extension used
+        by the filters of scipy.ndimage with mode='reflect'.
+
+    """
+    period = 2 * size
+    indices = numpy.mod(indices, period)
+    return numpy.where(indices < size, indices, period - 1 - indices)
+
+
+class TileStack:
+    """Stack of equally sized regions of interest of an image
+
+    Each region (tile) is defined by the position of its first row
+    and column. The tiles are gathered from the image with a margin
+    around them, extending the image as mode='reflect' when the tile
+    is close to the borders. A filter with a symmetric footprint,
+    applied to the stack with mode='reflect' along the axes of the
+    image, gives then the same values in the core of the tiles as the
+    same filter applied to the whole image, provided that the margin
+    is not smaller than the sum of the half sizes of the filters
+    applied in sequence.
+
+    Parameters
+    ----------
+    rows, cols : array_like
+        First row and column of each tile. They can be outside of
+        the image.
+    shape : tuple of int
+        Number of rows and columns of the tiles.
+    margin : tuple of int
+        Number of rows and columns added to each side of the tiles
+        when they are gathered.
+
+    """
+
+    def __init__(self, rows, cols, shape, margin=(0, 0)):
+        self.rows = numpy.atleast_1d(numpy.asarray(rows, dtype=int))
+        self.cols = numpy.atleast_1d(numpy.asarray(cols, dtype=int))
+        if self.rows.shape != self.cols.shape:
+            raise ValueError("rows and cols must have the same length")
+        self.shape = tuple(shape)
+        self.margin = tuple(margin)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def gather(self, arr):
+        """Stack of the tiles of an image, with their margins.
+
+        Parameters
+        ----------
+        arr : numpy.ndarray
+            2D image.
+
+        Returns
+        -------
+        tiles : numpy.ndarray
+            Array of shape (ntiles, nrows + 2 * mrows, ncols + 2 * mcols)
+            with the same type as arr.
+
+        """
+        (nrows, ncols), (mrows, mcols) = self.shape, self.margin
+        offr = numpy.arange(-mrows, nrows + mrows)
+        offc = numpy.arange(-mcols, ncols + mcols)
+        idxr = reflect_indices(self.rows[:, numpy.newaxis] + offr, arr.shape[0])
+        idxc = reflect_indices(self.cols[:, numpy.newaxis] + offc, arr.shape[1])
+        return arr[idxr[:, :, numpy.newaxis], idxc[:, numpy.newaxis, :]]
+
+    def core(self, tiles):
+        """Tiles without their margins."""
+        (nrows, ncols), (mrows, mcols) = self.shape, self.margin
+        return tiles[:, mrows : mrows + nrows, mcols : mcols + ncols]
+
+    def scatter(self, tiles, shape, fill=0):
+        """Image with the values of the tiles in their positions.
+
+        Parameters
+        ----------
+        tiles : numpy.ndarray
+            Stack of tiles, with or without margins.
+        shape : tuple of int
+            Shape of the output image.
+        fill : scalar
+            Value of the pixels outside the tiles.
+
+        Returns
+        -------
+        arr : numpy.ndarray
+            Image with the type of the tiles. Overlapping tiles are
+            written in order, the parts outside the image are ignored.
+
+        """
+        if tiles.shape[1:] != self.shape:
+            tiles = self.core(tiles)
+        nrows, ncols = self.shape
+        arr = numpy.full(shape, fill, dtype=tiles.dtype)
+        for tile, row, col in zip(tiles, self.rows, self.cols):
+            r1, r2 = max(row, 0), min(row + nrows, shape[0])
+            c1, c2 = max(col, 0), min(col + ncols, shape[1])
+            if r1 < r2 and c1 < c2:
+                arr[r1:r2, c1:c2] = tile[r1 - row : r2 - row, c1 - col : c2 - col]
+        return arr
+
+
+class StageTimer:
+    """Wall-clock time spent in the stages of a computation
+
+    Use an instance as a context manager for each stage; the times of
+    stages with the same name are added.
+
+    Attributes
+    ----------
+    timings : dict
+        Time in seconds of each stage, in order of first use.
+
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+
+    @property
+    def total(self):
+        return sum(self.timings.values())
+
+    def __str__(self):
+        parts = [
+            f"{stage} {value * 1e3:.1f} ms" for stage, value in self.timings.items()
+        ]
+        parts.append(f"total {self.total * 1e3:.1f} ms")
+        return ", ".join(parts)
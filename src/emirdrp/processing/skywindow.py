@@ -0,0 +1,120 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Resident window of sky frames shared between consecutive targets"""
+
+import logging
+
+import numpy
+
+_logger = logging.getLogger(__name__)
+
+
+class SkyWindow:
+    """Resident stack of the sky frames used to compute a sliding sky
+
+    The sky of consecutive target frames is computed from sets of
+    neighbouring sky frames that differ only in a few frames. This
+    class keeps in memory the data, mask and scale of the frames of
+    the current window, so that moving the window only loads the
+    frames that enter it. The buffers of the frames that leave the
+    window are recycled for the new ones.
+
+    The scales of the frames are computed only once, and they are
+    preserved even after the frame leaves the window.
+
+    Parameters
+    ----------
+    load : callable
+        Function that, given a key, returns a tuple (data, mask, scale)
+        for that frame. If scale is None, it is computed as the median
+        of the data in the pixels where mask is 0 (or of all the
+        pixels if mask is None).
+
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self._frames = {}
+        self._free = []
+        self.scales = {}
+        self.loads = 0
+        self.reuses = 0
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def select(self, keys):
+        """Move the window to the frames in keys.
+
+        Parameters
+        ----------
+        keys : list
+            Keys of the frames in the window.
+
+        Returns
+        -------
+        data : list of numpy.ndarray
+            Data of the frames, in the same order as keys.
+        masks : list of numpy.ndarray
+            Masks of the frames, in the same order as keys.
+        scales : list of float
+            Scales of the frames, in the same order as keys.
+
+        """
+        keys = list(keys)
+        if len(set(keys)) != len(keys):
+            raise ValueError(f"repeated keys in sky window: {keys}")
+
+        for key in list(self._frames):
+            if key not in keys:
+                buff, _ = self._frames.pop(key)
+                self._free.append(buff)
+
+        for key in keys:
+            if key in self._frames:
+                self.reuses += 1
+            else:
+                self._frames[key] = self._load(key)
+                self.loads += 1
+
+        data = [self._frames[key][0] for key in keys]
+        masks = [self._frames[key][1] for key in keys]
+        scales = [self.scales[key] for key in keys]
+        return data, masks, scales
+
+    def _load(self, key):
+        _logger.debug("loading frame %s in sky window", key)
+        data, mask, scale = self.load(key)
+        buff = self._buffer(data.shape, data.dtype)
+        buff[...] = data
+        if key not in self.scales:
+            if scale is None:
+                if mask is None:
+                    scale = numpy.median(buff)
+                else:
+                    scale = numpy.median(buff[mask == 0])
+            self.scales[key] = scale
+        return buff, mask
+
+    def _buffer(self, shape, dtype):
+        while self._free:
+            buff = self._free.pop()
+            if buff.shape == shape and buff.dtype == dtype:
+                return buff
+        return numpy.empty(shape, dtype=dtype)
+
+    def clear(self):
+        """Release the frames and the scales of the window."""
+        self._frames.clear()
+        self._free.clear()
+        self.scales.clear()
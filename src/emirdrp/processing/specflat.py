@@ -0,0 +1,178 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Array kernels shared by the spectroscopic flatfield recipes"""
+
+import numpy
+
+from emirdrp.core import EMIR_NAXIS1
+from emirdrp.tools.nscan_minmax_frontiers import nscan_minmax_frontiers_array
+
+
+def safe_divide(numerator, denominator, fill_value=1.0):
+    """Divide two arrays, using fill_value where the denominator is zero.
+
+    Parameters
+    ----------
+    numerator : numpy.ndarray
+        Numerator.
+    denominator : numpy.ndarray
+        Denominator, same shape as numerator.
+    fill_value : float
+        Value of the result where the denominator is zero.
+
+    Returns
+    -------
+    result : numpy.ndarray
+        Quotient, with the same dtype as numerator.
+
+    """
+    result = numpy.full_like(numerator, fill_value)
+    numpy.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
+
+def fix_pix_borders(image2d, nreplace, sought_value, replacement_value, axis=1):
+    """Replace a few pixels at the borders of each spectrum.
+
+    Vectorized version of
+    numina.array.wavecalib.fix_pix_borders.fix_pix_borders.
+    Set to 'replacement_value' 'nreplace' pixels at the beginning (at
+    the end) of each spectrum just after (before) the spectrum value
+    changes from (to) 'sought_value', as seen from the image borders.
+    The image is modified in place.
+
+    Parameters
+    ----------
+    image2d : numpy.ndarray
+        Initial 2D image.
+    nreplace : int
+        Number of pixels to be replaced in each border.
+    sought_value : int, float, bool
+        Pixel value that indicates missing data in the spectrum.
+    replacement_value : int, float, bool
+        Pixel value to be employed in the 'nreplace' pixels.
+    axis : int
+        Axis along which the spectra are arranged (1 for rows,
+        0 for columns).
+
+    Returns
+    -------
+    image2d : numpy.ndarray
+        Final 2D image.
+
+    """
+    if axis not in [0, 1]:
+        raise ValueError(f"Unexpected axis={axis}")
+
+    work = image2d if axis == 1 else image2d.T
+    naxis1 = work.shape[1]
+
+    useful = work != sought_value
+    has_data = useful.any(axis=1)
+    jborder_min = numpy.argmax(useful, axis=1)
+    jborder_max = naxis1 - 1 - numpy.argmax(useful[:, ::-1], axis=1)
+
+    jj = numpy.arange(naxis1)
+    left = (jj >= jborder_min[:, None]) & (jj < jborder_min[:, None] + nreplace)
+    right = (jj <= jborder_max[:, None]) & (jj > jborder_max[:, None] - nreplace)
+    work[(left | right) & has_data[:, None]] = replacement_value
+
+    return image2d
+
+
+def frontier_scan_limits(list_frontiers, naxis1=EMIR_NAXIS1):
+    """Scan limits between the frontiers of a slitlet for every column.
+
+    Parameters
+    ----------
+    list_frontiers : list of numpy.polynomial.Polynomial instances
+        Lower and upper frontiers of the slitlet.
+    naxis1 : int
+        Number of columns.
+
+    Returns
+    -------
+    n1, n2 : numpy.ndarray
+        Minimum and maximum useful scans (ranging from 1 to NAXIS2)
+        of each column.
+
+    """
+    xchannel = numpy.arange(1, naxis1 + 1)
+    y0_lower = list_frontiers[0](xchannel)
+    y0_upper = list_frontiers[1](xchannel)
+    return nscan_minmax_frontiers_array(
+        y0_frontier_lower=y0_lower, y0_frontier_upper=y0_upper, resize=True
+    )
+
+
+def insert_slitlet(
+    image2d,
+    slitlet2d,
+    n1,
+    n2,
+    bb_ns1_orig,
+    same_slitlet_below=False,
+    same_slitlet_above=False,
+):
+    """Insert the region of a slitlet between its frontiers in an image.
+
+    For each column j, the scans from n1[j] to n2[j] of image2d
+    are replaced by the corresponding values in slitlet2d. The
+    image is modified in place.
+
+    Parameters
+    ----------
+    image2d : numpy.ndarray
+        Full 2D image.
+    slitlet2d : numpy.ndarray
+        Slitlet image, starting at scan bb_ns1_orig of image2d.
+    n1, n2 : numpy.ndarray
+        Minimum and maximum useful scans (ranging from 1 to NAXIS2)
+        of each column, as returned by frontier_scan_limits().
+    bb_ns1_orig : int
+        First scan (from 1 to NAXIS2) of the slitlet in image2d.
+    same_slitlet_below : bool
+        If False, set to 1.0 three scans above the lower frontier.
+    same_slitlet_above : bool
+        If False, set to 1.0 five scans below the upper frontier.
+
+    Returns
+    -------
+    image2d : numpy.ndarray
+        Updated 2D image.
+
+    """
+    naxis2 = image2d.shape[0]
+    naxis2_slitlet2d, naxis1_slitlet2d = slitlet2d.shape
+    n1 = numpy.asarray(n1)[:naxis1_slitlet2d]
+    n2 = numpy.asarray(n2)[:naxis1_slitlet2d]
+
+    # band of image2d covered by the slitlet (array coordinates)
+    i0 = bb_ns1_orig - 1
+    band = image2d[i0 : i0 + naxis2_slitlet2d, :naxis1_slitlet2d]
+    # scans (from 1 to NAXIS2) of the band
+    nscan = numpy.arange(bb_ns1_orig, bb_ns1_orig + band.shape[0])[:, None]
+    inside = (nscan >= n1) & (nscan <= n2)
+    band[inside] = slitlet2d[: band.shape[0]][inside]
+
+    # force to 1.0 region around frontiers
+    cols = numpy.arange(naxis1_slitlet2d)
+    if not same_slitlet_below:
+        for k in range(3):
+            rows = n1 - 1 + k
+            valid = rows < naxis2
+            image2d[rows[valid], cols[valid]] = 1
+    if not same_slitlet_above:
+        valid = n2 >= 5
+        for k in range(1, 6):
+            rows = n2 - k
+            image2d[rows[valid], cols[valid]] = 1
+
+    return image2d
@@ -8,15 +8,16 @@
 #
 
 import argparse
+import concurrent.futures
 from astropy.io import fits
 from datetime import datetime
 import logging
 import numpy as np
+import os
 import sys
 
 from numina.array.display.logging_from_debugplot import logging_from_debugplot
 from numina.array.wavecalib.apply_integer_offsets import apply_integer_offsets
-from numina.array.wavecalib.fix_pix_borders import find_pix_borders
 from numina.array.wavecalib.resample import resample_image2d_flux
 from numina.frame.utils import copy_img
 from numina.tools.arg_file_is_new import arg_file_is_new
@@ -24,6 +25,7 @@ from numina.tools.arg_file_is_new import arg_file_is_new
 from emirdrp.instrument.components.dtu import DtuConf
 from emirdrp.products import RectWaveCoeff
 
+from .rectmaps import RectWaveMapCache
 from .set_wv_parameters import set_wv_parameters
 from .slitlet2d import Slitlet2D
 
@@ -31,6 +33,75 @@ from numina.array.display.pause_debugplot import DEBUGPLOT_CODES
 from emirdrp.core import EMIR_NBARS
 from emirdrp.core import EMIR_NPIXPERSLIT_RECTIFIED
 
+EXECUTOR_KINDS = ["serial", "thread", "process"]
+
+
+def rectwv_slitlet(slt, slitlet2d, args_resampling, wv_parameters, rectwv_map=None):
+    """Rectify and wavelength calibrate a single slitlet.
+
+    Parameters
+    ----------
+    slt : Slitlet2D instance
+        Slitlet to be processed.
+    slitlet2d : numpy array
+        Image of the (distorted) slitlet, as returned by
+        slt.extract_slitlet2d().
+    args_resampling : int
+        1: nearest neighbour, 2: flux preserving interpolation.
+    wv_parameters : dict
+        Wavelength calibration parameters, as returned by
+        set_wv_parameters().
+    rectwv_map : RectWaveMap instance or None
+        If not None, precompiled rectification and wavelength
+        calibration map of the slitlet, employed instead of
+        slt.rectify() and resample_image2d_flux().
+
+    Returns
+    -------
+    slitlet2d_rect_wv : numpy array
+        Useful rows of the rectified and wavelength calibrated slitlet,
+        to be stored in the rows slt.iminslt to slt.imaxslt of the
+        full 2d rectified image.
+    jminslt, jmaxslt : int
+        Minimum and maximum useful channel (from 1 to NAXIS1) of the
+        rectified and wavelength calibrated slitlet. Both values are 0
+        if there are no useful channels.
+
+    """
+
+    if rectwv_map is not None:
+        slitlet2d_rect_wv = rectwv_map.apply(slitlet2d)
+    else:
+        # rectify slitlet
+        slitlet2d_rect = slt.rectify(slitlet2d, resampling=args_resampling)
+
+        # wavelength calibration of the rectifed slitlet
+        slitlet2d_rect_wv = resample_image2d_flux(
+            image2d_orig=slitlet2d_rect,
+            naxis1=wv_parameters["naxis1_enlarged"],
+            cdelt1=wv_parameters["cdelt1_enlarged"],
+            crval1=wv_parameters["crval1_enlarged"],
+            crpix1=wv_parameters["crpix1_enlarged"],
+            coeff=slt.wpoly,
+        )
+
+    # minimum and maximum scan in the rectified slitlet
+    # (in pixels, from 1 to NAXIS2)
+    ii1 = slt.min_row_rectified
+    ii2 = slt.max_row_rectified + 1
+
+    # useful channel region, considering all the spectra of the slitlet
+    # (the first and last channel with a nonzero value in any spectrum)
+    useful = np.any(slitlet2d_rect_wv[ii1 : (ii2 + 1), :] != 0, axis=0)
+    if np.any(useful):
+        jminslt = int(np.argmax(useful)) + 1
+        jmaxslt = len(useful) - int(np.argmax(useful[::-1]))
+    else:
+        jminslt = 0
+        jmaxslt = 0
+
+    return slitlet2d_rect_wv[ii1:ii2, :], jminslt, jmaxslt
+
 
 def apply_rectwv_coeff(
     reduced_image,
@@ -38,6 +109,9 @@ def apply_rectwv_coeff(
     args_resampling=2,
     args_ignore_dtu_configuration=True,
     debugplot=0,
+    executor="serial",
+    max_workers=None,
+    rectwv_maps=None,
 ):
     """Compute rectification and wavelength calibration coefficients.
 
@@ -56,6 +130,19 @@ def apply_rectwv_coeff(
     debugplot : int
         Debugging level for messages and plots. For details see
         'numina.array.display.pause_debugplot.py'.
+    executor : str
+        How the slitlets are processed: 'serial' (one after another),
+        'thread' (pool of threads) or 'process' (pool of processes).
+        The slitlets are always processed serially when debugplot
+        is not zero.
+    max_workers : int or None
+        Maximum number of workers of the pool. If None or 0, the default
+        value of concurrent.futures is employed.
+    rectwv_maps : RectWaveMapCache instance or None
+        If not None, cache of precompiled rectification and wavelength
+        calibration maps. The maps are reused by subsequent calls with
+        the same RectWaveCoeff instance. Ignored when debugplot is not
+        zero.
 
     Returns
     -------
@@ -132,101 +219,107 @@ def apply_rectwv_coeff(
     logger.info("Applying rectification and wavelength calibration")
     logger.info("RectWaveCoeff uuid={}".format(rectwv_coeff.uuid))
 
-    cout = "0"
-    for islitlet in range(1, EMIR_NBARS + 1):
-
-        if islitlet in list_valid_islitlets:
-
-            # define Slitlet2D object
-            slt = Slitlet2D(
-                islitlet=islitlet, rectwv_coeff=rectwv_coeff, debugplot=debugplot
-            )
-
-            # extract (distorted) slitlet from the initial image
-            slitlet2d = slt.extract_slitlet2d(image2d)
-
-            # rectify slitlet
-            slitlet2d_rect = slt.rectify(slitlet2d, resampling=args_resampling)
-
-            # wavelength calibration of the rectifed slitlet
-            slitlet2d_rect_wv = resample_image2d_flux(
-                image2d_orig=slitlet2d_rect,
-                naxis1=naxis1_enlarged,
-                cdelt1=cdelt1_enlarged,
-                crval1=crval1_enlarged,
-                crpix1=crpix1_enlarged,
-                coeff=slt.wpoly,
-            )
-
-            # minimum and maximum useful row in the full 2d rectified image
-            # (starting from 0)
-            i1 = slt.iminslt - 1
-            i2 = slt.imaxslt
-
-            # minimum and maximum scan in the rectified slitlet
-            # (in pixels, from 1 to NAXIS2)
-            ii1 = slt.min_row_rectified
-            ii2 = slt.max_row_rectified + 1
-
-            # save rectified slitlet in its corresponding location within
-            # the full 2d rectified image
-            image2d_rectwv[i1:i2, :] = slitlet2d_rect_wv[ii1:ii2, :]
-
-            # include scan range in FITS header
-            header["imnslt" + str(islitlet).zfill(2)] = (
-                slt.iminslt,
-                "minimum Y pixel of useful slitlet region",
+    if executor not in EXECUTOR_KINDS:
+        raise ValueError("Unexpected executor=" + str(executor))
+    if executor != "serial" and debugplot != 0:
+        logger.info("debugplot != 0: processing slitlets serially")
+        executor = "serial"
+    if debugplot != 0:
+        rectwv_maps = None
+
+    # define Slitlet2D objects and extract (distorted) slitlets from the
+    # initial image
+    list_slitlets = []
+    for islitlet in list_valid_islitlets:
+        slt = Slitlet2D(
+            islitlet=islitlet, rectwv_coeff=rectwv_coeff, debugplot=debugplot
+        )
+        slitlet2d = slt.extract_slitlet2d(image2d)
+        if rectwv_maps is not None:
+            rectwv_map = rectwv_maps.get(
+                rectwv_coeff, slt, args_resampling, wv_parameters
             )
-            header["imxslt" + str(islitlet).zfill(2)] = (
-                slt.imaxslt,
-                "maximum Y pixel of useful slitlet region",
+        else:
+            rectwv_map = None
+        list_slitlets.append((slt, slitlet2d, rectwv_map))
+    if rectwv_maps is not None:
+        logger.info(
+            "Rectification maps: {} hits, {} misses".format(
+                rectwv_maps.hits, rectwv_maps.misses
             )
+        )
 
-            # determine useful channel region in each spectrum and include
-            # that information in FITS header
-            jminslt = []
-            jmaxslt = []
-            for idum in range(ii1, ii2 + 1):
-                jminmax = find_pix_borders(slitlet2d_rect_wv[idum, :], sought_value=0)
-                if jminmax != (-1, naxis1_enlarged):
-                    jminslt.append(jminmax[0])
-                    jmaxslt.append(jminmax[1])
-            if len(jminslt) > 0:
-                slt.jminslt = min(jminslt) + 1
-                slt.jmaxslt = max(jmaxslt) + 1
-            header["jmnslt" + str(islitlet).zfill(2)] = (
-                slt.jminslt,
-                "minimum X pixel of useful slitlet region",
-            )
-            header["jmxslt" + str(islitlet).zfill(2)] = (
-                slt.jmaxslt,
-                "maximum X pixel of useful slitlet region",
+    # each slitlet is saved in its own band of the full 2d rectified image
+    # as soon as it is available; the useful channel region of each
+    # slitlet is kept to update the header afterwards
+    dict_jminmax = {}
+
+    def store_slitlet(slt, result):
+        slitlet2d_rect_wv, jminslt, jmaxslt = result
+        # minimum and maximum useful row in the full 2d rectified image
+        # (starting from 0)
+        i1 = slt.iminslt - 1
+        i2 = slt.imaxslt
+        image2d_rectwv[i1:i2, :] = slitlet2d_rect_wv
+        dict_jminmax[slt.islitlet] = (jminslt, jmaxslt)
+
+    if executor == "serial":
+        for slt, slitlet2d, rectwv_map in list_slitlets:
+            result = rectwv_slitlet(
+                slt, slitlet2d, args_resampling, wv_parameters, rectwv_map
             )
+            store_slitlet(slt, result)
+    else:
+        if executor == "thread":
+            pool_class = concurrent.futures.ThreadPoolExecutor
+        else:
+            pool_class = concurrent.futures.ProcessPoolExecutor
+        logger.info("Processing slitlets with executor={}".format(executor))
+        with pool_class(max_workers=max_workers or None) as pool:
+            futures = {}
+            for slt, slitlet2d, rectwv_map in list_slitlets:
+                future = pool.submit(
+                    rectwv_slitlet,
+                    slt,
+                    slitlet2d,
+                    args_resampling,
+                    wv_parameters,
+                    rectwv_map,
+                )
+                futures[future] = slt
+            for future in concurrent.futures.as_completed(futures):
+                store_slitlet(futures[future], future.result())
+
+    # include scan and channel range in FITS header, in slitlet order
+    cout = "0"
+    for islitlet in range(1, EMIR_NBARS + 1):
 
+        if islitlet in dict_jminmax:
+            iminslt = (islitlet - 1) * EMIR_NPIXPERSLIT_RECTIFIED + 1
+            imaxslt = islitlet * EMIR_NPIXPERSLIT_RECTIFIED
+            jminslt, jmaxslt = dict_jminmax[islitlet]
             cout += "."
-
         else:
-
-            # include scan and channel range in FITS header
-            header["imnslt" + str(islitlet).zfill(2)] = (
-                0,
-                "minimum Y pixel of useful slitlet region",
-            )
-            header["imxslt" + str(islitlet).zfill(2)] = (
-                0,
-                "maximum Y pixel of useful slitlet region",
-            )
-            header["jmnslt" + str(islitlet).zfill(2)] = (
-                0,
-                "minimum X pixel of useful slitlet region",
-            )
-            header["jmxslt" + str(islitlet).zfill(2)] = (
-                0,
-                "maximum X pixel of useful slitlet region",
-            )
-
+            iminslt = imaxslt = jminslt = jmaxslt = 0
             cout += "i"
 
+        header["imnslt" + str(islitlet).zfill(2)] = (
+            iminslt,
+            "minimum Y pixel of useful slitlet region",
+        )
+        header["imxslt" + str(islitlet).zfill(2)] = (
+            imaxslt,
+            "maximum Y pixel of useful slitlet region",
+        )
+        header["jmnslt" + str(islitlet).zfill(2)] = (
+            jminslt,
+            "minimum X pixel of useful slitlet region",
+        )
+        header["jmxslt" + str(islitlet).zfill(2)] = (
+            jmaxslt,
+            "maximum X pixel of useful slitlet region",
+        )
+
         if islitlet % 10 == 0:
             if cout != "i":
                 cout = str(islitlet // 10)
@@ -340,6 +433,25 @@ def main(args=None):
         "transformation and input image",
         action="store_true",
     )
+    parser.add_argument(
+        "--executor",
+        help="Process the slitlets serially (default) or using a pool "
+        "of threads or processes",
+        default="serial",
+        choices=EXECUTOR_KINDS,
+    )
+    parser.add_argument(
+        "--max_workers",
+        help="Maximum number of workers of the pool (default=None)",
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "--cache_maps",
+        help="Store (and reuse) the precompiled rectification maps "
+        "in the directory of the JSON file",
+        action="store_true",
+    )
     parser.add_argument(
         "--debugplot",
         help="Integer indicating plotting & debugging options" " (default=0)",
@@ -364,6 +476,14 @@ def main(args=None):
     rectwv_coeff.global_integer_offset_x_pix += args.delta_global_integer_offset_x_pix
     rectwv_coeff.global_integer_offset_y_pix += args.delta_global_integer_offset_y_pix
 
+    if args.cache_maps:
+        rectwv_maps = RectWaveMapCache(
+            maxsize=EMIR_NBARS,
+            directory=os.path.dirname(os.path.abspath(args.rectwv_coeff.name)),
+        )
+    else:
+        rectwv_maps = None
+
     # generate HDUList object
     # read FITS image and its corresponding header
     hdulist = fits.open(args.fitsfile)
@@ -375,6 +495,9 @@ def main(args=None):
         args_resampling=args.resampling,
         args_ignore_dtu_configuration=args.ignore_dtu_configuration,
         debugplot=args.debugplot,
+        executor=args.executor,
+        max_workers=args.max_workers,
+        rectwv_maps=rectwv_maps,
     )
 
     # save result
@@ -0,0 +1,357 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Precompiled rectification and wavelength calibration maps"""
+
+import logging
+import os
+
+import numpy as np
+from numpy.polynomial.polynomial import polyval
+from scipy import sparse
+
+from numina.array.distortion import fmap
+from numina.array.distortion import order_fmap
+from numina.array.interpolation import SteffenInterpolator
+from numina.array.wavecalib.resample import map_borders
+
+from emirdrp.core.cache import LRUCache
+
+_logger = logging.getLogger(__name__)
+
+
+def _overlap_area(px, py, x0, y0):
+    """Area of the overlap between quadrilaterals and unit squares.
+
+    The area is computed applying Green's theorem to the function
+    F(x, y) = clip(x, x0, x0 + 1) - x0 (restricted to y0 <= y <= y0 + 1),
+    integrated along the edges of each quadrilateral.
+
+    Parameters
+    ----------
+    px, py : numpy array
+        Arrays of shape (n, 4) with the vertices of the quadrilaterals,
+        sorted in anticlockwise order.
+    x0, y0 : numpy array
+        Arrays of shape (n,) with the lower left corner of the squares.
+
+    Returns
+    -------
+    area : numpy array
+        Overlapping area of each quadrilateral and square.
+
+    """
+
+    x1 = x0 + 1
+    y1 = y0 + 1
+    area = np.zeros(px.shape[0])
+    for k in range(4):
+        xa = px[:, k]
+        ya = py[:, k]
+        dx = px[:, (k + 1) % 4] - xa
+        dy = py[:, (k + 1) % 4] - ya
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ty0 = (y0 - ya) / dy
+            ty1 = (y1 - ya) / dy
+            tx0 = (x0 - xa) / dx
+            tx1 = (x1 - xa) / dx
+        # range of the edge parameter t within y0 <= y <= y1
+        tlo = np.where(dy == 0, 0, np.clip(np.minimum(ty0, ty1), 0, 1))
+        thi = np.where(dy == 0, 0, np.clip(np.maximum(ty0, ty1), 0, 1))
+        # the integrand is linear between the crossings with x0 and x1
+        tx0 = np.clip(np.where(np.isfinite(tx0), tx0, tlo), tlo, thi)
+        tx1 = np.clip(np.where(np.isfinite(tx1), tx1, tlo), tlo, thi)
+        tbreak = [tlo, np.minimum(tx0, tx1), np.maximum(tx0, tx1), thi]
+        for j in range(3):
+            tmid = 0.5 * (tbreak[j] + tbreak[j + 1])
+            xmid = xa + dx * tmid
+            area += (np.clip(xmid, x0, x1) - x0) * dy * (tbreak[j + 1] - tbreak[j])
+    return area
+
+
+def rectification_matrix(shape, aij, bij, resampling):
+    """Sparse matrix equivalent to numina.array.distortion.rectify2d.
+
+    The rectified image is obtained as the product of the returned
+    matrix and the flattened original image. The output image has
+    the same shape as the original one.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape (naxis2, naxis1) of the original image.
+    aij : numpy array
+        1D array with the coefficients a_ij of the transformation.
+    bij : numpy array
+        1D array with the coefficients b_ij of the transformation.
+    resampling : int
+        1: nearest neighbour, 2: flux preserving interpolation.
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix
+        Matrix of shape (naxis2 * naxis1, naxis2 * naxis1).
+
+    """
+
+    naxis2, naxis1 = shape
+    npix = naxis2 * naxis1
+    aij = np.asarray(aij, dtype=float)
+    bij = np.asarray(bij, dtype=float)
+    if len(aij) != len(bij):
+        raise ValueError("aij and bij lengths are different!")
+    order = order_fmap(len(aij))
+
+    # pixel coordinates (rectified image)
+    jj, ii = np.meshgrid(np.arange(naxis1, dtype=float), np.arange(naxis2, dtype=float))
+    jj = jj.ravel()
+    ii = ii.ravel()
+
+    if resampling == 1:
+        xxx, yyy = fmap(order, aij, bij, jj, ii)
+        ixxx = np.rint(xxx).astype(int)
+        iyyy = np.rint(yyy).astype(int)
+        lok = (ixxx >= 0) & (ixxx < naxis1) & (iyyy >= 0) & (iyyy < naxis2)
+        rows = np.arange(npix)[lok]
+        cols = iyyy[lok] * naxis1 + ixxx[lok]
+        weights = np.ones(len(rows))
+    elif resampling == 2:
+        # coordinates (original image) of the four corners, sorted in
+        # anticlockwise order, of every pixel
+        cx = jj[:, np.newaxis] + np.array([-0.5, 0.5, 0.5, -0.5])
+        cy = ii[:, np.newaxis] + np.array([-0.5, -0.5, 0.5, 0.5])
+        u, v = fmap(order, aij, bij, cx.ravel(), cy.ravel())
+        u = u.reshape(-1, 4)
+        v = v.reshape(-1, 4)
+        # range of original pixels covered by every rectified pixel
+        kx0 = np.floor(u.min(axis=1) + 0.5).astype(int)
+        kx1 = np.floor(u.max(axis=1) + 0.5).astype(int)
+        ky0 = np.floor(v.min(axis=1) + 0.5).astype(int)
+        ky1 = np.floor(v.max(axis=1) + 0.5).astype(int)
+        list_rows = []
+        list_cols = []
+        list_weights = []
+        for iy in range(int(np.max(ky1 - ky0, initial=0)) + 1):
+            for ix in range(int(np.max(kx1 - kx0, initial=0)) + 1):
+                kx = kx0 + ix
+                ky = ky0 + iy
+                lok = (kx <= kx1) & (ky <= ky1)
+                lok &= (kx >= 0) & (kx < naxis1) & (ky >= 0) & (ky < naxis2)
+                area = _overlap_area(u[lok], v[lok], kx[lok] - 0.5, ky[lok] - 0.5)
+                nonzero = area != 0
+                list_rows.append(np.flatnonzero(lok)[nonzero])
+                list_cols.append((ky[lok] * naxis1 + kx[lok])[nonzero])
+                list_weights.append(area[nonzero])
+        rows = np.concatenate(list_rows)
+        cols = np.concatenate(list_cols)
+        weights = np.concatenate(list_weights)
+    else:
+        raise ValueError("Unexpected resampling value=" + str(resampling))
+
+    return sparse.csr_matrix((weights, (rows, cols)), shape=(npix, npix))
+
+
+def resample_flux_borders(image2d, old_wl_borders, new_borders):
+    """Flux preserving resampling using precomputed pixel borders.
+
+    Equivalent to numina.array.wavecalib.resample.resample_image2d_flux,
+    with the wavelength of the pixel borders already evaluated.
+
+    Parameters
+    ----------
+    image2d : numpy array
+        2D image to be resampled.
+    old_wl_borders : numpy array
+        Wavelength of the borders of the pixels of the original image.
+    new_borders : numpy array
+        Wavelength of the borders of the pixels of the resampled image.
+
+    Returns
+    -------
+    image2d_resampled : numpy array
+        Wavelength calibrated 2D image.
+
+    """
+
+    nscan, nchan = image2d.shape
+    accum_flux = np.empty((nscan, nchan + 1))
+    accum_flux[:, 1:] = np.cumsum(image2d, axis=1)
+    accum_flux[:, 0] = 0.0
+    image2d_resampled = np.zeros((nscan, len(new_borders) - 1))
+    for iscan in range(nscan):
+        interpolator = SteffenInterpolator(
+            old_wl_borders, accum_flux[iscan], extrapolate="border"
+        )
+        fl_borders = interpolator(new_borders)
+        image2d_resampled[iscan] = fl_borders[1:] - fl_borders[:-1]
+    return image2d_resampled
+
+
+class RectWaveMap:
+    """Precompiled rectification and wavelength calibration of a slitlet.
+
+    The rectification is stored as a sparse matrix, so that it reduces
+    to a matrix-vector product. The flux preserving wavelength
+    calibration depends on the data (the cumulative flux is
+    interpolated with a monotonic Steffen interpolator), so only the
+    wavelength of the pixel borders is stored.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.csr_matrix
+        Rectification matrix, as returned by rectification_matrix().
+    shape : tuple
+        Shape (naxis2, naxis1) of the slitlet image.
+    old_wl_borders : numpy array
+        Wavelength of the borders of the pixels of the rectified slitlet.
+    new_borders : numpy array
+        Wavelength of the borders of the pixels of the wavelength
+        calibrated slitlet.
+
+    """
+
+    def __init__(self, matrix, shape, old_wl_borders, new_borders):
+        self.matrix = matrix
+        self.shape = tuple(shape)
+        self.old_wl_borders = old_wl_borders
+        self.new_borders = new_borders
+
+    @classmethod
+    def from_slitlet(cls, slt, resampling, wv_parameters):
+        """Compile the map of a Slitlet2D instance.
+
+        Parameters
+        ----------
+        slt : Slitlet2D instance
+            Slitlet.
+        resampling : int
+            1: nearest neighbour, 2: flux preserving interpolation.
+        wv_parameters : dict
+            Wavelength calibration parameters, as returned by
+            set_wv_parameters().
+
+        Returns
+        -------
+        rectwv_map : RectWaveMap instance
+            Compiled map.
+
+        """
+        naxis1 = slt.bb_nc2_orig - slt.bb_nc1_orig + 1
+        naxis2 = slt.bb_ns2_orig - slt.bb_ns1_orig + 1
+        matrix = rectification_matrix(
+            (naxis2, naxis1), slt.ttd_aij, slt.ttd_bij, resampling
+        )
+        # same pixel borders as in resample_image2d_flux()
+        old_x_borders = np.arange(-0.5, naxis1)
+        old_x_borders += wv_parameters["crpix1_enlarged"]
+        old_wl_borders = polyval(old_x_borders, slt.wpoly)
+        new_x = np.arange(wv_parameters["naxis1_enlarged"])
+        new_wl = (
+            wv_parameters["crval1_enlarged"] + wv_parameters["cdelt1_enlarged"] * new_x
+        )
+        new_borders = map_borders(new_wl)
+        return cls(matrix, (naxis2, naxis1), old_wl_borders, new_borders)
+
+    def rectify(self, slitlet2d):
+        """Rectify a slitlet image."""
+        if slitlet2d.shape != self.shape:
+            raise ValueError("Unexpected slitlet2d shape")
+        return (self.matrix @ slitlet2d.ravel()).reshape(self.shape)
+
+    def apply(self, slitlet2d):
+        """Rectify and wavelength calibrate a slitlet image."""
+        return resample_flux_borders(
+            self.rectify(slitlet2d), self.old_wl_borders, self.new_borders
+        )
+
+    def save(self, filename):
+        """Save the map in a .npz file."""
+        np.savez(
+            filename,
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            shape=self.shape,
+            old_wl_borders=self.old_wl_borders,
+            new_borders=self.new_borders,
+        )
+
+    @classmethod
+    def load(cls, filename):
+        """Load a map from a .npz file created with save()."""
+        with np.load(filename) as npz:
+            shape = tuple(int(n) for n in npz["shape"])
+            npix = shape[0] * shape[1]
+            matrix = sparse.csr_matrix(
+                (npz["data"], npz["indices"], npz["indptr"]), shape=(npix, npix)
+            )
+            return cls(matrix, shape, npz["old_wl_borders"], npz["new_borders"])
+
+
+class RectWaveMapCache(LRUCache):
+    """LRU cache of RectWaveMap instances.
+
+    The maps are identified by the uuid of the RectWaveCoeff instance,
+    the slitlet number and the resampling method.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of maps kept in memory. The least recently
+        used map is discarded when the limit is reached.
+    directory : str or None
+        If not None, the maps are also stored in (and read from)
+        .npz files in this directory.
+
+    """
+
+    def __init__(self, maxsize=128, directory=None):
+        super().__init__(maxsize)
+        self.directory = directory
+
+    def filename(self, uuid, islitlet, resampling):
+        """Name of the .npz file of a map."""
+        basename = f"rectwv_map_{uuid}_{islitlet:02d}_{resampling}.npz"
+        return os.path.join(self.directory, basename)
+
+    def get(self, rectwv_coeff, slt, resampling, wv_parameters):
+        """Return the map of a slitlet, compiling it if necessary.
+
+        Parameters
+        ----------
+        rectwv_coeff : RectWaveCoeff instance
+            Rectification and wavelength calibration coefficients.
+        slt : Slitlet2D instance
+            Slitlet, created from rectwv_coeff.
+        resampling : int
+            1: nearest neighbour, 2: flux preserving interpolation.
+        wv_parameters : dict
+            Wavelength calibration parameters, as returned by
+            set_wv_parameters().
+
+        Returns
+        -------
+        rectwv_map : RectWaveMap instance
+            Compiled map.
+
+        """
+        key = (rectwv_coeff.uuid, slt.islitlet, resampling)
+
+        def compile_map():
+            if self.directory is not None:
+                filename = self.filename(*key)
+                if os.path.exists(filename):
+                    _logger.debug("loading rectification map from %s", filename)
+                    return RectWaveMap.load(filename)
+            rectwv_map = RectWaveMap.from_slitlet(slt, resampling, wv_parameters)
+            if self.directory is not None:
+                rectwv_map.save(self.filename(*key))
+            return rectwv_map
+
+        return self.lookup(key, compile_map)
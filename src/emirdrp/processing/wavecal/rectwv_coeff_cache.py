@@ -0,0 +1,134 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Cache of RectWaveCoeff instances computed for a CSU configuration"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+from emirdrp.core.cache import LRUCache
+from emirdrp.products import RectWaveCoeff
+
+_logger = logging.getLogger(__name__)
+
+
+class RectWaveCoeffCache(LRUCache):
+    """Cache of the RectWaveCoeff instances synthesized from a library
+
+    The RectWaveCoeff computed from a MasterRectWave depends only on
+    the library, the CSU configuration and the DTU configuration of
+    the image. The instances are stored under a key derived from
+    those three items, in memory (keeping the most recently used
+    ones) and, optionally, as JSON files in a cache directory, that
+    can be shared between processes.
+
+    Each call to `get` returns an independent copy, with a new uuid,
+    so that the returned instance can be modified (for example, to
+    set the global integer offsets) without changing the cache.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of instances kept in memory.
+
+    """
+
+    def __init__(self, maxsize=8):
+        super().__init__(maxsize)
+
+    @staticmethod
+    def key(master_rectwv, csu_conf, dtu_conf):
+        """Key of the RectWaveCoeff of a given configuration.
+
+        Parameters
+        ----------
+        master_rectwv : MasterRectWave instance
+            Rectification and wavelength calibration library.
+        csu_conf : CsuConfiguration instance
+            CSU configuration of the image.
+        dtu_conf : DtuConf instance
+            DTU configuration of the image.
+
+        Returns
+        -------
+        key : str
+            Hexadecimal digest.
+
+        """
+        dtu_info = json.dumps(dtu_conf.outdict(), sort_keys=True)
+        string = f"{master_rectwv.uuid}:{csu_conf.csuhash()}:{dtu_info}"
+        return hashlib.md5(string.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def filename(key, cache_dir):
+        """Name of the JSON file of a key in the cache directory."""
+        return os.path.join(cache_dir, f"rectwv_coeff_{key}.json")
+
+    def get(self, key, cache_dir=None):
+        """Copy of the RectWaveCoeff stored under key.
+
+        Parameters
+        ----------
+        key : str
+            Key of the instance (see `key`).
+        cache_dir : str or None
+            Directory with JSON files of previously stored instances.
+
+        Returns
+        -------
+        rectwv_coeff : RectWaveCoeff instance or None
+            Copy of the stored instance, or None if the key is not in
+            the cache.
+
+        """
+        if key not in self and cache_dir is not None:
+            fname = self.filename(key, cache_dir)
+            if os.path.isfile(fname):
+                _logger.debug("loading RectWaveCoeff from %s", fname)
+                self.store(key, RectWaveCoeff._datatype_load(fname))
+        rectwv_coeff = self.lookup(key)
+        if rectwv_coeff is None:
+            return None
+
+        result = copy.deepcopy(rectwv_coeff)
+        result.uuid = str(uuid.uuid1())
+        return result
+
+    def put(self, key, rectwv_coeff, cache_dir=None):
+        """Store a copy of a RectWaveCoeff under key.
+
+        Parameters
+        ----------
+        key : str
+            Key of the instance (see `key`).
+        rectwv_coeff : RectWaveCoeff instance
+            Instance to be stored.
+        cache_dir : str or None
+            If not None, the instance is also saved as a JSON file in
+            this directory.
+
+        """
+        rectwv_coeff = copy.deepcopy(rectwv_coeff)
+        self.store(key, rectwv_coeff)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            fname = self.filename(key, cache_dir)
+            # write to a temporary file first, so that other processes
+            # sharing the directory never read an incomplete file
+            tmpname = f"{fname}.{os.getpid()}.tmp"
+            rectwv_coeff.writeto(tmpname)
+            os.replace(tmpname, fname)
+            _logger.debug("RectWaveCoeff saved in %s", fname)
+
+
+rectwv_coeff_cache = RectWaveCoeffCache()
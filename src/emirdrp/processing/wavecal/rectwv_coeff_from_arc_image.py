@@ -12,8 +12,10 @@ Rectification and wavelength calibration polynomials from arc image
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from astropy.io import fits
 from datetime import datetime
+import functools
 import logging
 import numpy as np
 from scipy.signal import medfilt
@@ -35,9 +37,9 @@ from emirdrp.instrument.components.dtu import DtuConf
 from emirdrp.products import RefinedBoundaryModelParam
 from emirdrp.products import RectWaveCoeff
 from emirdrp.tools.fit_boundaries import bound_params_from_dict
-from emirdrp.tools.select_unrectified_slitlets import select_unrectified_slitlet
 
 from .set_wv_parameters import set_wv_parameters
+from .slitletgeometry import SlitletGeometry
 from .slitlet2darc import Slitlet2dArc
 
 from numina.array.display.pause_debugplot import DEBUGPLOT_CODES
@@ -63,6 +65,7 @@ def rectwv_coeff_from_arc_image(
     args_ylogscale=False,
     args_pdf=None,
     args_geometry=(0, 0, 640, 480),
+    args_max_workers=0,
     debugplot=0,
 ):
     """Evaluate rect.+wavecal. coefficients from arc image
@@ -103,6 +106,10 @@ def rectwv_coeff_from_arc_image(
         TBD
     args_pdf : TBD
     args_geometry : TBD
+    args_max_workers : int
+        Number of processes used to calibrate the slitlets (0 for
+        serial). The slitlets are always computed serially when
+        plots, the interactive mode or a PDF output are requested.
     debugplot : int
             Debugging level for messages and plots. For details see
             'numina.array.display.pause_debugplot.py'.
@@ -166,12 +173,6 @@ def rectwv_coeff_from_arc_image(
         nbrightlines = wv_parameters["nbrightlines"]
     else:
         nbrightlines = [int(idum) for idum in args_nbrightlines.split(",")]
-    poly_crval1_linear = wv_parameters["poly_crval1_linear"]
-    poly_cdelt1_linear = wv_parameters["poly_cdelt1_linear"]
-    wvmin_expected = wv_parameters["wvmin_expected"]
-    wvmax_expected = wv_parameters["wvmax_expected"]
-    wvmin_useful = wv_parameters["wvmin_useful"]
-    wvmax_useful = wv_parameters["wvmax_useful"]
 
     # list of slitlets to be computed
     logger.info(
@@ -209,211 +210,135 @@ def rectwv_coeff_from_arc_image(
 
     measured_slitlets = []
 
-    cout = "0"
-    for islitlet in range(1, EMIR_NBARS + 1):
-
-        if islitlet_min <= islitlet <= islitlet_max:
-
-            # define Slitlet2dArc object
-            slt = Slitlet2dArc(
-                islitlet=islitlet,
-                csu_conf=csu_conf,
-                ymargin_bb=args_ymargin_bb,
-                params=params,
-                parmodel=parmodel,
-                debugplot=debugplot,
-            )
-
-            # extract 2D image corresponding to the selected slitlet, clipping
-            # the image beyond the unrectified slitlet (in order to isolate
-            # the arc lines of the current slitlet; otherwise there are
-            # problems with arc lines from neighbour slitlets)
-            image2d_tmp = select_unrectified_slitlet(
-                image2d=image2d,
-                islitlet=islitlet,
-                csu_bar_slit_center=csu_conf.csu_bar_slit_center(islitlet),
-                params=params,
-                parmodel=parmodel,
-                maskonly=False,
-            )
-            slitlet2d = slt.extract_slitlet2d(image2d_tmp)
-
-            # subtract smooth background computed as follows:
-            # - median collapsed spectrum of the whole slitlet2d
-            # - independent median filtering of the previous spectrum in the
-            #   two halves in the spectral direction
-            if args_remove_sp_background:
-                spmedian = np.median(slitlet2d, axis=0)
-                naxis1_tmp = spmedian.shape[0]
-                jmidpoint = naxis1_tmp // 2
-                sp1 = medfilt(spmedian[:jmidpoint], [201])
-                sp2 = medfilt(spmedian[jmidpoint:], [201])
-                spbackground = np.concatenate((sp1, sp2))
-                slitlet2d -= spbackground
-
-            # locate unknown arc lines
-            slt.locate_unknown_arc_lines(
-                slitlet2d=slitlet2d, times_sigma_threshold=args_times_sigma_threshold
-            )
-
-            # continue working with current slitlet only if arc lines have
-            # been detected
-            if slt.list_arc_lines is not None:
+    # scan limits of the unrectified slitlets, computed only once
+    geometry = SlitletGeometry.from_bound_params(
+        csu_conf, params, parmodel, range(islitlet_min, islitlet_max + 1)
+    )
 
-                # compute intersections between spectrum trails and arc lines
-                slt.xy_spectrail_arc_intersections(slitlet2d=slitlet2d)
+    # calibration of the individual slitlets, which do not depend on
+    # each other (except for the plots and the interactive mode, that
+    # require the slitlets to be computed one after another)
+    calibrate_slitlet = functools.partial(
+        arc_calibration_slitlet,
+        wv_master=wv_master,
+        wv_master_all=wv_master_all,
+        wv_parameters=wv_parameters,
+        nbrightlines=nbrightlines,
+        args_remove_sp_background=args_remove_sp_background,
+        args_times_sigma_threshold=args_times_sigma_threshold,
+        args_order_fmap=args_order_fmap,
+        args_sigma_gaussian_filtering=args_sigma_gaussian_filtering,
+        args_margin_npix=args_margin_npix,
+        args_poldeg_initial=args_poldeg_initial,
+        args_poldeg_refined=args_poldeg_refined,
+        args_interactive=args_interactive,
+        args_threshold_wv=args_threshold_wv,
+        args_ylogscale=args_ylogscale,
+        args_pdf=args_pdf,
+        args_geometry=args_geometry,
+    )
+    parallel = args_max_workers > 0
+    if parallel and (debugplot != 0 or args_interactive or args_pdf is not None):
+        logger.info("plots or interactive mode requested: computing slitlets serially")
+        parallel = False
+
+    executor = ProcessPoolExecutor(max_workers=args_max_workers) if parallel else None
+    futures = {}
+    try:
+        for islitlet in range(1, EMIR_NBARS + 1):
+
+            if islitlet_min <= islitlet <= islitlet_max:
+
+                # define Slitlet2dArc object
+                slt = Slitlet2dArc(
+                    islitlet=islitlet,
+                    csu_conf=csu_conf,
+                    ymargin_bb=args_ymargin_bb,
+                    params=params,
+                    parmodel=parmodel,
+                    debugplot=debugplot,
+                )
 
-                # compute rectification transformation
-                slt.estimate_tt_to_rectify(order=args_order_fmap, slitlet2d=slitlet2d)
+                # extract 2D image corresponding to the selected slitlet, clipping
+                # the image beyond the unrectified slitlet (in order to isolate
+                # the arc lines of the current slitlet; otherwise there are
+                # problems with arc lines from neighbour slitlets)
+                slitlet2d = slt.extract_slitlet2d(image2d)
+                slitlet2d[
+                    ~geometry.mask(
+                        islitlet,
+                        slt.bb_ns1_orig,
+                        slt.bb_ns1_orig + slitlet2d.shape[0] - 1,
+                        slt.bb_nc1_orig,
+                        slt.bb_nc1_orig + slitlet2d.shape[1] - 1,
+                    )
+                ] = 0
 
-                # rectify image
-                slitlet2d_rect = slt.rectify(slitlet2d, resampling=2, transformation=1)
+                if parallel:
+                    futures[islitlet] = executor.submit(
+                        calibrate_slitlet, slt, slitlet2d
+                    )
+                else:
+                    slt, sp_median = calibrate_slitlet(slt, slitlet2d)
+                    if sp_median is not None:
+                        image2d_55sp[islitlet - 1, :] = sp_median
+                    if debugplot != 0:
+                        pause_debugplot(debugplot)
 
-                # median spectrum and line peaks from rectified image
-                sp_median, fxpeaks = slt.median_spectrum_from_rectified_image(
-                    slitlet2d_rect,
-                    sigma_gaussian_filtering=args_sigma_gaussian_filtering,
-                    nwinwidth_initial=5,
-                    nwinwidth_refined=5,
-                    times_sigma_threshold=5,
-                    npix_avoid_border=6,
-                    nbrightlines=nbrightlines,
-                )
+            else:
 
-                image2d_55sp[islitlet - 1, :] = sp_median
-
-                # determine expected wavelength limits prior to the wavelength
-                # calibration
-                csu_bar_slit_center = csu_conf.csu_bar_slit_center(islitlet)
-                crval1_linear = poly_crval1_linear(csu_bar_slit_center)
-                cdelt1_linear = poly_cdelt1_linear(csu_bar_slit_center)
-                expected_wvmin = crval1_linear - args_margin_npix * cdelt1_linear
-                naxis1_linear = sp_median.shape[0]
-                crvaln_linear = crval1_linear + (naxis1_linear - 1) * cdelt1_linear
-                expected_wvmax = crvaln_linear + args_margin_npix * cdelt1_linear
-                # override previous estimates when necessary
-                if wvmin_expected is not None:
-                    expected_wvmin = wvmin_expected
-                if wvmax_expected is not None:
-                    expected_wvmax = wvmax_expected
-
-                # clip initial master arc line list with bright lines to
-                # the expected wavelength range
-                lok1 = expected_wvmin <= wv_master
-                lok2 = wv_master <= expected_wvmax
-                lok = lok1 * lok2
-                wv_master_eff = wv_master[lok]
-
-                # perform initial wavelength calibration
-                solution_wv = wvcal_spectrum(
-                    sp=sp_median,
-                    fxpeaks=fxpeaks,
-                    poly_degree_wfit=args_poldeg_initial,
-                    wv_master=wv_master_eff,
-                    wv_ini_search=expected_wvmin,
-                    wv_end_search=expected_wvmax,
-                    wvmin_useful=wvmin_useful,
-                    wvmax_useful=wvmax_useful,
-                    geometry=args_geometry,
-                    debugplot=slt.debugplot,
-                )
-                # store initial wavelength calibration polynomial in current
-                # slitlet instance
-                slt.wpoly = np.polynomial.Polynomial(solution_wv.coeff)
-                pause_debugplot(debugplot)
-
-                # clip initial master arc line list with all the lines to
-                # the expected wavelength range
-                lok1 = expected_wvmin <= wv_master_all
-                lok2 = wv_master_all <= expected_wvmax
-                lok = lok1 * lok2
-                wv_master_all_eff = wv_master_all[lok]
-
-                # clip master arc line list to useful region
-                if wvmin_useful is not None:
-                    lok = wvmin_useful <= wv_master_all_eff
-                    wv_master_all_eff = wv_master_all_eff[lok]
-                if wvmax_useful is not None:
-                    lok = wv_master_all_eff <= wvmax_useful
-                    wv_master_all_eff = wv_master_all_eff[lok]
-
-                # refine wavelength calibration
-                if args_poldeg_refined > 0:
-                    plottitle = "[slitlet#{}, refined]".format(islitlet)
-                    poly_refined, yres_summary = refine_arccalibration(
-                        sp=sp_median,
-                        poly_initial=slt.wpoly,
-                        wv_master=wv_master_all_eff,
-                        poldeg=args_poldeg_refined,
-                        ntimes_match_wv=1,
-                        interactive=args_interactive,
-                        threshold=args_threshold_wv,
-                        plottitle=plottitle,
-                        ylogscale=args_ylogscale,
-                        geometry=args_geometry,
-                        pdf=args_pdf,
-                        debugplot=slt.debugplot,
-                    )
-                    # store refined wavelength calibration polynomial in
-                    # current slitlet instance
-                    slt.wpoly = poly_refined
-
-                # compute approximate linear values for CRVAL1 and CDELT1
-                naxis1_linear = sp_median.shape[0]
-                crmin1_linear = slt.wpoly(1)
-                crmax1_linear = slt.wpoly(naxis1_linear)
-                slt.crval1_linear = crmin1_linear
-                slt.cdelt1_linear = (crmax1_linear - crmin1_linear) / (
-                    naxis1_linear - 1
+                # define Slitlet2dArc object
+                slt = Slitlet2dArc(
+                    islitlet=islitlet,
+                    csu_conf=csu_conf,
+                    ymargin_bb=args_ymargin_bb,
+                    params=None,
+                    parmodel=None,
+                    debugplot=debugplot,
                 )
 
-                # check that the trimming of wv_master and wv_master_all has
-                # preserved the wavelength range [crmin1_linear, crmax1_linear]
-                if crmin1_linear < expected_wvmin:
-                    logger.warning(">>> islitlet: " + str(islitlet))
-                    logger.warning("expected_wvmin: " + str(expected_wvmin))
-                    logger.warning("crmin1_linear.: " + str(crmin1_linear))
-                    logger.warning(
-                        "WARNING: Unexpected crmin1_linear < " "expected_wvmin"
-                    )
-                if crmax1_linear > expected_wvmax:
-                    logger.warning(">>> islitlet: " + str(islitlet))
-                    logger.warning("expected_wvmax: " + str(expected_wvmax))
-                    logger.warning("crmax1_linear.: " + str(crmax1_linear))
-                    logger.warning(
-                        "WARNING: Unexpected crmax1_linear > " "expected_wvmax"
+            # store current slitlet in list of measured slitlets
+            measured_slitlets.append(slt)
+
+        # merge the results of the parallel computation, in slitlet order
+        if parallel:
+            failed_slitlets = []
+            first_error = None
+            for islitlet, future in futures.items():
+                try:
+                    slt, sp_median = future.result()
+                except Exception as error:
+                    logger.error(
+                        "arc calibration of slitlet %d failed: %s", islitlet, error
                     )
+                    failed_slitlets.append(islitlet)
+                    if first_error is None:
+                        first_error = error
+                    continue
+                measured_slitlets[islitlet - 1] = slt
+                if sp_median is not None:
+                    image2d_55sp[islitlet - 1, :] = sp_median
+            if failed_slitlets:
+                raise ValueError(
+                    f"arc calibration failed in slitlets {failed_slitlets}"
+                ) from first_error
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
+    cout = "0"
+    for slt in measured_slitlets:
+        islitlet = slt.islitlet
+        if islitlet_min <= islitlet <= islitlet_max:
+            if slt.list_arc_lines is not None:
                 cout += "."
-
             else:
-
                 cout += "x"
-
             if islitlet % 10 == 0:
                 if cout != "x":
                     cout = str(islitlet // 10)
-
-            if debugplot != 0:
-                pause_debugplot(debugplot)
-
         else:
-
-            # define Slitlet2dArc object
-            slt = Slitlet2dArc(
-                islitlet=islitlet,
-                csu_conf=csu_conf,
-                ymargin_bb=args_ymargin_bb,
-                params=None,
-                parmodel=None,
-                debugplot=debugplot,
-            )
-
             cout += "i"
-
-        # store current slitlet in list of measured slitlets
-        measured_slitlets.append(slt)
-
         logger.info(cout)
 
     # ---
@@ -611,6 +536,216 @@ def rectwv_coeff_from_arc_image(
     return rectwv_coeff, reduced_55sp
 
 
+def arc_calibration_slitlet(
+    slt,
+    slitlet2d,
+    wv_master,
+    wv_master_all,
+    wv_parameters,
+    nbrightlines,
+    args_remove_sp_background=True,
+    args_times_sigma_threshold=10,
+    args_order_fmap=2,
+    args_sigma_gaussian_filtering=2,
+    args_margin_npix=50,
+    args_poldeg_initial=3,
+    args_poldeg_refined=5,
+    args_interactive=False,
+    args_threshold_wv=0,
+    args_ylogscale=False,
+    args_pdf=None,
+    args_geometry=(0, 0, 640, 480),
+):
+    """Rect.+wavecal. coefficients of a single slitlet from arc image
+
+    The slitlets are independent of each other, so that this function
+    can be evaluated in a separate process for each slitlet.
+
+    Parameters
+    ----------
+    slt : Slitlet2dArc instance
+        Slitlet, defined with the expected boundaries.
+    slitlet2d : numpy array
+        Image of the bounding box of the slitlet, set to zero beyond
+        the unrectified slitlet.
+    wv_master : numpy array
+        Wavelengths of the brightest arc lines.
+    wv_master_all : numpy array
+        Wavelengths of all the arc lines.
+    wv_parameters : dictionary
+        Parameters of the grism+filter combination (see
+        `set_wv_parameters`).
+    nbrightlines : list of int
+        Number of bright lines employed in the initial wavelength
+        calibration.
+    args_* :
+        See `rectwv_coeff_from_arc_image`.
+
+    Returns
+    -------
+    slt : Slitlet2dArc instance
+        Slitlet with the rectification transformation and the
+        wavelength calibration polynomial.
+    sp_median : numpy array or None
+        Median spectrum of the rectified slitlet, employed to derive
+        the wavelength calibration polynomial. None when no arc lines
+        have been found in the slitlet.
+
+    """
+
+    logger = logging.getLogger(__name__)
+
+    islitlet = slt.islitlet
+    poly_crval1_linear = wv_parameters["poly_crval1_linear"]
+    poly_cdelt1_linear = wv_parameters["poly_cdelt1_linear"]
+    wvmin_expected = wv_parameters["wvmin_expected"]
+    wvmax_expected = wv_parameters["wvmax_expected"]
+    wvmin_useful = wv_parameters["wvmin_useful"]
+    wvmax_useful = wv_parameters["wvmax_useful"]
+
+    # subtract smooth background computed as follows:
+    # - median collapsed spectrum of the whole slitlet2d
+    # - independent median filtering of the previous spectrum in the
+    #   two halves in the spectral direction
+    if args_remove_sp_background:
+        spmedian = np.median(slitlet2d, axis=0)
+        naxis1_tmp = spmedian.shape[0]
+        jmidpoint = naxis1_tmp // 2
+        sp1 = medfilt(spmedian[:jmidpoint], [201])
+        sp2 = medfilt(spmedian[jmidpoint:], [201])
+        spbackground = np.concatenate((sp1, sp2))
+        slitlet2d -= spbackground
+
+    # locate unknown arc lines
+    slt.locate_unknown_arc_lines(
+        slitlet2d=slitlet2d, times_sigma_threshold=args_times_sigma_threshold
+    )
+
+    # continue working with current slitlet only if arc lines have
+    # been detected
+    if slt.list_arc_lines is not None:
+
+        # compute intersections between spectrum trails and arc lines
+        slt.xy_spectrail_arc_intersections(slitlet2d=slitlet2d)
+
+        # compute rectification transformation
+        slt.estimate_tt_to_rectify(order=args_order_fmap, slitlet2d=slitlet2d)
+
+        # rectify image
+        slitlet2d_rect = slt.rectify(slitlet2d, resampling=2, transformation=1)
+
+        # median spectrum and line peaks from rectified image
+        sp_median, fxpeaks = slt.median_spectrum_from_rectified_image(
+            slitlet2d_rect,
+            sigma_gaussian_filtering=args_sigma_gaussian_filtering,
+            nwinwidth_initial=5,
+            nwinwidth_refined=5,
+            times_sigma_threshold=5,
+            npix_avoid_border=6,
+            nbrightlines=nbrightlines,
+        )
+
+        # determine expected wavelength limits prior to the wavelength
+        # calibration
+        csu_bar_slit_center = slt.csu_bar_slit_center
+        crval1_linear = poly_crval1_linear(csu_bar_slit_center)
+        cdelt1_linear = poly_cdelt1_linear(csu_bar_slit_center)
+        expected_wvmin = crval1_linear - args_margin_npix * cdelt1_linear
+        naxis1_linear = sp_median.shape[0]
+        crvaln_linear = crval1_linear + (naxis1_linear - 1) * cdelt1_linear
+        expected_wvmax = crvaln_linear + args_margin_npix * cdelt1_linear
+        # override previous estimates when necessary
+        if wvmin_expected is not None:
+            expected_wvmin = wvmin_expected
+        if wvmax_expected is not None:
+            expected_wvmax = wvmax_expected
+
+        # clip initial master arc line list with bright lines to
+        # the expected wavelength range
+        lok1 = expected_wvmin <= wv_master
+        lok2 = wv_master <= expected_wvmax
+        lok = lok1 * lok2
+        wv_master_eff = wv_master[lok]
+
+        # perform initial wavelength calibration
+        solution_wv = wvcal_spectrum(
+            sp=sp_median,
+            fxpeaks=fxpeaks,
+            poly_degree_wfit=args_poldeg_initial,
+            wv_master=wv_master_eff,
+            wv_ini_search=expected_wvmin,
+            wv_end_search=expected_wvmax,
+            wvmin_useful=wvmin_useful,
+            wvmax_useful=wvmax_useful,
+            geometry=args_geometry,
+            debugplot=slt.debugplot,
+        )
+        # store initial wavelength calibration polynomial in current
+        # slitlet instance
+        slt.wpoly = np.polynomial.Polynomial(solution_wv.coeff)
+        pause_debugplot(slt.debugplot)
+
+        # clip initial master arc line list with all the lines to
+        # the expected wavelength range
+        lok1 = expected_wvmin <= wv_master_all
+        lok2 = wv_master_all <= expected_wvmax
+        lok = lok1 * lok2
+        wv_master_all_eff = wv_master_all[lok]
+
+        # clip master arc line list to useful region
+        if wvmin_useful is not None:
+            lok = wvmin_useful <= wv_master_all_eff
+            wv_master_all_eff = wv_master_all_eff[lok]
+        if wvmax_useful is not None:
+            lok = wv_master_all_eff <= wvmax_useful
+            wv_master_all_eff = wv_master_all_eff[lok]
+
+        # refine wavelength calibration
+        if args_poldeg_refined > 0:
+            plottitle = "[slitlet#{}, refined]".format(islitlet)
+            poly_refined, yres_summary = refine_arccalibration(
+                sp=sp_median,
+                poly_initial=slt.wpoly,
+                wv_master=wv_master_all_eff,
+                poldeg=args_poldeg_refined,
+                ntimes_match_wv=1,
+                interactive=args_interactive,
+                threshold=args_threshold_wv,
+                plottitle=plottitle,
+                ylogscale=args_ylogscale,
+                geometry=args_geometry,
+                pdf=args_pdf,
+                debugplot=slt.debugplot,
+            )
+            # store refined wavelength calibration polynomial in
+            # current slitlet instance
+            slt.wpoly = poly_refined
+
+        # compute approximate linear values for CRVAL1 and CDELT1
+        naxis1_linear = sp_median.shape[0]
+        crmin1_linear = slt.wpoly(1)
+        crmax1_linear = slt.wpoly(naxis1_linear)
+        slt.crval1_linear = crmin1_linear
+        slt.cdelt1_linear = (crmax1_linear - crmin1_linear) / (naxis1_linear - 1)
+
+        # check that the trimming of wv_master and wv_master_all has
+        # preserved the wavelength range [crmin1_linear, crmax1_linear]
+        if crmin1_linear < expected_wvmin:
+            logger.warning(">>> islitlet: " + str(islitlet))
+            logger.warning("expected_wvmin: " + str(expected_wvmin))
+            logger.warning("crmin1_linear.: " + str(crmin1_linear))
+            logger.warning("WARNING: Unexpected crmin1_linear < " "expected_wvmin")
+        if crmax1_linear > expected_wvmax:
+            logger.warning(">>> islitlet: " + str(islitlet))
+            logger.warning("expected_wvmax: " + str(expected_wvmax))
+            logger.warning("crmax1_linear.: " + str(crmax1_linear))
+            logger.warning("WARNING: Unexpected crmax1_linear > " "expected_wvmax")
+
+        return slt, sp_median
+
+    return slt, None
+
+
 def main(args=None):
 
     # parse command-line options
@@ -738,6 +873,13 @@ def main(args=None):
         help="output PDF file name",
         type=lambda x: arg_file_is_new(parser, x, mode="wb"),
     )
+    parser.add_argument(
+        "--max_workers",
+        help="Number of processes used to calibrate the slitlets "
+        "(default=0, serial)",
+        default=0,
+        type=int,
+    )
     parser.add_argument(
         "--debugplot",
         help="Integer indicating plotting & debugging options" " (default=0)",
@@ -805,6 +947,7 @@ def main(args=None):
         args_ylogscale=args.ylogscale,
         args_pdf=pdf,
         args_geometry=geometry,
+        args_max_workers=args.max_workers,
         debugplot=args.debugplot,
     )
 
@@ -16,7 +16,6 @@ from astropy.io import fits
 from datetime import datetime
 import logging
 import numpy as np
-from scipy.interpolate import interp1d
 import sys
 from uuid import uuid4
 
@@ -29,6 +28,7 @@ from emirdrp.instrument.csu_configuration import CsuConfiguration
 from emirdrp.instrument.components.dtu import DtuConf
 from emirdrp.products import MasterRectWave
 from emirdrp.products import RectWaveCoeff
+from emirdrp.processing.wavecal.rectwv_coeff_cache import rectwv_coeff_cache
 from emirdrp.tools.fit_boundaries import bound_params_from_dict
 from emirdrp.tools.fit_boundaries import expected_distorted_boundaries
 from emirdrp.tools.fit_boundaries import expected_distorted_frontiers
@@ -42,7 +42,12 @@ from emirdrp.core import EMIR_NBARS
 
 
 def rectwv_coeff_from_mos_library(
-    reduced_image, master_rectwv, ignore_dtu_configuration=True, debugplot=0
+    reduced_image,
+    master_rectwv,
+    ignore_dtu_configuration=True,
+    use_cache=False,
+    cache_dir=None,
+    debugplot=0,
 ):
     """Evaluate rect.+wavecal. coefficients from MOS library
 
@@ -59,6 +64,14 @@ def rectwv_coeff_from_mos_library(
         CSU configuration.
     ignore_dtu_configuration : bool
         If True, ignore differences in DTU configuration.
+    use_cache : bool
+        If True, reuse the coefficients previously computed with the
+        same library, CSU configuration and DTU configuration (see
+        `RectWaveCoeffCache`).
+    cache_dir : str or None
+        Directory to save and look up the cached coefficients as JSON
+        files, in addition to the cache in memory. Only used if
+        use_cache is True.
     debugplot : int
         Debugging level for messages and plots. For details see
         'numina.array.display.pause_debugplot.py'.
@@ -110,6 +123,17 @@ def rectwv_coeff_from_mos_library(
     if grism_name != master_rectwv.tags["grism"]:
         raise ValueError("Grism name does not match!")
 
+    # reuse the coefficients already computed for this configuration
+    if use_cache:
+        cache_key = rectwv_coeff_cache.key(master_rectwv, csu_conf, dtu_conf)
+        rectwv_coeff = rectwv_coeff_cache.get(cache_key, cache_dir)
+        if rectwv_coeff is not None:
+            logger.info("RectWaveCoeff for this CSU configuration found in cache")
+            logger.info(
+                "Generating RectWaveCoeff object with uuid=" + rectwv_coeff.uuid
+            )
+            return rectwv_coeff
+
     # valid slitlet numbers
     list_valid_islitlets = list(range(1, EMIR_NBARS + 1))
     for idel in master_rectwv.missing_slitlets:
@@ -168,44 +192,35 @@ def rectwv_coeff_from_mos_library(
             )
             logger.warning("sought value...........: " + str(csu_bar_slit_center))
 
-        # rectification coefficients
+        # rectification and wavelength calibration coefficients, all of
+        # them interpolated at once
         ttd_order = tmpdict["ttd_order"]
         ncoef = ncoef_fmap(ttd_order)
+        ncoef_wpoly = tmpdict["wpoly_degree"] + 1
+        list_keycoef = ["ttd_aij", "ttd_bij", "tti_aij", "tti_bij"]
+        table = [
+            tmpdict["list_" + keycoef + "_" + str(icoef).zfill(2)]
+            for keycoef in list_keycoef
+            for icoef in range(ncoef)
+        ]
+        table += [
+            tmpdict["list_wpoly_coeff_" + str(icoef).zfill(2)]
+            for icoef in range(ncoef_wpoly)
+        ]
+        coef_out = list(
+            interpolate_coefficients(
+                list_csu_bar_slit_center, table, csu_bar_slit_center
+            )
+        )
         outdict["contents"][cslitlet] = {}
         outdict["contents"][cslitlet]["ttd_order"] = ttd_order
         outdict["contents"][cslitlet]["ttd_order_longslit_model"] = None
-        for keycoef in ["ttd_aij", "ttd_bij", "tti_aij", "tti_bij"]:
-            coef_out = []
-            for icoef in range(ncoef):
-                ccoef = str(icoef).zfill(2)
-                list_cij = tmpdict["list_" + keycoef + "_" + ccoef]
-                funinterp_coef = interp1d(
-                    list_csu_bar_slit_center,
-                    list_cij,
-                    kind="linear",
-                    fill_value="extrapolate",
-                )
-                # note: funinterp_coef expects a numpy array
-                dum = funinterp_coef([csu_bar_slit_center])
-                coef_out.append(dum[0])
-            outdict["contents"][cslitlet][keycoef] = coef_out
+        for i, keycoef in enumerate(list_keycoef):
+            outdict["contents"][cslitlet][keycoef] = coef_out[
+                i * ncoef : (i + 1) * ncoef
+            ]
             outdict["contents"][cslitlet][keycoef + "_longslit_model"] = None
-
-        # wavelength calibration coefficients
-        ncoef = tmpdict["wpoly_degree"] + 1
-        wpoly_coeff = []
-        for icoef in range(ncoef):
-            ccoef = str(icoef).zfill(2)
-            list_cij = tmpdict["list_wpoly_coeff_" + ccoef]
-            funinterp_coef = interp1d(
-                list_csu_bar_slit_center,
-                list_cij,
-                kind="linear",
-                fill_value="extrapolate",
-            )
-            # note: funinterp_coef expects a numpy array
-            dum = funinterp_coef([csu_bar_slit_center])
-            wpoly_coeff.append(dum[0])
+        wpoly_coeff = coef_out[len(list_keycoef) * ncoef :]
         outdict["contents"][cslitlet]["wpoly_coeff"] = wpoly_coeff
         outdict["contents"][cslitlet]["wpoly_coeff_longslit_model"] = None
 
@@ -417,9 +432,55 @@ def rectwv_coeff_from_mos_library(
     # check_setstate_getstate(rectwv_coeff, args.out_rect_wpoly.name)
     logger.info("Generating RectWaveCoeff object with uuid=" + rectwv_coeff.uuid)
 
+    if use_cache:
+        rectwv_coeff_cache.put(cache_key, rectwv_coeff, cache_dir)
+
     return rectwv_coeff
 
 
+def interpolate_coefficients(list_csu_bar_slit_center, table, csu_bar_slit_center):
+    """Linear interpolation of a table of coefficients.
+
+    All the coefficients are evaluated at once, with the same
+    arithmetic as a linear `~scipy.interpolate.interp1d` with
+    fill_value='extrapolate' (i.e., extrapolating outside the
+    tabulated range with the first or last segment).
+
+    Parameters
+    ----------
+    list_csu_bar_slit_center : list of floats
+        Tabulated csu_bar_slit_center values (not necessarily sorted).
+    table : list of lists of floats
+        Tabulated values of each coefficient, with the same length
+        as list_csu_bar_slit_center.
+    csu_bar_slit_center : float
+        Value at which the coefficients are evaluated.
+
+    Returns
+    -------
+    coef_out : numpy array
+        Interpolated value of each coefficient.
+
+    """
+
+    x = np.asarray(list_csu_bar_slit_center, dtype=float)
+    y = np.asarray(table, dtype=float)
+    if x.ndim != 1 or x.size < 2:
+        raise ValueError("at least two tabulated values are required")
+    if y.ndim != 2 or y.shape[1] != x.size:
+        raise ValueError("x and table arrays must have the same length")
+
+    ind = np.argsort(x, kind="mergesort")
+    x = x[ind]
+    y = y[:, ind]
+
+    x_new = np.asarray([csu_bar_slit_center], dtype=float)
+    hi = np.searchsorted(x, x_new).clip(1, x.size - 1)
+    lo = hi - 1
+    slope = (y[:, hi] - y[:, lo]) / (x[hi] - x[lo])
+    return (slope * (x_new - x[lo]) + y[:, lo])[:, 0]
+
+
 def main(args=None):
     # parse command-line options
     parser = argparse.ArgumentParser(
@@ -463,6 +524,11 @@ def main(args=None):
         help="Ignore DTU configurations differences between " "model and input image",
         action="store_true",
     )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory to save and look up the coefficients computed "
+        "for each CSU configuration",
+    )
     parser.add_argument(
         "--debugplot",
         help="Integer indicating plotting & debugging options" " (default=0)",
@@ -489,6 +555,8 @@ def main(args=None):
         hdulist,
         master_rectwv,
         ignore_dtu_configuration=args.ignore_dtu_configuration,
+        use_cache=args.cache_dir is not None,
+        cache_dir=args.cache_dir,
         debugplot=args.debugplot,
     )
 
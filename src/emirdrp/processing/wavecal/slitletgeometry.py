@@ -0,0 +1,200 @@
+#
+# Copyright 2026 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Index of the unrectified slitlet regions of a CSU configuration"""
+
+import numpy as np
+
+from emirdrp.core import EMIR_NAXIS1
+from emirdrp.core import EMIR_NAXIS2
+from emirdrp.core import EMIR_NBARS
+from emirdrp.processing.specflat import frontier_scan_limits
+from emirdrp.tools.fit_boundaries import expected_distorted_frontiers
+
+
+class SlitletGeometry:
+    """Per-column scan limits of the slitlets of a CSU configuration.
+
+    For each slitlet, the minimum and maximum useful scans (n1, n2,
+    ranging from 1 to NAXIS2) between its frontiers are computed
+    once for every column and stored as int16 arrays. The region of
+    a slitlet in an image can then be read from its bounding box,
+    without full-frame masked copies of the image.
+
+    Parameters
+    ----------
+    naxis1 : int
+        Number of columns of the images.
+    naxis2 : int
+        Number of scans of the images.
+
+    Attributes
+    ----------
+    n1, n2 : numpy.ndarray
+        Arrays of shape (EMIR_NBARS, naxis1) with the minimum and
+        maximum useful scans of each slitlet (row islitlet - 1).
+        Columns without useful scans have n2 < n1.
+    defined : numpy.ndarray
+        Boolean array with the slitlets that have been defined.
+
+    """
+
+    def __init__(self, naxis1=EMIR_NAXIS1, naxis2=EMIR_NAXIS2):
+        self.naxis1 = naxis1
+        self.naxis2 = naxis2
+        self.n1 = np.ones((EMIR_NBARS, naxis1), dtype="int16")
+        self.n2 = np.zeros((EMIR_NBARS, naxis1), dtype="int16")
+        self.defined = np.zeros(EMIR_NBARS, dtype=bool)
+
+    @classmethod
+    def from_rectwv_coeff(cls, rectwv_coeff):
+        """Geometry from the frontiers of a RectWaveCoeff instance."""
+        geometry = cls()
+        for islitlet in range(1, EMIR_NBARS + 1):
+            if islitlet in rectwv_coeff.missing_slitlets:
+                continue
+            tmpcontent = rectwv_coeff.contents[islitlet - 1]
+            list_frontiers = [
+                np.polynomial.Polynomial(tmpcontent["frontier"]["poly_coef_" + cdum])
+                for cdum in ["lower", "upper"]
+            ]
+            geometry.add(islitlet, list_frontiers)
+        return geometry
+
+    @classmethod
+    def from_bound_params(cls, csu_conf, params, parmodel, list_islitlets):
+        """Geometry from the frontiers expected with a boundary model.
+
+        Parameters
+        ----------
+        csu_conf : CsuConfiguration instance
+            CSU configuration.
+        params : :class:`~lmfit.parameter.Parameters`
+            Parameters of the boundary model.
+        parmodel : str
+            Model to be assumed. Allowed values are 'longslit' and
+            'multislit'.
+        list_islitlets : list of int
+            Slitlets to include.
+
+        """
+        geometry = cls()
+        for islitlet in list_islitlets:
+            geometry.add_expected(
+                islitlet, csu_conf.csu_bar_slit_center(islitlet), params, parmodel
+            )
+        return geometry
+
+    def add(self, islitlet, list_frontiers):
+        """Define a slitlet from its lower and upper frontiers."""
+        n1, n2 = frontier_scan_limits(list_frontiers, self.naxis1)
+        self.n1[islitlet - 1] = n1
+        self.n2[islitlet - 1] = n2
+        self.defined[islitlet - 1] = True
+
+    def add_expected(self, islitlet, csu_bar_slit_center, params, parmodel):
+        """Define a slitlet from the frontiers expected with a boundary model."""
+        list_expected_frontiers = expected_distorted_frontiers(
+            islitlet,
+            csu_bar_slit_center,
+            params,
+            parmodel,
+            numpts=101,
+            deg=5,
+            debugplot=0,
+        )
+        list_frontiers = [
+            list_expected_frontiers[0].poly_funct,
+            list_expected_frontiers[1].poly_funct,
+        ]
+        self.add(islitlet, list_frontiers)
+
+    def _check(self, islitlet):
+        if not 1 <= islitlet <= EMIR_NBARS:
+            raise ValueError(f"Unexpected islitlet={islitlet}")
+        if not self.defined[islitlet - 1]:
+            raise ValueError(f"Slitlet {islitlet} is not defined")
+
+    def limits(self, islitlet):
+        """Minimum and maximum useful scans of each column of a slitlet."""
+        self._check(islitlet)
+        return self.n1[islitlet - 1], self.n2[islitlet - 1]
+
+    def footprint(self, islitlet):
+        """Run-length encoded footprint of a slitlet.
+
+        Returns
+        -------
+        columns : numpy.ndarray
+            Columns (from 0 to NAXIS1 - 1) with useful scans.
+        starts : numpy.ndarray
+            First row (from 0 to NAXIS2 - 1) of each column.
+        lengths : numpy.ndarray
+            Number of rows of each column.
+
+        """
+        n1, n2 = self.limits(islitlet)
+        lengths = n2.astype(int) - n1 + 1
+        columns = np.nonzero(lengths > 0)[0]
+        return columns, n1[columns] - 1, lengths[columns]
+
+    def mask(self, islitlet, ns1=1, ns2=None, nc1=1, nc2=None):
+        """Mask of the slitlet within a bounding box.
+
+        Parameters
+        ----------
+        islitlet : int
+            Slitlet number.
+        ns1, ns2 : int
+            First and last scans (from 1 to NAXIS2) of the box.
+        nc1, nc2 : int
+            First and last channels (from 1 to NAXIS1) of the box.
+
+        Returns
+        -------
+        mask : numpy.ndarray
+            Boolean array of shape (ns2 - ns1 + 1, nc2 - nc1 + 1),
+            True within the slitlet.
+
+        """
+        n1, n2 = self.limits(islitlet)
+        if ns2 is None:
+            ns2 = self.naxis2
+        if nc2 is None:
+            nc2 = self.naxis1
+        nscan = np.arange(ns1, ns2 + 1)[:, np.newaxis]
+        return (nscan >= n1[nc1 - 1 : nc2]) & (nscan <= n2[nc1 - 1 : nc2])
+
+    def extract(self, image2d, islitlet, ns1, ns2, nc1, nc2):
+        """Region of a slitlet within a bounding box of an image.
+
+        Parameters
+        ----------
+        image2d : numpy.ndarray
+            Image of shape (naxis2, naxis1).
+        islitlet : int
+            Slitlet number.
+        ns1, ns2 : int
+            First and last scans (from 1 to NAXIS2) of the box.
+        nc1, nc2 : int
+            First and last channels (from 1 to NAXIS1) of the box.
+
+        Returns
+        -------
+        slitlet2d : numpy.ndarray
+            Float copy of the box, set to zero outside the slitlet.
+
+        """
+        if image2d.shape != (self.naxis2, self.naxis1):
+            raise ValueError("NAXIS1, NAXIS2 unexpected for EMIR detector")
+        slitlet2d = image2d[(ns1 - 1) : ns2, (nc1 - 1) : nc2].astype(float)
+        nrows, ncols = slitlet2d.shape
+        mask = self.mask(islitlet, ns1, ns1 + nrows - 1, nc1, nc1 + ncols - 1)
+        slitlet2d[~mask] = 0
+        return slitlet2d
@@ -8,8 +8,146 @@
 #
 
 
+import hashlib
+
 import numpy
 from astropy import wcs
+from astropy.io import fits
+
+from emirdrp.core.cache import LRUCache
+from emirdrp.processing.headerindex import celestial_wcs_cards, frame_records
+
+
+class WCSCache(LRUCache):
+    """Celestial WCS of headers, shared between recipes
+
+    The WCS are built from the cards of the celestial WCS of the
+    header (see `celestial_wcs_cards`), and stored under a hash of
+    those cards, so the WCS of a frame is parsed only once, however
+    many times its header is read.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of WCS kept in memory.
+
+    """
+
+    def __init__(self, maxsize=512):
+        super().__init__(maxsize)
+
+    def get(self, header):
+        """WCS of a header."""
+        cards = celestial_wcs_cards(header)
+        key = hashlib.sha1(cards.encode("ascii", errors="replace")).hexdigest()
+        return self.lookup(key, lambda: wcs.WCS(fits.Header.fromstring(cards)))
+
+
+wcs_cache = WCSCache()
+
+
+def angular_separation(lon1, lat1, lon2, lat2):
+    """Angular separation between points of the sphere.
+
+    The separation is computed with the haversine formula,
+    element by element.
+
+    Parameters
+    ----------
+    lon1, lat1, lon2, lat2 : array_like
+        Longitude and latitude (degrees) of the points.
+
+    Returns
+    -------
+    separation : numpy.ndarray
+        Separation in degrees.
+
+    """
+    lon1, lat1, lon2, lat2 = (
+        numpy.radians(numpy.asarray(value, dtype=float))
+        for value in (lon1, lat1, lon2, lat2)
+    )
+    hav = (
+        numpy.sin(0.5 * (lat2 - lat1)) ** 2
+        + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(0.5 * (lon2 - lon1)) ** 2
+    )
+    return numpy.degrees(2 * numpy.arcsin(numpy.sqrt(numpy.clip(hav, 0, 1))))
+
+
+def pixels_to_sky(wcslist, pixels, origin=1):
+    """Sky coordinates of the same pixels in several WCS.
+
+    Parameters
+    ----------
+    wcslist : list of astropy.wcs.WCS
+        Celestial WCS of the frames.
+    pixels : array_like
+        Array of shape (npix, 2) with the pixel coordinates.
+    origin : int
+        Origin of the pixel coordinates (0 or 1).
+
+    Returns
+    -------
+    sky : numpy.ndarray
+        Array of shape (nframes, npix, 2) with the world coordinates
+        (degrees) of the pixels in each frame.
+
+    """
+    pixels = numpy.atleast_2d(numpy.asarray(pixels, dtype=float))
+    sky = numpy.empty((len(wcslist), pixels.shape[0], 2))
+    for idx, wcsh in enumerate(wcslist):
+        sky[idx] = wcsh.wcs_pix2world(pixels, origin)
+    return sky
+
+
+def sky_offsets_from_wcs(headers, pixref, step=(0.0, 1.0), origin=1):
+    """Sky offsets and pixel scales of frames from their WCS.
+
+    The world coordinates of the reference pixel, and of a probe pixel
+    displaced *step* from it, are computed in every frame in a single
+    call per WCS. The separations are then computed together for all
+    the frames.
+
+    Parameters
+    ----------
+    headers : list of astropy.io.fits.Header
+        Headers with the celestial WCS of the frames.
+    pixref : array_like
+        Reference pixel (x, y).
+    step : array_like
+        Displacement (x, y) of the probe pixel, in pixels.
+    origin : int
+        Origin of the pixel coordinates (0 or 1).
+
+    Returns
+    -------
+    offsets : numpy.ndarray
+        Separation (arcsec) between the reference pixel of each frame
+        and the reference pixel of the first frame.
+    scales : numpy.ndarray
+        Separation (arcsec) between the reference and the probe pixels
+        of each frame, divided by the length of step.
+
+    """
+    pixref = numpy.asarray(pixref, dtype=float)
+    pixels = numpy.array([pixref, pixref + numpy.asarray(step, dtype=float)])
+    sky = pixels_to_sky([wcs_cache.get(header) for header in headers], pixels, origin)
+    ref = sky[:, 0]
+    probe = sky[:, 1]
+    offsets = angular_separation(ref[:, 0], ref[:, 1], ref[0, 0], ref[0, 1])
+    scales = angular_separation(ref[:, 0], ref[:, 1], probe[:, 0], probe[:, 1])
+    scales /= numpy.hypot(*step)
+    return 3600 * offsets, 3600 * scales
+
+
+def _pixels_from_wcs(wcslist, pixref, origin):
+    """Pixels of each frame with the sky coordinates of pixref in the first."""
+    skyref = wcslist[0].wcs_pix2world(pixref, origin)
+    result = numpy.empty((len(wcslist),) + skyref.shape)
+    result[0] = pixref
+    for idx, wcsh in enumerate(wcslist[1:]):
+        result[idx + 1] = wcsh.wcs_world2pix(skyref, origin)
+    return result
 
 
 def offsets_from_wcs(frames, pixref):
@@ -30,34 +168,20 @@ def offsets_from_wcs(frames, pixref):
 
     """
 
-    result = numpy.zeros((len(frames), pixref.shape[1]))
-
-    with frames[0].open() as hdulist:
-        wcsh = wcs.WCS(hdulist[0].header)
-        skyref = wcsh.wcs_pix2world(pixref, 1)
-
-    for idx, frame in enumerate(frames[1:]):
-        with frame.open() as hdulist:
-            wcsh = wcs.WCS(hdulist[0].header)
-            pixval = wcsh.wcs_world2pix(skyref, 1)
-            result[idx + 1] = -(pixval[0] - pixref[0])
-
+    # only the headers of the frames are read
+    wcslist = [record.wcs for record in frame_records(frames)]
+    pixval = _pixels_from_wcs(wcslist, pixref, 1)
+    result = -(pixval[:, 0] - pixref[0])
+    result[0] = 0
     return result
 
 
 def offsets_from_wcs_imgs(imgs, pixref):
 
-    result = numpy.zeros((len(imgs), pixref.shape[1]))
-
-    ref = imgs[0]
-    wcsh = wcs.WCS(ref[0].header)
-    skyref = wcsh.wcs_pix2world(pixref, 1)
-
-    for idx, img in enumerate(imgs[1:]):
-        wcsh = wcs.WCS(img[0].header)
-        pixval = wcsh.wcs_world2pix(skyref, 1)
-        result[idx + 1] = -(pixval[0] - pixref[0])
-
+    wcslist = [wcs_cache.get(img[0].header) for img in imgs]
+    pixval = _pixels_from_wcs(wcslist, pixref, 1)
+    result = -(pixval[:, 0] - pixref[0])
+    result[0] = 0
     return result
 
 
@@ -74,20 +198,9 @@ def reference_pix_from_wcs(frames, pixref, origin=1):
 
     """
 
-    result = []
-
-    with frames[0].open() as hdulist:
-        wcsh = wcs.WCS(hdulist[0].header)
-        skyref = wcsh.wcs_pix2world([pixref], origin)
-        result.append(pixref)
-
-    for idx, frame in enumerate(frames[1:]):
-        with frame.open() as hdulist:
-            wcsh = wcs.WCS(hdulist[0].header)
-            pixval = wcsh.wcs_world2pix(skyref, origin)
-            result.append(tuple(pixval[0]))
-
-    return result
+    wcslist = [record.wcs for record in frame_records(frames)]
+    pixval = _pixels_from_wcs(wcslist, [pixref], origin)
+    return [pixref] + [tuple(pix[0]) for pix in pixval[1:]]
 
 
 def reference_pix_from_wcs_imgs(imgs, pixref, origin=1):
@@ -103,17 +216,6 @@ def reference_pix_from_wcs_imgs(imgs, pixref, origin=1):
 
     """
 
-    result = []
-
-    refimg = imgs[0]
-
-    wcsh = wcs.WCS(refimg[0].header)
-    skyref = wcsh.wcs_pix2world([pixref], origin)
-    result.append(pixref)
-
-    for idx, img in enumerate(imgs[1:]):
-        wcsh = wcs.WCS(img[0].header)
-        pixval = wcsh.wcs_world2pix(skyref, origin)
-        result.append(tuple(pixval[0]))
-
-    return result
+    wcslist = [wcs_cache.get(img[0].header) for img in imgs]
+    pixval = _pixels_from_wcs(wcslist, [pixref], origin)
+    return [pixref] + [tuple(pix[0]) for pix in pixval[1:]]
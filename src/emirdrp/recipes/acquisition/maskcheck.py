@@ -35,6 +35,7 @@ from emirdrp.core.recipe import EmirRecipe
 from emirdrp.core.utils import create_rot2d
 from emirdrp.processing.combine import basic_processing_, combine_images
 from emirdrp.processing.combine import process_ab, process_abba
+from emirdrp.processing.roi import StageTimer, TileStack
 import emirdrp.requirements as reqs
 import emirdrp.products as prods
 import emirdrp.instrument.distortions as dist
@@ -336,44 +337,95 @@ class MaskCheckRecipe(EmirRecipe):
         wcs = astropy.wcs.WCS(hdulist[0].header)
         self.logger.debug("dtype of data %s", data.dtype)
 
-        self.logger.debug("median filter (3x3)")
-        image_base = ndi.filters.median_filter(data, size=3)
+        timer = StageTimer()
+        with timer("windows"):
+            # Compute detector coordinates of bars
+            all_coords_virt = np.empty((110, 2))
+            all_coords_real = np.empty((110, 2))
+
+            # Origin of coordinates is 1
+            for bar in csu_conf.bars.values():
+                all_coords_virt[bar.idx - 1] = bar.xpos, bar.y0
+
+            # Origin of coordinates is 1 for this function
+            _x, _y = dist.wcs_exvp(wcs, all_coords_virt[:, 0], all_coords_virt[:, 1])
+            all_coords_real[:, 0] = _x
+            all_coords_real[:, 1] = _y
+
+            # FIXME: hardcoded value
+            # use what is defined in CSUBarModel instead
+            h = 16
+            slit_h_virt = 16.242
+            slit_h_tol = 3
+            slits_bb = {}
+
+            regionw = 12
+            candidates = []
+            for idx in range(csuconf.EMIR_NBARS):
+                lbarid = idx + 1
+                rbarid = lbarid + csuconf.EMIR_NBARS
+                ref_x_l_v, ref_y_l_v = all_coords_virt[lbarid - 1]
+                ref_x_r_v, ref_y_r_v = all_coords_virt[rbarid - 1]
+
+                ref_x_l_d, ref_y_l_d = all_coords_real[lbarid - 1]
+                ref_x_r_d, ref_y_r_d = all_coords_real[rbarid - 1]
+
+                width_v = ref_x_r_v - ref_x_l_v
+                # width_d = ref_x_r_d - ref_x_l_d
+
+                if (ref_y_l_d >= 2047 + h) or (ref_y_l_d <= 1 - h):
+                    # print('reference y position is outlimits, skipping')
+                    continue
+
+                if width_v < 5:
+                    # print('width is less than 5 pixels, skipping')
+                    continue
+
+                px1 = coor_to_pix_1d(ref_x_l_d) - 1
+                px2 = coor_to_pix_1d(ref_x_r_d) - 1
+                prow = coor_to_pix_1d(ref_y_l_d) - 1
+                candidates.append((idx, px1, px2, prow))
+
+            # windows around the borders of the bars, large enough
+            # for the search and the refinement of calc_bars_borders
+            wrows, wcols = _BORDER_WINDOW
+            tiles = TileStack(
+                [prow - wrows for _, _, _, prow in candidates] * 2,
+                [px1 - wcols for _, px1, _, _ in candidates]
+                + [px2 - wcols for _, _, px2, _ in candidates],
+                shape=(2 * wrows + 1, 2 * wcols + 1),
+                margin=(2, 2),
+            )
 
-        # Cast as original type for skimage
-        self.logger.debug("casting image to unit16 (for skimage)")
-        iuint16 = np.iinfo(np.uint16)
-        image = np.clip(image_base, iuint16.min, iuint16.max).astype(np.uint16)
+        self.logger.debug("median filter (3x3)")
+        with timer("median"):
+            image_base = ndi.median_filter(tiles.gather(data), size=(1, 3, 3))
+
+            # Cast as original type for skimage
+            self.logger.debug("casting image to unit16 (for skimage)")
+            iuint16 = np.iinfo(np.uint16)
+            image_tiles = np.clip(image_base, iuint16.min, iuint16.max).astype(
+                np.uint16
+            )
 
         self.logger.debug("compute Sobel filter")
-        # FIXME: compute sob and sob_v is redundant
-        sob = filt.sobel(image)
-        self.save_intermediate_array(sob, "sobel_image.fits")
-        sob_v = filt.sobel_v(image)
-        self.save_intermediate_array(sob_v, "sobel_v_image.fits")
-
-        # Compute detector coordinates of bars
-        all_coords_virt = np.empty((110, 2))
-        all_coords_real = np.empty((110, 2))
-
-        # Origin of coordinates is 1
-        for bar in csu_conf.bars.values():
-            all_coords_virt[bar.idx - 1] = bar.xpos, bar.y0
-
-        # Origin of coordinates is 1 for this function
-        _x, _y = dist.wcs_exvp(wcs, all_coords_virt[:, 0], all_coords_virt[:, 1])
-        all_coords_real[:, 0] = _x
-        all_coords_real[:, 1] = _y
-
-        # FIXME: hardcoded value
-        # use what is defined in CSUBarModel instead
-        h = 16
-        slit_h_virt = 16.242
-        slit_h_tol = 3
-        slits_bb = {}
+        with timer("sobel"):
+            sob_v = np.empty(image_tiles.shape)
+            for tile, tile_sob_v in zip(image_tiles, sob_v):
+                tile_sob_v[...] = filt.sobel_v(tile)
+            image = tiles.scatter(image_tiles, data.shape)
+            sob_v = tiles.scatter(sob_v, data.shape)
+
+        if self.intermediate_results:
+            # the complete filtered images are only computed to save them
+            image_full = ndi.median_filter(data, size=3)
+            image_full = np.clip(image_full, iuint16.min, iuint16.max).astype(np.uint16)
+            self.save_intermediate_array(filt.sobel(image_full), "sobel_image.fits")
+            self.save_intermediate_array(filt.sobel_v(image_full), "sobel_v_image.fits")
 
         mask1 = np.zeros_like(hdulist[0].data)
 
-        for idx in range(csuconf.EMIR_NBARS):
+        for idx, px1, px2, prow in candidates:
             lbarid = idx + 1
             rbarid = lbarid + csuconf.EMIR_NBARS
             ref_x_l_v, ref_y_l_v = all_coords_virt[lbarid - 1]
@@ -382,22 +434,7 @@ class MaskCheckRecipe(EmirRecipe):
             ref_x_l_d, ref_y_l_d = all_coords_real[lbarid - 1]
             ref_x_r_d, ref_y_r_d = all_coords_real[rbarid - 1]
 
-            width_v = ref_x_r_v - ref_x_l_v
-            # width_d = ref_x_r_d - ref_x_l_d
-
-            if (ref_y_l_d >= 2047 + h) or (ref_y_l_d <= 1 - h):
-                # print('reference y position is outlimits, skipping')
-                continue
-
-            if width_v < 5:
-                # print('width is less than 5 pixels, skipping')
-                continue
-
             plot = False
-            regionw = 12
-            px1 = coor_to_pix_1d(ref_x_l_d) - 1
-            px2 = coor_to_pix_1d(ref_x_r_d) - 1
-            prow = coor_to_pix_1d(ref_y_l_d) - 1
 
             comp_l, comp_r = calc_bars_borders(
                 image,
@@ -467,6 +504,7 @@ class MaskCheckRecipe(EmirRecipe):
             slits_bb[lbarid] = cbb
             mask1[cbb.slice] = lbarid
 
+        self.logger.info("slit detection timings: %s", timer)
         self.save_intermediate_array(mask1, "mask_slit_computed.fits")
         return slits_bb
 
@@ -591,6 +629,13 @@ def compute_off_rotation(
     return offset, angle, qc, (slits, p1, p2, q1, q2)
 
 
+# Half size (rows, columns) of the windows around the borders of the
+# bars read by calc_bars_borders: 3 rows x 3 steps around the bar and
+# 12 + 5 columns of the search and the refinement, plus the 3 pixels
+# used by refine_peaks
+_BORDER_WINDOW = (9, 18)
+
+
 def calc_bars_borders(
     image,
     sob,
@@ -19,8 +19,6 @@ import scipy.optimize as opz
 from scipy import ndimage
 
 from astropy.modeling import models, fitting
-import photutils
-from photutils.aperture import CircularAperture
 
 from numina.array.recenter import centering_centroid
 from numina.array.utils import image_box
@@ -28,9 +26,13 @@ from numina.array.fwhm import compute_fwhm_2d_spline
 from numina.constants import FWHM_G
 from numina.array.fwhm import compute_fwhm_2d_simple
 from numina.array.utils import expand_region
+from numina.array.utils import wcs_to_pix_np
 
-from .procedures import compute_fwhm_enclosed_direct
-from .procedures import compute_fwhm_enclosed_grow
+from .procedures import enclosed_flux_radii
+from .procedures import fit_fwhm_enclosed_direct
+from .procedures import fit_fwhm_enclosed_grow
+from .procedures import growth_curve
+from .procedures import GrowthCurve
 from .procedures import moments
 from .procedures import AnnulusBackgroundEstimator
 from .procedures import image_box2d
@@ -251,12 +253,9 @@ def pinhole_char(data, ncenters, box=4, recenter_pinhole=True, maxdist=10.0):
     # with radius 2.0 pixels and 4.0 pixels
 
     apertures = [2.0, 4.0]
-    for idx, rad in enumerate(apertures):
-        _logger.info("compute photometry with aperture radii %s", rad)
-        apertures = CircularAperture(centers_r[:, :2], r=rad)
-        faper = photutils.aperture_photometry(data, apertures)
-        mm0[:, 9 + idx] = faper["aperture_sum"]
-        _logger.info("done")
+    _logger.info("compute photometry with aperture radii %s", apertures)
+    mm0[:, 9 : 9 + 2] = GrowthCurve(apertures)(data, centers_r[:, :2])
+    _logger.info("done")
 
     # Convert coordinates to FITS
     mm0[:, 0:2] += 1
@@ -391,17 +390,20 @@ def pinhole_char2(
         _logger.info("background %6.2f, r1 %7.2f r2 %7.2f", bck, rs1, rs2)
         mm0[idx, 5 : 5 + 3] = bck, rs1, rs2
         aper_rad = rad
-        ca = CircularAperture([(xx0, yy0)], aper_rad)
-        m = photutils.aperture_photometry(part_s, ca)
-        flux_aper = m["aperture_sum"][0]
+        flux_aper = growth_curve(part_s, xx0, yy0, [aper_rad])[0]
         _logger.info("aper rad %f, aper flux %f", aper_rad, flux_aper)
         mm0[idx, 8 : 8 + 2] = aper_rad, flux_aper
 
         _logger.info("Radial fit, peak: %f fwhm %f", rpeak, rfwhm)
 
+        # growth curve shared by the direct and the fitted methods
+        enc_rad = enclosed_flux_radii(maxrad=fit_rad)
+        enc_flux = growth_curve(part_s, xx0, yy0, enc_rad)
+
         try:
-            dpeak, dfwhm, smsg = compute_fwhm_enclosed_direct(
-                part_s, xx0, yy0, maxrad=fit_rad
+            peak_pix = wcs_to_pix_np((xx0, yy0))
+            dpeak, dfwhm, smsg = fit_fwhm_enclosed_direct(
+                part_s[tuple(peak_pix)], enc_rad, enc_flux
             )
             _logger.info("Enclosed direct, peak: %f fwhm %f", dpeak, dfwhm)
         except Exception as error:
@@ -409,8 +411,9 @@ def pinhole_char2(
             dpeak, dfwhm = -99.0, -99.0
 
         try:
-            eamp, efwhm, epeak, emsg = compute_fwhm_enclosed_grow(
-                part_s, xx0, yy0, maxrad=fit_rad
+            enc_idx = enc_flux.argmax()
+            eamp, efwhm, epeak, emsg = fit_fwhm_enclosed_grow(
+                enc_flux[enc_idx], enc_rad[: enc_idx + 1], enc_flux[: enc_idx + 1]
             )
             _logger.info("Enclosed fit, peak: %f fwhm %f", epeak, efwhm)
         except Exception as error:
@@ -474,12 +477,9 @@ def pinhole_char2(
     # with radius 2.0 pixels and 4.0 pixels
 
     apertures = [2.0, 4.0]
-    for idx, rad in enumerate(apertures):
-        _logger.info("compute photometry with aperture radii %s", rad)
-        apertures = CircularAperture(centers_r[:, :2], r=rad)
-        faper = photutils.aperture_photometry(data, apertures)
-        mm0[:, 33 + idx] = faper["aperture_sum"]
-        _logger.info("done")
+    _logger.info("compute photometry with aperture radii %s", apertures)
+    mm0[:, 33 : 33 + 2] = GrowthCurve(apertures)(data, centers_r[:, :2])
+    _logger.info("done")
 
     # FITS coordinates
     mm0[:, :4] += 1
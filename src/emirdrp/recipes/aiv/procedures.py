@@ -27,6 +27,8 @@ from numina.array.utils import image_box2d
 from numina.modeling import EnclosedGaussian
 from numina.constants import FWHM_G
 
+from emirdrp.core.cache import LRUCache
+
 
 def encloses_annulus(x_min, x_max, y_min, y_max, nx, ny, r_in, r_out):
     """Encloses function backported from old photutils"""
@@ -79,18 +81,152 @@ class AnnulusBackgroundEstimator:
         return bck
 
 
+class GrowthCurve:
+    """Flux enclosed in circular apertures of several radii
+
+    The flux of every radius is computed with the exact overlap of
+    the circle with the pixels, as aperture_photometry with
+    method='exact', from a stamp of the image cut only once per
+    center. The overlap weights depend only on the radii and on the
+    offset of the center within its pixel, so they are computed once
+    and reused for the centers whose offsets are equal to `decimals`
+    digits, that differ only by floating point noise.
+
+    Parameters
+    ----------
+    rad : array_like
+        Radii of the apertures, in pixels.
+    maxcache : int
+        Maximum number of sets of weights kept.
+    decimals : int
+        Number of decimals of the offsets compared to reuse the weights.
+
+    """
+
+    def __init__(self, rad, maxcache=64, decimals=10):
+        self.rad = np.atleast_1d(np.asarray(rad, dtype=float))
+        if self.rad.size == 0 or self.rad.min() <= 0:
+            raise ValueError("the radii must be positive")
+        self.decimals = decimals
+        # half size of the stamps
+        self.half = int(math.ceil(self.rad.max())) + 1
+        self._weights = LRUCache(maxcache)
+
+    @property
+    def size(self):
+        return 2 * self.half + 1
+
+    def weights(self, dx, dy):
+        """Overlap weights of the apertures with the pixels of a stamp.
+
+        Parameters
+        ----------
+        dx, dy : float
+            Offset of the center from the central pixel of the stamp.
+
+        Returns
+        -------
+        weights : numpy.ndarray
+            Array of shape (nrad, size * size).
+
+        """
+        key = (round(dx, self.decimals), round(dy, self.decimals))
+        return self._weights.lookup(key, lambda: self._compute_weights(dx, dy))
+
+    def _compute_weights(self, dx, dy):
+        half = self.half
+        weights = np.zeros((len(self.rad), self.size, self.size))
+        for idx, r in enumerate(self.rad):
+            # box of half size k around the central pixel
+            k = min(half, int(math.ceil(r)) + 1)
+            sl = slice(half - k, half + k + 1)
+            weights[idx, sl, sl] = circular_overlap_grid(
+                -k - 0.5 - dx,
+                k + 0.5 - dx,
+                -k - 0.5 - dy,
+                k + 0.5 - dy,
+                2 * k + 1,
+                2 * k + 1,
+                r,
+                1,
+                1,
+            )
+        return weights.reshape(len(self.rad), -1)
+
+    def __call__(self, data, centers):
+        """Growth curves of the sources of an image.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            2D image.
+        centers : array_like
+            Array of shape (ncenters, 2) with the x, y coordinates of
+            the centers (center of first pixel is [0, 0]).
+
+        Returns
+        -------
+        flux : numpy.ndarray
+            Array of shape (ncenters, nrad) with the flux enclosed in
+            each radius. As in aperture_photometry, the flux is NaN
+            if the aperture does not overlap the image or if it
+            contains non finite pixels.
+
+        """
+        centers = np.atleast_2d(np.asarray(centers, dtype=float))
+        ny, nx = data.shape
+        half = self.half
+        flux = np.empty((len(centers), len(self.rad)))
+        for idx, (xc, yc) in enumerate(centers):
+            ix = math.floor(xc + 0.5)
+            iy = math.floor(yc + 0.5)
+            weights = self.weights(xc - ix, yc - iy)
+
+            # cut the stamp, padding with zeros outside the image
+            x1, x2 = max(ix - half, 0), min(ix + half + 1, nx)
+            y1, y2 = max(iy - half, 0), min(iy + half + 1, ny)
+            stamp = np.zeros((self.size, self.size), dtype=data.dtype)
+            inside = np.zeros((self.size, self.size))
+            if x1 < x2 and y1 < y2:
+                sly = slice(y1 - iy + half, y2 - iy + half)
+                slx = slice(x1 - ix + half, x2 - ix + half)
+                stamp[sly, slx] = data[y1:y2, x1:x2]
+                inside[sly, slx] = 1
+            stamp = stamp.ravel()
+
+            if np.isfinite(stamp).all():
+                flux[idx] = weights @ stamp
+            else:
+                for ridx, weight in enumerate(weights):
+                    useful = weight > 0
+                    flux[idx, ridx] = np.sum(weight[useful] * stamp[useful])
+            flux[idx, weights @ inside.ravel() == 0] = np.nan
+        return flux
+
+
+# growth curves by radii, reused by growth_curve
+growth_curve_cache = LRUCache(maxsize=8)
+
+
+def growth_curve(imgs, xc, yc, rad):
+    """Flux enclosed in circles of radii rad around (xc, yc)."""
+    rad = np.atleast_1d(np.asarray(rad, dtype=float))
+    growth = growth_curve_cache.lookup(tuple(rad), lambda: GrowthCurve(rad))
+    return growth(imgs, [(xc, yc)])[0]
+
+
+def enclosed_flux_radii(minrad=0.01, maxrad=15.0):
+    """Radii used to sample the enclosed flux."""
+    return np.logspace(np.log10(minrad), np.log10(maxrad), num=100)
+
+
 def compute_fwhm_enclosed(imgs, xc, yc, minrad=0.01, maxrad=15.0):
 
     peak_pix = wcs_to_pix_np((xc, yc))
     peak = imgs[tuple(peak_pix)]
 
-    rad = np.logspace(np.log10(minrad), np.log10(maxrad), num=100)
-    flux = np.zeros_like(rad)
-    positions = [(xc, yc)]
-    for idr, r in enumerate(rad):
-        ca = CircularAperture(positions, r)
-        m = aperture_photometry(imgs, ca)
-        flux[idr] = m["aperture_sum"][0]
+    rad = enclosed_flux_radii(minrad, maxrad)
+    flux = growth_curve(imgs, xc, yc, rad)
 
     idx = flux.argmax()
 
@@ -110,13 +246,8 @@ def compute_fwhm_enclosed_direct(imgs, xc, yc, minrad=0.01, maxrad=15.0):
     peak_pix = wcs_to_pix_np((xc, yc))
     peak = imgs[tuple(peak_pix)]
 
-    rad = np.logspace(np.log10(minrad), np.log10(maxrad), num=100)
-    flux = np.zeros_like(rad)
-    positions = [(xc, yc)]
-    for idr, r in enumerate(rad):
-        ca = CircularAperture(positions, r)
-        m = aperture_photometry(imgs, ca)
-        flux[idr] = m["aperture_sum"][0]
+    rad = enclosed_flux_radii(minrad, maxrad)
+    flux = growth_curve(imgs, xc, yc, rad)
 
     return fit_fwhm_enclosed_direct(peak, rad, flux)
 
@@ -153,13 +284,8 @@ def fit_fwhm_enclosed_direct(peak, rad, flux):
 
 def compute_fwhm_enclosed_grow(imgs, xc, yc, minrad=0.01, maxrad=15.0):
 
-    rad = np.logspace(np.log10(minrad), np.log10(maxrad), num=100)
-    flux = np.zeros_like(rad)
-    positions = [(xc, yc)]
-    for idr, r in enumerate(rad):
-        ca = CircularAperture(positions, r)
-        m = aperture_photometry(imgs, ca)
-        flux[idr] = m["aperture_sum"][0]
+    rad = enclosed_flux_radii(minrad, maxrad)
+    flux = growth_curve(imgs, xc, yc, rad)
     idx = flux.argmax()
     rmodel = rad[: idx + 1]
     fmodel = flux[: idx + 1]
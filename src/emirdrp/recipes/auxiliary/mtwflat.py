@@ -10,7 +10,9 @@
 
 """Twilight Flat Recipe for a list of frames in different filters"""
 
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+import os
 import sys
 import uuid
 
@@ -20,13 +22,14 @@ if sys.version_info[:2] <= (3, 10):
 import astropy.io.fits as fits
 from numina.array.combine import median
 from numina.array.robustfit import fit_theil_sen
-from numina.core import Result
+from numina.core import Parameter, Result
 from numina.frame.utils import copy_img
 import numina.types.datatype as dt
 from numina.processing.combine import basic_processing_with_combination_frames
 import numpy
 
 from emirdrp.core.recipe import EmirRecipe
+from emirdrp.processing.framestore import FrameStore
 import emirdrp.products as prods
 import emirdrp.requirements as reqs
 
@@ -39,6 +42,13 @@ class MultiTwilightFlatRecipe(EmirRecipe):
     master_bias = reqs.MasterBiasRequirement()
     master_dark = reqs.MasterDarkRequirement()
 
+    memory_budget = Parameter(
+        1024, "Memory (MB) used to fit the slopes of each block of rows"
+    )
+    max_workers = Parameter(
+        0, "Number of processes used to fit the blocks of rows (0 for serial)"
+    )
+
     twflatframes = Result(dt.ListOfType(prods.MasterIntensityFlat))
 
     def run(self, rinput):
@@ -70,7 +80,12 @@ class MultiTwilightFlatRecipe(EmirRecipe):
             # to revert to non-ramp
             # res = self.run_per_filter(frames, flow)
             try:
-                res = self.run_per_filter_ramp(frames, saturation=saturation)
+                res = self.run_per_filter_ramp(
+                    frames,
+                    saturation=saturation,
+                    memory_budget=rinput.memory_budget,
+                    max_workers=rinput.max_workers,
+                )
                 results.append(res)
             except ValueError:
                 self.logger.info("filter %s cannot be processed", filt)
@@ -102,24 +117,60 @@ class MultiTwilightFlatRecipe(EmirRecipe):
 
         return hdulist
 
-    def run_per_filter_ramp(self, frames, saturation, errors=False):
+    def run_per_filter_ramp(
+        self, frames, saturation, errors=False, memory_budget=1024, max_workers=0
+    ):
         imgs = [frame.open() for frame in frames]
-        return self.run_img_per_filter_ramp(imgs, saturation, errors)
+        return self.run_img_per_filter_ramp(
+            imgs,
+            saturation,
+            errors,
+            memory_budget=memory_budget,
+            max_workers=max_workers,
+        )
 
-    def run_img_per_filter_ramp(self, imgs, saturation, errors=False):
+    def run_img_per_filter_ramp(
+        self, imgs, saturation, errors=False, memory_budget=1024, max_workers=0
+    ):
 
         nimages = len(imgs)
         if nimages == 0:
             raise ValueError("len(images) == 0")
 
+        bshape = self.datamodel.shape
+        # the frames are stacked in a float32 cube in a memory-mapped
+        # file, the slopes are fitted in blocks of rows
+        with FrameStore(directory=os.getcwd()) as store:
+            flat_frames = store.create(
+                "flat_frames", (nimages, bshape[0], bshape[1]), fill=None
+            )
+            return self.run_cube_per_filter_ramp(
+                imgs,
+                flat_frames,
+                store.filename("flat_frames"),
+                saturation,
+                errors,
+                memory_budget=memory_budget,
+                max_workers=max_workers,
+            )
+
+    def run_cube_per_filter_ramp(
+        self,
+        imgs,
+        flat_frames,
+        filename,
+        saturation,
+        errors=False,
+        memory_budget=1024,
+        max_workers=0,
+    ):
+        nimages = len(imgs)
+        bshape = self.datamodel.shape
         median_frames = numpy.empty((nimages,))
         exptime_frames = []
         utc_frames = []
-        # generate 3D cube
-        bshape = self.datamodel.shape
-        flat_frames = numpy.empty((bshape[0], bshape[1], nimages))
         for idx, image in enumerate(imgs):
-            flat_frames[:, :, idx] = image["primary"].data
+            flat_frames[idx] = image["primary"].data
             exptime_frames.append(image[0].header["EXPTIME"])
             median_frames[idx] = numpy.median(image["primary"].data)
             utc_frames.append(image[0].header["UTC"])
@@ -131,6 +182,7 @@ class MultiTwilightFlatRecipe(EmirRecipe):
                 median_frames[idx],
                 utc_frames[-1],
             )
+        flat_frames.flush()
 
         # filter saturated images
         good_images = median_frames < saturation
@@ -160,13 +212,17 @@ class MultiTwilightFlatRecipe(EmirRecipe):
                     saturation,
                 )
 
-            m = flat_frames[:, :, good_images]
-            # Reshape array to obtain a 2D array
-            m_r = m.reshape((bshape[0] * bshape[1], ngood_images))
             self.logger.debug("fitting slopes with Theil-Sen")
             # self.logger.debug('fitting slopes with mean-squares')
             # ll = nppol.polyfit(median_frames[good_images], m_r.T, deg=1)
-            ll = self.filter_nsigma(median_frames[good_images], m_r.T)
+            ll = self.filter_nsigma_rows(
+                median_frames[good_images],
+                filename,
+                numpy.nonzero(good_images)[0],
+                bshape,
+                memory_budget=memory_budget,
+                max_workers=max_workers,
+            )
 
             slope = ll[1].reshape(bshape)
             # base = ll[0].reshape(bshape)
@@ -225,6 +281,100 @@ class MultiTwilightFlatRecipe(EmirRecipe):
 
         return ll
 
+    def filter_nsigma_rows(
+        self,
+        median_val,
+        filename,
+        index,
+        shape,
+        nsigma=10.0,
+        nloop=1,
+        memory_budget=1024,
+        max_workers=0,
+    ):
+        """Same as filter_nsigma, fitting the frames in a file by blocks of rows.
+
+        Parameters
+        ----------
+        median_val : numpy.ndarray
+            Median value of each frame.
+        filename : str
+            .npy file with the cube of frames, of shape (nimages,) + shape.
+        index : numpy.ndarray
+            Index of the frames to fit in the cube.
+        shape : tuple
+            Shape of the frames.
+        nsigma : float
+            Values farther than nsigma robust deviations from the fit are
+            replaced by the prediction of the fit.
+        nloop : int
+            Number of iterations of the rejection.
+        memory_budget : float
+            Memory (MB) used to fit each block of rows.
+        max_workers : int
+            Number of processes used to fit the blocks (0 for serial).
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (2, npixels) with the intercepts and slopes.
+
+        """
+        nrows = block_rows(shape, len(index), memory_budget)
+        blocks = [(r, min(r + nrows, shape[0])) for r in range(0, shape[0], nrows)]
+        self.logger.debug("fitting %d blocks of %d rows", len(blocks), nrows)
+
+        # Initial estimation
+        ll = self.fit_blocks(median_val, filename, index, blocks, max_workers)
+        ni = 0
+        self.logger.debug("initial estimation")
+        while ni < nloop:
+            # Compute MAD, one frame at a time
+            self.logger.debug("loop %d", ni + 1)
+            mad = numpy.empty(len(index))
+            cube = numpy.load(filename, mmap_mode="r")
+            for pos, idx in enumerate(index):
+                image_val = cube[idx].astype(float).ravel()
+                image_diff = image_val - (ll[0] + median_val[pos] * ll[1])
+                mad[pos] = compute_mad(image_diff[numpy.newaxis])[0]
+            del cube
+            sigma_robust = nsigma * 1.4826 * mad
+            self.logger.debug("compute robust std deviation")
+            self.logger.debug(
+                "min %7.1f max %7.1f mean %7.1f",
+                sigma_robust.min(),
+                sigma_robust.max(),
+                sigma_robust.mean(),
+            )
+            self.logger.debug("Theil-Sen fit")
+            ll = self.fit_blocks(
+                median_val, filename, index, blocks, max_workers, ll, sigma_robust
+            )
+            ni += 1
+
+        return ll
+
+    def fit_blocks(
+        self, median_val, filename, index, blocks, max_workers, ll=None, sigma=None
+    ):
+        """Theil-Sen fit of the blocks of rows of a cube of frames."""
+        ncols = numpy.load(filename, mmap_mode="r").shape[2]
+        args = []
+        for row1, row2 in blocks:
+            if ll is None:
+                coeff = None
+            else:
+                coeff = ll[:, row1 * ncols : row2 * ncols]
+            args.append((filename, median_val, index, row1, row2, coeff, sigma))
+
+        if max_workers > 0:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(fit_theil_sen_rows, *arg) for arg in args]
+                results = [future.result() for future in futures]
+        else:
+            results = [fit_theil_sen_rows(*arg) for arg in args]
+        return numpy.concatenate(results, axis=1)
+
     def compose_result(
         self,
         imgs,
@@ -280,3 +430,53 @@ def compute_mad(x):
     m2 = numpy.abs(x - m1[:, numpy.newaxis])
     mad = numpy.median(m2, axis=1)
     return mad
+
+
+def block_rows(shape, nimages, memory_budget):
+    """Number of rows of the blocks fitted within the memory budget (MB)."""
+    # the Theil-Sen fit and the rejection use about 16 float64
+    # temporary arrays of the size of the block
+    row_bytes = 16 * 8 * nimages * shape[1]
+    nrows = int(memory_budget * 1024**2 // row_bytes)
+    return min(shape[0], max(1, nrows))
+
+
+def fit_theil_sen_rows(filename, x, index, row1, row2, coeff=None, sigma=None):
+    """Theil-Sen fit of the pixels of a block of rows of a cube of frames.
+
+    Parameters
+    ----------
+    filename : str
+        .npy file with the cube of frames, of shape (nimages, ny, nx).
+    x : numpy.ndarray
+        X coordinate of each fitted frame.
+    index : numpy.ndarray
+        Index of the fitted frames in the cube.
+    row1, row2 : int
+        Rows of the block.
+    coeff : numpy.ndarray or None
+        Previous fit of the block, of shape (2, npixels). If given, the
+        values deviating more than sigma from the fit are replaced by
+        the prediction of the fit.
+    sigma : numpy.ndarray or None
+        Maximum deviation of each frame.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (2, npixels) with the intercepts and slopes.
+
+    """
+    cube = numpy.load(filename, mmap_mode="r")
+    image_val = cube[index, row1:row2].astype(float).reshape(len(index), -1)
+    if coeff is not None:
+        base, slope = coeff
+        image_val_pred = base + x[:, numpy.newaxis] * slope
+        image_diff = image_val - image_val_pred
+        # Check values over sigma
+        mask_over = numpy.abs(image_diff) >= sigma[:, numpy.newaxis]
+        # Insert expected values in image
+        # instead of masking
+        image_val[mask_over] = image_val_pred[mask_over]
+    ll = fit_theil_sen(x, image_val)
+    return numpy.reshape(ll, (2, -1))
@@ -12,7 +12,7 @@ Arc calibration Recipe for EMIR
 """
 
 from numina.array.combine import median
-from numina.core import Requirement, Result
+from numina.core import Parameter, Requirement, Result
 from numina.types.linescatalog import LinesCatalog
 
 from emirdrp.core.recipe import EmirRecipe
@@ -36,6 +36,9 @@ class ArcCalibrationRecipe(EmirRecipe):
     master_dark = reqs.MasterDarkRequirement()
     bound_param = reqs.RefinedBoundaryModelParamRequirement()
     lines_catalog = Requirement(LinesCatalog, "Catalog of lines")
+    max_workers = Parameter(
+        0, "Number of processes used to calibrate the slitlets (0 for serial)"
+    )
 
     reduced_image = Result(prods.ProcessedImage)
     rectwv_coeff = Result(prods.RectWaveCoeff)
@@ -66,6 +69,7 @@ class ArcCalibrationRecipe(EmirRecipe):
             reduced_image,
             rinput.bound_param,
             rinput.lines_catalog,
+            args_max_workers=rinput.max_workers,
         )
 
         # generate associated ds9 region files and save them in work directory
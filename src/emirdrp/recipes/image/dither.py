@@ -10,9 +10,9 @@
 """Recipe for the reduction of imaging mode observations."""
 
 import datetime
+import hashlib
 import logging
 import os
-import shutil
 import sys
 import uuid
 
@@ -29,7 +29,7 @@ import numina.array.combine as nacom
 import numina.frame.combine as nfcom
 from numina.util.context import manage_fits
 from numina.util.convert import convert_date
-from numina.frame import resize_fits, custom_region_to_str
+from numina.frame import resize_hdu, custom_region_to_str
 import numpy
 from scipy import interpolate
 from scipy.ndimage import median_filter
@@ -39,7 +39,13 @@ import sep
 import emirdrp.requirements as reqs
 import emirdrp.products as prods
 from emirdrp.processing.wcs import offsets_from_wcs_imgs
+from emirdrp.processing.blockcombine import combine_row_blocks
 from emirdrp.processing.corr import offsets_from_crosscor_regions
+from emirdrp.processing.framestore import FrameStore
+from emirdrp.processing.headerindex import INDEX_FILENAME, HeaderIndex, frame_records
+from emirdrp.processing.labelstats import LabelIndex, TileSurface
+from emirdrp.processing.polar import polar_coordinates, polar_binned_median
+from emirdrp.processing.skywindow import SkyWindow
 from emirdrp.core.recipe import EmirRecipe
 
 from .naming import name_redimensioned_frames, name_object_mask, name_skybackground
@@ -50,6 +56,13 @@ from emirdrp.core import EMIR_NAXIS1
 from emirdrp.core import EMIR_NAXIS2
 
 
+def _clear_outside(data, region):
+    """Set to zero the pixels of data outside region."""
+    outside = numpy.ones(data.shape, dtype=bool)
+    outside[region] = False
+    data[outside] = 0
+
+
 class ImageInfo:
     def __init__(self, origin):
         self.origin = origin
@@ -67,6 +80,12 @@ class ImageInfo:
         self.resized_mask = ""
         self.lastname = ""
         self.flat_corrected = ""
+        # header and memory-mapped data of the processing stages
+        self.header = None
+        self.resized_data = None
+        self.resized_mask_data = None
+        self.flat_data = None
+        self.lastdata = None
 
     def __str__(self):
         output = ""
@@ -185,6 +204,13 @@ class FullDitheredImagesRecipe(EmirRecipe):
     method_kwargs = Parameter(
         dict(), description="Arguments for combination method", optional=True
     )
+    combine_memory = Parameter(
+        128, description="Memory budget for the combination of frames [MB]"
+    )
+    header_index = Parameter(
+        False,
+        description="Keep the headers of the frames in an index in the work directory",
+    )
 
     sky_images = Parameter(
         0, "Images used to estimate the " "background before and after current image"
@@ -206,6 +232,29 @@ class FullDitheredImagesRecipe(EmirRecipe):
     result_sky = Result(prods.ProcessedImage, optional=True)
 
     def run(self, rinput):
+        # the intermediate frames are updated in place in memory-mapped
+        # files, that are removed at the end of the reduction; the
+        # intermediate FITS files are only saved if intermediate_results
+        # is set
+        self.frame_store = FrameStore(directory=os.getcwd())
+        # precomputed models of the ad hoc sky correction
+        self.adhoc_sky_models = {}
+        # the frames are combined by blocks of rows within this budget
+        self.combine_max_memory = rinput.combine_memory * 1024**2
+        # the headers are read again in every run, unless they are kept
+        # in an index
+        if rinput.header_index:
+            self.header_index = HeaderIndex(os.path.join(os.getcwd(), INDEX_FILENAME))
+        else:
+            self.header_index = None
+        try:
+            return self.run_frames(rinput)
+        finally:
+            self.frame_store.close()
+            if self.header_index is not None:
+                self.header_index.close()
+
+    def run_frames(self, rinput):
 
         target_is_sky = True
         obresult = rinput.obresult
@@ -227,13 +276,11 @@ class FullDitheredImagesRecipe(EmirRecipe):
         # insconf = rinput.obresult.configuration
         # detector_channels = insconf.get_device("detector").get_property("channels")
         # temporal workaround
-        with obresult.frames[0].open() as hdul:
-            if convert_date(hdul[0].header["DATE-OBS"]) > convert_date(
-                "2023-07-01T12:00:00.0"
-            ):
-                detector_channels = "H2RG_FULL"
-            else:
-                detector_channels = "FULL"
+        records = frame_records(obresult.frames, index=self.header_index)
+        if convert_date(records[0]["DATE-OBS"]) > convert_date("2023-07-01T12:00:00.0"):
+            detector_channels = "H2RG_FULL"
+        else:
+            detector_channels = "FULL"
         self.logger.info(f"Detector channels: {detector_channels}")
         img_channels_layout = None
         if detector_channels == "FULL":  # original EMIR detector
@@ -372,13 +419,11 @@ class FullDitheredImagesRecipe(EmirRecipe):
 
     def compute_offset_xy_crosscor_regions(self, iinfo, regions, refine=False, tol=0.5):
 
-        names = [frame.lastname for frame in iinfo]
-        with manage_fits(names) as imgs:
-            arrs = [img[0].data for img in imgs]
-            offsets_xy = offsets_from_crosscor_regions(
-                arrs, regions, refine=refine, order="xy", tol=tol
-            )
-            self.logger.debug(f"offsets_xy cross-corr:\n{offsets_xy}")
+        arrs = [frame.lastdata for frame in iinfo]
+        offsets_xy = offsets_from_crosscor_regions(
+            arrs, regions, refine=refine, order="xy", tol=tol
+        )
+        self.logger.debug(f"offsets_xy cross-corr:\n{offsets_xy}")
         return offsets_xy
 
     def compute_size(self, target_info, baseshape, user_offsets=None):
@@ -580,46 +625,46 @@ class FullDitheredImagesRecipe(EmirRecipe):
             self.logger.debug(f"using previously computed median sky {sky}")
         else:
 
-            with fits.open(skyframe.lastname, mode="readonly") as hdulist:
-                data = hdulist["primary"].data
-                valid = data[frame.valid_region]
+            valid = skyframe.lastdata[frame.valid_region]
 
-                if skyframe.objmask_data is not None:
-                    self.logger.debug(
-                        "object mask defined (it must include the footprint)"
-                    )
-                    msk = frame.objmask_data
-                else:
-                    self.logger.debug("object mask empty (using only footprint)")
-                    footprint = skyframe.mask[0].data
-                    msk = footprint
-                sky = numpy.median(valid[msk == 0])
+            if skyframe.objmask_data is not None:
+                self.logger.debug("object mask defined (it must include the footprint)")
+                msk = frame.objmask_data
+            else:
+                self.logger.debug("object mask empty (using only footprint)")
+                footprint = skyframe.mask[0].data
+                msk = footprint
+            sky = numpy.median(valid[msk == 0])
 
             self.logger.debug(f"median sky value is {sky}")
             skyframe.median_sky = sky
 
         dst = name_skysub_proc(frame.label, step)
-        prev = frame.lastname
-
-        if save:
-            shutil.copyfile(prev, dst)
-        else:
-            os.rename(prev, dst)
+        prev = frame.lastdata[frame.valid_region]
 
+        # the frame is not reinitialized, because prev can be its
+        # previous content; the pixels outside the valid region can
+        # be from a previous pass with other offsets, and are cleared
+        data = self.frame_store.create(
+            f"{frame.label}_rfs", frame.lastdata.shape, fill=None
+        )
         frame.lastname = dst
+        frame.lastdata = data
 
-        with fits.open(frame.lastname, mode="update") as hdulist:
-            data = hdulist["primary"].data
-            valid = data[frame.valid_region]
-            if doughnut_arr is None:
-                valid -= sky
-            else:
-                # since the doughnut_arr was computed when deriving the superflat,
-                # its averaged signal is around 1.0; for that reason here we
-                # scale it by the median sky value
-                self.logger.debug("subtracting (median sky value) * doughnut_fit")
-                valid -= sky * doughnut_arr
-            self.logger.info(f"Sky-subtrated image in frame: {frame.lastname}")
+        valid = data[frame.valid_region]
+        if doughnut_arr is None:
+            numpy.subtract(prev, sky, out=valid)
+        else:
+            # since the doughnut_arr was computed when deriving the superflat,
+            # its averaged signal is around 1.0; for that reason here we
+            # scale it by the median sky value
+            self.logger.debug("subtracting (median sky value) * doughnut_fit")
+            numpy.subtract(prev, sky * doughnut_arr, out=valid)
+        _clear_outside(data, frame.valid_region)
+        self.logger.info(f"Sky-subtrated image in frame: {frame.lastname}")
+        self.save_intermediate_img(
+            fits.PrimaryHDU(data, header=frame.header), frame.lastname
+        )
 
     def compute_simple_sky(self, frame, skyframe, step=0, save=True):
         raise NotImplementedError
@@ -627,71 +672,69 @@ class FullDitheredImagesRecipe(EmirRecipe):
     def correct_superflat(self, frame, fitted, step=0, save=True):
 
         frame.flat_corrected = name_skyflat_proc(frame.label, step)
-        if save:
-            shutil.copyfile(frame.resized_base, frame.flat_corrected)
-        else:
-            os.rename(frame.resized_base, frame.flat_corrected)
 
         self.logger.info(
             f"Step {step}, SF: apply superflat, generating {frame.flat_corrected}"
         )
-        with fits.open(frame.flat_corrected, mode="update") as hdulist:
-            data = hdulist["primary"].data
-            datar = data[frame.valid_region]
-            # although the superflat contains very small values (1e-5) outside
-            # the useful footprint region (in order to avoid division by zero),
-            # those pixels in the array datar are zero and the flatfield corrected
-            # result is correct
-            data[frame.valid_region] = narray.correct_flatfield(datar, fitted)
-
-            frame.lastname = frame.flat_corrected
+        # outside the valid region, the resized frame is zero
+        data = self.frame_store.create(f"{frame.label}_rf", frame.resized_data.shape)
+        datar = frame.resized_data[frame.valid_region]
+        # although the superflat contains very small values (1e-5) outside
+        # the useful footprint region (in order to avoid division by zero),
+        # those pixels in the array datar are zero and the flatfield corrected
+        # result is correct
+        data[frame.valid_region] = narray.correct_flatfield(datar, fitted)
+
+        frame.flat_data = data
+        frame.lastname = frame.flat_corrected
+        frame.lastdata = data
+        self.save_intermediate_img(
+            fits.PrimaryHDU(data, header=frame.header), frame.flat_corrected
+        )
 
     def initial_classification(self, obresult, target_is_sky=False):
         """Classify input frames,"""
         # lists of targets and sky frames
 
-        with obresult.frames[0].open() as baseimg:
-            # Initial checks
-            has_bpm_ext = "BPM" in baseimg
-            self.logger.info("images have BPM extension: %s", has_bpm_ext)
+        # metadata of the frames, read only from their headers
+        records = frame_records(obresult.frames, index=self.header_index)
+        # Initial checks
+        has_bpm_ext = "BPM" in records[0]
+        self.logger.info("images have BPM extension: %s", has_bpm_ext)
 
         images_info = []
-        for f in obresult.frames:
-            with f.open() as img:
-                # Getting some metadata from FITS header
-                hdr = img[0].header
-
-                iinfo = ImageInfo(f)
-
-                finfo = {}
-                iinfo.metadata = finfo
-
-                finfo["uuid"] = hdr["UUID"]
-                finfo["exposure"] = hdr["EXPTIME"]
-                # frame.baseshape = get_image_shape(hdr)
-                finfo["airmass"] = hdr["airmass"]
-                finfo["mjd"] = hdr["tstamp"]
-
-                iinfo.label = "reduced_image_{}".format(finfo["uuid"])
-                iinfo.mask = nfcom.Extension("BPM")
-                # Insert pixel offsets between frames
-                iinfo.objmask_data = None
-                iinfo.valid_target = False
-                iinfo.valid_sky = False
-
-                # ToDo: revise this!
-                # FIXME: hardcode itype for the moment
-                iinfo.itype = "TARGET"
-                if iinfo.itype == "TARGET":
-                    iinfo.valid_target = True
-                    # targetframes.append(iinfo)
-                    if target_is_sky:
-                        iinfo.valid_sky = True
-                        # skyframes.append(iinfo)
-                if iinfo.itype == "SKY":
+        for f, record in zip(obresult.frames, records):
+            iinfo = ImageInfo(f)
+
+            finfo = {}
+            iinfo.metadata = finfo
+
+            finfo["uuid"] = record["UUID"]
+            finfo["exposure"] = record["EXPTIME"]
+            # frame.baseshape = get_image_shape(hdr)
+            finfo["airmass"] = record["airmass"]
+            finfo["mjd"] = record["tstamp"]
+
+            iinfo.label = "reduced_image_{}".format(finfo["uuid"])
+            iinfo.mask = nfcom.Extension("BPM")
+            # Insert pixel offsets between frames
+            iinfo.objmask_data = None
+            iinfo.valid_target = False
+            iinfo.valid_sky = False
+
+            # ToDo: revise this!
+            # FIXME: hardcode itype for the moment
+            iinfo.itype = "TARGET"
+            if iinfo.itype == "TARGET":
+                iinfo.valid_target = True
+                # targetframes.append(iinfo)
+                if target_is_sky:
                     iinfo.valid_sky = True
                     # skyframes.append(iinfo)
-                images_info.append(iinfo)
+            if iinfo.itype == "SKY":
+                iinfo.valid_sky = True
+                # skyframes.append(iinfo)
+            images_info.append(iinfo)
 
         return images_info
 
@@ -707,79 +750,75 @@ class FullDitheredImagesRecipe(EmirRecipe):
 
         self.logger.info(f"Step {step}, SF: combining the frames without offsets")
 
-        base_imgs = [img.resized_base for img in images_info]
-        with manage_fits(base_imgs) as imgs:
-
-            data = []
-            scales = []
-            for img, img_info in zip(imgs, images_info):
-                # read resized data and select valid_region
-                self.logger.debug(
-                    f"Step {step}, opening resized frame {img_info.resized_base}"
-                )
-                tmp_data = img["primary"].data[img_info.valid_region]
-                data.append(tmp_data)
-                # to compute the proper scale, it is important to skip the
-                # masked pixels (and those outside the image footprint);
-                # read resized mask and select valid_region
-                self.logger.debug(
-                    f"Step {step}, opening resized mask  {img_info.resized_mask}"
-                )
-                with fits.open(img_info.resized_mask, mode="readonly") as hdul:
-                    tmp_mask = hdul["primary"].data[img_info.valid_region]
-                scales.append(numpy.median(tmp_data[tmp_mask == 0]))
-
-            self.logger.debug(f"Step {step}, scales: {scales}")
-
-            if segmask is not None:
-                # segmask contains the object mask (when iterating, step > 0) for
-                # the full combined image (final size); for that reason it is important
-                # to extract the valid_region for each individual exposure
-                masks = [segmask[frame.valid_region] for frame in images_info]
-            else:
-                """
-                masks = []
-                for frame in images_info:
-                    self.logger.debug('Step %d, opening resized mask  %s',
-                                      step, frame.resized_mask)
-                    hdulist = fits.open(
-                         frame.resized_mask, memmap=True, mode='readonly')
-                    masks.append(hdulist['primary'].data[frame.valid_region])
-                """
-                # finally we are not using masks here because the masked
-                # pixels in the bad-pixel mask were interpolated with the
-                # StareImageRecipe2, whereas the masked pixels corresponding
-                # to those outside the footprint of the reprojected images
-                # contain zeros (there is no problem averaging them)
-                masks = None
-
-            # note that the only masks relevant here are the object masks;
-            # the footprint mask is not required because the data outside
-            # the image footprint is zero in all the individual exposures to
-            # be combined (the computed superflat is initially zero in those
-            # pixels outside the footprint region: for that reason these pixels
-            # are set to a small, but not zero, value below)
-            self.logger.debug(
-                f"Step {step}, combining {len(data)} frames using '{method.__name__}'"
-            )
-            time_ini_combination = datetime.datetime.now()
-            sf_data, _sf_var, sf_num = method(
-                data, masks, scales=scales, dtype="float32", **method_kwargs
+        data = []
+        scales = []
+        for img_info in images_info:
+            # resized data in valid_region
+            tmp_data = img_info.resized_data[img_info.valid_region]
+            data.append(tmp_data)
+            # to compute the proper scale, it is important to skip the
+            # masked pixels (and those outside the image footprint);
+            # resized mask in valid_region
+            tmp_mask = img_info.resized_mask_data[img_info.valid_region]
+            scales.append(numpy.median(tmp_data[tmp_mask == 0]))
+
+        self.logger.debug(f"Step {step}, scales: {scales}")
+
+        if segmask is not None:
+            # segmask contains the object mask (when iterating, step > 0) for
+            # the full combined image (final size); for that reason it is important
+            # to extract the valid_region for each individual exposure
+            masks = [segmask[frame.valid_region] for frame in images_info]
+        else:
+            """
+            masks = []
+            for frame in images_info:
+                self.logger.debug('Step %d, opening resized mask  %s',
+                                  step, frame.resized_mask)
+                hdulist = fits.open(
+                     frame.resized_mask, memmap=True, mode='readonly')
+                masks.append(hdulist['primary'].data[frame.valid_region])
+            """
+            # finally we are not using masks here because the masked
+            # pixels in the bad-pixel mask were interpolated with the
+            # StareImageRecipe2, whereas the masked pixels corresponding
+            # to those outside the footprint of the reprojected images
+            # contain zeros (there is no problem averaging them)
+            masks = None
+
+        # note that the only masks relevant here are the object masks;
+        # the footprint mask is not required because the data outside
+        # the image footprint is zero in all the individual exposures to
+        # be combined (the computed superflat is initially zero in those
+        # pixels outside the footprint region: for that reason these pixels
+        # are set to a small, but not zero, value below)
+        self.logger.debug(
+            f"Step {step}, combining {len(data)} frames using '{method.__name__}'"
+        )
+        time_ini_combination = datetime.datetime.now()
+        sf_data, _sf_var, sf_num = combine_row_blocks(
+            method,
+            data,
+            masks,
+            scales=scales,
+            dtype="float32",
+            max_memory=self.combine_max_memory,
+            **method_kwargs,
+        )
+        time_end_combination = datetime.datetime.now()
+        self.logger.debug(
+            f"Step {step}, combination time: {time_end_combination-time_ini_combination}"
+        )
+        # avoid pixels without flatfield information
+        if numpy.any(sf_num == 0):
+            self.logger.warning(
+                "pixels without flatfield information found: potential problem!"
             )
-            time_end_combination = datetime.datetime.now()
-            self.logger.debug(
-                f"Step {step}, combination time: {time_end_combination-time_ini_combination}"
+            self.logger.warning(
+                "interpolating missing flatfield pixels using neighbouring data"
             )
-            # avoid pixels without flatfield information
-            if numpy.any(sf_num == 0):
-                self.logger.warning(
-                    "pixels without flatfield information found: potential problem!"
-                )
-                self.logger.warning(
-                    "interpolating missing flatfield pixels using neighbouring data"
-                )
-                binmask = sf_num == 0
-                narray.fixpix2(sf_data, binmask, out=sf_data, iterations=1)
+            binmask = sf_num == 0
+            narray.fixpix2(sf_data, binmask, out=sf_data, iterations=1)
 
         # Normalize, flat has mean = 1
         # avoid region outside footprint
@@ -834,61 +873,43 @@ class FullDitheredImagesRecipe(EmirRecipe):
         xc = naxis1 / 2 + 0.5
         yc = naxis2 / 2 + 0.5
 
-        pixel_x = numpy.arange(1, naxis1 + 1)
-        pixel_y = numpy.arange(1, naxis2 + 1)
-
-        ix_array = numpy.meshgrid(pixel_x, pixel_y)[0].flatten()
-        iy_array = numpy.meshgrid(pixel_x, pixel_y)[1].flatten()
-
         # polar coordinates
-        r = numpy.sqrt((ix_array - xc) ** 2 + (iy_array - yc) ** 2)
-        theta = numpy.arctan2(iy_array - yc, ix_array - xc)
+        r, theta = polar_coordinates(image.shape, center=(xc, yc))
 
         # 2D histogram using r, theta
         nbins_r = 140
-        r_bins = numpy.linspace(0, max(r), nbins_r + 1)
+        r_bins = numpy.linspace(0, r.max(), nbins_r + 1)
 
         nbins_theta_per_quarter = 90
         nbins_theta = nbins_theta_per_quarter * 4
         theta_bins = numpy.linspace(-180, 180, nbins_theta + 1) * numpy.pi / 180
 
-        hist2d = numpy.zeros((nbins_theta, nbins_r))
-
-        imax = -numpy.ones(nbins_theta, dtype=int)
-        for i in range(nbins_r):
-            iok = (r >= r_bins[i]) & (r < r_bins[i + 1])
-            if numpy.sum(iok) > 0:
-                # xdum = r[iok]
-                ydum = theta[iok]
-                zdum = image.flatten()[iok]
-                fdum = footprint_useful.flatten()[iok]
-                for j in range(nbins_theta):
-                    jok = (ydum >= theta_bins[j]) & (ydum < theta_bins[j + 1]) & fdum
-                    if numpy.sum(jok) > 0:
-                        hist2d[j, i] = numpy.median(zdum[jok])
-                        if i > imax[j]:
-                            imax[j] = i
-                    else:
-                        hist2d[j, i] = -1
-            else:
-                for j in range(nbins_theta):
-                    hist2d[j, i] = -1
+        # each pixel is assigned to its bin only once
+        hist2d, counts = polar_binned_median(
+            image, r, theta, r_bins, theta_bins, mask=footprint_useful
+        )
+        filled = counts > 0
+        hist2d[~filled] = -1
+
+        # last radial bin with data for each theta
+        imax = nbins_r - 1 - numpy.argmax(filled[:, ::-1], axis=1)
+        imax[~filled.any(axis=1)] = -1
 
         # fill rows
-        for j in range(nbins_theta):
-            for i in range(imax[j] + 1, nbins_r):
-                hist2d[j, i] = hist2d[j, imax[j]]
+        beyond = (numpy.arange(nbins_r) > imax[:, None]) & (imax[:, None] >= 0)
+        last_value = hist2d[numpy.arange(nbins_theta), imax]
+        hist2d = numpy.where(beyond, last_value[:, None], hist2d)
 
         # for the first radii (with empty data in some bins), average all
         # undefined values with the median within each quadrant
-        j1, j2, j3, j4, j5 = numpy.arange(
-            5 * nbins_theta_per_quarter, step=nbins_theta_per_quarter
-        )
-        for i in range(nbins_r):
-            if len(numpy.argwhere(hist2d[:, i] == -1)) > 0:
-                for jj1, jj2 in zip([j1, j2, j3, j4], [j2, j3, j4, j5]):
-                    minicolumn = hist2d[jj1:jj2, i]
-                    hist2d[jj1:jj2, i] = numpy.median(minicolumn[minicolumn > -1])
+        undefined = numpy.any(hist2d == -1, axis=0)
+        if numpy.any(undefined):
+            quadrants = hist2d[:, undefined].reshape(4, nbins_theta_per_quarter, -1)
+            quadrants = numpy.where(quadrants > -1, quadrants, numpy.nan)
+            quadrant_median = numpy.nanmedian(quadrants, axis=1)
+            hist2d[:, undefined] = numpy.repeat(
+                quadrant_median, nbins_theta_per_quarter, axis=0
+            )
 
         # smooth result in theta
         hist2d_smooth = median_filter(hist2d, size=(21, 1), mode="wrap")
@@ -981,97 +1002,79 @@ class FullDitheredImagesRecipe(EmirRecipe):
         self, frames, extinction, out=None, step=0, method=None, method_kwargs=None
     ):
 
-        # define auxiliary function
-        def fits_open(name):
-            """Open FITS with memmap in readonly mode"""
-            return fits.open(name, mode="readonly", memmap=True)
-
-        self.logger.debug(f"Step {step}, opening sky-subtracted frames")
-        frameslll = [
-            fits_open(frame.lastname) for frame in frames if frame.valid_target
-        ]
-
-        self.logger.debug(f"Step {step}, opening mask frames")
-        mskslll = [
-            fits_open(frame.resized_mask) for frame in frames if frame.valid_target
+        frames = [frame for frame in frames if frame.valid_target]
+        self.logger.debug(
+            f"Step {step}, combining {len(frames)} frames using '{method.__name__}'"
+        )
+        extinc = [
+            pow(10, -0.4 * frame.metadata["airmass"] * extinction) for frame in frames
         ]
-
+        # sky-subtracted frames and masks
+        data = [frame.lastdata for frame in frames]
+        masks = [frame.resized_mask_data for frame in frames]
+        regions = [frame.valid_region for frame in frames]
+        headers = [frame.header for frame in frames]
+
+        # compute combination, reading by blocks of rows only the
+        # valid region of each frame
+        time_ini_combination = datetime.datetime.now()
+        out = combine_row_blocks(
+            method,
+            data,
+            masks,
+            regions=regions,
+            scales=extinc,
+            dtype="float32",
+            out=out,
+            max_memory=self.combine_max_memory,
+            **method_kwargs,
+        )
+        time_end_combination = datetime.datetime.now()
         self.logger.debug(
-            f"Step {step}, combining {len(frameslll)} frames using '{method.__name__}'"
+            f"Step {step}, combination time: {time_end_combination - time_ini_combination}"
         )
-        try:
-            extinc = [
-                pow(10, -0.4 * frame.metadata["airmass"] * extinction)
-                for frame in frames
-                if frame.valid_target
-            ]
-            data = [i["primary"].data for i in frameslll]
-            masks = [i["primary"].data for i in mskslll]
-            headers = [i["primary"].header for i in frameslll]
-
-            # compute combination
-            time_ini_combination = datetime.datetime.now()
-            out = method(
-                data, masks, scales=extinc, dtype="float32", out=out, **method_kwargs
-            )
-            time_end_combination = datetime.datetime.now()
-            self.logger.debug(
-                f"Step {step}, combination time: {time_end_combination - time_ini_combination}"
-            )
 
-            # update header
-            base_header = headers[0]
-            hdu = fits.PrimaryHDU(out[0], header=base_header)
-            # remove previous HISTORY entries
-            # (corresponding to the reduction of the first indidivual exposure)
-            self.logger.debug(
-                f"Step {step}, preserving primary header from first exposure"
-            )
-            self.logger.debug(
-                f"Step {step}, removing HISTORY entries in previous header"
-            )
-            while "HISTORY" in hdu.header:
-                hdu.header.remove("history")
-            # define new HISTORY entries with the id of the combined images
-            self.logger.debug(
-                f"Step {step}, updating HISTORY entries with list of individual exposures"
-            )
-            hdu.header["history"] = "Combined %d images using '%s'" % (
-                len(frameslll),
-                method.__name__,
-            )
-            hdu.header["history"] = "Combination time {}".format(
-                datetime.datetime.now(datetime.UTC).isoformat()
-            )
-            for img in frameslll:
-                hdu.header["history"] = "Image {}".format(img[0].header["uuid"])
-            prevnum = base_header.get("NUM-NCOM", 1)
-            hdu.header["NUM-NCOM"] = prevnum * len(frameslll)
-            hdu.header["NUMRNAM"] = "FullDitheredImagesRecipe"
-            hdu.header["UUID"] = str(uuid.uuid1())
-            hdu.header["OBSMODE"] = "FULL_DITHERED_IMAGE"
-            # Headers of last image
-            hdu.header["TSUTC2"] = headers[-1]["TSUTC2"]
-
-            varhdu = fits.ImageHDU(out[1], name="VARIANCE")
-            num = fits.ImageHDU(out[2].astype("uint8"), name="MAP")
-
-            result = fits.HDUList([hdu, varhdu, num])
-            # saving the three extensions
-            fits.writeto("result_i%0d.fits" % step, out[0], overwrite=True)
-            fits.writeto("result_i%0d_var.fits" % step, out[1], overwrite=True)
-            fits.writeto("result_i%0d_npix.fits" % step, out[2], overwrite=True)
-            # saving the combined image (result)
-            result.writeto("result_i%0d_full.fits" % step, overwrite=True)
-            return result
-
-        finally:
-            self.logger.debug(f"Step {step}, closing sky-subtracted frames")
-            for f in frameslll:
-                f.close()
-            self.logger.debug(f"Step {step}, closing mask frames")
-            for f in mskslll:
-                f.close()
+        # update header
+        base_header = headers[0]
+        hdu = fits.PrimaryHDU(out[0], header=base_header)
+        # remove previous HISTORY entries
+        # (corresponding to the reduction of the first indidivual exposure)
+        self.logger.debug(f"Step {step}, preserving primary header from first exposure")
+        self.logger.debug(f"Step {step}, removing HISTORY entries in previous header")
+        while "HISTORY" in hdu.header:
+            hdu.header.remove("history")
+        # define new HISTORY entries with the id of the combined images
+        self.logger.debug(
+            f"Step {step}, updating HISTORY entries with list of individual exposures"
+        )
+        hdu.header["history"] = "Combined %d images using '%s'" % (
+            len(frames),
+            method.__name__,
+        )
+        hdu.header["history"] = "Combination time {}".format(
+            datetime.datetime.now(datetime.UTC).isoformat()
+        )
+        for header in headers:
+            hdu.header["history"] = "Image {}".format(header["uuid"])
+        prevnum = base_header.get("NUM-NCOM", 1)
+        hdu.header["NUM-NCOM"] = prevnum * len(frames)
+        hdu.header["NUMRNAM"] = "FullDitheredImagesRecipe"
+        hdu.header["UUID"] = str(uuid.uuid1())
+        hdu.header["OBSMODE"] = "FULL_DITHERED_IMAGE"
+        # Headers of last image
+        hdu.header["TSUTC2"] = headers[-1]["TSUTC2"]
+
+        varhdu = fits.ImageHDU(out[1], name="VARIANCE")
+        num = fits.ImageHDU(out[2].astype("uint8"), name="MAP")
+
+        result = fits.HDUList([hdu, varhdu, num])
+        # saving the three extensions
+        fits.writeto("result_i%0d.fits" % step, out[0], overwrite=True)
+        fits.writeto("result_i%0d_var.fits" % step, out[1], overwrite=True)
+        fits.writeto("result_i%0d_npix.fits" % step, out[2], overwrite=True)
+        # saving the combined image (result)
+        result.writeto("result_i%0d_full.fits" % step, overwrite=True)
+        return result
 
     def resize_all(
         self, target_info, shape, offsetsp, finalshape, window=None, scale=1, step=0
@@ -1115,17 +1118,17 @@ class FullDitheredImagesRecipe(EmirRecipe):
             hdul[0].header["crpix1"] = crpix1 + iinfo.rel_offset[1]
             hdul[0].header["crpix2"] = crpix2 + iinfo.rel_offset[0]
 
-            # resize_fits saves the resized image in frame_name
-            frame_name = iinfo.resized_base
-            resize_fits(
-                hdul,
-                frame_name,
+            newhdu = resize_hdu(
+                hdul[0],
                 finalshape,
                 iinfo.valid_region,
                 window=window,
                 scale=scale,
                 dtype="float32",
             )
+            iinfo.header = newhdu.header
+            iinfo.resized_data = self.frame_store.store(f"{iinfo.label}_r", newhdu.data)
+            self.save_intermediate_img(newhdu, iinfo.resized_base)
 
         self.logger.debug("resizing mask  %s", iinfo.resized_mask)
         if iinfo.mask is None:
@@ -1140,10 +1143,8 @@ class FullDitheredImagesRecipe(EmirRecipe):
 
         # We don't conserve the sum of the values of the frame here, just
         # expand the mask
-        mask_name = iinfo.resized_mask
-        resize_fits(
-            iinfo.mask,
-            mask_name,
+        newhdu = resize_hdu(
+            iinfo.mask["primary"],
             finalshape,
             iinfo.valid_region,
             fill=1,
@@ -1151,6 +1152,10 @@ class FullDitheredImagesRecipe(EmirRecipe):
             scale=scale,
             conserve=False,
         )
+        iinfo.resized_mask_data = self.frame_store.store(
+            f"{iinfo.label}_mr", newhdu.data
+        )
+        self.save_intermediate_img(newhdu, iinfo.resized_mask)
 
     def create_objmask(self, img, seeing_fwhm, step=0):
 
@@ -1302,6 +1307,8 @@ class FullDitheredImagesRecipe(EmirRecipe):
         )
 
         nsky = len(sarray)
+        # frames shared by consecutive targets are loaded only once
+        skywindow = SkyWindow(self.load_sky_frame)
 
         for tid, idss in enumerate(idxs):
             self.logger.info("---")
@@ -1331,11 +1338,18 @@ class FullDitheredImagesRecipe(EmirRecipe):
                     nside_adhoc_sky_correction=nside_adhoc_sky_correction,
                     detector_channels=detector_channels,
                     img_channels_layout=img_channels_layout,
+                    skywindow=skywindow,
                 )
             except IndexError:
                 self.logger.error(f"No sky image available for frame {tf.lastname}")
                 raise
 
+        self.logger.debug(
+            f"Step {step}, SC: sky frames loaded {skywindow.loads} times, "
+            f"reused {skywindow.reuses} times"
+        )
+        skywindow.clear()
+
     def compute_advanced_sky_for_frame(
         self,
         frame,
@@ -1346,90 +1360,46 @@ class FullDitheredImagesRecipe(EmirRecipe):
         nside_adhoc_sky_correction=0,
         detector_channels=None,
         img_channels_layout=None,
+        skywindow=None,
     ):
         self.logger.info("Correcting sky in frame %s", frame.lastname)
         self.logger.info("with sky computed from frames:")
         for i in skyframes:
             self.logger.info("%s", i.flat_corrected)
 
-        data = []
-        scales = []
-        masks = []
-        # handle the FITS file to close it finally
-        desc = []
-        try:
-            for i in skyframes:
-                filename = i.flat_corrected
-                hdulist = fits.open(filename, mode="readonly", memmap=True)
-
-                data.append(hdulist["primary"].data[i.valid_region])
-                desc.append(hdulist)
-
-                if i.objmask_data is not None:
-                    msk = i.objmask_data
-                    masks.append(msk)
-                    self.logger.debug("object mask (including footprint) is shared")
-                elif i.objmask is not None:
-                    hdulistmask = fits.open(i.objmask, mode="readonly", memmap=True)
-                    # note that this image has the correct shape (2048x2048)
-                    # and there is no need to use i.valid_region; in addition,
-                    # this image also contain the footprint
-                    msk = hdulistmask["primary"].data
-                    masks.append(msk)
-                    desc.append(hdulistmask)
-                    self.logger.debug(
-                        "object mask is particular (it must contain the footprint)"
-                    )
-                    self.logger.debug(f"reading {i.objmask}")
-                else:
-                    footprint = i.mask[0].data
-                    msk = footprint
-                    self.logger.warning(
-                        f"no object mask (using only footprint) for {filename}"
-                    )
+        if skywindow is None:
+            skywindow = SkyWindow(self.load_sky_frame)
+        data, masks, scales = skywindow.select(skyframes)
 
-                # this should never happen now (after including the footprint)
-                if msk is None:
-                    scales.append(numpy.median(data[-1]))
-                else:
-                    scales.append(numpy.median(data[-1][msk == 0]))
+        self.logger.debug(
+            f"computing scaled background with {len(data)} frames using '{method.__name__}'"
+        )
+        self.logger.debug(f"... scales: {scales}")
+        # note: this sky is scaled to have a mean value of 1.0 (using the unmasked pixels)
+        sky, _, num = method(data, masks, scales=scales, **method_kwargs)
 
-            self.logger.debug(
-                f"computing scaled background with {len(data)} frames using '{method.__name__}'"
-            )
-            self.logger.debug(f"... scales: {scales}")
-            # note: this sky is scaled to have a mean value of 1.0 (using the unmasked pixels)
-            sky, _, num = method(data, masks, scales=scales, **method_kwargs)
-
-            with fits.open(frame.lastname) as hdulist:
-                data = hdulist["primary"].data
-                valid = data[frame.valid_region]
-
-                if frame.objmask_data is not None:
-                    self.logger.debug("object mask defined (including footprint)")
-                    msk = frame.objmask_data
-                else:
-                    self.logger.debug("object mask empty (using only footprint)")
-                    footprint = frame.mask[0].data
-                    msk = footprint
-
-                skymedian = numpy.median(valid[msk == 0])
-                self.logger.debug(f"rescaling background with skymedian {skymedian}")
-
-            # avoid pixels without sky information
-            if numpy.any(num == 0):
-                self.logger.warning(
-                    "pixels without sky information found (set to skymedian)"
-                )
-                sky[num == 0] = 1.0
+        valid = frame.lastdata[frame.valid_region]
 
-            # rescale sky to have a mean value equal to skymedian
-            sky *= skymedian
+        if frame.objmask_data is not None:
+            self.logger.debug("object mask defined (including footprint)")
+            msk = frame.objmask_data
+        else:
+            self.logger.debug("object mask empty (using only footprint)")
+            footprint = frame.mask[0].data
+            msk = footprint
 
-        finally:
-            # Closing all FITS files
-            for hdl in desc:
-                hdl.close()
+        skymedian = numpy.median(valid[msk == 0])
+        self.logger.debug(f"rescaling background with skymedian {skymedian}")
+
+        # avoid pixels without sky information
+        if numpy.any(num == 0):
+            self.logger.warning(
+                "pixels without sky information found (set to skymedian)"
+            )
+            sky[num == 0] = 1.0
+
+        # rescale sky to have a mean value equal to skymedian
+        sky *= skymedian
 
         # the following code is not necessary because we have already avoided
         # those pixels where num == 0
@@ -1456,24 +1426,55 @@ class FullDitheredImagesRecipe(EmirRecipe):
         fits.writeto(name_sky, sky, overwrite=True)
 
         dst = name_skysub_proc(frame.label, step)
-        prev = frame.lastname
-        shutil.copyfile(prev, dst)
+        prev = frame.lastdata[frame.valid_region]
+
+        # the frame is not reinitialized, because prev can be its
+        # previous content; the pixels outside the valid region can
+        # be from a previous pass with other offsets, and are cleared
+        data = self.frame_store.create(
+            f"{frame.label}_rfs", frame.lastdata.shape, fill=None
+        )
         frame.lastname = dst
+        frame.lastdata = data
+
+        valid = data[frame.valid_region]
+        numpy.subtract(prev, sky, out=valid)
+        if nside_adhoc_sky_correction > 0 or img_channels_layout is not None:
+            skycorr = self.adhoc_sky_correction(
+                arr=valid,
+                objmask=frame.objmask_data,
+                nside=nside_adhoc_sky_correction,
+                detector_channels=detector_channels,
+                img_channels_layout=img_channels_layout,
+            )
+            valid -= skycorr
+        _clear_outside(data, frame.valid_region)
+        self.logger.debug(f"saving sky subtracted result {frame.lastname}")
+        self.save_intermediate_img(
+            fits.PrimaryHDU(data, header=frame.header), frame.lastname
+        )
 
-        with fits.open(frame.lastname, mode="update") as hdulist:
-            data = hdulist["primary"].data
-            valid = data[frame.valid_region]
-            valid -= sky
-            if nside_adhoc_sky_correction > 0 or img_channels_layout is not None:
-                skycorr = self.adhoc_sky_correction(
-                    arr=valid,
-                    objmask=frame.objmask_data,
-                    nside=nside_adhoc_sky_correction,
-                    detector_channels=detector_channels,
-                    img_channels_layout=img_channels_layout,
-                )
-                valid -= skycorr
-            self.logger.debug(f"saving sky subtracted result {frame.lastname}")
+    def load_sky_frame(self, frame):
+        """Data, object mask and scale (computed later) of a sky frame."""
+        data = frame.flat_data[frame.valid_region]
+        if frame.objmask_data is not None:
+            msk = frame.objmask_data
+            self.logger.debug("object mask (including footprint) is shared")
+        elif frame.objmask is not None:
+            # note that this image has the correct shape (2048x2048)
+            # and there is no need to use frame.valid_region; in addition,
+            # this image also contain the footprint
+            self.logger.debug(
+                "object mask is particular (it must contain the footprint)"
+            )
+            self.logger.debug(f"reading {frame.objmask}")
+            msk = fits.getdata(frame.objmask)
+        else:
+            self.logger.warning(
+                f"no object mask (using only footprint) for {frame.flat_corrected}"
+            )
+            msk = frame.mask[0].data
+        return data, msk, None
 
     def compute_regions_from_objs(self, step, arr, finalshape, box=50, corners=True):
         regions = []
@@ -1514,6 +1515,44 @@ class FullDitheredImagesRecipe(EmirRecipe):
         )
         return objects, objmask
 
+    def adhoc_sky_model(
+        self, shape, nside=10, detector_channels=None, img_channels_layout=None
+    ):
+        """Model of the ad hoc sky correction, computed once and reused.
+
+        For the original EMIR detector, the model is a `TileSurface`
+        fitted to nside x nside tiles in each quadrant. For the H2RG
+        detector, the model is a `LabelIndex` of the channels.
+        """
+        if detector_channels == "FULL":  # original EMIR detector
+            key = (detector_channels, nside)
+        elif detector_channels == "H2RG_FULL":  # new H2RG detector
+            if img_channels_layout is None:
+                raise ValueError("Expected img_channels_layout is None")
+            if img_channels_layout.shape != shape:
+                raise ValueError(
+                    f"Unexpected img_channels_layout.shape: "
+                    f"{img_channels_layout.shape} != {shape}"
+                )
+            # the layouts read from different frames are equal arrays
+            layout = numpy.ascontiguousarray(img_channels_layout)
+            digest = hashlib.sha1(layout.view(numpy.uint8)).hexdigest()
+            key = (detector_channels, layout.shape, layout.dtype.str, digest)
+        else:
+            raise ValueError(f"Unexpected {detector_channels=}")
+
+        model = self.adhoc_sky_models.get(key)
+        if model is None:
+            self.logger.debug(f"computing ad hoc sky model for {detector_channels}")
+            if detector_channels == "FULL":
+                lim_i = [0, 1024, 2048]
+                lim_j = [0, 1024, 2048]
+                model = TileSurface(lim_i, lim_j, nside)
+            else:
+                model = LabelIndex(img_channels_layout)
+            self.adhoc_sky_models[key] = model
+        return model
+
     def adhoc_sky_correction(
         self, arr, objmask, nside=10, detector_channels=None, img_channels_layout=None
     ):
@@ -1521,95 +1560,34 @@ class FullDitheredImagesRecipe(EmirRecipe):
 
         self.logger.info("computing ad hoc sky correction")
 
-        skyfit = numpy.zeros_like(arr)
-
+        model = self.adhoc_sky_model(
+            arr.shape,
+            nside=nside,
+            detector_channels=detector_channels,
+            img_channels_layout=img_channels_layout,
+        )
         if detector_channels == "FULL":  # original EMIR detector
             # fit each quadrant separately (original EMIR detector)
-            lim_i = [0, 1024, 2048]
-            lim_j = [0, 1024, 2048]
-            nside_i = nside
-            nside_j = nside
-            for i in range(len(lim_i) - 1):
-                i1 = lim_i[i]
-                i2 = lim_i[i + 1]
-                for j in range(len(lim_j) - 1):
-                    j1 = lim_j[j]
-                    j2 = lim_j[j + 1]
-                    xyfit = []
-                    zfit = []
-                    limi = numpy.linspace(i1, i2, nside_i + 1, dtype=int)
-                    limj = numpy.linspace(j1, j2, nside_j + 1, dtype=int)
-                    for ii in range(nside_i):
-                        ii1 = limi[ii]
-                        ii2 = limi[ii + 1]
-                        for jj in range(nside_j):
-                            jj1 = limj[jj]
-                            jj2 = limj[jj + 1]
-                            tmprect = arr[ii1:ii2, jj1:jj2]
-                            tmpmask = objmask[ii1:ii2, jj1:jj2]
-                            usefulpix = tmprect[tmpmask == 0]
-                            if usefulpix.size > 0:
-                                x0 = (jj1 + jj2) / 2.0
-                                y0 = (ii1 + ii2) / 2.0
-                                z0 = numpy.median(usefulpix)
-                                xyfit.append([x0, y0])
-                                zfit.append(z0)
-                    xyfit = numpy.array(xyfit)
-                    zfit = numpy.array(zfit)
-                    xgrid, ygrid = numpy.meshgrid(
-                        numpy.arange(j1, j2, dtype=float),
-                        numpy.arange(i1, i2, dtype=float),
-                    )
-                    surface_nearest = interpolate.griddata(
-                        xyfit, zfit, (xgrid, ygrid), method="nearest", rescale=True
-                    )
-                    surface_cubic = interpolate.griddata(
-                        xyfit,
-                        zfit,
-                        (xgrid, ygrid),
-                        method="cubic",
-                        fill_value=-1.0e30,
-                        rescale=True,
-                    )
-                    skyfit[i1:i2, j1:j2] = numpy.where(
-                        surface_cubic < -1.0e29, surface_nearest, surface_cubic
-                    )
-                    debug = False
-                    if debug:
-                        import matplotlib.pyplot as plt
-
-                        fig, axarr = plt.subplots(nrows=1, ncols=2, figsize=(12, 6))
-                        vmin, vmax = numpy.percentile(arr, [30, 70])
-                        axarr[0].imshow(arr, origin="lower", vmin=vmin, vmax=vmax)
-                        axarr[1].imshow(skyfit, origin="lower", vmin=vmin, vmax=vmax)
-                        for xdum, ydum in xyfit:
-                            axarr[0].plot(xdum, ydum, "r+")
-                        plt.show()
-
-        elif detector_channels == "H2RG_FULL":  # new H2RG detector
-            if img_channels_layout is None:
-                raise ValueError("Expected img_channels_layout is None")
-            for j_channel in range(32):
-                within_channel = img_channels_layout == j_channel + 1
-                objmask_for_channel = objmask[within_channel]
-                if len(arr[within_channel][objmask_for_channel == 0]) > 0:
-                    skyfit[within_channel] = numpy.median(
-                        arr[within_channel][objmask_for_channel == 0]
-                    )
-                debug = False
-                if debug:
-                    import matplotlib.pyplot as plt
-
-                    fig, axarr = plt.subplots(nrows=1, ncols=2, figsize=(12, 6))
-                    vmin, vmax = numpy.percentile(arr, [30, 70])
-                    axarr[0].imshow(arr, origin="lower", vmin=vmin, vmax=vmax)
-                    axarr[1].imshow(skyfit, origin="lower", vmin=vmin, vmax=vmax)
-                    ydum, xdum = numpy.where(objmask > 0)
-                    axarr[1].scatter(xdum, ydum, color="red", marker=".", s=1)
-                    plt.show()
-
-        else:
-            raise ValueError(f"Unexpected {detector_channels=}")
+            skyfit = model(arr, objmask)
+        else:  # new H2RG detector
+            medians, counts = model.median(arr, objmask)
+            # only channels 1 to 32 with useful pixels are corrected
+            medians[counts == 0] = 0
+            medians[0] = 0
+            medians[33:] = 0
+            skyfit = model.expand(medians).astype(arr.dtype, copy=False)
+
+        debug = False
+        if debug:
+            import matplotlib.pyplot as plt
+
+            fig, axarr = plt.subplots(nrows=1, ncols=2, figsize=(12, 6))
+            vmin, vmax = numpy.percentile(arr, [30, 70])
+            axarr[0].imshow(arr, origin="lower", vmin=vmin, vmax=vmax)
+            axarr[1].imshow(skyfit, origin="lower", vmin=vmin, vmax=vmax)
+            ydum, xdum = numpy.where(objmask > 0)
+            axarr[1].scatter(xdum, ydum, color="red", marker=".", s=1)
+            plt.show()
 
         # hdu = fits.PrimaryHDU(arr.astype('float32'))
         # hdul = fits.HDUList([hdu])
@@ -22,7 +22,7 @@ from numina.core import Result, Requirement, Parameter
 from numina.core.requirements import ObservationResultRequirement
 from numina.array import combine
 from numina.array import combine_shape, combine_shapes
-from numina.array import resize_arrays, resize_arrays_alt
+from numina.array import resize_arrays
 from numina.array.combine import flatcombine, median, quantileclip
 from numina.array.utils import coor_to_pix, image_box2d
 import numina.processing as proc
@@ -40,6 +40,7 @@ from emirdrp.processing.wcs import offsets_from_wcs_imgs, reference_pix_from_wcs
 from emirdrp.processing.corr import offsets_from_crosscor, offsets_from_crosscor_regions
 from emirdrp.core.recipe import EmirRecipe
 from emirdrp.processing.combine import segmentation_combined
+from emirdrp.processing.accumulator import ACCUM_EXTENSIONS, MosaicAccumulator
 
 
 class JoinDitheredImagesRecipe(EmirRecipe):
@@ -520,19 +521,16 @@ class JoinDitheredImagesRecipe(EmirRecipe):
         return sky_result
 
     def aggregate2(self, frame1, frame2, naccum):
-        # FIXME, this is almost identical to run_single
-        frames = [frame1, frame2]
-        use_errors = True
-        # Initial checks
-        fframe = frames[0]
-        img = fframe.open()
-        result = copy_img(img)
-        # base_header = result[0].header
+        """Add the frame of a new block to the accumulated result.
 
-        imgs = []
-        for f in frames:
-            img = f.open()
-            imgs.append(img)
+        The accumulated result stores the weighted sums of the
+        blocks (see MosaicAccumulator), so adding a block only
+        updates the pixels it covers. Each block has the same weight.
+        """
+        use_errors = True
+        accum_img = frame1.open()
+        frame_img = frame2.open()
+        imgs = [accum_img, frame_img]
 
         self.logger.info("Computing offsets from WCS information")
 
@@ -543,44 +541,35 @@ class JoinDitheredImagesRecipe(EmirRecipe):
         self.logger.info("Shape of resized array is %s", finalshape)
         self.logger.debug("partial shapes %s", partial_shapes)
 
-        masks = []
         self.logger.debug("Obtains masks")
-        for img in imgs:
-            if "NUM" in img:
-                self.logger.debug("Using NUM extension as mask")
-                mask = numpy.where(img["NUM"].data, 0, 1).astype("int16")
-            elif "BPM" in img:
-                self.logger.debug("Using BPM extension as mask")
-                mask = numpy.where(img["BPM"].data, 1, 0).astype("int16")
-            else:
-                self.logger.warning("BPM missing, use zeros instead")
-                mask = numpy.zeros_like(img[0].data)
-            masks.append(mask)
-
-        # Resizing target frames
-        data_arr_r = resize_arrays_alt(
-            [img[0].data for img in imgs], partial_shapes, finalshape, fill=1
+        has_accumulator = all(name in accum_img for name in ACCUM_EXTENSIONS)
+        if has_accumulator:
+            accum_mask = None
+        else:
+            # the accumulated result is the mean of naccum - 1 blocks
+            accum_mask = self.aggregate_mask(accum_img)
+        accumulator = MosaicAccumulator.from_hdulist(
+            accum_img, mask=accum_mask, weight=naccum - 1
         )
+        resized = accumulator.resize(finalshape, partial_shapes[0])
 
-        self.logger.debug("resize bad pixel masks")
-        mask_arr_r = resize_arrays_alt(masks, partial_shapes, finalshape, fill=1)
-
-        self.logger.debug("not computing sky")
-        data_arr_sr = data_arr_r
-
-        self.logger.info("Combine target images (final, aggregate)")
-        self.logger.debug("weights for 'accum' and 'frame'")
-
-        weight_accum = 2 * (1 - 1.0 / naccum)
-        weight_frame = 2.0 / naccum
-        scales = [1.0 / weight_accum, 1.0 / weight_frame]
-        self.logger.debug("weights for 'accum' and 'frame', %s", scales)
-        method = combine.mean
-        out = method(data_arr_sr, masks=mask_arr_r, scales=scales, dtype="float32")
+        self.logger.info("Add target image (final, aggregate)")
+        region = partial_shapes[1]
+        accumulator.add(
+            frame_img[0].data, mask=self.aggregate_mask(frame_img), region=region
+        )
 
         self.logger.debug("create result image")
+        result = fits.HDUList([accum_img[0].copy()])
         hdu = result[0]
-        hdu.data = out[0]
+        if resized or not has_accumulator:
+            out = accumulator.mean()
+            hdu.data = out[0]
+        else:
+            # only the pixels of the new block change
+            out = accumulator.mean(region)
+            hdu.data[region] = out[0]
+
         self.logger.debug("update result header")
         hdr = hdu.header
         self.set_base_headers(hdr)
@@ -588,10 +577,7 @@ class JoinDitheredImagesRecipe(EmirRecipe):
         hdr["TSUTC2"] = imgs[-1][0].header["TSUTC2"]
         # Update obsmode in header
         hdr["OBSMODE"] = "DITHERED_IMAGE"
-        hdu.header["history"] = "Combined %d images using '%s'" % (
-            len(imgs),
-            method.__name__,
-        )
+        hdu.header["history"] = "Combined %d images using 'mean'" % len(imgs)
         hdu.header["history"] = "Combination time {}".format(
             datetime.datetime.now(datetime.UTC).isoformat()
         )
@@ -608,12 +594,33 @@ class JoinDitheredImagesRecipe(EmirRecipe):
 
         #
         if use_errors:
-            varhdu = fits.ImageHDU(out[1], name="VARIANCE")
-            result.append(varhdu)
-            num = fits.ImageHDU(out[2].astype("int16"), name="MAP")
-            result.append(num)
+            if resized or not has_accumulator:
+                variance, num = out[1], out[2].astype("int16")
+            else:
+                variance = accum_img["VARIANCE"].data.copy()
+                variance[region] = out[1]
+                num = accum_img["MAP"].data.copy()
+                num[region] = out[2]
+            result.append(fits.ImageHDU(variance, name="VARIANCE"))
+            result.append(fits.ImageHDU(num, name="MAP"))
+        result.extend(accumulator.to_hdus())
         return result
 
+    def aggregate_mask(self, img):
+        """Mask of the pixels of a combined image without data."""
+        if "NUM" in img:
+            self.logger.debug("Using NUM extension as mask")
+            return numpy.where(img["NUM"].data, 0, 1).astype("int16")
+        elif "MAP" in img:
+            self.logger.debug("Using MAP extension as mask")
+            return numpy.where(img["MAP"].data, 0, 1).astype("int16")
+        elif "BPM" in img:
+            self.logger.debug("Using BPM extension as mask")
+            return numpy.where(img["BPM"].data, 1, 0).astype("int16")
+        else:
+            self.logger.warning("BPM missing, use zeros instead")
+            return None
+
     def compute_regions_from_objs(self, arr, finalshape, box=50, corners=True):
         regions = []
         catalog, mask = self.create_object_catalog(arr, border=300)
@@ -27,16 +27,15 @@ from numina.core import Result, Parameter
 from numina.core.query import Ignore
 from numina.core.recipes import timeit
 from numina.processing.combine import basic_processing_with_combination
-from numina.tools.pixel_solid_angle_arcsec2 import pixel_solid_angle_arcsec2
 from numina.util.context import manage_fits
 import numpy as np
-from reproject import reproject_interp, reproject_adaptive, reproject_exact
 
 from emirdrp.core.recipe import EmirRecipe
 import emirdrp.core.extra as extra
 import emirdrp.requirements as reqs
 import emirdrp.products as prods
 import emirdrp.processing.combine as comb
+from emirdrp.processing.reprojection import reprojection_cache
 import emirdrp.decorators
 
 _logger = logging.getLogger(__name__)
@@ -100,13 +99,7 @@ class StareImageRecipe2(EmirRecipe):
         convert_to_surface_brightness = True
         reprojection_method = rinput.reprojection_method
         if reprojection_method != "none":
-            if reprojection_method == "interp":
-                reproject_function = reproject_interp
-            elif reprojection_method == "adaptive":
-                reproject_function = reproject_adaptive
-            elif reprojection_method == "exact":
-                reproject_function = reproject_exact
-            else:
+            if reprojection_method not in ("interp", "adaptive", "exact"):
                 raise ValueError(
                     f"Unexpected astrometric_reprojection value: {reprojection_method}"
                 )
@@ -128,45 +121,55 @@ class StareImageRecipe2(EmirRecipe):
                 else:
                     raise ValueError("Unexpected PVi_j value")
             wcs_final = WCS(hdr)
-            naxis2, naxis1 = processed_img[0].data.shape
+            shape = processed_img[0].data.shape
+            # the transformation and the solid angles depend only on the
+            # distortion of the WCS, they are shared by all the frames of
+            # a dither pattern and computed once per process
+            cache = reprojection_cache
+            hits = cache.hits
+            plan = cache.plan(
+                wcs_original, wcs_final, shape, method=reprojection_method
+            )
             if convert_to_surface_brightness:
                 # solid angle subtended by every pixel
                 self.logger.debug(
                     "... computing solid angle of every pixel in the original WCS"
                 )
-                pixel_solid_angle_original = pixel_solid_angle_arcsec2(
-                    wcs=wcs_original,
-                    naxis1=naxis1,
-                    naxis2=naxis2,
-                    method=3,
-                    kernel_size=(11, 11),
+                pixel_solid_angle_original = cache.pixel_solid_angle(
+                    wcs_original, shape
                 )
                 surface_brightness_data = (
                     processed_img[0].data / pixel_solid_angle_original
                 )
             else:
                 surface_brightness_data = processed_img[0].data
+            layers = [surface_brightness_data, hdu_bpm.data]
+            if detector_channels == "H2RG_FULL":
+                # generate image with individual channel distortion
+                image_channels = np.zeros((2048, 2048))
+                for j_channel in range(32):
+                    j1 = j_channel * 64
+                    j2 = j1 + 64
+                    image_channels[:, j1:j2] = j_channel + 1
+                layers.append(image_channels)
             # reprojection itself
             self.logger.debug(
-                f"... reprojecting surface brightness using reproject_{reprojection_method}"
-            )
-            data_final, footprint = reproject_function(
-                input_data=(surface_brightness_data, wcs_original),
-                output_projection=wcs_final,
-                shape_out=processed_img[0].data.shape,
+                f"... reprojecting surface brightness, mask and channels "
+                f"using reproject_{reprojection_method}"
             )
+            reprojected = plan(*layers)
+            data_final, footprint = reprojected[0]
             if convert_to_surface_brightness:
                 self.logger.debug(
                     "... computing solid angle of every pixel in the final WCS"
                 )
-                pixel_solid_angle_final = pixel_solid_angle_arcsec2(
-                    wcs=wcs_final,
-                    naxis1=naxis1,
-                    naxis2=naxis2,
-                    method=3,
-                    kernel_size=(11, 11),
-                )
-                data_final *= pixel_solid_angle_final
+                data_final *= cache.pixel_solid_angle(wcs_final, shape)
+            self.logger.debug(
+                "... reprojection cache: %d hits in this frame, %d hits, %d misses",
+                cache.hits - hits,
+                cache.hits,
+                cache.misses,
+            )
             # avoid undefined values: note that using footprint < 1.0 does not work
             # properly with reproject_exact(), which gives a footprint with values around 1.0
             # but with a non-negligible dispersion below 0.01 (for safety, here we use
@@ -176,32 +179,15 @@ class StareImageRecipe2(EmirRecipe):
             data_final[footprint < minimum_footprint] = 0
             processed_img[0].data = data_final
             mask_footprint = (footprint < minimum_footprint).astype("uint8")
-            # reproject mask
-            self.logger.debug(
-                f"... reprojecting mask using reproject_{reprojection_method}"
-            )
-            mask_reprojected, footprint = reproject_function(
-                input_data=(hdu_bpm.data, wcs_original),
-                output_projection=wcs_final,
-                shape_out=hdu_bpm.data.shape,
-            )
+            # reprojected mask
+            mask_reprojected, footprint = reprojected[1]
             # avoid undefined values
             mask_reprojected[footprint < minimum_footprint] = 0
             self.logger.debug("... merging existing mask with footprint from reproject")
             # there is no need to recompute mask_footprint (is the one computed for data)
             hdu_bpm.data = (mask_reprojected > 0).astype("uint8") + mask_footprint
-            # generate image with individual channel distortion
             if detector_channels == "H2RG_FULL":
-                image_channels = np.zeros((2048, 2048))
-                for j_channel in range(32):
-                    j1 = j_channel * 64
-                    j2 = j1 + 64
-                    image_channels[:, j1:j2] = j_channel + 1
-                channels_reprojected, footprint = reproject_function(
-                    input_data=(image_channels, wcs_original),
-                    output_projection=wcs_final,
-                    shape_out=image_channels.shape,
-                )
+                channels_reprojected, footprint = reprojected[2]
                 channels_reprojected[footprint < minimum_footprint] = 0.0
                 channels_reprojected_int = np.round(channels_reprojected).astype(
                     "uint8"
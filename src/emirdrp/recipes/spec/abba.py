@@ -11,11 +11,11 @@
 Spectroscopy mode, combine AB or ABBA observations
 """
 
-from astropy import wcs
-from astropy.coordinates import SkyCoord
 import astropy.io.fits as fits
+import collections
 import contextlib
 import logging
+import os
 import numpy as np
 from scipy import ndimage
 import uuid
@@ -35,12 +35,18 @@ from emirdrp.processing.wavecal.apply_rectwv_coeff import apply_rectwv_coeff
 from emirdrp.processing.wavecal.median_slitlets_rectified import (
     median_slitlets_rectified,
 )
+from emirdrp.processing.wavecal.rectmaps import RectWaveMapCache
 from emirdrp.processing.wavecal.rectwv_coeff_to_ds9 import save_four_ds9
 from emirdrp.processing.wavecal.rectwv_coeff_to_ds9 import save_spectral_lines_ds9
 from emirdrp.processing.wavecal.useful_mos_xpixels import useful_mos_xpixels
+from emirdrp.processing.wcs import sky_offsets_from_wcs
+from emirdrp.processing.blockcombine import combine_row_blocks
+from emirdrp.processing.combine import create_combined_hdulist
+from emirdrp.processing.framestore import FrameStore
 
 from emirdrp.core import EMIR_NAXIS1
 from emirdrp.core import EMIR_NAXIS2
+from emirdrp.core import EMIR_NBARS
 
 
 def get_isky(i, basic_pattern, repeat):
@@ -84,25 +90,13 @@ def compute_wcs_offsets(hduls):
 
     """
 
-    nimages = len(hduls)
-    c0 = None
-    list_sep_arcsec = []
-    list_spatial_scales_arcsecperpix = []
-    for i in range(nimages):
-        wcsh = wcs.WCS(hduls[i][0].header)
-        ra, dec = wcsh.wcs_pix2world(EMIR_NAXIS1 / 2 + 0.5, EMIR_NAXIS2 / 2 + 0.5, 1)
-        ra_, dec_ = wcsh.wcs_pix2world(EMIR_NAXIS1 / 2 + 0.5, EMIR_NAXIS2 / 2 + 1.5, 1)
-        if i == 0:
-            c0 = SkyCoord(ra, dec, unit="deg")
-        ci = SkyCoord(ra, dec, unit="deg")
-        ci_ = SkyCoord(ra_, dec_, unit="deg")
-        sep = ci.separation(c0).arcsec
-        scale = ci.separation(ci_).arcsec
-        list_sep_arcsec.append(round(sep, 4))
-        list_spatial_scales_arcsecperpix.append(round(scale, 7))
-
-    sep_arcsec = np.array(list_sep_arcsec)
-    spatial_scales_arcsecperpix = np.array(list_spatial_scales_arcsecperpix)
+    sep_arcsec, spatial_scales_arcsecperpix = sky_offsets_from_wcs(
+        [hdul[0].header for hdul in hduls],
+        pixref=(EMIR_NAXIS1 / 2 + 0.5, EMIR_NAXIS2 / 2 + 0.5),
+        step=(0.0, 1.0),
+    )
+    sep_arcsec = np.round(sep_arcsec, 4)
+    spatial_scales_arcsecperpix = np.round(spatial_scales_arcsecperpix, 7)
 
     return sep_arcsec, spatial_scales_arcsecperpix
 
@@ -141,11 +135,32 @@ class ABBASpectraRectwv(EmirRecipe):
     refine_target_along_slitlet = Parameter(
         dict(), description="Parameters to refine location of target along the slitlet"
     )
+    rectwv_executor = Parameter(
+        "serial",
+        description="Processing of the slitlets in the rectification "
+        "and wavelength calibration",
+        choices=["serial", "thread", "process"],
+    )
+    rectwv_max_workers = Parameter(
+        0,
+        description="Maximum number of workers in the rectification and "
+        "wavelength calibration (0: default value)",
+        optional=True,
+    )
+
+    combine_memory = Parameter(
+        128, description="Memory budget for the combination of frames [MB]"
+    )
 
     reduced_mos_abba = Result(prods.ProcessedMOS)
     reduced_mos_abba_combined = Result(prods.ProcessedMOS)
 
     def run(self, rinput):
+        # the rectified images are kept in files, not in memory
+        with FrameStore(directory=os.getcwd(), prefix="abba_") as store:
+            return self.run_store(rinput, store)
+
+    def run_store(self, rinput, store):
 
         nimages = len(rinput.obresult.frames)
         basic_pattern = rinput.pattern
@@ -346,7 +361,19 @@ class ABBASpectraRectwv(EmirRecipe):
         flow = self.init_filters(rinput)
 
         # basic reduction, rectification and wavelength calibration of all the individual images
-        list_reduced_mos_images = []
+        # (the rectification maps are compiled once and reused for all the
+        # images sharing the same RectWaveCoeff; the maps of the RectWaveCoeff
+        # used by a single image are not kept)
+        uuid_count = collections.Counter(calib.uuid for calib in list_rectwv_coeff)
+        nshared = sum(1 for count in uuid_count.values() if count > 1)
+        if nshared > 0:
+            rectwv_maps = RectWaveMapCache(maxsize=EMIR_NBARS * nshared)
+        else:
+            rectwv_maps = None
+        # first pass: only the headers and extensions of the rectified
+        # images are kept in memory, their data are stored in files
+        list_headers = []
+        list_extensions = []
         self.logger.info("starting reduction of individual images")
         for i, char in enumerate(full_set):
             frame = rinput.obresult.frames[i]
@@ -372,13 +399,25 @@ class ABBASpectraRectwv(EmirRecipe):
             hdr = reduced_image[0].header
             self.set_base_headers(hdr)
             # rectification and wavelength calibration
-            reduced_mos_image = apply_rectwv_coeff(reduced_image, list_rectwv_coeff[i])
+            reduced_mos_image = apply_rectwv_coeff(
+                reduced_image,
+                list_rectwv_coeff[i],
+                executor=rinput.rectwv_executor,
+                max_workers=rinput.rectwv_max_workers,
+                rectwv_maps=(
+                    rectwv_maps if uuid_count[list_rectwv_coeff[i].uuid] > 1 else None
+                ),
+            )
             if save_individual_images != 0:
                 self.save_intermediate_img(
                     reduced_mos_image,
                     "reduced_mos_image_" + char + "_" + frame.filename[:10] + ".fits",
                 )
-            list_reduced_mos_images.append(reduced_mos_image)
+            store.store(f"rect{i}", reduced_mos_image[0].data)
+            store.release(f"rect{i}")
+            list_headers.append(reduced_mos_image[0].header)
+            list_extensions.append(reduced_mos_image[1:])
+            del reduced_image, reduced_mos_image
 
         # intermediate PDF file with crosscorrelation plots
         if self.intermediate_results:
@@ -413,12 +452,13 @@ class ABBASpectraRectwv(EmirRecipe):
                 self.logger.info(f"image {char} ({i+1} of {nimages})")
                 self.logger.info(f"image: {frame.filename}")
                 self.logger.info(f"(sky): {frame_sky.filename}")
-                data = list_reduced_mos_images[i][0].data.copy()
-                data_sky = list_reduced_mos_images[isky][0].data
-                data -= data_sky
-                base_header = list_reduced_mos_images[i][0].header
+                base_header = list_headers[i]
 
                 # get useful pixels in the wavelength direction
+                # (only the first images of each position are read whole)
+                if (char == "A" and first_a) or (char == "B" and first_b):
+                    data = store.reader(f"rect{i}")[...]
+                    data -= store.reader(f"rect{isky}")[...]
                 if char == "A" and first_a:
                     xisok_a = useful_mos_xpixels(
                         data,
@@ -466,9 +506,11 @@ class ABBASpectraRectwv(EmirRecipe):
                     raise ValueError(f"Unexpected char value: {char}")
 
                 # initial slitlet region
-                slitlet2d = data[(nsmin - 1) : nsmax, :].copy()
+                slitlet2d = self.read_rows_minus_sky(store, i, isky, nsmin, nsmax)
                 if skysubtraction:
-                    slitlet2d_sky = data[(nsmin_sky - 1) : nsmax_sky, :].copy()
+                    slitlet2d_sky = self.read_rows_minus_sky(
+                        store, i, isky, nsmin_sky, nsmax_sky
+                    )
                     median_sky = np.median(slitlet2d_sky, axis=0)
                     slitlet2d -= median_sky
 
@@ -537,27 +579,38 @@ class ABBASpectraRectwv(EmirRecipe):
                     first_a = False
                 elif char == "B" and first_b:
                     first_b = False
+                data = None
             else:
                 list_offsets.append(0.0)
         self.logger.info(f"computed offsets: {list_offsets}")
 
+        # combination method
+        method = getattr(combine, rinput.method)
+        method_kwargs = dict(rinput.method_kwargs)
+        dtype = method_kwargs.pop("dtype", "float32")
+        running_mean = method is combine.mean and not method_kwargs
+
+        # second pass: the images are shifted one by one, and added to
+        # running sums (mean) or stored again for a combination by
+        # blocks of rows
         self.logger.info("correcting vertical offsets between individual images")
         list_a = []
         list_b = []
+        sums = {}
         for i, (char, offset) in enumerate(zip(full_set, list_offsets)):
             frame = rinput.obresult.frames[i]
             self.logger.info(f"image {char} ({i+1} of {nimages})")
             self.logger.info(f"image: {frame.filename}")
-            reduced_mos_image = list_reduced_mos_images[i]
-            data = reduced_mos_image[0].data
-            base_header = reduced_mos_image[0].header
+            data = store.reader(f"rect{i}")[...]
+            base_header = list_headers[i]
             self.logger.info(f"correcting vertical offset (pixesl): {offset}")
             if offset != 0:
-                reduced_mos_image[0].data = shift_image2d(data, yoffset=-offset).astype(
-                    "float32"
-                )
+                data = shift_image2d(data, yoffset=-offset).astype("float32")
             base_header["HISTORY"] = f"Applying voffset_pix {offset}"
             if save_individual_images != 0:
+                reduced_mos_image = fits.HDUList(
+                    [fits.PrimaryHDU(data, header=base_header)] + list_extensions[i]
+                )
                 self.save_intermediate_img(
                     reduced_mos_image,
                     "reduced_mos_image_refined_"
@@ -567,37 +620,53 @@ class ABBASpectraRectwv(EmirRecipe):
                     + ".fits",
                 )
 
-            # store reduced_mos_image
-            if char == "A":
-                list_a.append(reduced_mos_image)
-            elif char == "B":
-                list_b.append(reduced_mos_image)
-            else:
+            if char not in ["A", "B"]:
                 raise ValueError("Unexpected char value: {}".format(char))
+            if running_mean:
+                if char not in sums:
+                    sums[char] = np.zeros(data.shape)
+                sums[char] += data
+                store.remove(f"rect{i}")
+            elif offset != 0:
+                store.store(f"rect{i}", data)
+                store.release(f"rect{i}")
+            del data
 
-        # combination method
-        method = getattr(combine, rinput.method)
-        method_kwargs = rinput.method_kwargs
+            if char == "A":
+                list_a.append(i)
+            else:
+                list_b.append(i)
+
+        combined = {}
+        for char, indices in [("A", list_a), ("B", list_b)]:
+            self.logger.info(f"combining individual {char} images")
+            if running_mean:
+                # as numina.array.combine.mean, without masks
+                combined[char] = (sums.pop(char) / len(indices)).astype(dtype)
+            else:
+                combined[char] = combine_row_blocks(
+                    method,
+                    [store.reader(f"rect{i}") for i in indices],
+                    dtype=dtype,
+                    max_memory=rinput.combine_memory * 1024**2,
+                    **method_kwargs,
+                )[0]
+                for i in indices:
+                    store.remove(f"rect{i}")
+
+        def header_only(i):
+            primary = fits.PrimaryHDU(header=list_headers[i].copy())
+            return fits.HDUList([primary] + list_extensions[i])
 
         # final combination of A images
-        self.logger.info("combining individual A images")
-        reduced_mos_image_a = combine_imgs(
-            list_a,
-            method=method,
-            method_kwargs=method_kwargs,
-            errors=False,
-            prolog=None,
+        reduced_mos_image_a = create_combined_hdulist(
+            [header_only(i) for i in list_a], combined.pop("A"), method.__name__
         )
         self.save_intermediate_img(reduced_mos_image_a, "reduced_mos_image_a.fits")
 
         # final combination of B images
-        self.logger.info("combining individual B images")
-        reduced_mos_image_b = combine_imgs(
-            list_b,
-            method=method,
-            method_kwargs=method_kwargs,
-            errors=False,
-            prolog=None,
+        reduced_mos_image_b = create_combined_hdulist(
+            [header_only(i) for i in list_b], combined.pop("B"), method.__name__
         )
         self.save_intermediate_img(reduced_mos_image_b, "reduced_mos_image_b.fits")
 
@@ -727,6 +796,14 @@ class ABBASpectraRectwv(EmirRecipe):
         )
         return result
 
+    @staticmethod
+    def read_rows_minus_sky(store, i, isky, nsmin, nsmax):
+        """Rows nsmin to nsmax (from 1) of image i minus image isky."""
+        rows = slice(nsmin - 1, nsmax)
+        data = store.reader(f"rect{i}")[rows, :]
+        data -= store.reader(f"rect{isky}")[rows, :]
+        return data
+
     def create_mos_abba_image(
         self,
         rinput,
@@ -57,7 +57,7 @@ class SkySpecRecipe(EmirRecipe):
         # RectWaveCoeff object with rectification and wavelength calibration
         # coefficients for the particular CSU configuration
         rectwv_coeff = rectwv_coeff_from_mos_library(
-            reduced_image, rinput.master_rectwv
+            reduced_image, rinput.master_rectwv, use_cache=True
         )
         # save as JSON file in work directory
         self.save_structured_as_json(rectwv_coeff, "rectwv_coeff.json")
@@ -125,7 +125,7 @@ class StareSpectraWaveRecipe(EmirRecipe):
             # RectWaveCoeff object with rectification and wavelength
             # calibration coefficients for the particular CSU configuration
             rectwv_coeff = rectwv_coeff_from_mos_library(
-                reduced_image, rinput.master_rectwv
+                reduced_image, rinput.master_rectwv, use_cache=True
             )
 
             # apply rectification and wavelength calibration
@@ -302,7 +302,7 @@ class GenerateRectwvCoeff(EmirRecipe):
         # RectWaveCoeff object with rectification and wavelength
         # calibration coefficients for the particular CSU configuration
         rectwv_coeff = rectwv_coeff_from_mos_library(
-            reduced_image, rinput.master_rectwv
+            reduced_image, rinput.master_rectwv, use_cache=True
         )
 
         # wavelength calibration refinement
@@ -495,6 +495,18 @@ class StareSpectraRectwv(EmirRecipe):
     master_dark = reqs.MasterDarkRequirement()
     master_flat = reqs.MasterSpectralFlatFieldRequirement()
     rectwv_coeff = reqs.RectWaveCoeffRequirement()
+    rectwv_executor = Parameter(
+        "serial",
+        description="Processing of the slitlets in the rectification "
+        "and wavelength calibration",
+        choices=["serial", "thread", "process"],
+    )
+    rectwv_max_workers = Parameter(
+        0,
+        description="Maximum number of workers in the rectification and "
+        "wavelength calibration (0: default value)",
+        optional=True,
+    )
 
     reduced_mos = Result(prods.ProcessedMOS)
 
@@ -518,7 +530,12 @@ class StareSpectraRectwv(EmirRecipe):
         self.save_intermediate_img(reduced_image, "reduced_image.fits")
 
         # apply rectification and wavelength calibration
-        reduced_mos = apply_rectwv_coeff(reduced_image, rinput.rectwv_coeff)
+        reduced_mos = apply_rectwv_coeff(
+            reduced_image,
+            rinput.rectwv_coeff,
+            executor=rinput.rectwv_executor,
+            max_workers=rinput.rectwv_max_workers,
+        )
 
         # ds9 region files (to be saved in the work directory)
         if self.intermediate_results:
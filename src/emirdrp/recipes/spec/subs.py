@@ -37,7 +37,11 @@ import emirdrp.datamodel
 import emirdrp.decorators
 import emirdrp.products as prods
 from emirdrp.core.recipe import EmirRecipe
-from emirdrp.processing.combine import basic_processing
+from emirdrp.processing.combine import (
+    basic_processing,
+    copy_img_with_data,
+    nodded_difference,
+)
 
 
 class BaseABBARecipe(EmirRecipe):
@@ -152,17 +156,12 @@ class BaseABBARecipe(EmirRecipe):
 
     def process_abba(self, images):
         """Process four images in ABBA mode"""
-        # FIXME: Duplicated in processing
-        dataA0 = images[0][0].data.astype("float32")
-        dataB0 = images[1][0].data.astype("float32")
-
-        dataB1 = images[2][0].data.astype("float32")
-        dataA1 = images[3][0].data.astype("float32")
-
-        dataAB0 = dataA0 - dataB0
-        dataAB1 = dataA1 - dataB1
-
-        dataABBA = dataAB0 + dataAB1
+        dataABBA, _ = nodded_difference(
+            [
+                (images[0][0].data, images[1][0].data),
+                (images[3][0].data, images[2][0].data),
+            ]
+        )
 
         hdulist = self.create_proc_hdulist(images, dataABBA)
         self.logger.debug("update result header")
@@ -179,10 +178,9 @@ class BaseABBARecipe(EmirRecipe):
 
     def create_proc_hdulist(self, cdata, data_array):
         # Copy header of first image
-        result = copy_img(cdata[0])
+        result = copy_img_with_data(cdata[0], data_array)
 
         hdu = result[0]
-        hdu.data = data_array
         self.set_base_headers(hdu.header)
         hdu.header["UUID"] = str(uuid.uuid1())
         # Update obsmode in header
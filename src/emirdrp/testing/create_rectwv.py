@@ -0,0 +1,76 @@
+import astropy.io.fits as fits
+import numpy
+
+from emirdrp.core import EMIR_NBARS, EMIR_NPIXPERSLIT_RECTIFIED
+from emirdrp.products import RectWaveCoeff
+from emirdrp.testing.create_headers import create_dtu_header_example
+
+
+def create_rectwv_coeff(valid_islitlets):
+    rectwv_coeff = RectWaveCoeff(instrument="EMIR")
+    rectwv_coeff.tags = {"grism": "J", "filter": "J"}
+    rectwv_coeff.meta_info["dtu_configuration"] = create_dtu_header_example()
+    rectwv_coeff.meta_info["origin"] = {"bound_param": "uuid" + "0" * 32}
+    rectwv_coeff.total_slitlets = EMIR_NBARS
+    rectwv_coeff.missing_slitlets = [
+        islitlet
+        for islitlet in range(1, EMIR_NBARS + 1)
+        if islitlet not in valid_islitlets
+    ]
+    for islitlet in range(1, EMIR_NBARS + 1):
+        if islitlet not in valid_islitlets:
+            rectwv_coeff.contents.append({})
+            continue
+        ns1 = (islitlet - 1) * EMIR_NPIXPERSLIT_RECTIFIED + 1
+        ylower = ns1 + 3.5
+        yupper = ns1 + 34.5
+        rectwv_coeff.contents.append(
+            {
+                "csu_bar_left": 100.0,
+                "csu_bar_right": 101.0,
+                "csu_bar_slit_center": 100.5,
+                "csu_bar_slit_width": 1.0,
+                "bb_nc1_orig": 101 + islitlet,
+                "bb_nc2_orig": 1900,
+                "bb_ns1_orig": ns1,
+                "bb_ns2_orig": ns1 + 40,
+                "x0_reference": 1024.5,
+                "spectrail": {
+                    "poly_coef_lower": [ylower],
+                    "poly_coef_middle": [0.5 * (ylower + yupper)],
+                    "poly_coef_upper": [yupper],
+                },
+                "y0_reference_lower": ylower,
+                "y0_reference_middle": 0.5 * (ylower + yupper),
+                "y0_reference_upper": yupper,
+                "frontier": {
+                    "poly_coef_lower": [ns1 + 1.5],
+                    "poly_coef_upper": [ns1 + 36.5],
+                },
+                "y0_frontier_lower": ns1 + 1.5,
+                "y0_frontier_upper": ns1 + 36.5,
+                "y0_frontier_lower_expected": ns1 + 1.5,
+                "y0_frontier_upper_expected": ns1 + 36.5,
+                "corr_yrect_a": 0.0,
+                "corr_yrect_b": 1.0,
+                "min_row_rectified": 1,
+                "max_row_rectified": 38,
+                "ttd_aij": [0.0, 1.0, 0.0],
+                "ttd_bij": [0.25 + 0.01 * islitlet, 0.0, 1.0],
+                "tti_aij": [0.0, 1.0, 0.0],
+                "tti_bij": [-0.25 - 0.01 * islitlet, 0.0, 1.0],
+                "wpoly_coeff": [11500.0 + islitlet, 0.78, 1e-6],
+            }
+        )
+    return rectwv_coeff
+
+
+def create_rectwv_image():
+    rng = numpy.random.default_rng(10)
+    data = rng.uniform(100.0, 200.0, size=(2048, 2048)).astype("float32")
+    hdu = fits.PrimaryHDU(data)
+    hdu.header["FILTER"] = "J"
+    hdu.header["GRISM"] = "J"
+    for key, value in create_dtu_header_example().items():
+        hdu.header[key] = value
+    return fits.HDUList([hdu])
@@ -20,6 +20,9 @@ from numina.array.display.pause_debugplot import pause_debugplot
 from numina.array.wavecalib.apply_integer_offsets import apply_integer_offsets
 from numina.tools.arg_file_is_new import arg_file_is_new
 
+from emirdrp.processing.specflat import safe_divide
+from emirdrp.processing.specflat import insert_slitlet
+from emirdrp.processing.wavecal.slitletgeometry import SlitletGeometry
 from emirdrp.processing.wavecal.slitlet2d import Slitlet2D
 from emirdrp.processing.wavecal.set_wv_parameters import set_wv_parameters
 from emirdrp.instrument.components.dtu import DtuConf
@@ -439,6 +442,9 @@ def main(args=None):
     # initialize rectified image
     image2d_flatfielded = np.zeros((EMIR_NAXIS2, EMIR_NAXIS1))
 
+    # scan limits of the slitlets, computed only once
+    geometry = SlitletGeometry.from_rectwv_coeff(rectwv_coeff)
+
     # main loop
     for islitlet in list(range(1, EMIR_NBARS + 1)):
         if islitlet in list_valid_islitlets:
@@ -481,14 +487,7 @@ def main(args=None):
             )
 
             # normalize initial slitlet image (avoid division by zero)
-            slitlet2d_norm = np.zeros_like(slitlet2d)
-            for j in range(naxis1_slitlet2d):
-                for i in range(naxis2_slitlet2d):
-                    den = slitlet2d_unrect_spmedian[i, j]
-                    if den == 0:
-                        slitlet2d_norm[i, j] = 1.0
-                    else:
-                        slitlet2d_norm[i, j] = slitlet2d[i, j] / den
+            slitlet2d_norm = safe_divide(slitlet2d, slitlet2d_unrect_spmedian)
 
             if abs(args.debugplot) > 10:
                 slt.ximshow_unrectified(
@@ -535,25 +534,17 @@ def main(args=None):
             else:
                 same_slitlet_above = False
 
-            for j in range(EMIR_NAXIS1):
-                xchannel = j + 1
-                y0_lower = slt.list_frontiers[0](xchannel)
-                y0_upper = slt.list_frontiers[1](xchannel)
-                n1, n2 = nscan_minmax_frontiers(
-                    y0_frontier_lower=y0_lower, y0_frontier_upper=y0_upper, resize=True
-                )
-                # note that n1 and n2 are scans (ranging from 1 to NAXIS2)
-                nn1 = n1 - slt.bb_ns1_orig + 1
-                nn2 = n2 - slt.bb_ns1_orig + 1
-                image2d_flatfielded[(n1 - 1) : n2, j] = slitlet2d_norm[
-                    (nn1 - 1) : nn2, j
-                ]
-
-                # force to 1.0 region around frontiers
-                if not same_slitlet_below:
-                    image2d_flatfielded[(n1 - 1) : (n1 + 2), j] = 1
-                if not same_slitlet_above:
-                    image2d_flatfielded[(n2 - 5) : n2, j] = 1
+            # note that n1 and n2 are scans (ranging from 1 to NAXIS2)
+            n1, n2 = geometry.limits(islitlet)
+            insert_slitlet(
+                image2d_flatfielded,
+                slitlet2d_norm,
+                n1,
+                n2,
+                slt.bb_ns1_orig,
+                same_slitlet_below=same_slitlet_below,
+                same_slitlet_above=same_slitlet_above,
+            )
         else:
             if args.debugplot == 0:
                 islitlet_progress(islitlet, EMIR_NBARS, ignore=True)
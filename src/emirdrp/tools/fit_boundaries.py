@@ -251,9 +251,9 @@ def exvp_scalar(x, y, x0, y0, c2, c4, theta0, ff):
 def exvp(x, y, x0, y0, c2, c4, theta0, ff):
     """Convert virtual pixel(s) to real pixel(s).
 
-    This function makes use of exvp_scalar(), which performs the
-    conversion for a single point (x, y), over an array of X and Y
-    values.
+    The conversion is computed over the whole arrays of X and Y
+    values at once. The model parameters can also be arrays,
+    as long as they broadcast against x and y.
 
     Parameters
     ----------
@@ -261,19 +261,19 @@ def exvp(x, y, x0, y0, c2, c4, theta0, ff):
         X coordinate (pixel).
     y : array-like
         Y coordinate (pixel).
-    x0 : float
-        X coordinate of reference pixel.
-    y0 : float
-        Y coordinate of reference pixel.
-    c2 : float
+    x0 : float or array-like
+        X coordinate of reference pixel, in units of 1E3.
+    y0 : float or array-like
+        Y coordinate of reference pixel, in units of 1E3.
+    c2 : float or array-like
         Coefficient corresponding to the term r**2 in distortion
-        equation.
-    c4 : float
+        equation, in units of 1E4.
+    c4 : float or array-like
         Coefficient corresponding to the term r**4 in distortion
-        equation.
-    theta0 : float
+        equation, in units of 1E9.
+    theta0 : float or array-like
         Additional rotation angle (radians).
-    ff : float
+    ff : float or array-like
         Scaling factor to be applied to the Y axis.
 
     Returns
@@ -283,23 +283,35 @@ def exvp(x, y, x0, y0, c2, c4, theta0, ff):
 
     """
 
-    if all([np.isscalar(x), np.isscalar(y)]):
-        xdist, ydist = exvp_scalar(
-            x, y, x0=x0, y0=y0, c2=c2, c4=c4, theta0=theta0, ff=ff
-        )
-        return xdist, ydist
-    elif any([np.isscalar(x), np.isscalar(y)]):
+    scalar_input = np.isscalar(x) and np.isscalar(y)
+    if not scalar_input and (np.isscalar(x) or np.isscalar(y)):
         raise ValueError("invalid mixture of scalars and arrays")
-    else:
-        xdist = []
-        ydist = []
-        for x_, y_ in zip(x, y):
-            xdist_, ydist_ = exvp_scalar(
-                x_, y_, x0=x0, y0=y0, c2=c2, c4=c4, theta0=theta0, ff=ff
-            )
-            xdist.append(xdist_)
-            ydist.append(ydist_)
-        return np.array(xdist), np.array(ydist)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # plate scale: 0.1944 arcsec/pixel
+    # conversion factor (in radian/pixel)
+    factor = 0.1944 * np.pi / (180.0 * 3600)
+    xc = x0 * 1000
+    yc = y0 * 1000
+    # distance from image center (pixels)
+    r_pix = np.sqrt((x - xc) ** 2 + (y - yc) ** 2)
+    # distance from imagen center (radians)
+    r_rad = factor * r_pix
+    # radial distortion (see exvp_scalar)
+    rdist = 1 + c2 * 1.0e4 * r_rad**2 + c4 * 1.0e9 * r_rad**4
+    # angle measured from the Y axis towards the X axis; arctan2 takes
+    # care of the quadrant (this angle differs in 2*pi from the one
+    # computed in exvp_scalar when x > x0 and y < y0)
+    theta = np.arctan2(x - xc, y - yc)
+    # distorted coordinates
+    xdist = (rdist * r_pix * np.sin(theta + theta0)) + xc
+    ydist = (ff * rdist * r_pix * np.cos(theta + theta0)) + yc
+
+    if scalar_input:
+        return float(xdist), float(ydist)
+    return xdist, ydist
 
 
 def return_params(islitlet, csu_bar_slit_center, params, parmodel):
@@ -628,71 +640,218 @@ def fun_residuals(
 
     """
 
-    global FUNCTION_EVALUATIONS
-    global_residual = 0.0
-    nsummed = 0
+    residuals = BoundaryResiduals(
+        parmodel=parmodel,
+        bounddict=bounddict,
+        shrinking_factor=shrinking_factor,
+        numresolution=numresolution,
+        islitmin=islitmin,
+        islitmax=islitmax,
+    )
+    return residuals(params, debugplot=debugplot)
 
-    read_slitlets = list(bounddict["contents"].keys())
-    # read_slitlets.sort()  # this is not really necessary
-    for tmp_slitlet in read_slitlets:
-        islitlet = int(tmp_slitlet[7:])
-        if islitmin <= islitlet <= islitmax:
-            read_dateobs = list(bounddict["contents"][tmp_slitlet].keys())
-            # read_dateobs.sort()  # this is not really necessary
-            for tmp_dateobs in read_dateobs:
-                tmp_dict = bounddict["contents"][tmp_slitlet][tmp_dateobs]
-                csu_bar_slit_center = tmp_dict["csu_bar_slit_center"]
-                # expected boundaries using provided parameters
-                list_spectrails = expected_distorted_boundaries(
-                    islitlet,
-                    csu_bar_slit_center,
-                    [0, 1],
-                    params,
-                    parmodel,
-                    numpts=numresolution,
-                    deg=5,
-                    debugplot=0,
-                )
-                poly_lower_expected = list_spectrails[0].poly_funct
-                poly_upper_expected = list_spectrails[1].poly_funct
-                # measured lower boundary
-                poly_lower_measured = np.polynomial.Polynomial(
-                    tmp_dict["boundary_coef_lower"]
-                )
+
+def polfit_eval_batch(x, y, deg, xeval):
+    """Fit polynomials to each row of (x, y) and evaluate them at xeval.
+
+    Each polynomial is fitted by least squares in the scaled domain
+    [min(x), max(x)] --> [-1, 1] (as done by
+    numpy.polynomial.Polynomial.fit), which keeps the problem
+    well conditioned.
+
+    Parameters
+    ----------
+    x : 2d numpy array, float
+        X coordinates of the data being fitted, one fit per row.
+    y : 2d numpy array, float
+        Y coordinates of the data being fitted, same shape as x.
+    deg : int
+        Degree of the fitted polynomials.
+    xeval : 2d numpy array, float
+        X coordinates where the polynomial of each row is evaluated.
+
+    Returns
+    -------
+    yeval : 2d numpy array, float
+        Values of the fitted polynomials at xeval.
+
+    """
+
+    xmin = x.min(axis=1, keepdims=True)
+    xmax = x.max(axis=1, keepdims=True)
+    scl = 2.0 / (xmax - xmin)
+    off = -(xmax + xmin) / (xmax - xmin)
+
+    def vander(t):
+        powers = [np.ones_like(t)]
+        for _ in range(deg):
+            powers.append(powers[-1] * t)
+        return np.stack(powers, axis=-1)
+
+    q, r = np.linalg.qr(vander(off + scl * x))
+    qty = np.einsum("nmk,nm->nk", q, y)
+    coef = np.linalg.solve(r, qty[..., np.newaxis])[..., 0]
+
+    return np.einsum("nmk,nk->nm", vander(off + scl * xeval), coef)
+
+
+class BoundaryResiduals:
+    """Residuals between measured and expected slitlet boundaries.
+
+    The measured boundaries stored in the bounddict structure are
+    evaluated only once, when the instance is created. Each call
+    computes the expected boundaries of every slitlet and every
+    DATE-OBS in a single batched evaluation of the distortion model.
+
+    Parameters
+    ----------
+    parmodel : str
+        Model to be assumed. Allowed values are 'longslit' and
+        'multislit'.
+    bounddict : JSON structure
+        Structure employed to store bounddict information.
+    shrinking_factor : float
+        Fraction of the detected X range (specrtral) to be employed
+        in the fit. This must be a number verifying
+        0 < shrinking_factor <= 1. The resulting interval will be
+        centered within the original one.
+    numresolution : int
+        Number of points in which the X-range interval is subdivided
+        before computing the residuals.
+    islitmin : int
+        Minimum slitlet number.
+    islitmax : int
+        Maximum slitlet number.
+    deg : int
+        Degree of the polynomials fitted to the expected boundaries.
+
+    """
+
+    def __init__(
+        self,
+        parmodel,
+        bounddict,
+        shrinking_factor,
+        numresolution,
+        islitmin,
+        islitmax,
+        deg=5,
+    ):
+        self.parmodel = parmodel
+        self.numresolution = numresolution
+        self.deg = deg
+
+        list_islitlet = []
+        list_csu_bar_slit_center = []
+        list_borderval = []
+        list_xdum = []
+        list_ymeasured = []
+
+        for tmp_slitlet in bounddict["contents"]:
+            islitlet = int(tmp_slitlet[7:])
+            if not islitmin <= islitlet <= islitmax:
+                continue
+            for tmp_dict in bounddict["contents"][tmp_slitlet].values():
                 xmin_lower_bound = tmp_dict["boundary_xmin_lower"]
                 xmax_lower_bound = tmp_dict["boundary_xmax_lower"]
+                # note that the same shrinking is applied to both boundaries
                 dx = (xmax_lower_bound - xmin_lower_bound) * (1 - shrinking_factor) / 2
-                xdum_lower = np.linspace(
-                    xmin_lower_bound + dx, xmax_lower_bound - dx, num=numresolution
-                )
-                # distance between expected and measured polynomials
-                poly_diff = poly_lower_expected - poly_lower_measured
-                global_residual += np.sum(poly_diff(xdum_lower) ** 2)
-                nsummed += numresolution
-                # measured upper boundary
-                poly_upper_measured = np.polynomial.Polynomial(
-                    tmp_dict["boundary_coef_upper"]
-                )
-                xmin_upper_bound = tmp_dict["boundary_xmin_upper"]
-                xmax_upper_bound = tmp_dict["boundary_xmax_upper"]
-                dx = (xmax_lower_bound - xmin_lower_bound) * (1 - shrinking_factor) / 2
-                xdum_upper = np.linspace(
-                    xmin_upper_bound + dx, xmax_upper_bound - dx, num=numresolution
-                )
-                # distance between expected and measured polynomials
-                poly_diff = poly_upper_expected - poly_upper_measured
-                global_residual += np.sum(poly_diff(xdum_upper) ** 2)
-                nsummed += numresolution
-
-    if nsummed > 0:
-        global_residual = np.sqrt(global_residual / nsummed)
-    if debugplot >= 10:
-        FUNCTION_EVALUATIONS += 1
-        print("-" * 79)
-        print(">>> Number of function evaluations:", FUNCTION_EVALUATIONS)
-        print(">>> global residual...............:", global_residual)
-        params.pretty_print()
-    return global_residual
+                for borderval, label in [(0, "lower"), (1, "upper")]:
+                    poly_measured = np.polynomial.Polynomial(
+                        tmp_dict["boundary_coef_" + label]
+                    )
+                    xdum = np.linspace(
+                        tmp_dict["boundary_xmin_" + label] + dx,
+                        tmp_dict["boundary_xmax_" + label] - dx,
+                        num=numresolution,
+                    )
+                    list_islitlet.append(islitlet)
+                    list_csu_bar_slit_center.append(tmp_dict["csu_bar_slit_center"])
+                    list_borderval.append(borderval)
+                    list_xdum.append(xdum)
+                    list_ymeasured.append(poly_measured(xdum))
+
+        self.islitlet = np.array(list_islitlet, dtype=int)
+        self.csu_bar_slit_center = np.array(list_csu_bar_slit_center, dtype=float)
+        self.borderval = np.array(list_borderval, dtype=float)
+        self.xdum = np.array(list_xdum, dtype=float).reshape(-1, numresolution)
+        self.ymeasured = np.array(list_ymeasured, dtype=float).reshape(
+            -1, numresolution
+        )
+        self.xp = np.linspace(1, EMIR_NAXIS1, numresolution)
+
+    def __len__(self):
+        return len(self.islitlet)
+
+    def expected_boundaries(self, params):
+        """Evaluate the expected boundaries at the measured abscissae.
+
+        Parameters
+        ----------
+        params : :class:`~lmfit.parameter.Parameters`
+            Parameters to be employed in the prediction of the distorted
+            boundaries.
+
+        Returns
+        -------
+        yexpected : 2d numpy array, float
+            Expected boundaries, one row per slitlet, DATE-OBS
+            and boundary.
+
+        """
+
+        nrows = len(self)
+        c2, c4, ff, slit_gap, slit_height, theta0, x0, y0, y_baseline = [
+            np.broadcast_to(value, (nrows,))[:, np.newaxis]
+            for value in return_params(
+                self.islitlet, self.csu_bar_slit_center, params, self.parmodel
+            )
+        ]
+
+        slit_dist = (slit_height * 10) + slit_gap
+        # undistorted (constant) y-coordinate of the lower and upper boundaries
+        ybottom = y_baseline * 100 + (self.islitlet[:, np.newaxis] - 1) * slit_dist
+        ytop = ybottom + (slit_height * 10)
+        yvalue = ybottom + self.borderval[:, np.newaxis] * (ytop - ybottom)
+
+        xp = np.broadcast_to(self.xp, (nrows, self.numresolution))
+        yp = np.broadcast_to(yvalue, (nrows, self.numresolution))
+        xdist, ydist = exvp(xp, yp, x0=x0, y0=y0, c2=c2, c4=c4, theta0=theta0, ff=ff)
+        return polfit_eval_batch(xdist, ydist, self.deg, self.xdum)
+
+    def __call__(self, params, debugplot=0):
+        """Function to be minimised.
+
+        Parameters
+        ----------
+        params : :class:`~lmfit.parameter.Parameters`
+            Parameters to be employed in the prediction of the distorted
+            boundaries.
+        debugplot : int
+            Debugging level for messages and plots. For details see
+            'numina.array.display.pause_debugplot.py'.
+
+        Returns
+        -------
+        global_residual : float
+            Squared root of the averaged sum of squared residuals.
+
+        """
+
+        global FUNCTION_EVALUATIONS
+
+        if len(self) > 0:
+            yexpected = self.expected_boundaries(params)
+            global_residual = np.sqrt(np.mean((yexpected - self.ymeasured) ** 2))
+        else:
+            global_residual = 0.0
+        if debugplot >= 10:
+            FUNCTION_EVALUATIONS += 1
+            print("-" * 79)
+            print(">>> Number of function evaluations:", FUNCTION_EVALUATIONS)
+            print(">>> global residual...............:", global_residual)
+            params.pretty_print()
+        return global_residual
 
 
 def overplot_boundaries_from_bounddict(ax, bounddict, micolors, linetype="-"):
@@ -1557,19 +1716,15 @@ def main(args=None):
     if args.pickle_input is not None:
         result = pickle.load(args.pickle_input)
     else:
-        fitter = Minimizer(
-            fun_residuals,
-            params,
-            fcn_args=(
-                args.parmodel,
-                bounddict,
-                args.shrinking_factor,
-                args.numresolution,
-                islitlet_min,
-                islitlet_max,
-                args.debugplot,
-            ),
+        residuals = BoundaryResiduals(
+            parmodel=args.parmodel,
+            bounddict=bounddict,
+            shrinking_factor=args.shrinking_factor,
+            numresolution=args.numresolution,
+            islitmin=islitlet_min,
+            islitmax=islitlet_max,
         )
+        fitter = Minimizer(residuals, params, fcn_args=(args.debugplot,))
         result = fitter.scalar_minimize(method="Nelder-Mead", tol=args.tolerance)
         pickle.dump(result, open("dum.pickle", "wb"))
 
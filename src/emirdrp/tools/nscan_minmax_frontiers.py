@@ -7,6 +7,8 @@
 # License-Filename: LICENSE.txt
 #
 
+import numpy as np
+
 from emirdrp.core import EMIR_NAXIS2
 
 
@@ -54,3 +56,54 @@ def nscan_minmax_frontiers(y0_frontier_lower, y0_frontier_upper, resize=False):
             )
 
     return nscan_min, nscan_max
+
+
+def nscan_minmax_frontiers_array(y0_frontier_lower, y0_frontier_upper, resize=False):
+    """Compute valid scan ranges for arrays of y0_frontier values.
+
+    Vectorized version of nscan_minmax_frontiers().
+
+    Parameters
+    ----------
+    y0_frontier_lower : array-like
+        Ordinates of the lower frontier.
+    y0_frontier_upper : array-like
+        Ordinates of the upper frontier.
+    resize : bool
+        If True, when the limits are beyond the expected values
+        [1,EMIR_NAXIS2], the values are truncated.
+    Returns
+    -------
+    nscan_min : numpy.ndarray
+        Minimum useful scans for the image.
+    nscan_max : numpy.ndarray
+        Maximum useful scans for the image.
+    """
+
+    y0_frontier_lower = np.asarray(y0_frontier_lower, dtype=float)
+    y0_frontier_upper = np.asarray(y0_frontier_upper, dtype=float)
+
+    int_lower = np.trunc(y0_frontier_lower)
+    nscan_min = np.where(y0_frontier_lower - int_lower > 0.0, int_lower + 1, int_lower)
+    nscan_min = nscan_min.astype(int)
+    if np.any(nscan_min < 1):
+        if resize:
+            nscan_min[nscan_min < 1] = 1
+        else:
+            raise ValueError("nscan_min=" + str(nscan_min.min()) + " is < 1")
+
+    int_upper = np.trunc(y0_frontier_upper)
+    nscan_max = np.where(y0_frontier_upper - int_upper > 0.0, int_upper, int_upper - 1)
+    nscan_max = nscan_max.astype(int)
+    if np.any(nscan_max > EMIR_NAXIS2):
+        if resize:
+            nscan_max[nscan_max > EMIR_NAXIS2] = EMIR_NAXIS2
+        else:
+            raise ValueError(
+                "nscan_max="
+                + str(nscan_max.max())
+                + " is > NAXIS2_EMIR="
+                + str(EMIR_NAXIS2)
+            )
+
+    return nscan_min, nscan_max
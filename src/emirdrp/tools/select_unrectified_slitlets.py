@@ -19,10 +19,9 @@ from numina.array.display.pause_debugplot import pause_debugplot
 from numina.array.display.ximshow import ximshow
 from numina.tools.arg_file_is_new import arg_file_is_new
 from emirdrp.instrument.csu_configuration import CsuConfiguration
-from emirdrp.tools.nscan_minmax_frontiers import nscan_minmax_frontiers
+from emirdrp.processing.wavecal.slitletgeometry import SlitletGeometry
 
 from emirdrp.tools.fit_boundaries import bound_params_from_dict
-from emirdrp.tools.fit_boundaries import expected_distorted_frontiers
 from emirdrp.tools.fit_boundaries import overplot_boundaries_from_params
 from emirdrp.tools.fit_boundaries import overplot_frontiers_from_params
 from emirdrp.tools.list_slitlets_from_string import list_slitlets_from_string
@@ -67,29 +66,17 @@ def select_unrectified_slitlet(
     if image2d.shape != (EMIR_NAXIS2, EMIR_NAXIS1):
         raise ValueError("NAXIS1, NAXIS2 unexpected for EMIR detector")
 
+    # compute for each channel the minimum and maximum scan
+    geometry = SlitletGeometry(naxis1=EMIR_NAXIS1, naxis2=EMIR_NAXIS2)
+    geometry.add_expected(islitlet, csu_bar_slit_center, params, parmodel)
+    mask = geometry.mask(islitlet)
+
     # initialize image output
     image2d_output = np.zeros_like(image2d)
-
-    # expected slitlet frontiers
-    list_expected_frontiers = expected_distorted_frontiers(
-        islitlet, csu_bar_slit_center, params, parmodel, numpts=101, deg=5, debugplot=0
-    )
-    pol_lower_expected = list_expected_frontiers[0].poly_funct
-    pol_upper_expected = list_expected_frontiers[1].poly_funct
-
-    # main loop: compute for each channel the minimum and maximum scan
-    for j in range(EMIR_NAXIS1):
-        xchannel = j + 1
-        y0_lower = pol_lower_expected(xchannel)
-        y0_upper = pol_upper_expected(xchannel)
-        n1, n2 = nscan_minmax_frontiers(
-            y0_frontier_lower=y0_lower, y0_frontier_upper=y0_upper, resize=True
-        )
-        # note that n1 and n2 are scans (ranging from 1 to NAXIS2)
-        if maskonly:
-            image2d_output[(n1 - 1) : n2, j] = np.repeat([1.0], (n2 - n1 + 1))
-        else:
-            image2d_output[(n1 - 1) : n2, j] = image2d[(n1 - 1) : n2, j]
+    if maskonly:
+        image2d_output[mask] = 1.0
+    else:
+        image2d_output[mask] = image2d[mask]
 
     return image2d_output
 
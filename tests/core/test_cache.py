@@ -0,0 +1,32 @@
+import pytest
+
+from emirdrp.core.cache import LRUCache
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        return value
+
+    assert cache.lookup("a", lambda: compute(1)) == 1
+    assert cache.lookup("b", lambda: compute(2)) == 2
+    assert cache.lookup("a", lambda: compute(3)) == 1
+    assert calls == [1, 2]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # 'b' is the least recently used value
+    cache.store("c", 4)
+    assert len(cache) == 2
+    assert "b" not in cache
+    assert "a" in cache
+    assert cache.lookup("b") is None
+    assert cache.misses == 3
+
+    cache.clear()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
+    with pytest.raises(ValueError):
+        LRUCache(maxsize=0)
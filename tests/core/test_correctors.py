@@ -0,0 +1,120 @@
+import os
+import types
+
+from astropy.io import fits
+import numpy
+import pytest
+from numina.types.dataframe import DataFrame
+
+import emirdrp.core.correctors as cor
+from emirdrp.core.correctors import CalibrationCache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = CalibrationCache(maxsize=2)
+    monkeypatch.setattr(cor, "calibration_cache", cache)
+    return cache
+
+
+def create_calibration(path, data, uuid="calib"):
+    hdu = fits.PrimaryHDU(data)
+    hdu.header["UUID"] = uuid
+    hdu.writeto(path, overwrite=True, checksum=True)
+    return DataFrame(filename=str(path))
+
+
+def test_calibration_cache(tmp_path):
+    cache = CalibrationCache(maxsize=2)
+    data = numpy.arange(12, dtype=">f4").reshape(3, 4)
+    frame = create_calibration(tmp_path / "bias.fits", data)
+    calib1 = cache.load(frame)
+    calib2 = cache.load(frame)
+    assert calib1 is calib2
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert calib1.calibid == "uuid:calib"
+    assert calib1.data.dtype.isnative
+    assert not calib1.data.flags.writeable
+    numpy.testing.assert_array_equal(calib1.data, data)
+    # the kind is part of the key
+    cache.load(frame, kind="other")
+    assert cache.misses == 2
+    cache.clear()
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_calibration_cache_modified(tmp_path):
+    cache = CalibrationCache()
+    path = tmp_path / "dark.fits"
+    frame = create_calibration(path, numpy.zeros((3, 4), dtype="float32"))
+    cache.load(frame)
+    create_calibration(path, numpy.ones((3, 4), dtype="float32"), uuid="new")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    calib = cache.load(frame)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert calib.calibid == "uuid:new"
+    numpy.testing.assert_array_equal(calib.data, 1)
+
+
+def test_calibration_cache_lru(tmp_path):
+    cache = CalibrationCache(maxsize=2)
+    frames = [
+        create_calibration(tmp_path / f"c{idx}.fits", numpy.zeros((2, 2)))
+        for idx in range(3)
+    ]
+    for frame in frames:
+        cache.load(frame)
+    cache.load(frames[0])
+    assert (cache.hits, cache.misses) == (0, 4)
+    cache.load(frames[2])
+    assert cache.hits == 1
+    with pytest.raises(ValueError):
+        CalibrationCache(maxsize=0)
+
+
+def test_calibration_cache_memory():
+    cache = CalibrationCache()
+    hdu = fits.PrimaryHDU(numpy.ones((2, 2)))
+    hdu.header["UUID"] = "mem"
+    calib = cache.load(DataFrame(frame=fits.HDUList([hdu])))
+    assert calib.calibid == "uuid:mem"
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_get_corrector_f(tmp_path, cache):
+    flat = numpy.ones((4, 5), dtype="float32")
+    flat[1, 1] = -1
+    flat[2, 2] = 0
+    flat[3, 3] = numpy.nan
+    frame = create_calibration(tmp_path / "flat.fits", flat)
+    rinput = types.SimpleNamespace(master_flat=frame)
+    meta = {"master_flat": None}
+    corrector1 = cor.get_corrector_f(rinput, meta, None, None)
+    corrector2 = cor.get_corrector_sf(rinput, meta, None, None)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert corrector1.flatdata is corrector2.flatdata
+    assert corrector1.flatdata[1, 1] == 1.0
+    assert corrector1.flatdata[2, 2] == 1.0
+    assert numpy.isnan(corrector1.flatdata[3, 3])
+
+    img = fits.HDUList([fits.PrimaryHDU(numpy.full((4, 5), 2.0, dtype="float32"))])
+    result = corrector1(img)
+    assert result[0].data[1, 1] == 2.0
+    assert result[0].data[0, 0] == 2.0
+
+
+def test_get_corrector_p(tmp_path, cache):
+    bpm = numpy.zeros((10, 10), dtype="uint8")
+    bpm[5, 5] = 1
+    frame = create_calibration(tmp_path / "bpm.fits", bpm)
+    rinput = types.SimpleNamespace(master_bpm=frame)
+    meta = {"master_bpm": {"name": "bpm"}}
+    cor.get_corrector_p(rinput, meta, None, None)
+    corrector = cor.get_corrector_p(rinput, meta, None, None)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    data = numpy.ones((10, 10), dtype="float32")
+    data[5, 5] = 100
+    result = corrector(fits.HDUList([fits.PrimaryHDU(data)]))
+    assert result[0].data[5, 5] == 1.0
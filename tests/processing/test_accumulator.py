@@ -0,0 +1,79 @@
+from astropy.io import fits
+import numpy
+
+from emirdrp.processing.accumulator import ACCUM_EXTENSIONS, MosaicAccumulator
+
+
+def test_accumulator_mean():
+    rng = numpy.random.default_rng(51)
+    shape = (30, 40)
+    regions = [
+        (slice(0, 20), slice(0, 30)),
+        (slice(5, 25), slice(10, 40)),
+        (slice(10, 30), slice(5, 35)),
+    ]
+    weights = [1.0, 2.0, 0.5]
+    stack = numpy.zeros((3,) + shape)
+    stack_weights = numpy.zeros((3,) + shape)
+    accumulator = MosaicAccumulator(shape)
+    for idx, (region, weight) in enumerate(zip(regions, weights)):
+        data = rng.normal(100, 5, size=(20, 30))
+        mask = (rng.random((20, 30)) < 0.1).astype("int16")
+        data[0, 0] = numpy.nan
+        accumulator.add(data, mask=mask, region=region, weight=weight)
+        valid = (mask == 0) & numpy.isfinite(data)
+        stack[idx][region] = numpy.where(valid, data, 0)
+        stack_weights[idx][region] = valid * weight
+
+    mean, variance, num = accumulator.mean(dtype="float64")
+    total = stack_weights.sum(axis=0)
+    used = total > 0
+    expected = (stack * stack_weights).sum(axis=0)[used] / total[used]
+    assert numpy.allclose(mean[used], expected)
+    assert numpy.all(mean[~used] == 0)
+    assert numpy.array_equal(num, (stack_weights > 0).sum(axis=0))
+    deviations = (stack - mean) ** 2 * stack_weights
+    multiple = total > 1
+    expected = deviations.sum(axis=0)[multiple] / (total[multiple] - 1)
+    assert numpy.allclose(variance[multiple], expected)
+
+    region = (slice(8, 12), slice(12, 20))
+    partial = accumulator.mean(region, dtype="float64")
+    assert numpy.array_equal(partial[0], mean[region])
+
+
+def test_accumulator_resize_and_store():
+    rng = numpy.random.default_rng(52)
+    data = rng.normal(10, 1, size=(10, 12))
+    accumulator = MosaicAccumulator(data.shape)
+    accumulator.add(data)
+    region = (slice(3, 13), slice(0, 12))
+    assert not accumulator.resize(data.shape, Ellipsis)
+    assert accumulator.resize((15, 12), region)
+    accumulator.add(data + 1, region=(slice(0, 10), slice(0, 12)))
+    mean, _, num = accumulator.mean(dtype="float64")
+    assert numpy.allclose(mean[0:3], data[0:3] + 1)
+    assert numpy.allclose(mean[3:10], (data[0:7] + data[3:10] + 1) / 2)
+    assert numpy.allclose(mean[10:13], data[7:10])
+    assert num.max() == 2
+
+    hdulist = fits.HDUList([fits.PrimaryHDU(mean)] + accumulator.to_hdus())
+    assert all(name in hdulist for name in ACCUM_EXTENSIONS)
+    stored = MosaicAccumulator.from_hdulist(hdulist)
+    assert numpy.array_equal(stored.sum, accumulator.sum)
+    assert numpy.array_equal(stored.num, accumulator.num)
+
+
+def test_accumulator_from_mean():
+    # a mean of 3 frames, continued with a fourth one
+    data = numpy.full((5, 6), 4.0)
+    mask = numpy.zeros(data.shape, dtype="int16")
+    mask[0] = 1
+    accumulator = MosaicAccumulator.from_hdulist(
+        fits.HDUList([fits.PrimaryHDU(data)]), mask=mask, weight=3
+    )
+    accumulator.add(numpy.full((5, 6), 8.0))
+    mean, _, num = accumulator.mean()
+    assert numpy.all(mean[1:] == 5.0)
+    assert numpy.all(mean[0] == 8.0)
+    assert numpy.all(num[1:] == 4)
@@ -0,0 +1,40 @@
+import numpy
+import pytest
+
+from emirdrp.core import EMIR_NBARS, EMIR_NPIXPERSLIT_RECTIFIED
+from emirdrp.processing.wavecal.apply_rectwv_coeff import apply_rectwv_coeff
+from emirdrp.testing.create_rectwv import create_rectwv_coeff, create_rectwv_image
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_apply_rectwv_coeff_executor(executor):
+    rectwv_coeff = create_rectwv_coeff([3, 4, 20, 50])
+    image = create_rectwv_image()
+
+    expected = apply_rectwv_coeff(image, rectwv_coeff)
+    computed = apply_rectwv_coeff(image, rectwv_coeff, executor=executor, max_workers=2)
+
+    assert expected[0].data.shape == (
+        EMIR_NBARS * EMIR_NPIXPERSLIT_RECTIFIED,
+        3400,
+    )
+    assert numpy.array_equal(computed[0].data, expected[0].data)
+
+    keys_expected = [key for key in expected[0].header if key.endswith("SLT20")]
+    keys_computed = [key for key in computed[0].header if key.endswith("SLT20")]
+    assert keys_computed == keys_expected
+    for islitlet in range(1, EMIR_NBARS + 1):
+        for prefix in ["IMNSLT", "IMXSLT", "JMNSLT", "JMXSLT"]:
+            key = prefix + str(islitlet).zfill(2)
+            assert computed[0].header[key] == expected[0].header[key]
+
+    assert expected[0].header["JMNSLT01"] == 0
+    assert expected[0].header["IMNSLT20"] == 723
+    assert 0 < expected[0].header["JMNSLT20"] < expected[0].header["JMXSLT20"]
+
+
+def test_apply_rectwv_coeff_executor_raise():
+    rectwv_coeff = create_rectwv_coeff([3])
+    image = create_rectwv_image()
+    with pytest.raises(ValueError):
+        apply_rectwv_coeff(image, rectwv_coeff, executor="cluster")
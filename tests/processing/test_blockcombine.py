@@ -0,0 +1,64 @@
+import numpy
+import pytest
+import numina.array as narray
+import numina.array.combine as nacom
+
+from emirdrp.processing.blockcombine import combine_row_blocks, rows_per_block
+
+
+def create_dithered_frames(nframes=8, base=(60, 50), final=(80, 75)):
+    rng = numpy.random.default_rng(94)
+    data, masks, regions, scales = [], [], [], []
+    for idx in range(nframes):
+        offset = rng.integers(0, 20, size=2)
+        region, _ = narray.subarray_match(final, offset, base)
+        arr = numpy.zeros(final, dtype="float32")
+        arr[region] = rng.normal(100, 5, size=base)
+        mask = numpy.ones(final, dtype="int16")
+        mask[region] = rng.random(base) < 0.05
+        data.append(arr)
+        masks.append(mask)
+        regions.append(region)
+        scales.append(1.0 + 0.01 * idx)
+    return data, masks, regions, scales
+
+
+def test_rows_per_block():
+    assert rows_per_block(10, 100, 5, max_memory=100000) == 20
+    assert rows_per_block(10, 100, 5, max_memory=10) == 1
+
+
+@pytest.mark.parametrize("method", ["mean", "median", "sigmaclip"])
+@pytest.mark.parametrize("max_memory", [1, 20000, 10**9])
+def test_combine_row_blocks(method, max_memory):
+    method = getattr(nacom, method)
+    data, masks, regions, scales = create_dithered_frames()
+    expected = numpy.array(method(data, masks, scales=scales, dtype="float32"))
+    computed = combine_row_blocks(
+        method, data, masks, regions=regions, scales=scales, max_memory=max_memory
+    )
+    assert computed.dtype == expected.dtype
+    assert numpy.array_equal(computed, expected)
+
+
+def test_combine_row_blocks_without_masks():
+    data, _, regions, scales = create_dithered_frames()
+    # frames of the same size, as in the superflat
+    data = [arr[region] for arr, region in zip(data, regions)]
+    expected = numpy.array(nacom.median(data, None, scales=scales, dtype="float32"))
+    out = numpy.full((3,) + data[0].shape, numpy.nan, dtype="float32")
+    computed = combine_row_blocks(
+        nacom.median, data, scales=scales, out=out, max_memory=5000
+    )
+    assert computed is out
+    assert numpy.array_equal(computed, expected)
+
+
+def test_combine_row_blocks_wrong_input():
+    data, masks, regions, scales = create_dithered_frames(nframes=2)
+    with pytest.raises(ValueError):
+        combine_row_blocks(nacom.mean, [])
+    with pytest.raises(ValueError):
+        combine_row_blocks(nacom.mean, [data[0], data[1][1:]])
+    with pytest.raises(ValueError):
+        combine_row_blocks(nacom.mean, data, out=numpy.zeros((3, 2, 2)))
@@ -1,6 +1,15 @@
+from astropy.io import fits
+import numpy
+import pytest
 from numina.array import combine
 
-from emirdrp.processing.combine import combine_images, scale_with_median
+from emirdrp.processing.combine import (
+    combine_images,
+    nodded_difference,
+    process_ab,
+    process_abba,
+    scale_with_median,
+)
 from emirdrp.testing.create_base import create_images_mecs
 
 
@@ -25,3 +34,90 @@ def test_combine_images3():
     assert "MECS" in res
     assert "VARIANCE" in res
     assert "MAP" in res
+
+
+def create_nodded_images(dtype="uint16", variance=False):
+    rng = numpy.random.default_rng(6354)
+    images = []
+    for idx in range(4):
+        data = rng.integers(0, 60000, size=(300, 17)).astype(dtype)
+        hdu = fits.PrimaryHDU(data)
+        hdu.header["TSUTC2"] = idx
+        hdu.header["UUID"] = f"image-{idx}"
+        hdul = fits.HDUList([hdu])
+        if variance:
+            var = rng.uniform(1, 10, size=data.shape).astype("float32")
+            hdul.append(fits.ImageHDU(var, name="VARIANCE"))
+        images.append(hdul)
+    return images
+
+
+@pytest.mark.parametrize("dtype", ["uint16", "int32", "float64", "float32"])
+@pytest.mark.parametrize("chunk_rows", [1, 7, 128, 1000])
+def test_nodded_difference(dtype, chunk_rows):
+    images = create_nodded_images(dtype)
+    a0, b0, b1, a1 = [img[0].data for img in images]
+    out, out_variance = nodded_difference([(a0, b0), (a1, b1)], chunk_rows=chunk_rows)
+    expected = (a0.astype("float32") - b0.astype("float32")) + (
+        a1.astype("float32") - b1.astype("float32")
+    )
+    assert out.dtype == numpy.float32
+    assert out_variance is None
+    numpy.testing.assert_array_equal(out, expected)
+
+
+def test_nodded_difference_out_variance():
+    images = create_nodded_images(variance=True)
+    data = [img[0].data for img in images]
+    var = [img["VARIANCE"].data for img in images]
+    out = numpy.empty(data[0].shape, dtype="float32")
+    out_variance = numpy.empty(data[0].shape, dtype="float32")
+    res, res_variance = nodded_difference(
+        [(data[0], data[1])],
+        variances=[(var[0], var[1])],
+        out=out,
+        out_variance=out_variance,
+        chunk_rows=50,
+    )
+    assert res is out
+    assert res_variance is out_variance
+    numpy.testing.assert_array_equal(
+        out, data[0].astype("float32") - data[1].astype("float32")
+    )
+    numpy.testing.assert_array_equal(out_variance, var[0] + var[1])
+
+
+def test_nodded_difference_shape():
+    arr = numpy.zeros((10, 10))
+    with pytest.raises(ValueError):
+        nodded_difference([(arr, numpy.zeros((10, 11)))])
+    with pytest.raises(ValueError):
+        nodded_difference([(arr, arr)], out=numpy.zeros((11, 10)))
+    with pytest.raises(ValueError):
+        nodded_difference([])
+
+
+def test_process_abba():
+    images = create_nodded_images(variance=True)
+    a0, b0, b1, a1 = [img[0].data.astype("float32") for img in images]
+    res = process_abba(images)
+    numpy.testing.assert_array_equal(res[0].data, (a0 - b0) + (a1 - b1))
+    assert res[0].header["TSUTC2"] == 3
+    assert res[0].header["NUM-NCOM"] == 2
+    # the input is not modified
+    assert images[0][0].data.dtype == numpy.uint16
+    # without errors, the extensions of the first image are copied
+    numpy.testing.assert_array_equal(res["VARIANCE"].data, images[0]["VARIANCE"].data)
+    res = process_abba(images, errors=True)
+    var = [img["VARIANCE"].data for img in images]
+    numpy.testing.assert_array_equal(
+        res["VARIANCE"].data, (var[0] + var[1]) + (var[3] + var[2])
+    )
+
+
+def test_process_ab():
+    images = create_nodded_images()[:2]
+    a0, b0 = [img[0].data.astype("float32") for img in images]
+    res = process_ab(images)
+    numpy.testing.assert_array_equal(res[0].data, a0 - b0)
+    assert res[0].header["TSUTC2"] == 1
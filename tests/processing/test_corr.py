@@ -68,3 +68,85 @@ def test_coor_raises(images):
     region = utils.image_box2d(xref_cross, yref_cross, shape, (box, box))
     with pytest.raises(ValueError):
         offsets_from_crosscor(arrs, region, order="sksjd")
+
+
+def test_region_correlator(images):
+    import scipy.signal
+    from emirdrp.processing.corr import RegionCorrelator, filter_region, standarize
+
+    arrs = images
+    shape = arrs[0].shape
+    regions = [
+        utils.image_box2d(500, 500, shape, (50, 50)),
+        utils.image_box2d(480, 510, shape, (50, 50)),
+        utils.image_box2d(500, 10, shape, (50, 50)),
+    ]
+    correlator = RegionCorrelator(arrs[0], regions)
+    corrs = correlator.correlate(arrs[1])
+    for region, corr in zip(regions, corrs):
+        d1 = standarize(filter_region(arrs[0][region]))
+        d2 = standarize(filter_region(arrs[1][region]))
+        expected = scipy.signal.fftconvolve(d1, d2[::-1, ::-1], mode="same")
+        expected /= expected.max()
+        assert corr.shape == d1.shape
+        assert numpy.allclose(corr, expected, rtol=0, atol=1e-12, equal_nan=True)
+
+    offsets = correlator.offsets(arrs[1], refine=False)
+    assert numpy.allclose(offsets[:2], [[-20.0, -10.0], [-20.0, -10.0]])
+
+
+def test_region_correlator_flat(images):
+    from emirdrp.processing.corr import RegionCorrelator, offsets_from_crosscor_regions
+
+    arrs = [arr.copy() for arr in images]
+    shape = arrs[0].shape
+    regions = [
+        utils.image_box2d(500, 500, shape, (50, 50)),
+        utils.image_box2d(100, 100, shape, (50, 50)),
+    ]
+    # a region without signal in one of the images
+    arrs[1][regions[1]] = 1000.0
+    with numpy.errstate(invalid="ignore"):
+        offsets = RegionCorrelator(arrs[0], regions).offsets(arrs[1], refine=False)
+        assert numpy.allclose(offsets[0], [-20.0, -10.0])
+        assert numpy.isnan(offsets[1]).all()
+        computed = offsets_from_crosscor_regions(
+            arrs[:2], regions, refine=True, order="ij", tol=0.5
+        )
+    assert numpy.allclose(computed[1], [-20.0, -10.0], atol=0.1)
+
+
+def test_coor_regions(images):
+    from emirdrp.processing.corr import offsets_from_crosscor_regions
+
+    arrs = images
+    shape = arrs[0].shape
+    regions = [
+        utils.image_box2d(500, 500, shape, (50, 50)),
+        utils.image_box2d(490, 480, shape, (60, 60)),
+        utils.image_box2d(500, 10, shape, (50, 50)),
+    ]
+    region = utils.image_box2d(500, 500, shape, (50, 50))
+    expected = offsets_from_crosscor(arrs, region, refine=True, order="xy")
+    computed = offsets_from_crosscor_regions(
+        arrs, regions, refine=True, order="xy", tol=0.5
+    )
+    assert numpy.allclose(computed, expected, atol=0.1)
+
+
+def test_refine_peaks():
+    from numina.array.imsurfit import imsurfit, vertex_of_quadratic
+    from emirdrp.processing.corr import refine_peaks
+
+    yy, xx = numpy.mgrid[0:40, 0:40]
+    corrs = [
+        numpy.exp(-((xx - 20.3) ** 2 + (yy - 15.6) ** 2) / 10.0),
+        numpy.exp(-((xx - 1.2) ** 2 + (yy - 30.1) ** 2) / 10.0),
+    ]
+    maxindices = [numpy.unravel_index(corr.argmax(), corr.shape) for corr in corrs]
+    computed = refine_peaks(corrs, maxindices, refine_box=3)
+    for corr, maxindex, final in zip(corrs, maxindices, computed):
+        region = utils.image_box(maxindex, corr.shape, box=(3, 3))
+        (coeffs,) = imsurfit(corr[region], order=2)
+        xm, ym = vertex_of_quadratic(coeffs)
+        assert numpy.allclose(final, maxindex + numpy.asarray([ym, xm]))
@@ -0,0 +1,72 @@
+import os
+
+import numpy
+
+from emirdrp.processing.framestore import FrameStore
+
+
+def test_framestore(tmp_path):
+    with FrameStore(directory=tmp_path) as store:
+        frame = store.create("frame_r", (20, 30), fill=1.0)
+        assert isinstance(frame, numpy.memmap)
+        assert frame.dtype == numpy.float32
+        assert numpy.all(frame == 1.0)
+        assert os.path.exists(store.filename("frame_r"))
+
+        # updates in place are seen in the file
+        frame[2:5, 3:9] -= 4.0
+        store.flush()
+        ondisk = numpy.load(store.filename("frame_r"))
+        assert numpy.array_equal(ondisk, frame)
+
+        # same shape and dtype, the frame is reused
+        assert store.create("frame_r", (20, 30), fill=0) is frame
+        assert numpy.all(frame == 0)
+        # different shape, the frame is recreated
+        frame2 = store.create("frame_r", (10, 30))
+        assert frame2.shape == (10, 30)
+        # not initialized
+        frame2[...] = 3.0
+        assert numpy.all(store.create("frame_r", (10, 30), fill=None) == 3.0)
+        assert len(store) == 1
+
+        mask = numpy.arange(12, dtype="uint8").reshape(3, 4)
+        stored = store.store("frame_mr", mask)
+        assert stored.dtype == mask.dtype
+        assert numpy.array_equal(stored, mask)
+
+        store.remove("frame_mr")
+        assert "frame_mr" not in store
+        assert not os.path.exists(store.filename("frame_mr"))
+        directory = store.directory
+
+    assert not os.path.exists(directory)
+    assert os.listdir(tmp_path) == []
+
+
+def test_framestore_release(tmp_path):
+    with FrameStore(directory=tmp_path) as store:
+        data = numpy.arange(200, dtype="float32").reshape(20, 10)
+        store.store("frame", data)
+        store.release("frame")
+        assert "frame" in store
+
+        # the frame is read without mapping it
+        reader = store.reader("frame")
+        assert reader.shape == (20, 10)
+        assert reader.dtype == numpy.float32
+        rows = reader[3:7, :]
+        assert not isinstance(rows, numpy.memmap)
+        assert numpy.array_equal(rows, data[3:7])
+        rows[...] = 0
+        assert numpy.array_equal(reader[...], data)
+
+        # a released frame is mapped again when accessed
+        frame = store["frame"]
+        assert isinstance(frame, numpy.memmap)
+        frame[0] = -1
+        assert numpy.all(store.reader("frame")[0] == -1)
+
+        store.release("frame")
+        store.remove("frame")
+        assert not os.path.exists(store.filename("frame"))
@@ -0,0 +1,133 @@
+import copy
+
+from astropy.io import fits
+import numpy
+import pytest
+import numina.processing as proc
+from numina.util.flow import SerialFlow
+from numina.util.node import IdNode
+
+from emirdrp.datamodel import EmirDataModel
+from emirdrp.processing.checkers import Checker
+from emirdrp.processing.flatfield import FlatFieldCorrector
+from emirdrp.processing.fusedflow import FusedCorrector, fuse_flow
+
+SHAPE = (150, 40)
+
+
+def create_calibrations(dtype="float32"):
+    rng = numpy.random.default_rng(2718)
+    bpm = (rng.uniform(size=SHAPE) > 0.98).astype("uint8")
+    bias = rng.normal(1000, 10, size=SHAPE).astype(dtype)
+    dark = rng.uniform(0, 0.2, size=SHAPE).astype(dtype)
+    flat = rng.uniform(0.8, 1.2, size=SHAPE).astype(dtype)
+    flat[3, 3] = 0
+    flat[4, 4] = -1
+    sflat = rng.uniform(0.9, 1.1, size=SHAPE).astype(dtype)
+    sky = rng.normal(100, 3, size=SHAPE).astype(dtype)
+    return bpm, bias, dark, flat, sflat, sky
+
+
+def create_flow(dtype="float32"):
+    bpm, bias, dark, flat, sflat, sky = create_calibrations(dtype)
+    datamodel = EmirDataModel()
+    return SerialFlow(
+        [
+            proc.BadPixelCorrector(bpm, datamodel=datamodel, calibid="bpm"),
+            proc.BiasCorrector(bias, datamodel=datamodel, calibid="bias"),
+            proc.DarkCorrector(dark, datamodel=datamodel, calibid="dark"),
+            FlatFieldCorrector(flat, datamodel=datamodel, calibid="flat"),
+            Checker(),
+            FlatFieldCorrector(sflat, datamodel=datamodel, calibid="sflat"),
+            IdNode(),
+            proc.SkyCorrector(sky, datamodel=datamodel, calibid="sky"),
+        ]
+    )
+
+
+def create_image(dtype="uint16", skyadd=True):
+    rng = numpy.random.default_rng(31415)
+    data = rng.uniform(1000, 30000, size=SHAPE).astype(dtype)
+    if numpy.dtype(dtype).kind == "f":
+        data[10, 10] = numpy.nan
+    hdu = fits.PrimaryHDU(data)
+    hdu.header["EXPTIME"] = 10.0
+    hdu.header["DARKTIME"] = 10.5
+    hdu.header["UUID"] = "image"
+    hdu.header["SKYADD"] = skyadd
+    return fits.HDUList([hdu])
+
+
+def test_fuse_flow():
+    flow = create_flow()
+    fused = fuse_flow(flow)
+    assert len(fused) == 2
+    assert isinstance(fused[0], proc.BadPixelCorrector)
+    assert isinstance(fused[1], FusedCorrector)
+    assert fused[1].correctors == [flow[i] for i in [1, 2, 3, 4, 5, 7]]
+
+    # unknown correctors split the fused groups
+    other = proc.BadPixelCorrector(numpy.zeros(SHAPE))
+    fused = fuse_flow(SerialFlow([flow[1], other, flow[2], flow[3]]))
+    assert [type(node) for node in fused] == [
+        FusedCorrector,
+        proc.BadPixelCorrector,
+        FusedCorrector,
+    ]
+    assert len(fuse_flow(SerialFlow([IdNode()]))) == 0
+
+
+@pytest.mark.parametrize("img_dtype", ["uint16", "float32", "float64"])
+@pytest.mark.parametrize("cal_dtype", ["float32", "float64"])
+@pytest.mark.parametrize("chunk_rows", [1, 7, 64, 1000])
+@pytest.mark.parametrize("skyadd", [True, False])
+def test_fused_equivalence(img_dtype, cal_dtype, chunk_rows, skyadd):
+    flow = create_flow(cal_dtype)
+    fused = fuse_flow(flow, chunk_rows=chunk_rows)
+    img = create_image(img_dtype, skyadd=skyadd)
+    expected = flow(copy.deepcopy(img))
+    result = fused(copy.deepcopy(img))
+    assert result[0].data.dtype == expected[0].data.dtype
+    numpy.testing.assert_array_equal(result[0].data, expected[0].data)
+    for key in ["NUM-BS", "NUM-DK", "NUM-FF", "NUM-SK", "NUM-BPM"]:
+        assert result[0].header.get(key) == expected[0].header.get(key)
+    assert len(result[0].header["history"]) == len(expected[0].header["history"])
+
+
+def test_fused_variance():
+    rng = numpy.random.default_rng(1)
+    bias = rng.normal(1000, 10, size=SHAPE).astype("float32")
+    biasvar = rng.uniform(1, 2, size=SHAPE).astype("float32")
+    dark = rng.uniform(0, 0.2, size=SHAPE).astype("float32")
+    darkvar = rng.uniform(0, 0.1, size=SHAPE).astype("float32")
+    datamodel = EmirDataModel()
+    bias_corr = proc.BiasCorrector(bias, datamodel=datamodel)
+    dark_corr = proc.DarkCorrector(dark, datamodel=datamodel)
+    # the constructors do not accept arrays of variance
+    bias_corr.biasvar, bias_corr.update_variance = biasvar, True
+    dark_corr.darkvar, dark_corr.update_variance = darkvar, True
+    flow = SerialFlow([bias_corr, dark_corr])
+
+    img = create_image("float32")
+    img.append(fits.ImageHDU(numpy.ones(SHAPE, dtype="float32"), name="VARIANCE"))
+    expected = flow(copy.deepcopy(img))
+    result = FusedCorrector([bias_corr, dark_corr], chunk_rows=16)(copy.deepcopy(img))
+    numpy.testing.assert_array_equal(result[0].data, expected[0].data)
+    numpy.testing.assert_array_equal(result["VARIANCE"].data, expected["VARIANCE"].data)
+
+
+@pytest.mark.parametrize("with_bias", [True, False])
+def test_fused_inplace(with_bias):
+    bias, flat = create_calibrations()[1:4:2]
+    correctors = [proc.BiasCorrector(bias)] if with_bias else []
+    correctors.append(FlatFieldCorrector(flat))
+    fused = FusedCorrector(correctors, chunk_rows=10)
+    img = create_image("float32")
+    data = img[0].data
+    original = data.copy()
+    result = fused(img)
+    # the input data are not modified
+    assert result[0].data is not data
+    numpy.testing.assert_array_equal(data, original)
+    expected = (original - bias) / flat if with_bias else original / flat
+    numpy.testing.assert_array_equal(result[0].data, expected)
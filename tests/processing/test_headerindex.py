@@ -0,0 +1,152 @@
+import gzip
+import os
+
+from astropy.io import fits
+from astropy.wcs import WCS
+import numina.core
+import numpy
+import pytest
+
+import emirdrp.datamodel as datamodel
+from emirdrp.instrument.components.dtu import DtuConf
+from emirdrp.instrument.csu_configuration import CsuConfiguration
+from emirdrp.processing.headerindex import (
+    HeaderIndex,
+    frame_record,
+    frame_records,
+    read_headers,
+)
+from emirdrp.testing.create_wcs import create_wcs_new
+
+
+def create_frame(idx, shape=(20, 30)):
+    header = create_wcs_new().to_header()
+    header["UUID"] = f"uuid-{idx}"
+    header["DATE-OBS"] = "2023-08-01T01:02:03.4"
+    header["MJD-OBS"] = 60157.04 + idx
+    header["AIRMASS"] = 1.1 + 0.01 * idx
+    header["EXPTIME"] = 10.0
+    mecs = fits.Header()
+    for axis in "XYZ":
+        mecs[f"{axis}DTU"] = 1.5 * idx - 0.25
+        mecs[f"{axis}DTU_F"] = 0.922
+        mecs[f"{axis}DTU_0"] = -3.5e-1
+    for bar in range(1, 111):
+        mecs[f"CSUP{bar}"] = 100.0 + bar + 0.001 * idx
+    for sensor in range(440):
+        mecs[f"CS_{sensor}"] = sensor
+    return fits.HDUList(
+        [
+            fits.PrimaryHDU(numpy.zeros(shape, dtype="float32"), header=header),
+            fits.ImageHDU(header=mecs, name="MECS"),
+            fits.ImageHDU(numpy.zeros(shape, dtype="uint8"), name="BPM"),
+        ]
+    )
+
+
+def test_read_headers(tmp_path):
+    filename = tmp_path / "frame.fits"
+    create_frame(1).writeto(filename)
+    with open(filename, "rb") as fd, gzip.open(f"{filename}.gz", "wb") as gz:
+        gz.write(fd.read())
+    with fits.open(filename) as hdulist:
+        expected = [hdu.header for hdu in hdulist]
+        for name in [filename, f"{filename}.gz"]:
+            headers = read_headers(name)
+            assert len(headers) == len(expected)
+            for header, other in zip(headers, expected):
+                assert header == other
+
+
+def test_header_index(tmp_path):
+    filenames = []
+    for idx in range(3):
+        filename = str(tmp_path / f"frame{idx}.fits")
+        create_frame(idx).writeto(filename)
+        filenames.append(filename)
+
+    index = HeaderIndex(str(tmp_path / "index.sqlite"))
+    assert index.scan(filenames) == 3
+    assert index.scan(filenames) == 0
+    assert len(index) == 3
+    index.close()
+
+    # a new index on the same file does not read the frames again
+    index = HeaderIndex(str(tmp_path / "index.sqlite"))
+    records = frame_records(
+        [numina.core.DataFrame(filename=name) for name in filenames], index=index
+    )
+    assert index.scanned == 0
+    pixels = numpy.array([[1.0, 1.0], [15.0, 12.0]])
+    for filename, record in zip(filenames, records):
+        with fits.open(filename) as hdulist:
+            header = hdulist[0].header
+            mecs = hdulist["MECS"].header
+            expected = frame_record(numina.core.DataFrame(filename=filename))
+            assert numpy.array_equal(
+                record.wcs.wcs_pix2world(pixels, 1),
+                WCS(header).wcs_pix2world(pixels, 1),
+            )
+            assert record.dtu_conf() == DtuConf.from_header(mecs)
+            assert (
+                record.csu_conf().outdict()
+                == CsuConfiguration.define_from_header(mecs).outdict()
+            )
+            assert record.csup == datamodel.get_csup_from_header(mecs)
+            assert record.cs == datamodel.get_cs_from_header(mecs)
+            assert record.airmass == header["AIRMASS"]
+            assert record["uuid"] == header["UUID"]
+            assert "BPM" in record
+            assert record.keywords == expected.keywords
+            assert [h.tostring() for h in record.headers] == [
+                hdu.header.tostring() for hdu in hdulist
+            ]
+    assert index.query("mjd > ?", (60158.5,)) == [os.path.abspath(filenames[2])]
+
+    # modified frames are read again
+    hdulist = create_frame(7)
+    hdulist[0].header["AIRMASS"] = 2.0
+    hdulist.writeto(filenames[0], overwrite=True)
+    os.utime(filenames[0], (1, 1))
+    assert index.get(filenames[0]).airmass == 2.0
+    assert index.scanned == 1
+    index.close()
+
+
+def test_gather_info(tmp_path, monkeypatch):
+    filename = str(tmp_path / "frame.fits")
+    create_frame(2).writeto(filename)
+    monkeypatch.chdir(tmp_path)
+    model = datamodel.EmirDataModel()
+    info = model.gather_info(numina.core.DataFrame(filename=filename))
+    with fits.open(filename) as hdulist:
+        assert info == model.gather_info_hdu(hdulist)
+    # the index is only created on request
+    assert os.listdir(tmp_path) == ["frame.fits"]
+
+
+def test_undefined_keyword(tmp_path):
+    filename = str(tmp_path / "frame.fits")
+    hdulist = create_frame(3)
+    hdulist[0].header["AIRMASS"] = fits.card.UNDEFINED
+    hdulist["MECS"].header["XDTU"] = fits.card.UNDEFINED
+    hdulist.writeto(filename)
+    with HeaderIndex(":memory:") as index:
+        record = index.get(filename)
+        assert record["AIRMASS"] is None
+        assert (
+            record.keywords
+            == frame_record(numina.core.DataFrame(filename=filename)).keywords
+        )
+        assert index.get(filename)._dtu["XDTU"] is None
+
+
+def test_truncated_file(tmp_path):
+    filename = tmp_path / "frame.fits"
+    create_frame(1).writeto(filename)
+    with open(filename, "rb") as fd:
+        content = fd.read()
+    with open(filename, "wb") as fd:
+        fd.write(content[:1000])
+    with pytest.raises(ValueError):
+        read_headers(filename)
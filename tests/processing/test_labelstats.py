@@ -0,0 +1,87 @@
+import numpy
+import pytest
+from scipy import interpolate
+
+from emirdrp.processing.labelstats import LabelIndex, TileSurface
+
+
+def test_label_index_median():
+    rng = numpy.random.default_rng(1290)
+    labels = rng.integers(0, 6, size=(40, 50))
+    labels[labels == 4] = 3
+    arr = rng.normal(size=(40, 50)).astype("float32")
+    mask = (rng.uniform(size=(40, 50)) < 0.3).astype("uint8")
+    mask[labels == 5] = 1
+
+    index = LabelIndex(labels)
+    assert index.nlabels == 6
+    medians, counts = index.median(arr, mask)
+    assert medians.dtype == numpy.float32
+    for label in range(6):
+        useful = arr[(labels == label) & (mask == 0)]
+        assert counts[label] == useful.size
+        if useful.size > 0:
+            assert medians[label] == numpy.median(useful)
+        else:
+            assert medians[label] == 0
+
+    medians, counts = index.median(arr)
+    assert medians[5] == numpy.median(arr[labels == 5])
+    assert numpy.array_equal(index.expand(numpy.arange(6)), labels)
+
+
+def test_label_index_raise():
+    with pytest.raises(ValueError):
+        LabelIndex(numpy.zeros((3, 3)))
+    with pytest.raises(ValueError):
+        LabelIndex(-numpy.ones((3, 3), dtype=int))
+    with pytest.raises(ValueError):
+        LabelIndex(numpy.zeros((3, 3), dtype=int)).median(numpy.zeros((3, 4)))
+
+
+def test_tile_surface():
+    rng = numpy.random.default_rng(561)
+    nside = 4
+    lim = [0, 40, 80]
+    surface = TileSurface(lim, lim, nside)
+
+    for _ in range(2):
+        arr = rng.normal(size=(90, 80)).astype("float32")
+        mask = (rng.uniform(size=(90, 80)) < 0.3).astype("uint8")
+        # fully masked tile
+        mask[0:10, 0:10] = 1
+        computed = surface(arr, mask)
+        assert computed.shape == arr.shape
+        assert numpy.all(computed[80:] == 0)
+
+        for i1, i2 in zip(lim[:-1], lim[1:]):
+            for j1, j2 in zip(lim[:-1], lim[1:]):
+                limi = numpy.linspace(i1, i2, nside + 1, dtype=int)
+                limj = numpy.linspace(j1, j2, nside + 1, dtype=int)
+                xyfit = []
+                zfit = []
+                for ii1, ii2 in zip(limi[:-1], limi[1:]):
+                    for jj1, jj2 in zip(limj[:-1], limj[1:]):
+                        useful = arr[ii1:ii2, jj1:jj2][mask[ii1:ii2, jj1:jj2] == 0]
+                        if useful.size > 0:
+                            xyfit.append([(jj1 + jj2) / 2.0, (ii1 + ii2) / 2.0])
+                            zfit.append(numpy.median(useful))
+                xgrid, ygrid = numpy.meshgrid(
+                    numpy.arange(j1, j2, dtype=float),
+                    numpy.arange(i1, i2, dtype=float),
+                )
+                nearest = interpolate.griddata(
+                    xyfit, zfit, (xgrid, ygrid), method="nearest", rescale=True
+                )
+                cubic = interpolate.griddata(
+                    xyfit,
+                    zfit,
+                    (xgrid, ygrid),
+                    method="cubic",
+                    fill_value=-1.0e30,
+                    rescale=True,
+                )
+                expected = numpy.where(cubic < -1.0e29, nearest, cubic)
+                assert numpy.array_equal(
+                    computed[i1:i2, j1:j2], expected.astype("float32")
+                )
@@ -0,0 +1,67 @@
+import numpy
+import pytest
+
+from emirdrp.processing.polar import polar_coordinates
+from emirdrp.processing.polar import polar_binned_median, segment_median
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_segment_median(dtype):
+    rng = numpy.random.default_rng(3213)
+    nlabels = 20
+    labels = rng.integers(0, nlabels - 2, size=1000)
+    values = rng.normal(size=1000).astype(dtype)
+
+    median, counts = segment_median(labels, values, nlabels)
+
+    for label in range(nlabels):
+        sel = labels == label
+        assert counts[label] == sel.sum()
+        if sel.any():
+            assert numpy.isclose(median[label], numpy.median(values[sel]))
+        else:
+            assert numpy.isnan(median[label])
+
+
+def test_segment_median_nan():
+    rng = numpy.random.default_rng(3214)
+    nlabels = 6
+    labels = rng.integers(0, nlabels, size=200)
+    values = rng.normal(size=200)
+    # a single NaN in label 2, all NaN in label 4
+    values[numpy.flatnonzero(labels == 2)[3]] = numpy.nan
+    values[labels == 4] = numpy.nan
+
+    median, counts = segment_median(labels, values, nlabels)
+
+    for label in range(nlabels):
+        expected = numpy.median(values[labels == label])
+        numpy.testing.assert_equal(median[label], expected)
+    assert numpy.isnan(median[[2, 4]]).all()
+    assert not numpy.isnan(median[[0, 1, 3, 5]]).any()
+
+
+def test_polar_binned_median():
+    rng = numpy.random.default_rng(9123)
+    shape = (60, 80)
+    image = rng.normal(1.0, 0.1, size=shape)
+    mask = rng.uniform(size=shape) > 0.2
+
+    r, theta = polar_coordinates(shape)
+    r_bins = numpy.linspace(0, r.max(), 11)
+    theta_bins = numpy.linspace(-numpy.pi, numpy.pi, 13)
+
+    median, counts = polar_binned_median(image, r, theta, r_bins, theta_bins, mask=mask)
+    assert median.shape == (12, 10)
+
+    values = image.ravel()
+    fmask = mask.ravel()
+    for j in range(12):
+        for i in range(10):
+            sel = (r >= r_bins[i]) & (r < r_bins[i + 1])
+            sel &= (theta >= theta_bins[j]) & (theta < theta_bins[j + 1]) & fmask
+            assert counts[j, i] == sel.sum()
+            if sel.any():
+                assert numpy.isclose(median[j, i], numpy.median(values[sel]))
+            else:
+                assert numpy.isnan(median[j, i])
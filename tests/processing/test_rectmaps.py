@@ -0,0 +1,107 @@
+import numpy
+import pytest
+from numina.array.distortion import rectify2d
+from numina.array.wavecalib.resample import resample_image2d_flux
+
+from emirdrp.processing.wavecal.apply_rectwv_coeff import apply_rectwv_coeff
+from emirdrp.processing.wavecal.rectmaps import RectWaveMap, RectWaveMapCache
+from emirdrp.processing.wavecal.rectmaps import rectification_matrix
+from emirdrp.processing.wavecal.rectmaps import resample_flux_borders
+from emirdrp.processing.wavecal.set_wv_parameters import set_wv_parameters
+from emirdrp.processing.wavecal.slitlet2d import Slitlet2D
+from emirdrp.testing.create_rectwv import create_rectwv_coeff, create_rectwv_image
+
+
+@pytest.mark.parametrize("resampling", [1, 2])
+@pytest.mark.parametrize(
+    "aij,bij",
+    [
+        ([0.0, 1.0, 0.0], [0.0, 0.0, 1.0]),
+        ([0.3, 1.0, 0.0], [0.6, 0.0, 1.0]),
+        ([0.0, 1.3, 0.1], [0.2, -0.05, 0.8]),
+        (
+            [0.0, 1.0, 0.0, 1e-5, 2e-6, 0.0],
+            [0.3, 0.002, 1.0, 1e-6, 0.0, 1e-5],
+        ),
+    ],
+)
+def test_rectification_matrix(aij, bij, resampling):
+    rng = numpy.random.default_rng(3421)
+    image2d = rng.uniform(size=(41, 300))
+    matrix = rectification_matrix(image2d.shape, aij, bij, resampling)
+    computed = (matrix @ image2d.ravel()).reshape(image2d.shape)
+    expected = rectify2d(image2d, aij, bij, resampling)
+    assert numpy.allclose(computed, expected, rtol=0, atol=1e-10)
+
+
+def test_rectification_matrix_raise():
+    with pytest.raises(ValueError):
+        rectification_matrix((10, 10), [0.0, 1.0, 0.0], [0.0, 0.0, 1.0], 3)
+
+
+def test_resample_flux_borders():
+    rng = numpy.random.default_rng(9832)
+    image2d = rng.uniform(size=(10, 500))
+    slt = Slitlet2D(3, create_rectwv_coeff([3]), debugplot=0)
+    wv_parameters = set_wv_parameters("J", "J")
+    rectwv_map = RectWaveMap.from_slitlet(slt, 2, wv_parameters)
+
+    expected = resample_image2d_flux(
+        image2d,
+        naxis1=wv_parameters["naxis1_enlarged"],
+        cdelt1=wv_parameters["cdelt1_enlarged"],
+        crval1=wv_parameters["crval1_enlarged"],
+        crpix1=wv_parameters["crpix1_enlarged"],
+        coeff=slt.wpoly,
+    )
+    computed = resample_flux_borders(
+        image2d, rectwv_map.old_wl_borders[:501], rectwv_map.new_borders
+    )
+    assert numpy.array_equal(computed, expected)
+
+
+def test_rectwv_map_save_load(tmp_path):
+    slt = Slitlet2D(3, create_rectwv_coeff([3]), debugplot=0)
+    rectwv_map = RectWaveMap.from_slitlet(slt, 2, set_wv_parameters("J", "J"))
+    filename = tmp_path / "map.npz"
+    rectwv_map.save(filename)
+    loaded = RectWaveMap.load(filename)
+
+    rng = numpy.random.default_rng(22)
+    slitlet2d = rng.uniform(size=rectwv_map.shape)
+    assert numpy.array_equal(loaded.apply(slitlet2d), rectwv_map.apply(slitlet2d))
+
+
+def test_rectwv_map_cache(tmp_path):
+    rectwv_coeff = create_rectwv_coeff([3, 4, 5])
+    wv_parameters = set_wv_parameters("J", "J")
+    slitlets = [Slitlet2D(i, rectwv_coeff, debugplot=0) for i in [3, 4, 5]]
+
+    cache = RectWaveMapCache(maxsize=2, directory=tmp_path)
+    map3 = cache.get(rectwv_coeff, slitlets[0], 2, wv_parameters)
+    cache.get(rectwv_coeff, slitlets[1], 2, wv_parameters)
+    assert cache.get(rectwv_coeff, slitlets[0], 2, wv_parameters) is map3
+    # slitlet 4 is the least recently used
+    cache.get(rectwv_coeff, slitlets[2], 2, wv_parameters)
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert len(list(tmp_path.glob("*.npz"))) == 3
+
+    # slitlet 4 is read from disk
+    cache.get(rectwv_coeff, slitlets[1], 2, wv_parameters)
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert len(list(tmp_path.glob("*.npz"))) == 3
+
+
+def test_apply_rectwv_coeff_maps():
+    rectwv_coeff = create_rectwv_coeff([3, 20])
+    image = create_rectwv_image()
+
+    expected = apply_rectwv_coeff(image, rectwv_coeff)
+    cache = RectWaveMapCache()
+    for _ in range(2):
+        computed = apply_rectwv_coeff(image, rectwv_coeff, rectwv_maps=cache)
+        assert numpy.allclose(computed[0].data, expected[0].data, rtol=1e-6)
+        for key in ["JMNSLT03", "JMXSLT03", "JMNSLT20", "JMXSLT20"]:
+            assert computed[0].header[key] == expected[0].header[key]
+    assert (cache.hits, cache.misses) == (2, 2)
@@ -0,0 +1,129 @@
+import numpy
+import pytest
+from astropy.io import fits
+from scipy.interpolate import interp1d
+
+from emirdrp.core import EMIR_NBARS
+from emirdrp.products import MasterRectWave
+from emirdrp.processing.wavecal.rectwv_coeff_cache import rectwv_coeff_cache
+from emirdrp.processing.wavecal.rectwv_coeff_from_mos_library import (
+    interpolate_coefficients,
+    rectwv_coeff_from_mos_library,
+)
+from emirdrp.testing.create_headers import create_dtu_header_example
+from emirdrp.tools.fit_boundaries import EXPECTED_PARAMETER_LIST
+
+
+def create_master_rectwv(missing_slitlets):
+    rng = numpy.random.default_rng(3981)
+    bound_param = dict(
+        c2=0.0,
+        c4=0.0,
+        ff=1.0,
+        slit_gap=4.7,
+        slit_height=3.33,
+        theta0_origin=0.0,
+        theta0_slope=0.0,
+        x0=1.024,
+        y0=1.024,
+        y_baseline=0.05,
+    )
+    master_rectwv = MasterRectWave(instrument="EMIR")
+    master_rectwv.tags = {"grism": "J", "filter": "J"}
+    master_rectwv.total_slitlets = EMIR_NBARS
+    master_rectwv.missing_slitlets = missing_slitlets
+    master_rectwv.meta_info["dtu_configuration"] = create_dtu_header_example()
+    master_rectwv.meta_info["origin"]["bound_param"] = "uuid1234"
+    master_rectwv.meta_info["refined_boundary_model"] = {"parmodel": "longslit"}
+    for mainpar in EXPECTED_PARAMETER_LIST:
+        master_rectwv.meta_info["refined_boundary_model"][mainpar] = {
+            "value": bound_param[mainpar],
+            "vary": False,
+        }
+    for islitlet in range(1, EMIR_NBARS + 1):
+        content = {
+            "islitlet": islitlet,
+            "bb_nc1_orig": 1,
+            "bb_nc2_orig": 2048,
+            "ymargin_bb": 2,
+            "ttd_order": 2,
+            "wpoly_degree": 3,
+        }
+        if islitlet not in missing_slitlets:
+            content["list_csu_bar_slit_center"] = [170.0, 120.0, 250.0, 200.0]
+            for keycoef in ["ttd_aij", "ttd_bij", "tti_aij", "tti_bij"]:
+                for icoef in range(6):
+                    ccoef = str(icoef).zfill(2)
+                    content["list_" + keycoef + "_" + ccoef] = list(rng.normal(size=4))
+            for icoef in range(4):
+                ccoef = str(icoef).zfill(2)
+                content["list_wpoly_coeff_" + ccoef] = list(rng.normal(size=4))
+        master_rectwv.contents.append(content)
+    return master_rectwv
+
+
+def create_image(center):
+    hdr = fits.Header()
+    hdr["FILTER"] = "J"
+    hdr["GRISM"] = "J"
+    for islitlet in range(1, EMIR_NBARS + 1):
+        hdr[f"CSUP{islitlet}"] = center - 1.0 + 0.1 * islitlet
+        hdr[f"CSUP{islitlet + EMIR_NBARS}"] = 341.5 - (center + 1.0)
+    for key, value in create_dtu_header_example().items():
+        hdr[key] = value
+    return fits.HDUList([fits.PrimaryHDU(header=hdr)])
+
+
+@pytest.mark.parametrize("x_new", [95.0, 120.0, 185.3, 200.0, 260.0])
+def test_interpolate_coefficients(x_new):
+    rng = numpy.random.default_rng(28)
+    x = [170.0, 120.0, 250.0, 200.0]
+    table = rng.normal(size=(7, 4))
+    computed = interpolate_coefficients(x, table, x_new)
+    for row, value in zip(table, computed):
+        expected = interp1d(x, row, kind="linear", fill_value="extrapolate")
+        assert value == expected([x_new])[0]
+
+
+def test_rectwv_coeff_cache(tmp_path):
+    master_rectwv = create_master_rectwv([1, 55])
+    image = create_image(170.0)
+    rectwv_coeff_cache.clear()
+
+    # the cache is only used on request
+    expected = rectwv_coeff_from_mos_library(image, master_rectwv, cache_dir=tmp_path)
+    assert len(rectwv_coeff_cache) == 0
+    assert len(list(tmp_path.glob("rectwv_coeff_*.json"))) == 0
+
+    first = rectwv_coeff_from_mos_library(
+        image, master_rectwv, use_cache=True, cache_dir=tmp_path
+    )
+    assert (rectwv_coeff_cache.hits, rectwv_coeff_cache.misses) == (0, 1)
+    assert first.contents == expected.contents
+    assert first.missing_slitlets == [1, 55]
+    assert len(list(tmp_path.glob("rectwv_coeff_*.json"))) == 1
+
+    # the cached instance is not modified through the returned copies
+    first.global_integer_offset_x_pix = 5
+    first.contents[10]["wpoly_coeff"][0] = 0.0
+    second = rectwv_coeff_from_mos_library(image, master_rectwv, use_cache=True)
+    assert rectwv_coeff_cache.hits == 1
+    assert second.uuid != first.uuid
+    assert second.global_integer_offset_x_pix == 0
+    assert second.contents == expected.contents
+
+    # a different CSU configuration is computed again
+    other = rectwv_coeff_from_mos_library(
+        create_image(180.0), master_rectwv, use_cache=True
+    )
+    assert rectwv_coeff_cache.misses == 2
+    assert other.contents != expected.contents
+
+    # JSON file in the cache directory
+    rectwv_coeff_cache.clear()
+    third = rectwv_coeff_from_mos_library(
+        image, master_rectwv, use_cache=True, cache_dir=tmp_path
+    )
+    assert rectwv_coeff_cache.hits == 1
+    assert third.contents == expected.contents
+    rectwv_coeff_cache.clear()
@@ -0,0 +1,152 @@
+import io
+import pkgutil
+import time
+
+from astropy.io import fits
+import numpy
+import pytest
+import skimage.restoration
+
+import emirdrp.processing.wavecal.rectwv_coeff_from_arc_image as arcmod
+from emirdrp.core import EMIR_NBARS
+from emirdrp.processing.wavecal.set_wv_parameters import set_wv_parameters
+from emirdrp.processing.wavecal.slitlet2darc import Slitlet2dArc
+from emirdrp.testing.create_headers import create_dtu_header_example
+from emirdrp.tools.fit_boundaries import EXPECTED_PARAMETER_LIST
+
+ISLITLET_MIN = 10
+ISLITLET_MAX = 13
+
+_denoise_nl_means = skimage.restoration.denoise_nl_means
+_arc_calibration_slitlet = arcmod.arc_calibration_slitlet
+_estimate_tt_to_rectify = Slitlet2dArc.estimate_tt_to_rectify
+
+
+class BoundParam:
+    tags = {"filter": "J", "grism": "J"}
+    meta_info = {"parmodel": "longslit"}
+    uuid = "8a6e1e02-0f0a-4b8c-9a37-1a5f0b6c3a11"
+
+    def __getstate__(self):
+        values = dict(
+            c2=0.0,
+            c4=0.0,
+            ff=1.0,
+            slit_gap=4.7,
+            slit_height=3.33,
+            theta0_origin=0.0,
+            theta0_slope=0.0,
+            x0=1.024,
+            y0=1.024,
+            y_baseline=0.05,
+        )
+        contents = {
+            key: {"value": values[key], "vary": False}
+            for key in EXPECTED_PARAMETER_LIST
+        }
+        return {"meta_info": self.meta_info, "contents": contents}
+
+
+def denoise_nl_means(image, multichannel=False, **kwargs):
+    # multichannel was removed from scikit-image
+    return _denoise_nl_means(image, channel_axis=None, **kwargs)
+
+
+def wv_parameters(filter_name, grism_name):
+    result = set_wv_parameters(filter_name, grism_name)
+    result["islitlet_min"] = ISLITLET_MIN
+    result["islitlet_max"] = ISLITLET_MAX
+    return result
+
+
+def calibrate_reversed(slt, slitlet2d, **kwargs):
+    # the first slitlets finish last
+    time.sleep(0.3 * (ISLITLET_MAX - slt.islitlet))
+    return _arc_calibration_slitlet(slt, slitlet2d, **kwargs)
+
+
+def estimate_tt_failing(self, *args, **kwargs):
+    if self.islitlet in (11, 13):
+        raise RuntimeError(f"failure in slitlet {self.islitlet}")
+    return _estimate_tt_to_rectify(self, *args, **kwargs)
+
+
+@pytest.fixture
+def small_arc(monkeypatch):
+    monkeypatch.setattr(skimage.restoration, "denoise_nl_means", denoise_nl_means)
+    monkeypatch.setattr(arcmod, "set_wv_parameters", wv_parameters)
+
+    data = pkgutil.get_data(
+        "emirdrp.instrument.configs", "lines_argon_neon_xenon_empirical.dat"
+    )
+    catalog = numpy.genfromtxt(io.StringIO(data.decode("utf8")))
+    center = 170.0
+    params = set_wv_parameters("J", "J")
+    crval = params["poly_crval1_linear"](center)
+    cdelt = params["poly_cdelt1_linear"](center)
+    x = numpy.arange(1, 2049)
+    spectrum = numpy.zeros(2048)
+    for wave, flux in catalog:
+        xc = (wave - crval) / cdelt + 1
+        spectrum += flux * numpy.exp(-0.5 * ((x - xc) / 1.5) ** 2)
+    rng = numpy.random.default_rng(1)
+    image = numpy.tile(spectrum, (2048, 1)) + rng.normal(0, 2.0, (2048, 2048)) + 10
+
+    header = fits.Header()
+    header["FILTER"] = "J"
+    header["GRISM"] = "J"
+    for idx in range(1, EMIR_NBARS + 1):
+        header[f"CSUP{idx}"] = center - 1.0
+        header[f"CSUP{idx + EMIR_NBARS}"] = 341.5 - (center + 1.0)
+    for key, value in create_dtu_header_example().items():
+        header[key] = value
+    hdulist = fits.HDUList([fits.PrimaryHDU(image.astype("float32"), header=header)])
+    return hdulist, catalog
+
+
+def run_calibration(small_arc, **kwargs):
+    hdulist, catalog = small_arc
+    return arcmod.rectwv_coeff_from_arc_image(hdulist, BoundParam(), catalog, **kwargs)
+
+
+def check_same_calibration(result1, result2):
+    rectwv1, sp1 = result1
+    rectwv2, sp2 = result2
+    assert rectwv1.missing_slitlets == rectwv2.missing_slitlets
+    assert repr(rectwv1.contents) == repr(rectwv2.contents)
+    numpy.testing.assert_array_equal(sp1.data, sp2.data)
+
+
+def test_arc_serial_parallel(small_arc):
+    serial = run_calibration(small_arc)
+    rectwv, sp55 = serial
+    calibrated = [
+        content["islitlet"]
+        for content in rectwv.contents
+        if content.get("wpoly_coeff") is not None
+    ]
+    assert calibrated == list(range(ISLITLET_MIN, ISLITLET_MAX + 1))
+    for islitlet in range(1, EMIR_NBARS + 1):
+        used = ISLITLET_MIN <= islitlet <= ISLITLET_MAX
+        assert numpy.any(sp55.data[islitlet - 1] != 0) == used
+
+    parallel = run_calibration(small_arc, args_max_workers=2)
+    check_same_calibration(serial, parallel)
+
+
+def test_arc_parallel_order(small_arc, monkeypatch):
+    serial = run_calibration(small_arc)
+    monkeypatch.setattr(arcmod, "arc_calibration_slitlet", calibrate_reversed)
+    parallel = run_calibration(small_arc, args_max_workers=4)
+    assert [content["islitlet"] for content in parallel[0].contents] == list(
+        range(1, EMIR_NBARS + 1)
+    )
+    check_same_calibration(serial, parallel)
+
+
+def test_arc_parallel_failures(small_arc, monkeypatch):
+    monkeypatch.setattr(Slitlet2dArc, "estimate_tt_to_rectify", estimate_tt_failing)
+    with pytest.raises(ValueError, match=r"slitlets \[11, 13\]") as excinfo:
+        run_calibration(small_arc, args_max_workers=2)
+    assert isinstance(excinfo.value.__cause__, RuntimeError)
+    assert str(excinfo.value.__cause__) == "failure in slitlet 11"
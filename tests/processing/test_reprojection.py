@@ -0,0 +1,126 @@
+import numpy
+import pytest
+from reproject import reproject_adaptive, reproject_interp
+
+from emirdrp.processing.reprojection import (
+    ReprojectionCache,
+    ReprojectionPlan,
+    distortion_signature,
+)
+from emirdrp.testing.create_wcs import create_wcs_new
+
+
+def create_wcs_pair(shape, crval_offset=0.0):
+    wcs_in = create_wcs_new()
+    wcs_in.wcs.crval = wcs_in.wcs.crval + crval_offset
+    wcs_in.wcs.crpix = [shape[1] / 2.0 + 0.46, shape[0] / 2.0 + 0.55]
+    wcs_out = wcs_in.deepcopy()
+    wcs_out.wcs.set_pv([(2, 1, 1.0)])
+    # exaggerate the distortion, to test the borders of the image
+    wcs_in.wcs.set_pv([(2, 1, 1.0), (2, 3, 1e8)])
+    wcs_in.wcs.set()
+    wcs_out.wcs.set()
+    return wcs_in, wcs_out
+
+
+def test_interp_plan_reproject_interp():
+    shape = (40, 50)
+    wcs_in, wcs_out = create_wcs_pair(shape)
+    rng = numpy.random.default_rng(76)
+    data = rng.normal(100, 10, size=shape)
+    data[20, 20] = numpy.nan
+    mask = (rng.random(shape) < 0.05).astype("uint8")
+
+    plan = ReprojectionPlan(wcs_in, wcs_out, shape)
+    result = plan(data, mask)
+    for layer, (computed, footprint) in zip([data, mask], result):
+        expected, expected_footprint = reproject_interp(
+            (layer, wcs_in), wcs_out, shape_out=shape
+        )
+        assert numpy.array_equal(footprint, expected_footprint)
+        assert footprint.min() == 0
+        # the plan moves CRVAL to (0, 0), the coordinates differ by rounding
+        assert numpy.allclose(computed, expected, rtol=1e-6, atol=1e-6, equal_nan=True)
+
+
+def test_adaptive_plan():
+    shape = (20, 24)
+    wcs_in, wcs_out = create_wcs_pair(shape)
+    data = numpy.arange(shape[0] * shape[1], dtype=float).reshape(shape)
+    plan = ReprojectionPlan(wcs_in, wcs_out, shape, method="adaptive")
+    ((computed, footprint),) = plan(data)
+    expected, expected_footprint = reproject_adaptive(
+        (data, wcs_in), wcs_out, shape_out=shape
+    )
+    assert numpy.allclose(footprint, expected_footprint)
+    assert numpy.allclose(computed, expected, rtol=1e-9, equal_nan=True)
+
+
+def test_plan_wrong_input():
+    shape = (20, 24)
+    wcs_in, wcs_out = create_wcs_pair(shape)
+    with pytest.raises(ValueError):
+        ReprojectionPlan(wcs_in, wcs_out, shape, method="nearest")
+    plan = ReprojectionPlan(wcs_in, wcs_out, shape)
+    with pytest.raises(ValueError):
+        plan(numpy.zeros((24, 20)))
+
+
+def test_reprojection_cache():
+    shape = (30, 30)
+    cache = ReprojectionCache(maxsize=1)
+    wcs_in, wcs_out = create_wcs_pair(shape)
+    plan = cache.plan(wcs_in, wcs_out, shape)
+    # a dither changes only the reference point
+    other_in, other_out = create_wcs_pair(shape, crval_offset=0.01)
+    assert distortion_signature(other_in) == distortion_signature(wcs_in)
+    assert cache.plan(other_in, other_out, shape) is plan
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    data = numpy.ones(shape)
+    ((computed, footprint),) = plan(data)
+    expected, expected_footprint = reproject_interp(
+        (data, other_in), other_out, shape_out=shape
+    )
+    assert numpy.array_equal(footprint, expected_footprint)
+
+    solid_angle = cache.pixel_solid_angle(wcs_in, shape)
+    assert solid_angle.shape == shape
+    assert cache.pixel_solid_angle(other_in, shape) is solid_angle
+
+    # a different reference pixel needs a new plan
+    other_in.wcs.crpix = other_in.wcs.crpix + 1
+    assert cache.plan(other_in, other_out, shape) is not plan
+    assert cache.plan(wcs_in, wcs_out, shape) is not plan
+    assert (cache.hits, cache.misses) == (2, 4)
+
+    cache.clear()
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_reprojection_cache_crval():
+    shape = (30, 30)
+    cache = ReprojectionCache()
+    wcs_in, wcs_out = create_wcs_pair(shape)
+    plan = cache.plan(wcs_in, wcs_out, shape)
+    assert plan.canonical
+
+    # same distortions, but the reference points of the pair differ
+    other_out = wcs_out.deepcopy()
+    other_out.wcs.crval = other_out.wcs.crval + [0.0005, 0.0003]
+    other_out.wcs.set()
+    assert distortion_signature(other_out) == distortion_signature(wcs_out)
+    other = cache.plan(wcs_in, other_out, shape)
+    assert other is not plan
+    assert not other.canonical
+    assert cache.plan(wcs_in, other_out, shape) is not other
+
+    data = numpy.arange(shape[0] * shape[1], dtype=float).reshape(shape)
+    ((computed, footprint),) = other(data)
+    expected, expected_footprint = reproject_interp(
+        (data, wcs_in), other_out, shape_out=shape
+    )
+    assert numpy.array_equal(footprint, expected_footprint)
+    assert numpy.allclose(computed, expected, rtol=1e-6, atol=1e-6, equal_nan=True)
+    ((shifted, _),) = plan(data)
+    assert not numpy.allclose(shifted, computed, equal_nan=True)
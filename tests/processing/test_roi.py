@@ -0,0 +1,52 @@
+import numpy
+import pytest
+from scipy.ndimage import convolve1d, median_filter
+
+from emirdrp.processing.roi import StageTimer, TileStack, reflect_indices
+
+
+def test_reflect_indices():
+    arr = numpy.arange(7)
+    padded = numpy.pad(arr, 9, mode="symmetric")
+    assert numpy.array_equal(arr[reflect_indices(numpy.arange(-9, 16), 7)], padded)
+
+
+@pytest.mark.parametrize("dtype", ["float32", ">f4", "int32"])
+def test_tile_stack_filters(dtype):
+    rng = numpy.random.default_rng(87)
+    arr = rng.normal(100, 30, size=(60, 80)).astype(dtype)
+    # tiles inside, overlapping and crossing the borders of the image
+    rows = [20, 25, -4, 50, -30]
+    cols = [30, 35, -3, 70, 10]
+    tiles = TileStack(rows, cols, shape=(9, 11), margin=(2, 4))
+    coeffs = [0.1, 0.05, 0, -0.05, -0.1]
+
+    expected = median_filter(arr, size=(1, 5))
+    expected = median_filter(expected, size=(5, 1))
+    expected = convolve1d(expected, coeffs, axis=-1)
+
+    stack = tiles.gather(arr)
+    assert stack.shape == (5, 13, 19)
+    stack = median_filter(stack, size=(1, 1, 5))
+    stack = median_filter(stack, size=(1, 5, 1))
+    stack = convolve1d(stack, coeffs, axis=-1)
+    computed = tiles.scatter(stack, arr.shape)
+
+    covered = numpy.zeros(arr.shape, dtype=bool)
+    for row, col in zip(rows, cols):
+        covered[max(row, 0) : max(row + 9, 0), max(col, 0) : max(col + 11, 0)] = True
+    assert computed.dtype == expected.dtype
+    assert numpy.array_equal(computed[covered], expected[covered])
+    assert numpy.all(computed[~covered] == 0)
+
+
+def test_stage_timer():
+    timer = StageTimer()
+    for _ in range(2):
+        with timer("first"):
+            pass
+    with timer("second"):
+        pass
+    assert list(timer.timings) == ["first", "second"]
+    assert timer.total == sum(timer.timings.values())
+    assert str(timer).endswith(f"total {timer.total * 1e3:.1f} ms")
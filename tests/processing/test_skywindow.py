@@ -0,0 +1,42 @@
+import numpy
+import pytest
+
+from emirdrp.processing.skywindow import SkyWindow
+
+
+def test_sky_window():
+    rng = numpy.random.default_rng(7812)
+    frames = {key: rng.normal(100.0 + key, 1.0, size=(30, 40)) for key in range(6)}
+    mask = numpy.zeros((30, 40), dtype="uint8")
+    mask[10:20, 5:15] = 1
+    loaded = []
+
+    def load(key):
+        loaded.append(key)
+        return frames[key], mask, None
+
+    window = SkyWindow(load)
+    for first in range(4):
+        keys = [first, first + 1, first + 2]
+        data, masks, scales = window.select(keys)
+        for key, arr, msk, scale in zip(keys, data, masks, scales):
+            assert numpy.array_equal(arr, frames[key])
+            assert msk is mask
+            assert scale == numpy.median(frames[key][mask == 0])
+        assert len(window) == 3
+
+    # each frame is loaded once when entering the window
+    assert loaded == list(range(6))
+    assert (window.loads, window.reuses) == (6, 6)
+    assert 0 not in window
+
+    # the order of the keys is preserved
+    data, _, scales = window.select([5, 3, 4])
+    assert numpy.array_equal(data[0], frames[5])
+    assert scales[1] == window.scales[3]
+
+    with pytest.raises(ValueError):
+        window.select([1, 1])
+
+    window.clear()
+    assert len(window) == 0
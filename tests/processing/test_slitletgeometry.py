@@ -0,0 +1,77 @@
+import numpy
+import pytest
+
+from emirdrp.core import EMIR_NAXIS1, EMIR_NAXIS2
+from emirdrp.processing.specflat import frontier_scan_limits
+from emirdrp.processing.wavecal.slitlet2d import Slitlet2D
+from emirdrp.processing.wavecal.slitletgeometry import SlitletGeometry
+import emirdrp.processing.wavecal.slitletgeometry as slitletgeometry
+from emirdrp.testing.create_rectwv import create_rectwv_coeff
+from emirdrp.tools.nscan_minmax_frontiers import nscan_minmax_frontiers
+from emirdrp.tools.select_unrectified_slitlets import select_unrectified_slitlet
+
+
+def test_slitlet_geometry():
+    rectwv_coeff = create_rectwv_coeff([3, 20])
+    geometry = SlitletGeometry.from_rectwv_coeff(rectwv_coeff)
+    assert list(numpy.nonzero(geometry.defined)[0] + 1) == [3, 20]
+    with pytest.raises(ValueError):
+        geometry.limits(4)
+
+    rng = numpy.random.default_rng(234)
+    image2d = rng.uniform(size=(EMIR_NAXIS2, EMIR_NAXIS1)).astype("float32")
+    for islitlet in [3, 20]:
+        slt = Slitlet2D(islitlet, rectwv_coeff, debugplot=0)
+        n1, n2 = geometry.limits(islitlet)
+        assert n1.dtype == numpy.int16
+        expected_n1, expected_n2 = frontier_scan_limits(slt.list_frontiers)
+        assert numpy.array_equal(n1, expected_n1)
+        assert numpy.array_equal(n2, expected_n2)
+
+        # full frame copy of the slitlet
+        expected = numpy.zeros_like(image2d)
+        for j in range(EMIR_NAXIS1):
+            expected[(n1[j] - 1) : n2[j], j] = image2d[(n1[j] - 1) : n2[j], j]
+
+        assert numpy.array_equal(geometry.mask(islitlet), expected != 0)
+        columns, starts, lengths = geometry.footprint(islitlet)
+        assert lengths.sum() == numpy.count_nonzero(expected)
+        assert numpy.all(expected[starts, columns] != 0)
+
+        ns1, ns2 = slt.bb_ns1_orig, slt.bb_ns2_orig
+        nc1, nc2 = slt.bb_nc1_orig, slt.bb_nc2_orig
+        slitlet2d = geometry.extract(image2d, islitlet, ns1, ns2, nc1, nc2)
+        assert slitlet2d.dtype == float
+        assert numpy.array_equal(slitlet2d, expected[ns1 - 1 : ns2, nc1 - 1 : nc2])
+
+
+class _Frontier:
+    def __init__(self, coeff):
+        self.poly_funct = numpy.polynomial.Polynomial(coeff)
+
+
+def test_select_unrectified_slitlet(monkeypatch):
+    def expected_distorted_frontiers(islitlet, csu_bar_slit_center, *args, **kwds):
+        y0 = 38.0 * islitlet + csu_bar_slit_center / 100.0
+        return [_Frontier([y0, 1e-3, 2e-6]), _Frontier([y0 + 36.5, 1e-3, -1e-6])]
+
+    monkeypatch.setattr(
+        slitletgeometry, "expected_distorted_frontiers", expected_distorted_frontiers
+    )
+
+    rng = numpy.random.default_rng(34)
+    image2d = rng.uniform(size=(EMIR_NAXIS2, EMIR_NAXIS1))
+    for maskonly in [False, True]:
+        computed = select_unrectified_slitlet(image2d, 12, 170.0, None, None, maskonly)
+
+        lower, upper = expected_distorted_frontiers(12, 170.0)
+        expected = numpy.zeros_like(image2d)
+        for j in range(EMIR_NAXIS1):
+            n1, n2 = nscan_minmax_frontiers(
+                lower.poly_funct(j + 1), upper.poly_funct(j + 1), resize=True
+            )
+            if maskonly:
+                expected[(n1 - 1) : n2, j] = 1.0
+            else:
+                expected[(n1 - 1) : n2, j] = image2d[(n1 - 1) : n2, j]
+        assert numpy.array_equal(computed, expected)
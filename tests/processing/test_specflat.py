@@ -0,0 +1,80 @@
+import numpy
+import pytest
+from numina.array.wavecalib.fix_pix_borders import fix_pix_borders as fix_pix_borders0
+
+from emirdrp.processing.specflat import fix_pix_borders, safe_divide
+from emirdrp.processing.specflat import frontier_scan_limits, insert_slitlet
+from emirdrp.tools.nscan_minmax_frontiers import nscan_minmax_frontiers
+
+
+def test_safe_divide():
+    num = numpy.array([[1.0, 2.0], [3.0, 4.0]], dtype="float32")
+    den = numpy.array([[2.0, 0.0], [0.0, 8.0]])
+    result = safe_divide(num, den)
+    assert result.dtype == num.dtype
+    assert numpy.allclose(result, [[0.5, 1.0], [1.0, 0.5]])
+
+
+@pytest.mark.parametrize("axis", [0, 1])
+@pytest.mark.parametrize("nreplace", [1, 3])
+def test_fix_pix_borders(axis, nreplace):
+    rng = numpy.random.default_rng(123)
+    image2d = rng.uniform(2.0, 3.0, size=(30, 40))
+    image2d[:, :5] = 1.0
+    image2d[4:9, 30:] = 1.0
+    image2d[10, :] = 1.0
+    image2d[12:20, :12] = 1.0
+
+    if axis == 1:
+        expected = fix_pix_borders0(image2d.copy(), nreplace, 1.0, 1.0)
+    else:
+        expected = fix_pix_borders0(image2d.T.copy(), nreplace, 1.0, 1.0).T
+    computed = fix_pix_borders(image2d, nreplace, 1.0, 1.0, axis=axis)
+    assert numpy.array_equal(computed, expected)
+
+
+def test_frontier_scan_limits():
+    list_frontiers = [
+        numpy.polynomial.Polynomial([-3.0, 0.01]),
+        numpy.polynomial.Polynomial([2040.0, 0.004]),
+    ]
+    naxis1 = 2048
+    n1, n2 = frontier_scan_limits(list_frontiers, naxis1)
+    for j in range(naxis1):
+        xchannel = j + 1
+        expected = nscan_minmax_frontiers(
+            list_frontiers[0](xchannel), list_frontiers[1](xchannel), resize=True
+        )
+        assert (n1[j], n2[j]) == expected
+
+
+@pytest.mark.parametrize("below,above", [(False, False), (True, True), (False, True)])
+def test_insert_slitlet(below, above):
+    naxis2, naxis1 = 200, 60
+    bb_ns1_orig = 50
+    rng = numpy.random.default_rng(4312)
+    slitlet2d = rng.uniform(size=(40, naxis1))
+    n1 = 55 + (numpy.arange(naxis1) // 10)
+    n2 = 80 + (numpy.arange(naxis1) // 7)
+
+    expected = numpy.zeros((naxis2, naxis1))
+    for j in range(naxis1):
+        nn1 = n1[j] - bb_ns1_orig + 1
+        nn2 = n2[j] - bb_ns1_orig + 1
+        expected[(n1[j] - 1) : n2[j], j] = slitlet2d[(nn1 - 1) : nn2, j]
+        if not below:
+            expected[(n1[j] - 1) : (n1[j] + 2), j] = 1
+        if not above:
+            expected[(n2[j] - 5) : n2[j], j] = 1
+
+    computed = numpy.zeros((naxis2, naxis1))
+    insert_slitlet(
+        computed,
+        slitlet2d,
+        n1,
+        n2,
+        bb_ns1_orig,
+        same_slitlet_below=below,
+        same_slitlet_above=above,
+    )
+    assert numpy.array_equal(computed, expected)
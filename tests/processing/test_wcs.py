@@ -0,0 +1,81 @@
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+import numpy
+import pytest
+
+from emirdrp.processing.wcs import (
+    WCSCache,
+    angular_separation,
+    offsets_from_wcs_imgs,
+    reference_pix_from_wcs_imgs,
+    sky_offsets_from_wcs,
+)
+from emirdrp.testing.create_wcs import create_wcs_new
+
+
+def create_images(nimages):
+    rng = numpy.random.default_rng(1234)
+    imgs = []
+    for _ in range(nimages):
+        wcs = create_wcs_new()
+        wcs.wcs.crval = wcs.wcs.crval + rng.normal(0, 5e-3, size=2)
+        header = wcs.to_header()
+        header["EXPTIME"] = 10.0
+        imgs.append(fits.HDUList([fits.PrimaryHDU(header=header)]))
+    return imgs
+
+
+def test_angular_separation():
+    rng = numpy.random.default_rng(42)
+    lon = rng.uniform(0, 360, size=(2, 50))
+    lat = rng.uniform(-89, 89, size=(2, 50))
+    c1 = SkyCoord(lon[0], lat[0], unit="deg")
+    c2 = SkyCoord(lon[1], lat[1], unit="deg")
+    result = angular_separation(lon[0], lat[0], lon[1], lat[1])
+    assert numpy.allclose(result, c1.separation(c2).deg, rtol=0, atol=1e-10)
+
+
+def test_sky_offsets_from_wcs():
+    imgs = create_images(5)
+    pixref = (1024.5, 1024.5)
+    offsets, scales = sky_offsets_from_wcs([img[0].header for img in imgs], pixref)
+
+    c0 = None
+    for img, offset, scale in zip(imgs, offsets, scales):
+        wcs = WCS(img[0].header)
+        ci = SkyCoord(*wcs.wcs_pix2world(*pixref, 1), unit="deg")
+        ci_ = SkyCoord(*wcs.wcs_pix2world(pixref[0], pixref[1] + 1, 1), unit="deg")
+        c0 = ci if c0 is None else c0
+        assert offset == pytest.approx(ci.separation(c0).arcsec, abs=1e-7)
+        assert scale == pytest.approx(ci.separation(ci_).arcsec, abs=1e-9)
+
+
+def test_offsets_from_wcs_imgs():
+    imgs = create_images(4)
+    pixref = numpy.array([[1000.0, 900.0]])
+    wcs0 = WCS(imgs[0][0].header)
+    skyref = wcs0.wcs_pix2world(pixref, 1)
+
+    offsets = offsets_from_wcs_imgs(imgs, pixref)
+    refpix = reference_pix_from_wcs_imgs(imgs, (1000.0, 900.0))
+    assert offsets.shape == (4, 2)
+    assert numpy.all(offsets[0] == 0)
+    assert refpix[0] == (1000.0, 900.0)
+    for img, offset, pix in zip(imgs[1:], offsets[1:], refpix[1:]):
+        expected = WCS(img[0].header).wcs_world2pix(skyref, 1)[0]
+        assert numpy.allclose(offset, pixref[0] - expected)
+        assert numpy.allclose(pix, expected)
+
+
+def test_wcs_cache():
+    imgs = create_images(3)
+    cache = WCSCache(maxsize=2)
+    first = cache.get(imgs[0][0].header)
+    header = imgs[0][0].header.copy()
+    header["OBJECT"] = "other keywords do not change the WCS"
+    assert cache.get(header) is first
+    cache.get(imgs[1][0].header)
+    cache.get(imgs[2][0].header)
+    assert cache.get(imgs[0][0].header) is not first
+    assert (cache.hits, cache.misses) == (1, 4)
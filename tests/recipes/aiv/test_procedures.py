@@ -12,8 +12,11 @@
 
 import numpy
 from numpy.testing import assert_allclose
+from photutils.aperture import CircularAperture, aperture_photometry
 
 from emirdrp.recipes.aiv.procedures import encloses_annulus
+from emirdrp.recipes.aiv.procedures import GrowthCurve
+from emirdrp.recipes.aiv.procedures import growth_curve, growth_curve_cache
 
 
 def test_encloses_annulus():
@@ -33,3 +36,62 @@ def test_encloses_annulus():
     )
 
     assert_allclose(aa[50, [20, 40, 50, 60]], [0.0, 1.0, 0.0, 1.0])
+
+
+def test_growth_curve():
+    rng = numpy.random.default_rng(932)
+    data = rng.normal(100, 10, size=(60, 70))
+    data[58, 1] = numpy.nan
+    rad = [0.3, 1.0, 2.5, 4.0, 7.3]
+    # inside, partially outside, with a nan pixel and outside the image
+    centers = [(30.25, 25.75), (1.6, 40.3), (0.7, 57.9), (-20.0, 10.0)]
+
+    growth = GrowthCurve(rad)
+    flux = growth(data, centers)
+    assert flux.shape == (4, 5)
+    for idx, center in enumerate(centers):
+        for ridx, r in enumerate(rad):
+            expected = aperture_photometry(data, CircularAperture([center], r))
+            assert_allclose(flux[idx, ridx], expected["aperture_sum"][0], rtol=1e-12)
+
+    # same offset within the pixel, the weights are reused
+    flux2 = growth(data, [(40.25, 15.75)])
+    assert len(growth._weights) == 4
+    expected = aperture_photometry(data, CircularAperture([(40.25, 15.75)], 2.5))
+    assert_allclose(flux2[0, 2], expected["aperture_sum"][0], rtol=1e-12)
+
+    # offsets that differ only by floating point noise share the weights
+    growth(data, [(40.25 + 1e-12, 15.75 - 1e-12)])
+    assert len(growth._weights) == 4
+    assert growth._weights.hits == 2
+    growth(data, [(40.2500001, 15.7499999)])
+    assert len(growth._weights) == 5
+
+
+def test_growth_curve_exact():
+    # a source at centers that are not exactly representable
+    yy, xx = numpy.mgrid[0:50, 0:50]
+    rad = [0.7, 1.5, 3.2, 6.1]
+    growth = GrowthCurve(rad)
+    rng = numpy.random.default_rng(934)
+    for xc, yc in rng.uniform(15, 35, size=(5, 2)):
+        data = 1000 * numpy.exp(-0.5 * ((xx - xc) ** 2 + (yy - yc) ** 2) / 2.1**2)
+        flux = growth(data, [(xc, yc)])[0]
+        for ridx, r in enumerate(rad):
+            expected = aperture_photometry(data, CircularAperture([(xc, yc)], r))
+            assert_allclose(flux[ridx], expected["aperture_sum"][0], rtol=1e-12)
+
+
+def test_growth_curve_reused():
+    rng = numpy.random.default_rng(933)
+    data = rng.normal(100, 10, size=(40, 40))
+    rad = [1.0, 2.5, 4.0]
+    growth_curve_cache.clear()
+    flux1 = growth_curve(data, 20.3, 18.6, rad)
+    flux2 = growth_curve(data, 10.3, 22.6, numpy.array(rad))
+    assert len(growth_curve_cache) == 1
+    assert growth_curve_cache.hits == 1
+    growth = growth_curve_cache.lookup(tuple(rad))
+    assert len(growth._weights) == 1
+    assert_allclose(flux1, GrowthCurve(rad)(data, [(20.3, 18.6)])[0])
+    assert_allclose(flux2, GrowthCurve(rad)(data, [(10.3, 22.6)])[0])
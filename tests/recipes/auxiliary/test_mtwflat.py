@@ -0,0 +1,47 @@
+import numpy
+import pytest
+
+from emirdrp.recipes.auxiliary.mtwflat import MultiTwilightFlatRecipe, block_rows
+
+
+@pytest.mark.parametrize("max_workers", [0, 2])
+def test_filter_nsigma_rows(tmp_path, max_workers):
+    rng = numpy.random.default_rng(4512)
+    shape = (30, 20)
+    nimages = 8
+    flat = rng.uniform(0.9, 1.1, size=shape)
+    levels = 1000.0 * numpy.arange(1, nimages + 1)
+    cube = numpy.array(
+        [rng.normal(level * flat, 10.0) for level in levels], dtype="float32"
+    )
+    # outliers
+    cube[2, 5, 7] = 40000
+    cube[6, 20, 3] = 0
+    filename = str(tmp_path / "cube.npy")
+    numpy.save(filename, cube)
+
+    index = numpy.array([0, 2, 3, 4, 5, 6])
+    median_val = numpy.median(cube[index], axis=(1, 2)).astype(float)
+
+    recipe = MultiTwilightFlatRecipe()
+    image_val = cube[index].astype(float).reshape(len(index), -1)
+    expected = recipe.filter_nsigma(median_val, image_val)
+
+    # blocks of 4 rows
+    memory_budget = 16 * 8 * len(index) * shape[1] * 4.5 / 1024**2
+    assert block_rows(shape, len(index), memory_budget) == 4
+    computed = recipe.filter_nsigma_rows(
+        median_val,
+        filename,
+        index,
+        shape,
+        memory_budget=memory_budget,
+        max_workers=max_workers,
+    )
+    assert numpy.array_equal(computed, expected)
+
+
+def test_block_rows():
+    assert block_rows((2048, 2048), 10, 1e6) == 2048
+    assert block_rows((2048, 2048), 10, 1e-6) == 1
+    assert block_rows((2048, 2048), 10, 20) == 8
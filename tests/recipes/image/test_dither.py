@@ -1,6 +1,9 @@
+import astropy.io.fits as fits
 import numpy
 import pytest
 
+from emirdrp.processing.framestore import FrameStore
+from emirdrp.recipes.image.dither import FullDitheredImagesRecipe, ImageInfo
 from emirdrp.recipes.image.join import JoinDitheredImagesRecipe
 from emirdrp.testing.create_base import dither_pattern
 from emirdrp.testing.create_ob import create_ob_1
@@ -47,6 +50,8 @@ def test_join(nimages, naccum):
     assert frame_hdul[0].header["TSUTC1"] == starttime
     assert frame_hdul[0].header["TSUTC2"] == starttime + nimages * exptime
     assert accum_hdul[0].header["NUM-NCOM"] == nimages * nstare * naccum
+    assert accum_hdul["MAP"].data.max() == naccum
+    assert len(accum_hdul) == 7
     assert accum_hdul[0].header["TSUTC1"] == inittime
     assert accum_hdul[0].header["TSUTC2"] == starttime + nimages * exptime
 
@@ -81,3 +86,66 @@ def test_init_aggregate_result(nimages):
     assert frame_hdul[0].header["NUM-NCOM"] == nimages * nstare
 
     assert numpy.allclose(frame_hdul[0].data, accum_hdul[0].data)
+
+
+def test_simple_sky_in_place(tmp_path):
+    # the sky is subtracted from a frame already stored as '_rfs'
+    recipe = FullDitheredImagesRecipe()
+    with FrameStore(directory=tmp_path) as store:
+        recipe.frame_store = store
+        frame = ImageInfo(None)
+        frame.label = "frame"
+        frame.lastname = "frame_rfs.fits"
+        frame.header = fits.Header()
+        frame.valid_region = (slice(2, 8), slice(1, 9))
+        frame.lastdata = store.create("frame_rfs", (10, 10))
+        frame.lastdata[frame.valid_region] = numpy.arange(48).reshape(6, 8)
+        frame.median_sky = 5.0
+
+        recipe.compute_simple_sky_for_frame(frame, frame)
+        valid = frame.lastdata[frame.valid_region]
+        assert numpy.array_equal(valid, numpy.arange(48).reshape(6, 8) - 5.0)
+        frame.lastdata[frame.valid_region] = 0
+        assert numpy.all(frame.lastdata == 0)
+
+
+def test_adhoc_sky_model_layout():
+    # the models are reused for equal layouts, read from different frames
+    recipe = FullDitheredImagesRecipe()
+    recipe.adhoc_sky_models = {}
+    layout = numpy.repeat(numpy.arange(1, 5), 5).reshape(4, 5)
+    model = recipe.adhoc_sky_model(
+        layout.shape, detector_channels="H2RG_FULL", img_channels_layout=layout
+    )
+    same = recipe.adhoc_sky_model(
+        layout.shape, detector_channels="H2RG_FULL", img_channels_layout=layout.copy()
+    )
+    assert same is model
+    other = recipe.adhoc_sky_model(
+        layout.shape, detector_channels="H2RG_FULL", img_channels_layout=layout[::-1]
+    )
+    assert other is not model
+    assert len(recipe.adhoc_sky_models) == 2
+
+
+def test_simple_sky_stale_pixels(tmp_path):
+    # a '_rfs' frame left by a previous pass with other offsets
+    recipe = FullDitheredImagesRecipe()
+    with FrameStore(directory=tmp_path) as store:
+        recipe.frame_store = store
+        store.create("frame_rfs", (10, 10), fill=7.0)
+        frame = ImageInfo(None)
+        frame.label = "frame"
+        frame.lastname = "frame_flat.fits"
+        frame.header = fits.Header()
+        frame.valid_region = (slice(3, 9), slice(2, 10))
+        frame.lastdata = store.create("frame_flat", (10, 10))
+        frame.lastdata[frame.valid_region] = numpy.arange(48).reshape(6, 8)
+        frame.median_sky = 5.0
+
+        recipe.compute_simple_sky_for_frame(frame, frame)
+        assert frame.lastdata is store.create("frame_rfs", (10, 10), fill=None)
+        valid = frame.lastdata[frame.valid_region]
+        assert numpy.array_equal(valid, numpy.arange(48).reshape(6, 8) - 5.0)
+        frame.lastdata[frame.valid_region] = 0
+        assert numpy.all(frame.lastdata == 0)
@@ -0,0 +1,147 @@
+import types
+
+import astropy.io.fits as fits
+import numpy
+import pytest
+
+import numina.core
+from numina.array import combine
+from numina.processing.combine import combine_imgs
+
+import emirdrp.recipes.spec.abba as abba
+from emirdrp.core import EMIR_NBARS
+from emirdrp.recipes.spec.abba import ABBASpectraRectwv
+from emirdrp.testing.create_rectwv import create_rectwv_coeff
+from emirdrp.testing.create_wcs import create_wcs_new
+
+SHAPE = (30, 20)
+
+
+def create_frame(path, idx, char, rng):
+    wcs = create_wcs_new()
+    wcs.wcs.crval = wcs.wcs.crval + [0, (0 if char == "A" else 10) / 3600.0]
+    header = wcs.to_header()
+    header["FILTER"] = "J"
+    header["GRISM"] = "J"
+    header["EXPTIME"] = 10.0
+    header["DATE-OBS"] = "2023-01-01T00:00:00"
+    header["TSUTC1"] = 1e9 + 100 * idx
+    header["TSUTC2"] = 1e9 + 100 * idx + 10
+    data = rng.normal(100, 10, size=SHAPE).astype("float32")
+    fits.PrimaryHDU(data, header=header).writeto(path)
+    return numina.core.DataFrame(filename=str(path))
+
+
+def create_calibration(path, data, uuid):
+    hdu = fits.PrimaryHDU(data)
+    hdu.header["UUID"] = uuid
+    hdu.writeto(path)
+    return numina.core.DataFrame(filename=str(path))
+
+
+@pytest.fixture
+def rectified(monkeypatch):
+    rectified = types.SimpleNamespace(images=[], maps=[])
+
+    def apply_rectwv_coeff(reduced_image, rectwv_coeff, rectwv_maps=None, **kwargs):
+        # a cheap stand-in for the rectification, that keeps the
+        # rectified images in memory, as the recipe did before
+        data = numpy.flipud(reduced_image[0].data).astype("float32")
+        result = fits.HDUList(
+            [fits.PrimaryHDU(data, header=reduced_image[0].header.copy())]
+        )
+        result[0].header["CRPIX1"] = 1.0
+        result[0].header["CRVAL1"] = 11200.0
+        result[0].header["CDELT1"] = 0.77
+        rectified.images.append(fits.HDUList([hdu.copy() for hdu in result]))
+        rectified.maps.append(rectwv_maps)
+        return result
+
+    monkeypatch.setattr(abba, "apply_rectwv_coeff", apply_rectwv_coeff)
+    return rectified
+
+
+def run_recipe(path, pattern, **kwargs):
+    rng = numpy.random.default_rng(42)
+    obsresult = numina.core.ObservationResult()
+    obsresult.frames = [
+        create_frame(path / f"frame{idx}.fits", idx, char, rng)
+        for idx, char in enumerate(pattern)
+    ]
+    recipe = ABBASpectraRectwv()
+    rinput = recipe.create_input(
+        obresult=obsresult,
+        master_bpm=create_calibration(
+            path / "bpm.fits", numpy.zeros(SHAPE, dtype="uint8"), "bpm"
+        ),
+        master_bias=create_calibration(
+            path / "bias.fits", numpy.zeros(SHAPE, dtype="float32"), "bias"
+        ),
+        master_flat=create_calibration(
+            path / "flat.fits", numpy.ones(SHAPE, dtype="float32"), "flat"
+        ),
+        refine_target_along_slitlet={"ab_different_target": 9},
+        **kwargs,
+    )
+    return recipe.run(rinput)
+
+
+@pytest.mark.parametrize(
+    "method, method_kwargs",
+    [("mean", {}), ("median", {}), ("sigmaclip", {"low": 1.0, "high": 1.0})],
+)
+def test_abba_rectwv_in_memory(tmp_path, monkeypatch, rectified, method, method_kwargs):
+    monkeypatch.chdir(tmp_path)
+    pattern = "ABBA" * 2
+    result = run_recipe(
+        tmp_path,
+        pattern,
+        rectwv_coeff=create_rectwv_coeff([1]),
+        method=method,
+        method_kwargs=method_kwargs,
+        combine_memory=0,
+    )
+
+    # the combination of the rectified images kept in memory
+    method_func = getattr(combine, method)
+    combined = {}
+    for char in "AB":
+        combined[char] = combine_imgs(
+            [img for img, c in zip(rectified.images, pattern) if c == char],
+            method=method_func,
+            method_kwargs=dict(method_kwargs),
+            errors=False,
+        )
+    expected = combined["A"][0].data - combined["B"][0].data
+
+    hdu = result.reduced_mos_abba.frame[0]
+    assert hdu.data.dtype == expected.dtype
+    numpy.testing.assert_array_equal(hdu.data, expected)
+    history = list(hdu.header["HISTORY"])
+    assert history.count(f"Combined 4 images using '{method}'") == 2
+    assert not any(path.name.startswith("abba_") for path in tmp_path.iterdir())
+
+
+def test_abba_rectwv_maps(tmp_path, monkeypatch, rectified):
+    monkeypatch.chdir(tmp_path)
+    shared1 = create_rectwv_coeff([1])
+    shared2 = create_rectwv_coeff([1])
+    single1 = create_rectwv_coeff([1])
+    single2 = create_rectwv_coeff([1])
+    list_rectwv_coeff = [shared1, shared2, single1, shared1]
+    list_rectwv_coeff += [shared2, single2, shared2, shared1]
+    run_recipe(tmp_path, "ABBA" * 2, list_rectwv_coeff=list_rectwv_coeff)
+
+    # the maps are kept only for the coefficients shared by several images
+    maps = rectified.maps[0]
+    assert maps.maxsize == 2 * EMIR_NBARS
+    assert [item is maps for item in rectified.maps] == [
+        calib not in (single1, single2) for calib in list_rectwv_coeff
+    ]
+    assert rectified.maps[2] is None
+
+    rectified.maps.clear()
+    list_rectwv_coeff = [create_rectwv_coeff([1]) for _ in range(4)]
+    (tmp_path / "single").mkdir()
+    run_recipe(tmp_path / "single", "ABBA", list_rectwv_coeff=list_rectwv_coeff)
+    assert rectified.maps == [None] * 4
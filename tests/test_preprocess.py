@@ -0,0 +1,124 @@
+import os
+
+from astropy.io import fits
+import numpy
+import pytest
+
+from emirdrp.preprocess import (
+    ReadoutParameters,
+    preprocess,
+    preprocess_fowler,
+    preprocess_ramp,
+    preprocess_stream,
+)
+
+
+def create_readout(mode, nreads=6, shape=(40, 30)):
+    rng = numpy.random.default_rng(2)
+    signal = rng.uniform(0, 3000, size=shape)
+    reads = numpy.arange(nreads)[:, numpy.newaxis, numpy.newaxis] / nreads
+    cube = 1000 + signal * reads + rng.normal(0, 5, size=(nreads,) + shape)
+    cube[:, 3, 4] = 60000
+    header = fits.Header()
+    header["READMODE"] = mode.upper()
+    header["EXPTIME"] = 10.0
+    return fits.HDUList(
+        [
+            fits.PrimaryHDU(numpy.round(cube).astype("uint16"), header=header),
+            fits.ImageHDU(numpy.ones((3, 3)), name="EXTRA"),
+        ]
+    )
+
+
+@pytest.mark.parametrize("mode", ["fowler", "ramp"])
+def test_preprocess_stream(tmp_path, mode):
+    filename = str(tmp_path / "raw.fits")
+    create_readout(mode).writeto(filename)
+    with fits.open(filename) as hdulist:
+        params = ReadoutParameters.from_header(hdulist[0].header)
+        expected = params.process(mode, hdulist[0].data)
+        assert params.ti == 10.0
+
+    output = str(tmp_path / "proc.fits")
+    for kwargs in [{}, {"max_memory": 20000}]:
+        preprocess(filename, output, **kwargs)
+        with fits.open(output) as hdulist:
+            hdulist.verify("exception")
+            assert hdulist[0].header["READPROC"]
+            assert [hdu.name for hdu in hdulist] == [
+                "PRIMARY",
+                "VARIANCE",
+                "MAP",
+                "MASK",
+                "EXTRA",
+            ]
+            for hdu, arr in zip(hdulist, expected):
+                assert numpy.array_equal(hdu.data, arr)
+            assert hdulist["MASK"].data[3, 4] != 0
+
+
+def check_output(output, expected):
+    with fits.open(output) as hdulist:
+        hdulist.verify("exception")
+        assert [hdu.name for hdu in hdulist] == [
+            "PRIMARY",
+            "VARIANCE",
+            "MAP",
+            "MASK",
+            "EXTRA",
+        ]
+        for hdu, arr in zip(hdulist, expected):
+            assert numpy.array_equal(hdu.data, arr)
+
+
+def test_preprocess_in_place(tmp_path):
+    filename = str(tmp_path / "raw.fits")
+    create_readout("ramp").writeto(filename)
+    with fits.open(filename) as hdulist:
+        expected = ReadoutParameters(ti=10.0).process("ramp", hdulist[0].data)
+
+    preprocess(filename, filename, max_memory=20000)
+    check_output(filename, expected)
+    assert os.listdir(tmp_path) == ["raw.fits"]
+    # a preprocessed file is not processed again
+    preprocess(filename, filename)
+    check_output(filename, expected)
+
+
+def test_preprocess_processes(tmp_path):
+    filename = str(tmp_path / "raw.fits")
+    create_readout("fowler", nreads=8).writeto(filename)
+    with fits.open(filename) as hdulist:
+        expected = ReadoutParameters(ti=10.0).process("fowler", hdulist[0].data)
+
+    output = str(tmp_path / "proc.fits")
+    preprocess(filename, output, max_memory=20000, processes=2)
+    check_output(output, expected)
+
+
+def test_preprocess_no_overwrite(tmp_path):
+    filename = str(tmp_path / "raw.fits")
+    create_readout("ramp").writeto(filename)
+    output = tmp_path / "proc.fits"
+    output.write_bytes(b"")
+    with pytest.raises(FileExistsError):
+        preprocess_stream(filename, str(output), "ramp", overwrite=False)
+    assert sorted(os.listdir(tmp_path)) == ["proc.fits", "raw.fits"]
+
+
+@pytest.mark.parametrize(
+    "mode, function", [("fowler", preprocess_fowler), ("ramp", preprocess_ramp)]
+)
+def test_preprocess_hdulist(mode, function):
+    hdulist = create_readout(mode)
+    expected = ReadoutParameters(ti=10.0).process(mode, hdulist[0].data)
+    result = function(hdulist, max_memory=20000)
+    assert result[0].data.shape == (40, 30)
+    for name, arr in zip(["PRIMARY", "VARIANCE", "MAP", "MASK"], expected):
+        assert numpy.array_equal(result[name].data, arr)
+
+
+def test_preprocess_not_a_cube():
+    hdulist = fits.HDUList([fits.PrimaryHDU(numpy.zeros((10, 10)))])
+    with pytest.raises(ValueError):
+        preprocess_fowler(hdulist)
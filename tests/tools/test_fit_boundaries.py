@@ -0,0 +1,113 @@
+import numpy
+import pytest
+from lmfit import Parameters
+
+from emirdrp.tools.fit_boundaries import BoundaryResiduals
+from emirdrp.tools.fit_boundaries import expected_distorted_boundaries
+from emirdrp.tools.fit_boundaries import exvp, exvp_scalar
+
+BASE_PARAMS = dict(
+    c2=1.77,
+    c4=0.05,
+    ff=1.0,
+    slit_gap=3.0,
+    slit_height=3.3,
+    theta0_origin=-0.5,
+    theta0_slope=0.1,
+    x0=1.0245,
+    y0=1.0245,
+    y_baseline=0.05,
+)
+
+
+def create_params(delta=0.0):
+    params = Parameters()
+    for key, value in BASE_PARAMS.items():
+        params.add(key + "_a0s", value=value * (1 + delta))
+        params.add(key + "_a1s", value=0.001)
+        params.add(key + "_a2s", value=0.0001)
+    return params
+
+
+def create_bounddict(params, nslitlets=5, ndates=2):
+    rng = numpy.random.default_rng(12345)
+    contents = {}
+    for islitlet in range(1, nslitlets + 1):
+        tmp_slitlet = {}
+        for idate in range(ndates):
+            center = rng.uniform(-100, 100)
+            lower, upper = expected_distorted_boundaries(
+                islitlet, center, [0, 1], params, "multislit", numpts=50, deg=5
+            )
+            tmp_slitlet[f"2017-01-0{idate + 1}T00:00:00"] = dict(
+                csu_bar_slit_center=center,
+                boundary_coef_lower=list(lower.poly_funct.coef),
+                boundary_coef_upper=list(upper.poly_funct.coef),
+                boundary_xmin_lower=30.0,
+                boundary_xmax_lower=2000.0,
+                boundary_xmin_upper=35.0,
+                boundary_xmax_upper=2010.0,
+            )
+        contents[f"slitlet{islitlet:02d}"] = tmp_slitlet
+    return {"contents": contents}
+
+
+def test_exvp_array():
+    x = numpy.linspace(-500, 2500, 101)
+    y = numpy.linspace(2500, -500, 101)
+    pars = dict(x0=1.0245, y0=1.0245, c2=1.77, c4=0.05, theta0=0.01, ff=1.0)
+    expected = numpy.array([exvp_scalar(x_, y_, **pars) for x_, y_ in zip(x, y)])
+    xdist, ydist = exvp(x, y, **pars)
+    assert numpy.allclose(xdist, expected[:, 0])
+    assert numpy.allclose(ydist, expected[:, 1])
+
+
+def test_exvp_raises():
+    with pytest.raises(ValueError):
+        exvp(1.0, [1.0, 2.0], 1.0, 1.0, 1.0, 0.0, 0.0, 1.0)
+
+
+def test_boundary_residuals():
+    bounddict = create_bounddict(create_params(delta=0.002))
+    params = create_params()
+    numresolution = 100
+    shrinking_factor = 0.9
+
+    residuals = BoundaryResiduals(
+        "multislit", bounddict, shrinking_factor, numresolution, 1, 55
+    )
+    assert len(residuals) == 5 * 2 * 2
+
+    # reference computation, slitlet by slitlet
+    sum_squares = 0.0
+    nsummed = 0
+    for tmp_slitlet, slitlet_dict in bounddict["contents"].items():
+        islitlet = int(tmp_slitlet[7:])
+        for tmp_dict in slitlet_dict.values():
+            expected = expected_distorted_boundaries(
+                islitlet,
+                tmp_dict["csu_bar_slit_center"],
+                [0, 1],
+                params,
+                "multislit",
+                numpts=numresolution,
+                deg=5,
+            )
+            xmin = tmp_dict["boundary_xmin_lower"]
+            xmax = tmp_dict["boundary_xmax_lower"]
+            dx = (xmax - xmin) * (1 - shrinking_factor) / 2
+            for spectrail, label in zip(expected, ["lower", "upper"]):
+                measured = numpy.polynomial.Polynomial(
+                    tmp_dict["boundary_coef_" + label]
+                )
+                xdum = numpy.linspace(
+                    tmp_dict["boundary_xmin_" + label] + dx,
+                    tmp_dict["boundary_xmax_" + label] - dx,
+                    num=numresolution,
+                )
+                poly_diff = spectrail.poly_funct - measured
+                sum_squares += numpy.sum(poly_diff(xdum) ** 2)
+                nsummed += numresolution
+
+    assert numpy.isclose(residuals(params), numpy.sqrt(sum_squares / nsummed))
+    assert residuals(create_params(delta=0.002)) < 1e-3